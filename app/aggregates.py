@@ -0,0 +1,84 @@
+"""
+Инкрементальное обновление агрегатов по отзывам.
+
+Функции вызываются в той же транзакции, что и запись или удаление
+отзыва, поэтому агрегаты фиксируются и откатываются вместе с ним.
+"""
+
+import math
+
+import app.leaderboards as leaderboards
+import app.statements as statements
+
+# Перцентили, которые возвращаются вместе с медианой
+PERCENTILES = (25, 75, 90)
+
+
+def record_reviews(cursor, movie_ids, ratings, user_keys):
+    """
+    Учитывает новые отзывы: movie_ids, ratings и user_keys - параллельные списки
+    """
+    movie_ids, ratings = list(movie_ids), list(ratings)
+    statements.execute(cursor, "movie_stats_add", (movie_ids, ratings))
+    statements.execute(cursor, "user_stats_add", (list(user_keys), ratings))
+    statements.execute(cursor, "movie_rollups_add", (movie_ids, ratings))
+    statements.execute(cursor, "genre_rollups_add", (movie_ids, ratings))
+
+
+def record_review(cursor, movie_id, rating, user_key):
+    """
+    Учитывает один новый отзыв
+    """
+    record_reviews(cursor, [movie_id], [rating], [user_key])
+
+
+def forget_review(cursor, movie_id, rating, user_key, created_at):
+    """
+    Убирает удаленный отзыв из агрегатов
+    """
+    statements.execute(cursor, "movie_stats_remove", (movie_id, rating))
+    statements.execute(cursor, "user_stats_remove", (user_key, rating))
+    statements.execute(cursor, "movie_rollups_remove", (movie_id, rating, created_at))
+    statements.execute(cursor, "genre_rollups_remove", (movie_id, rating, created_at))
+
+
+def _percentile(rating_counts, review_count, percent):
+    # Метод ближайшего ранга по кумулятивным счетчикам
+    rank = max(1, math.ceil(percent / 100 * review_count))
+    cumulative = 0
+    for rating, count in enumerate(rating_counts, 1):
+        cumulative += count
+        if cumulative >= rank:
+            return rating
+    return len(rating_counts)
+
+
+def rating_summary(rating_counts, prior_mean=None, prior_weight=leaderboards.PRIOR_WEIGHT):
+    """
+    Среднее, медиана, перцентили и байесовский рейтинг по счетчикам
+    оценок 1-10 (rating_counts[0] - количество оценок 1)
+    """
+    rating_counts = list(rating_counts)
+    review_count = sum(rating_counts)
+    rating_sum = sum(rating * count for rating, count in enumerate(rating_counts, 1))
+    
+    summary = {
+        'rating_counts': rating_counts,
+        'review_count': review_count,
+        'avg_rating': 0.0,
+        'median_rating': None,
+        'percentiles': {},
+        'bayesian_rating': None
+    }
+    if review_count:
+        summary['avg_rating'] = round(rating_sum / review_count, 2)
+        summary['median_rating'] = _percentile(rating_counts, review_count, 50)
+        summary['percentiles'] = {
+            f"p{percent}": _percentile(rating_counts, review_count, percent)
+            for percent in PERCENTILES
+        }
+    if prior_mean is not None:
+        summary['bayesian_rating'] = round(
+            (rating_sum + prior_weight * prior_mean) / (review_count + prior_weight), 2
+        )
+    return summary
@@ -0,0 +1,89 @@
+"""
+Гистограммы оценок по дням и неделям.
+
+Текущие периоды обновляются при записи отзывов (app/aggregates.py).
+Для исторических отзывов гистограммы пересчитываются командой:
+
+    python -m app.analytics backfill [--chunk-size 50000]
+
+Пересчет идет одной транзакцией: до ее фиксации эндпоинты видят
+прежние гистограммы, а не пустые или частичные. Запись отзывов на это
+время блокируется, как и при rebuild_aggregates (app/jobs.py).
+"""
+
+import argparse
+import logging
+
+import app.database as database
+import app.log as log
+import app.statements as statements
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 50000
+
+
+def to_points(rows):
+    """
+    Строки (bucket_start, rating_counts) в точки ряда со средним рейтингом
+    """
+    points = []
+    for bucket_start, rating_counts in rows:
+        review_count = sum(rating_counts)
+        rating_sum = sum(rating * count for rating, count in enumerate(rating_counts, 1))
+        points.append({
+            'bucket_start': bucket_start,
+            'rating_counts': rating_counts,
+            'review_count': review_count,
+            'avg_rating': round(rating_sum / review_count, 2) if review_count else None
+        })
+    return points
+
+
+def backfill(chunk_size=CHUNK_SIZE):
+    """
+    Пересчитывает все гистограммы по таблице reviews.
+
+    Старые строки удаляются (DELETE, а не TRUNCATE, чтобы чтения не
+    ждали блокировки) и пересчитываются пачками по ID в одной
+    транзакции. SHARE-блокировка reviews не дает записям отзывов
+    изменить гистограммы до фиксации пересчета.
+    """
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("LOCK TABLE reviews IN SHARE MODE")
+            cursor.execute("DELETE FROM movie_rating_rollups")
+            cursor.execute("DELETE FROM genre_rating_rollups")
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM reviews")
+            max_id = cursor.fetchone()[0]
+            
+            last_id = 0
+            while last_id < max_id:
+                upper_id = min(last_id + chunk_size, max_id)
+                statements.execute(cursor, "movie_rollups_backfill", (last_id, upper_id))
+                statements.execute(cursor, "genre_rollups_backfill", (last_id, upper_id))
+                logger.info("Гистограммы пересчитаны", extra={'upper_id': upper_id, 'max_id': max_id})
+                last_id = upper_id
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Гистограммы оценок")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="пересчитать гистограммы по всем отзывам")
+    backfill_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    log.setup("analytics")
+    
+    if args.command == "backfill":
+        backfill(args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
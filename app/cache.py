@@ -0,0 +1,275 @@
+"""
+Кеши процесса с временем жизни и схлопыванием одновременных промахов.
+
+Если несколько потоков одновременно не находят ключ в кеше, загрузку
+выполняет только первый (single-flight), остальные ждут его результат.
+Поэтому после деплоя или истечения TTL в базу уходит один запрос
+на ключ, а не по запросу на каждого клиента.
+
+AsyncSingleFlight делает то же для корутин: одинаковые одновременные
+чтения из обработчиков запросов выполняются в потоке один раз, а
+ожидающие запросы не занимают потоки пула.
+
+Прогрев кешей при старте процесса настраивается переменными WARMUP_*
+(app/main.py и бот).
+
+Запросы, которые читают с primary (read-your-writes, app/database.py),
+обходят кеши и схлопывание: общий результат мог быть прочитан с
+отстающей реплики до записи клиента.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from app import deadlines
+
+# Время жизни страниц и статистики в кеше, сек
+PAGE_TTL = int(os.getenv('CACHE_PAGE_TTL', '30'))
+# Прогрев кешей при старте
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', '1') == '1'
+# Сколько самых обсуждаемых фильмов загрузить при прогреве
+WARMUP_MOVIES = int(os.getenv('WARMUP_MOVIES', '20'))
+# Дольше прогрева процесс не ждет и начинает принимать запросы
+WARMUP_TIMEOUT = int(os.getenv('WARMUP_TIMEOUT', '30'))
+
+_MISSING = object()
+
+# Чтения текущего запроса идут на primary; задается через
+# app.database.prefer_primary()
+primary_reads = ContextVar("prefer_primary", default=False)
+
+# Все кеши и группы схлопывания процесса по имени (для метрик)
+CACHES = {}
+FLIGHTS = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Выполняет одну загрузку на ключ: одновременные вызовы с тем же
+    ключом ждут и получают ее результат (или ее исключение)
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.collapsed = 0
+
+    def do(self, key, loader):
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = loader()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    Схлопывание одинаковых одновременных вызовов в корутинах: функция
+    выполняется в потоке один раз на ключ, все ожидающие получают ее
+    результат. Загрузка идет отдельной задачей, поэтому отмена одного
+    из запросов не отменяет ее для остальных, а отключение клиента,
+    начавшего загрузку, не отменяет ее запросы к БД.
+
+    Результат общий для всех ожидающих - его нельзя изменять.
+    """
+
+    def __init__(self, name=None):
+        self._tasks = {}
+        self.calls = 0
+        self.collapsed = 0
+        if name:
+            FLIGHTS[name] = self
+
+    async def do(self, key, func, *args):
+        if primary_reads.get():
+            return await asyncio.to_thread(func, *args)
+        self.calls += 1
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(deadlines.shared(func), *args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'executed': self.calls - self.collapsed,
+            'collapsed': self.collapsed,
+            'in_flight': len(self._tasks)
+        }
+
+
+class TTLCache:
+    """
+    Кеш с временем жизни записей и вытеснением давно не использованных
+    записей сверх max_entries
+    """
+
+    def __init__(self, name, ttl, max_entries=1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        # Загрузка, начатая до invalidate(), не должна сохранить старые данные
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        CACHES[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=_MISSING):
+        """
+        Удаляет запись или, без ключа, весь кеш
+        """
+        with self._lock:
+            self._generation += 1
+            if key is _MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """
+        Удаляет записи, для которых predicate(key, value) истинно;
+        возвращает их количество
+        """
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            if keys:
+                self._generation += 1
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def update_where(self, update):
+        """
+        Заменяет значения записей на update(key, value), не меняя их срок
+        жизни; None удаляет запись. Возвращает количество удаленных
+        """
+        with self._lock:
+            changed = removed = 0
+            for key, (expires, value) in list(self._entries.items()):
+                new_value = update(key, value)
+                if new_value is None:
+                    del self._entries[key]
+                    removed += 1
+                elif new_value is not value:
+                    self._entries[key] = (expires, new_value)
+                    changed += 1
+            if changed or removed:
+                self._generation += 1
+        return removed
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Значение из кеша; при промахе вызывает loader() - один раз на ключ,
+        сколько бы потоков ни ждали это значение
+        """
+        if primary_reads.get():
+            return loader()
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        return self._load(key, loader, ttl)
+
+    def _load(self, key, loader, ttl):
+        def load():
+            generation = self._generation
+            value = loader()
+            self.loads += 1
+            self.set(key, value, ttl, generation)
+            return value
+
+        return self._flight.do(key, load)
+
+    async def aget_or_load(self, key, loader, ttl=None):
+        """
+        get_or_load для обработчиков запросов: при промахе загрузка идет
+        в потоке, одновременные промахи ждут ее, не занимая потоки
+        """
+        if primary_reads.get():
+            return await asyncio.to_thread(loader)
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        return await self._async_flight.do(key, self._load, key, loader, ttl)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'loads': self.loads,
+            'collapsed': self._flight.collapsed + self._async_flight.collapsed
+        }
+
+
+def stats():
+    """
+    Счетчики всех кешей процесса
+    """
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+def flight_stats():
+    """
+    Счетчики схлопывания одинаковых чтений без кеширования
+    """
+    return {name: flight.stats() for name, flight in FLIGHTS.items()}
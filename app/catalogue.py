@@ -0,0 +1,421 @@
+"""
+Колоночный снимок каталога фильмов в памяти процесса.
+
+Каталог небольшой и почти не меняется, поэтому списки фильмов с фильтром
+по жанру и сортировкой по названию или рейтингу строятся без обращения
+к PostgreSQL: каждый столбец хранится массивом NumPy (id, год, код жанра,
+длительность, сумма и количество оценок), а фильтр, сортировка и
+пагинация - векторные операции над ними. Строки (названия, режиссеры)
+хранятся списками, повторяющиеся значения интернированы, жанры
+закодированы номерами.
+
+Тот же снимок служит структурой фасетов для /movies/browse: количество
+фильмов по жанрам и десятилетиям считается np.bincount по маскам
+фильтров, без запросов к базе.
+
+Строки загружаются в порядке ORDER BY title, поэтому порядок по названию
+совпадает с сортировкой (collation) базы и не требует сортировки.
+
+Снимок обновляется по событиям шины (app/events.py): изменения рейтингов
+(movie_stats) применяются на месте, а добавление, изменение и удаление
+фильмов помечают снимок для перезагрузки. Снимок также перезагружается
+раз в CATALOGUE_REFRESH_INTERVAL секунд на случай пропущенных событий.
+
+Сравнение со списками из SQL: python -m app.catalogue bench
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+import numpy as np
+
+from app import statements
+from app.cache import primary_reads
+
+# Полная перезагрузка снимка, сек
+REFRESH_INTERVAL = int(os.getenv('CATALOGUE_REFRESH_INTERVAL', '300'))
+# Задержка перезагрузки после изменения каталога: несколько изменений подряд
+# приводят к одной перезагрузке, сек
+RELOAD_DELAY = float(os.getenv('CATALOGUE_RELOAD_DELAY', '1'))
+
+CATALOGUE_ENABLED = os.getenv('CATALOGUE_ENABLED', '1') == '1'
+
+MISSING = -1
+
+
+class CatalogueSnapshot:
+    """Столбцы каталога; позиция строки - место фильма в порядке по названию"""
+
+    def __init__(self, rows, loaded_at=None):
+        count = len(rows)
+        self.genres = []
+        genre_codes = {}
+
+        def genre_code(genre):
+            if genre is None:
+                return MISSING
+            if genre not in genre_codes:
+                genre_codes[genre] = len(self.genres)
+                self.genres.append(sys.intern(genre))
+            return genre_codes[genre]
+
+        self.ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+        self.titles = [row[1] for row in rows]
+        self.directors = [sys.intern(row[2]) if row[2] else row[2] for row in rows]
+        self.years = np.fromiter((row[3] or MISSING for row in rows), dtype=np.int32, count=count)
+        self.genre_codes = np.fromiter((genre_code(row[4]) for row in rows), dtype=np.int16, count=count)
+        self.descriptions = [row[5] for row in rows]
+        self.durations = np.fromiter((row[6] or MISSING for row in rows), dtype=np.int32, count=count)
+        self.created_at = [row[7] for row in rows]
+        self.review_counts = np.fromiter((row[8] for row in rows), dtype=np.int64, count=count)
+        self.rating_sums = np.fromiter((row[9] for row in rows), dtype=np.int64, count=count)
+        self.genre_codes_by_name = genre_codes
+        self.positions = {int(movie_id): position for position, movie_id in enumerate(self.ids)}
+        self.loaded_at = loaded_at or time.time()
+        # Порядок по рейтингу, пока рейтинги не изменились (rating_order)
+        self._rating_order = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update_stats(self, movie_id, review_count, rating_sum):
+        """
+        Обновляет рейтинг фильма на месте; False, если фильма нет в снимке
+        """
+        position = self.positions.get(movie_id)
+        if position is None:
+            return False
+        self.review_counts[position] = review_count
+        self.rating_sums[position] = rating_sum
+        self._rating_order = None
+        return True
+
+    def avg_ratings(self, positions):
+        counts = self.review_counts[positions]
+        ratings = np.zeros(len(counts), dtype=np.float64)
+        np.divide(self.rating_sums[positions], counts, out=ratings, where=counts > 0)
+        return ratings
+
+    def rating_order(self):
+        """
+        Позиции всех фильмов по убыванию рейтинга (при равном - по
+        названию и id, как в запросе movies_by_rating). Считается один раз до следующего изменения рейтингов,
+        поэтому страница по рейтингу не сортирует весь каталог заново
+        """
+        order = self._rating_order
+        if order is None:
+            order = self._rating_order = np.argsort(-self.avg_ratings(slice(None)), kind="stable")
+        return order
+
+    def query(self, genre=None, order="title", skip=0, limit=None):
+        """
+        Позиции строк с фильтром по жанру, сортировкой по названию или
+        рейтингу (по убыванию) и пагинацией
+        """
+        if order not in ("title", "rating"):
+            raise ValueError(f"Неизвестная сортировка: {order}")
+        end = len(self.ids) if limit is None else min(skip + limit, len(self.ids))
+
+        if genre is None:
+            if order == "title":
+                # Строки снимка уже упорядочены по названию
+                return np.arange(min(skip, end), end)
+            return self.rating_order()[skip:end]
+
+        code = self.genre_codes_by_name.get(genre)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        if order == "rating":
+            # Фильтр по упорядоченным позициям сохраняет порядок рейтинга
+            ranked = self.rating_order()
+            positions = ranked[self.genre_codes[ranked] == code]
+        else:
+            positions = np.flatnonzero(self.genre_codes == code)
+        return positions[skip:end]
+
+    def _range_mask(self, column, low, high):
+        mask = column != MISSING
+        if low is not None:
+            mask &= column >= low
+        if high is not None:
+            mask &= column <= high
+        return mask
+
+    def browse(self, genres=None, year_from=None, year_to=None, duration_min=None, duration_max=None,
+               min_rating=None, min_reviews=None, sort="title", skip=0, limit=20):
+        """
+        Страница фильмов по набору фильтров и фасеты: количество по жанрам
+        считается без фильтра по жанру, по десятилетиям - без фильтра
+        по году, чтобы клиент видел, сколько фильмов даст другой выбор.
+
+        Возвращает (позиции страницы, всего найдено, {жанр: n}, {десятилетие: n})
+        """
+        count = len(self.ids)
+        base = np.ones(count, dtype=bool)
+        if duration_min is not None or duration_max is not None:
+            base &= self._range_mask(self.durations, duration_min, duration_max)
+        ratings = None
+        if min_rating is not None or sort == "rating":
+            ratings = self.avg_ratings(slice(None))
+        if min_rating is not None:
+            base &= (self.review_counts > 0) & (ratings >= min_rating)
+        if min_reviews is not None:
+            base &= self.review_counts >= min_reviews
+
+        genre_mask = True
+        if genres:
+            codes = [self.genre_codes_by_name[genre] for genre in genres if genre in self.genre_codes_by_name]
+            genre_mask = np.isin(self.genre_codes, codes)
+        year_mask = True
+        if year_from is not None or year_to is not None:
+            year_mask = self._range_mask(self.years, year_from, year_to)
+
+        genre_codes = self.genre_codes[base & year_mask]
+        genre_counts = np.bincount(genre_codes[genre_codes != MISSING], minlength=len(self.genres))
+        years = self.years[base & genre_mask]
+        decades, decade_counts = np.unique(years[years != MISSING] // 10 * 10, return_counts=True)
+
+        positions = np.flatnonzero(base & genre_mask & year_mask)
+        if sort == "rating":
+            positions = positions[np.argsort(-ratings[positions], kind="stable")]
+        elif sort == "year":
+            positions = positions[np.argsort(-self.years[positions], kind="stable")]
+        elif sort == "reviews":
+            positions = positions[np.argsort(-self.review_counts[positions], kind="stable")]
+        elif sort != "title":
+            raise ValueError(f"Неизвестная сортировка: {sort}")
+
+        return (
+            positions[skip:skip + limit],
+            len(positions),
+            {genre: count for genre, count in zip(self.genres, genre_counts.tolist()) if count},
+            dict(zip(decades.tolist(), decade_counts.tolist()))
+        )
+
+    def _columns(self, positions):
+        # Столбцы выбираются срезом массивов и переводятся в Python разом,
+        # а не поэлементно
+        genres = [None if code == MISSING else self.genres[code] for code in self.genre_codes[positions].tolist()]
+        years = [None if year == MISSING else year for year in self.years[positions].tolist()]
+        return (
+            self.ids[positions].tolist(), years, genres,
+            self.avg_ratings(positions).tolist(), self.review_counts[positions].tolist()
+        )
+
+    def movies(self, positions):
+        """
+        Строки в формате SELECT m.*, avg_rating, review_count
+        """
+        ids, years, genres, ratings, counts = self._columns(positions)
+        durations = self.durations[positions].tolist()
+        return [
+            {
+                'id': ids[i],
+                'title': self.titles[position],
+                'director': self.directors[position],
+                'release_year': years[i],
+                'genre': genres[i],
+                'description': self.descriptions[position],
+                'duration_minutes': None if durations[i] == MISSING else durations[i],
+                'created_at': self.created_at[position],
+                'avg_rating': ratings[i],
+                'review_count': counts[i]
+            }
+            for i, position in enumerate(positions.tolist())
+        ]
+
+    def summaries(self, positions):
+        """
+        Строки главной страницы: рейтинг округлен до десятых
+        """
+        ids, years, genres, ratings, counts = self._columns(positions)
+        return [
+            {
+                'id': ids[i],
+                'title': self.titles[position],
+                'director': self.directors[position],
+                'release_year': years[i],
+                'genre': genres[i],
+                'avg_rating': round(ratings[i], 1),
+                'review_count': counts[i]
+            }
+            for i, position in enumerate(positions.tolist())
+        ]
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (
+            self.ids, self.years, self.genre_codes, self.durations, self.review_counts, self.rating_sums
+        ))
+
+
+_snapshot = None
+_lock = threading.Lock()
+# Снимок помечен для перезагрузки
+_dirty = False
+_reloading = False
+# Изменения рейтингов, пришедшие во время перезагрузки
+_pending = []
+counters = {'reloads': 0, 'stats_updates': 0, 'reload_seconds': 0.0}
+
+
+def get_snapshot():
+    """
+    Текущий снимок процесса или None, если он еще не загружен или
+    запрос читает с primary (снимок может отставать от его записей)
+    """
+    if not CATALOGUE_ENABLED or primary_reads.get():
+        return None
+    return _snapshot
+
+
+def load(cursor):
+    statements.execute(cursor, "catalogue_snapshot")
+    return CatalogueSnapshot(cursor.fetchall())
+
+
+def reload(connection_factory):
+    """
+    Загружает снимок заново; connection_factory возвращает подключение
+    к БД, которое закрывается после загрузки
+    """
+    global _snapshot, _dirty, _reloading
+    started = time.perf_counter()
+    with _lock:
+        _dirty = False
+        _reloading = True
+    try:
+        connection = connection_factory()
+        try:
+            with connection.cursor() as cursor:
+                snapshot = load(cursor)
+        finally:
+            connection.close()
+    except Exception:
+        with _lock:
+            _dirty = True
+            _reloading = False
+            _pending.clear()
+        raise
+
+    with _lock:
+        # События идут в порядке фиксации, поэтому повторное применение
+        # оставляет последнее значение
+        for movie_id, review_count, rating_sum in _pending:
+            snapshot.update_stats(movie_id, review_count, rating_sum)
+        _pending.clear()
+        _reloading = False
+        _snapshot = snapshot
+    counters['reloads'] += 1
+    counters['reload_seconds'] = round(time.perf_counter() - started, 4)
+    return snapshot
+
+
+def needs_reload():
+    snapshot = _snapshot
+    return snapshot is None or _dirty or time.time() - snapshot.loaded_at > REFRESH_INTERVAL
+
+
+def on_event(event):
+    """
+    Обработчик шины событий: рейтинги обновляются на месте, изменения
+    фильмов помечают снимок для перезагрузки
+    """
+    global _dirty
+    if event.type == 'movie_stats':
+        message = json.loads(event.data)
+        rating_counts = message.get('rating_counts')
+        if rating_counts is None:
+            _dirty = True
+            return
+        update = (
+            event.movie_id,
+            message.get('review_count') or 0,
+            sum(rating * count for rating, count in enumerate(rating_counts, start=1))
+        )
+        with _lock:
+            if _reloading:
+                _pending.append(update)
+            snapshot = _snapshot
+        if snapshot is not None and not snapshot.update_stats(*update):
+            _dirty = True
+        counters['stats_updates'] += 1
+    elif event.type in ('movie_created', 'movie_updated', 'movie_deleted'):
+        _dirty = True
+
+
+def stats():
+    snapshot = _snapshot
+    return {
+        'enabled': CATALOGUE_ENABLED,
+        'movies': len(snapshot) if snapshot is not None else None,
+        'bytes': snapshot.nbytes() if snapshot is not None else 0,
+        'age_seconds': round(time.time() - snapshot.loaded_at, 1) if snapshot is not None else None,
+        'dirty': _dirty,
+        **counters
+    }
+
+
+def _timings(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def bench(repeat):
+    """
+    Сравнение списков фильмов из снимка и из SQL (тех же запросов,
+    что у /api/v1/movies и главной страницы)
+    """
+    from app.database import get_read_connection
+
+    connection = get_read_connection()
+    try:
+        with connection.cursor() as cursor:
+            snapshot = load(cursor)
+            genre = snapshot.genres[0] if snapshot.genres else None
+
+            def fetch(name, params=()):
+                return lambda: (statements.execute(cursor, name, params), cursor.fetchall())
+
+            cases = [
+                ("по названию, 100", fetch("movies_page", (100, 0)),
+                 lambda: snapshot.movies(snapshot.query(limit=100))),
+                (f"жанр {genre}, 100", fetch("movies_page_by_genre", (genre, 100, 0)),
+                 lambda: snapshot.movies(snapshot.query(genre, limit=100))),
+                ("по рейтингу, все", fetch("movies_summary_by_rating"),
+                 lambda: snapshot.summaries(snapshot.query(order="rating")))
+            ]
+            print(f"Фильмов: {len(snapshot)}, столбцы: {snapshot.nbytes() / 1024:.1f} КБ")
+            for name, sql, columnar in cases:
+                sql_median, sql_max = _timings(sql, repeat)
+                snapshot_median, snapshot_max = _timings(columnar, repeat)
+                print(
+                    f"{name}: SQL {sql_median:.2f} мс (макс {sql_max:.2f}), "
+                    f"снимок {snapshot_median:.2f} мс (макс {snapshot_max:.2f}), "
+                    f"x{sql_median / max(snapshot_median, 1e-6):.1f}"
+                )
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Снимок каталога фильмов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="сравнить со списками из SQL")
+    bench_parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench(args.repeat)
+
+
+if __name__ == "__main__":
+    main()
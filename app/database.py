@@ -1,9 +1,163 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import logging
 import os
+import time
+import threading
 from dotenv import load_dotenv
 
+from app import deadlines, tracing
+from app.cache import AsyncSingleFlight, primary_reads as _prefer_primary
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
+def parse_endpoints(value):
+    """
+    Разбирает список реплик вида "host1:5432,host2:5433" в [(host, port)]
+    """
+    endpoints = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(":")
+        endpoints.append((host, int(port or 5432)))
+    return endpoints
+
+class ReplicaSet:
+    """
+    Набор реплик для чтения с ротацией и выводом недоступных узлов.
+
+    Реплика, к которой не удалось подключиться или которая отстает больше
+    max_lag секунд, исключается из ротации на retry_interval секунд.
+    """
+    
+    def __init__(self, endpoints, connect, retry_interval=30, max_lag=10):
+        self.endpoints = list(endpoints)
+        self.connect = connect
+        self.retry_interval = retry_interval
+        self.max_lag = max_lag
+        self._unhealthy_until = {}
+        self._position = 0
+        self._lock = threading.Lock()
+    
+    def is_healthy(self, endpoint):
+        return self._unhealthy_until.get(endpoint, 0) <= time.monotonic()
+    
+    def mark_unhealthy(self, endpoint):
+        self._unhealthy_until[endpoint] = time.monotonic() + self.retry_interval
+    
+    def healthy_endpoints(self):
+        """Доступные реплики, начиная со следующей по кругу"""
+        with self._lock:
+            start = self._position
+            self._position = (self._position + 1) % max(len(self.endpoints), 1)
+        ordered = self.endpoints[start:] + self.endpoints[:start]
+        return [endpoint for endpoint in ordered if self.is_healthy(endpoint)]
+    
+    def get_connection(self):
+        """
+        Возвращает подключение к первой доступной реплике или None
+        """
+        for endpoint in self.healthy_endpoints():
+            try:
+                return self.connect(*endpoint)
+            except Exception:
+                self.mark_unhealthy(endpoint)
+        return None
+    
+    def check(self):
+        """
+        Проверяет все реплики: доступность и отставание репликации
+        """
+        for endpoint in self.endpoints:
+            connection = None
+            try:
+                connection = self.connect(*endpoint)
+                cursor = connection.cursor()
+                cursor.execute("""
+                    SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                """)
+                lag = float(cursor.fetchone()[0] or 0)
+                cursor.close()
+                if lag > self.max_lag:
+                    self.mark_unhealthy(endpoint)
+                else:
+                    self._unhealthy_until.pop(endpoint, None)
+            except Exception:
+                self.mark_unhealthy(endpoint)
+            finally:
+                if connection:
+                    connection.close()
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    Подключение, которое помнит, какие именованные запросы на нем уже
+    подготовлены (PREPARE живет до конца сессии)
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        # statement_timeout сессии, мс; None - значение по умолчанию сервера
+        self.statement_timeout = None
+    
+    def apply_timeout(self, timeout):
+        """
+        Меняет statement_timeout сессии, только если он отличается от текущего
+        """
+        if timeout == self.statement_timeout:
+            return
+        with self.cursor() as cursor:
+            if timeout is None:
+                cursor.execute("RESET statement_timeout")
+            else:
+                cursor.execute("SELECT set_config('statement_timeout', %s, false)", (str(timeout),))
+        # Без commit настройка откатится вместе с транзакцией при возврате в пул
+        self.commit()
+        self.statement_timeout = timeout
+
+class PooledConnection:
+    """
+    Подключение из пула: close() возвращает его в пул вместо закрытия.
+    Без пула (отдельное подключение при исчерпанном пуле) close()
+    закрывает его.
+
+    Перед возвратом подключение отвязывается от срока запроса: detach()
+    ждет, пока Scope.cancel() закончит отмену, поэтому отмена не
+    попадет в запрос, который выполнит следующий владелец подключения
+    """
+    
+    def __init__(self, pool, connection, scope=None):
+        self._pool = pool
+        self._connection = connection
+        self._scope = scope
+    
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+    
+    def close(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if self._scope is not None:
+            self._scope.detach(connection)
+        if self._pool is None:
+            connection.close()
+            return
+        if connection.closed:
+            self._pool.putconn(connection, close=True)
+            return
+        try:
+            connection.rollback()
+        except Exception:
+            self._pool.putconn(connection, close=True)
+            return
+        self._pool.putconn(connection)
+
 class Database:
     """Класс для работы с базой данных PostgreSQL"""
     
@@ -13,34 +167,150 @@ class Database:
         self.user = os.getenv('DB_USER', 'postgres')
         self.password = os.getenv('DB_PASSWORD', '')
         self.database = os.getenv('DB_NAME', 'movie_reviews')
+        self.replicas = ReplicaSet(
+            parse_endpoints(os.getenv('DB_REPLICA_HOSTS', '')),
+            lambda host, port: self._connect(host, port, connect_timeout=3),
+            retry_interval=int(os.getenv('DB_REPLICA_RETRY_INTERVAL', '30')),
+            max_lag=float(os.getenv('DB_REPLICA_MAX_LAG', '10'))
+        )
+        self.pool_min = int(os.getenv('DB_POOL_MIN', '1'))
+        self.pool_max = int(os.getenv('DB_POOL_MAX', '10'))
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+    
+    def _connection_params(self, host, port, connect_timeout):
+        return dict(
+            host=host,
+            port=port,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            connect_timeout=connect_timeout,
+            connection_factory=PreparedConnection,
+            # Агрегаты по секционированной таблице reviews считаются посекционно
+            options='-c enable_partitionwise_aggregate=on -c enable_partitionwise_join=on'
+        )
+    
+    def _get_pool(self, host, port, connect_timeout):
+        key = (host, str(port))
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.pool_min, self.pool_max,
+                        **self._connection_params(host, port, connect_timeout)
+                    )
+                    self._pools[key] = pool
+        return pool
+    
+    def _connect(self, host, port, connect_timeout=10):
+        """
+        Берет подключение из пула узла; если пул исчерпан, открывает
+        отдельное подключение, которое закроется при close()
+        """
+        pool = self._get_pool(host, port, connect_timeout)
+        scope = deadlines.current()
+        # Срок запроса проверяется до того, как занять подключение
+        timeout = scope.statement_timeout() if scope else None
+        with tracing.span("db.connect", **{"db.host": f"{host}:{port}"}) as current:
+            try:
+                connection = pool.getconn()
+            except psycopg2.pool.PoolError:
+                current.set_attribute("db.pool_exhausted", True)
+                connection = psycopg2.connect(**self._connection_params(host, port, connect_timeout))
+                pooled = PooledConnection(None, connection, scope)
+            else:
+                pooled = PooledConnection(pool, connection, scope)
+            try:
+                connection.apply_timeout(timeout)
+            except Exception:
+                pooled.close()
+                raise
+        if scope is not None:
+            scope.attach(connection)
+        return pooled
     
     def get_connection(self):
         """
-        Создает и возвращает подключение к PostgreSQL
+        Возвращает подключение к PostgreSQL (primary) из пула
         """
         try:
-            connection = psycopg2.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                password=self.password,
-                database=self.database,
-                connect_timeout=10
-            )
-            return connection
+            return self._connect(self.host, self.port)
         except Exception as e:
-            print(f"❌ Ошибка подключения к БД: {e}")
+            logger.error("Ошибка подключения к БД: %s", e)
             raise
+    
+    def get_listen_connection(self):
+        """
+        Отдельное подключение к primary вне пула для LISTEN:
+        живет все время работы приложения, autocommit
+        """
+        params = self._connection_params(self.host, self.port, 10)
+        params.pop('connection_factory')
+        # keepalive нужен, чтобы обрыв простаивающего соединения был замечен
+        connection = psycopg2.connect(
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+            **params
+        )
+        connection.set_session(autocommit=True)
+        return connection
+
+    def get_read_connection(self):
+        """
+        Возвращает подключение для чтения: к реплике, если они настроены
+        и запрос не требует read-your-writes, иначе к primary
+        """
+        if self.replicas.endpoints and not _prefer_primary.get():
+            connection = self.replicas.get_connection()
+            if connection:
+                return connection
+        return self.get_connection()
 
 # Глобальный экземпляр базы данных
 db = Database()
 
+# Одинаковые одновременные чтения (например, страница популярного фильма)
+# выполняются один раз на процесс, результат получают все ожидающие
+reads = AsyncSingleFlight("db_reads")
+
 def get_db_connection():
     """
     Функция для получения подключения к БД
     """
     return db.get_connection()
 
+def get_read_connection():
+    """
+    Функция для получения подключения к БД только для чтения
+    """
+    return db.get_read_connection()
+
+def fetch_dict(cursor):
+    """
+    Следующая строка курсора как словарь {колонка: значение} или None.
+    Курсоры приложения возвращают кортежи
+    """
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([desc[0] for desc in cursor.description], row))
+
+def fetch_dicts(cursor):
+    """
+    Оставшиеся строки курсора как список словарей
+    """
+    columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def prefer_primary(value=True):
+    """
+    Направляет чтения текущего запроса на primary, мимо кешей и
+    схлопывания чтений (app/cache.py)
+    """
+    _prefer_primary.set(value)
+
 def init_db():
     """
     Инициализация базы данных - проверка подключения и таблиц
@@ -57,21 +327,13 @@ def init_db():
                 ORDER BY table_name
             """)
             tables = cursor.fetchall()
-            print("✅ Таблицы в базе данных:")
-            for table in tables:
-                print(f"   - {table[0]}")
-            
-            # Проверяем количество записей (используем индексы вместо ключей)
-            cursor.execute("SELECT COUNT(*) as count FROM movies")
-            movies_count = cursor.fetchone()[0]  # Используем индекс [0] вместо ['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM reviews")
-            reviews_count = cursor.fetchone()[0]  # Используем индекс [0] вместо ['count']
+            logger.info("Таблицы в базе данных", extra={'tables': [table[0] for table in tables]})
             
-            print(f"📊 Статистика: {movies_count} фильмов, {reviews_count} отзывов")
+            # Количество записей считает фоновая задача refresh_stats
+            # (app/jobs.py), а не запуск приложения
             
     except Exception as e:
-        print(f"❌ Ошибка инициализации БД: {e}")
+        logger.error("Ошибка инициализации БД: %s", e)
         raise
     finally:
         if connection:
@@ -87,11 +349,10 @@ def test_connection():
         with connection.cursor() as cursor:
             cursor.execute("SELECT version();")
             version = cursor.fetchone()
-            print(f"✅ Подключение к PostgreSQL успешно!")
-            print(f"📋 Версия: {version[0]}")
+            logger.info("Подключение к PostgreSQL успешно", extra={'version': version[0]})
         return True
     except Exception as e:
-        print(f"❌ Ошибка подключения: {e}")
+        logger.error("Ошибка подключения: %s", e)
         return False
     finally:
         if connection:
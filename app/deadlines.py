@@ -0,0 +1,228 @@
+"""
+Сроки обработки запросов и отмена запросов к БД.
+
+У каждого HTTP-запроса есть срок, зависящий от группы маршрутов (поиск и
+краулеры получают меньше времени, чем запись). Срок хранится в контексте
+запроса и доходит до слоя БД: при выдаче подключения из пула ему ставится
+statement_timeout не больше оставшегося времени, поэтому тяжелый поиск
+или ожидание блокировки строки не держит воркер дольше срока.
+
+Если клиент отключился, не дождавшись ответа, выполняющиеся запросы
+этого HTTP-запроса отменяются (pg_cancel_backend через connection.cancel()),
+а обработчик прерывается.
+
+Отключение замечает цикл событий, поэтому обработчики, которые ходят
+в БД синхронно (psycopg2), объявлены через def: FastAPI выполняет их
+в пуле потоков, а контекст со сроком запроса переходит в поток.
+Синхронный запрос внутри async def блокировал бы цикл событий, и
+отмена сработала бы только после его завершения.
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from fastapi.responses import JSONResponse
+
+from app import ratelimit
+
+# Таймаут одного SQL-запроса по умолчанию, мс
+STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '5000'))
+# Отмена запросов к БД при отключении клиента
+CANCEL_ON_DISCONNECT = os.getenv('DB_CANCEL_ON_DISCONNECT', '1') == '1'
+
+# Группа маршрутов (ratelimit.classify) -> срок обработки запроса, сек
+ROUTE_DEADLINES = {
+    name: float(os.getenv(f'DEADLINE_{name.upper()}', default))
+    for name, default in (
+        ('write', '10'),
+        ('page', '5'),
+        ('api', '5'),
+        ('search', '2'),
+        ('crawler', '2')
+    )
+}
+
+
+class DeadlineExceeded(Exception):
+    """Срок запроса истек до обращения к БД"""
+
+
+class Scope:
+    """
+    Срок и подключения к БД одного HTTP-запроса
+    """
+
+    def __init__(self, timeout, cancellable=True):
+        self.deadline = time.monotonic() + timeout
+        self.cancellable = cancellable
+        self.cancelled = False
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def statement_timeout(self):
+        """
+        statement_timeout для нового подключения, мс: не больше оставшегося
+        срока, с округлением вверх до 100 мс, чтобы реже менять настройку
+        """
+        if self.cancelled:
+            raise DeadlineExceeded("Клиент отключился")
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Срок обработки запроса истек")
+        return min(STATEMENT_TIMEOUT, math.ceil(remaining * 10) * 100)
+
+    def attach(self, connection):
+        if self.cancellable:
+            with self._lock:
+                self._connections.add(connection)
+
+    def detach(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def cancel(self):
+        """
+        Отменяет выполняющиеся запросы всех подключений запроса.
+        Блокировка держится до конца отмены: PooledConnection.close()
+        отвязывает подключение (detach) до возврата в пул и ждет ее,
+        поэтому отмена не достанется следующему владельцу подключения
+        """
+        self.cancelled = True
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.cancel()
+                except Exception:
+                    pass
+            return len(self._connections)
+
+    def shared(self):
+        """
+        Тот же срок без отмены: для загрузок, результат которых ждут
+        и другие запросы (кеши и схлопывание чтений)
+        """
+        scope = Scope(0, cancellable=False)
+        scope.deadline = self.deadline
+        return scope
+
+
+_scope = ContextVar("request_scope", default=None)
+
+# Счетчики процесса для /admin/metrics
+counters = {'disconnected': 0, 'cancelled_statements': 0, 'timed_out': 0}
+
+
+def current():
+    """
+    Scope текущего запроса или None (фоновые задачи, бот)
+    """
+    return _scope.get()
+
+
+def shared(func):
+    """
+    Оборачивает функцию, выполняемую в потоке от имени нескольких
+    запросов: отключение первого из них не отменяет ее запросы к БД
+    """
+    def run(*args):
+        scope = _scope.get()
+        if scope is not None:
+            _scope.set(scope.shared())
+        return func(*args)
+
+    return run
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware: задает срок запроса и отменяет его запросы к БД,
+    когда клиент отключается. Запросы, не уложившиеся в срок, получают
+    504 вместо 500 обработчика.
+    """
+
+    def __init__(self, app, skip_prefixes=()):
+        self.app = app
+        self.skip_prefixes = tuple(skip_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or ())
+        group, _ = ratelimit.classify(
+            scope["method"], scope["path"], headers.get(b"user-agent", b"").decode("latin-1")
+        )
+        request_scope = Scope(ROUTE_DEADLINES[group])
+        token = _scope.set(request_scope)
+
+        # Тело запроса читается заранее, чтобы дальше ждать только отключения
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                _scope.reset(token)
+                return
+            body.append(message)
+            if not message.get("more_body", False):
+                break
+
+        disconnected = asyncio.Event()
+
+        async def replay():
+            if body:
+                return body.pop(0)
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        timed_out = False
+
+        async def send_wrapper(message):
+            nonlocal timed_out
+            if message["type"] == "http.response.start" and message["status"] == 500 and request_scope.expired:
+                timed_out = True
+                counters['timed_out'] += 1
+                response = JSONResponse(status_code=504, content={"detail": "Превышено время обработки запроса"})
+                await response(scope, replay, send)
+                return
+            if timed_out:
+                return
+            await send(message)
+
+        handler = asyncio.ensure_future(self.app(scope, replay, send_wrapper))
+
+        async def watch():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    break
+            disconnected.set()
+            if CANCEL_ON_DISCONNECT and not handler.done():
+                counters['disconnected'] += 1
+                counters['cancelled_statements'] += request_scope.cancel()
+                handler.cancel()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not disconnected.is_set():
+                raise
+        finally:
+            watcher.cancel()
+            _scope.reset(token)
+
+
+def stats():
+    return dict(counters)
@@ -0,0 +1,430 @@
+"""
+Поиск почти одинаковых отзывов (копипаста, накрутка) по MinHash и LSH.
+
+Текст отзыва нормализуется и режется на символьные k-граммы (шинглы).
+Подпись MinHash - NUM_PERM минимумов хешей шинглов. Доля совпадающих
+позиций двух подписей оценивает коэффициент Жаккара их множеств шинглов.
+Сравнивать новый отзыв со всеми старыми не нужно. Подпись делится на
+BANDS полос по ROWS значений, и хеш полосы служит ключом корзины.
+Отзывы, совпавшие хотя бы в одной корзине, - кандидаты, и только их
+подписи сравниваются.
+
+Ключ корзины включает область: фильм или пользователя (user_key).
+Поэтому кандидаты - только отзывы того же фильма (флуд одним текстом)
+или того же пользователя (один текст под разными фильмами). Отзыв,
+похожий на более ранний не меньше чем на DEDUP_THRESHOLD, помечается в
+review_flags. Корзины хранятся в review_signatures.buckets под
+GIN-индексом (migrations/011_review_dedup.sql), так что проверка отзыва -
+один поиск по индексу и не зависит от числа отзывов. Копия попадает в
+корзины только тех областей, где она не дубликат, поэтому волна копий не
+раздувает корзину оригинала.
+
+Короткие тексты ("Отличный фильм!") совпадают естественно и не
+проверяются. NUM_PERM, BANDS, ROWS, SHINGLE_SIZE и SEED определяют
+сохраненные подписи: после их изменения review_signatures нужно
+очистить и заполнить заново.
+
+    python -m app.dedup backfill [--batch-size 2000]  # существующие отзывы
+    python -m app.dedup bench [--reviews 20000]       # пропускная способность
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import app.database as database
+import app.log as log
+import app.statements as statements
+
+logger = logging.getLogger(__name__)
+
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', '1') == '1'
+# Оценка коэффициента Жаккара, начиная с которой отзыв - дубликат
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.8'))
+# Тексты короче (после нормализации) не проверяются, символов
+DEDUP_MIN_LENGTH = int(os.getenv('DEDUP_MIN_LENGTH', '40'))
+# Кандидатов из БД на один проверяемый отзыв
+DEDUP_MAX_CANDIDATES = int(os.getenv('DEDUP_MAX_CANDIDATES', '50'))
+BACKFILL_BATCH_SIZE = int(os.getenv('DEDUP_BACKFILL_BATCH_SIZE', '2000'))
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+# 16 полос по 8 значений: кандидатами почти наверняка становятся пары с
+# Жаккаром от 0.8 (вероятность 0.94) и редко - ниже 0.5 (0.06)
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SEED = 20240601
+
+SCOPE_MOVIE = 'movie'
+SCOPE_USER = 'user'
+
+_MASK32 = np.uint64(0xFFFFFFFF)
+_SHIFT32 = np.uint64(32)
+_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_NON_WORD = re.compile(r"[\W_]+")
+
+# Хеши multiply-shift: ((a * x + b) mod 2^64) >> 32 с нечетными a
+_generator = np.random.default_rng(SEED)
+_A = (_generator.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+_B = _generator.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+# Смешивание значений полосы в один ключ
+_BAND_WEIGHTS = _generator.integers(1, 2 ** 63, (1, ROWS), dtype=np.uint64) | np.uint64(1)
+_BAND_SALTS = _generator.integers(0, 2 ** 63, BANDS, dtype=np.uint64)
+
+# keys: область -> ключи корзин (int)
+Signed = namedtuple("Signed", ["review_id", "movie_id", "user_key", "signature", "keys"])
+Flag = namedtuple("Flag", ["review_id", "movie_id", "duplicate_of", "duplicate_movie_id", "scope", "similarity"])
+
+counters = {'checked': 0, 'skipped': 0, 'flagged': 0, 'candidates': 0, 'errors': 0, 'seconds': 0.0}
+
+
+def normalize(text):
+    """Текст без регистра, пунктуации и лишних пробелов"""
+    return _NON_WORD.sub(" ", (text or "").lower().replace("ё", "е")).strip()
+
+
+def signature(text):
+    """
+    Подпись MinHash текста (NUM_PERM значений uint32) или None для
+    короткого текста
+    """
+    text = normalize(text)
+    if len(text) < max(DEDUP_MIN_LENGTH, SHINGLE_SIZE):
+        return None
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    # Полиномиальный хеш всех k-грамм сразу; переполнение uint64 - это mod 2^64
+    count = len(codes) - SHINGLE_SIZE + 1
+    shingles = np.zeros(count, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        shingles = shingles * _MULTIPLIER + codes[offset:offset + count]
+    shingles = (shingles ^ (shingles >> _SHIFT32)) & _MASK32
+    hashes = (_A[:, None] * shingles[None, :] + _B[:, None]) >> _SHIFT32
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+def _scope_seed(scope, value):
+    digest = hashlib.blake2b(f"{scope}:{value}".encode(), digest_size=8).digest()
+    return np.uint64(int.from_bytes(digest, "little"))
+
+
+def band_keys(sig, scope, value):
+    """
+    Ключи корзин подписи в области (фильм или пользователь): BANDS
+    чисел int64
+    """
+    bands = sig.astype(np.uint64).reshape(BANDS, ROWS)
+    keys = (bands * _BAND_WEIGHTS).sum(axis=1, dtype=np.uint64) ^ _BAND_SALTS ^ _scope_seed(scope, value)
+    keys ^= keys >> np.uint64(31)
+    keys *= _MULTIPLIER
+    keys ^= keys >> np.uint64(29)
+    return keys.view(np.int64).tolist()
+
+
+def similarity(first, second):
+    """Оценка коэффициента Жаккара по двум подписям"""
+    return float(np.count_nonzero(first == second)) / NUM_PERM
+
+
+def sign(review_id, movie_id, user_key, text):
+    """
+    Подпись отзыва с ключами корзин или None для короткого текста
+    """
+    sig = signature(text)
+    if sig is None:
+        return None
+    keys = {SCOPE_MOVIE: band_keys(sig, SCOPE_MOVIE, movie_id)}
+    if user_key:
+        keys[SCOPE_USER] = band_keys(sig, SCOPE_USER, user_key)
+    return Signed(review_id, movie_id, user_key, sig, keys)
+
+
+class LSHIndex:
+    """
+    Корзины LSH в памяти: ключ -> подписанные отзывы
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.size = 0
+
+    def add(self, item, keys):
+        for key in keys:
+            self.buckets.setdefault(key, []).append(item)
+        self.size += 1
+
+    def candidates(self, keys):
+        found = {}
+        for key in keys:
+            for item in self.buckets.get(key, ()):
+                found[item.review_id] = item
+        return found.values()
+
+
+def _in_scope(candidate, item, scope):
+    if scope == SCOPE_MOVIE:
+        return candidate.movie_id == item.movie_id
+    return candidate.user_key == item.user_key
+
+
+def detect(items, index, threshold=DEDUP_THRESHOLD):
+    """
+    Проверяет подписанные отзывы в порядке ID по индексу и добавляет их в
+    него. Возвращает флаги и ключи, под которыми отзывы попали в индекс
+    (области, где отзыв - дубликат, пропускаются)
+    """
+    flags, indexed = [], {}
+    for item in sorted(items, key=lambda item: item.review_id):
+        flag = None
+        keys = []
+        for scope, scope_keys in item.keys.items():
+            best, best_similarity = None, 0.0
+            for candidate in index.candidates(scope_keys):
+                # Дубликат - более поздний из двух отзывов
+                if candidate.review_id >= item.review_id or not _in_scope(candidate, item, scope):
+                    continue
+                value = similarity(item.signature, candidate.signature)
+                if value > best_similarity:
+                    best, best_similarity = candidate, value
+            if best is not None and best_similarity >= threshold:
+                if flag is None or best_similarity > flag.similarity:
+                    flag = Flag(item.review_id, item.movie_id, best.review_id, best.movie_id, scope, best_similarity)
+            else:
+                keys.extend(scope_keys)
+        index.add(item, keys)
+        indexed[item.review_id] = keys
+        if flag is not None:
+            flags.append(flag)
+    return flags, indexed
+
+
+def check_reviews(cursor, reviews, threshold=DEDUP_THRESHOLD):
+    """
+    Проверяет новые отзывы (review_id, movie_id, user_key, review_text) в
+    транзакции курсора: кандидаты из review_signatures, запись подписей
+    и флагов. Возвращает флаги
+    """
+    items = [item for item in (sign(*review) for review in reviews) if item is not None]
+    counters['skipped'] += len(reviews) - len(items)
+    if not items:
+        return []
+
+    all_keys = [key for item in items for keys in item.keys.values() for key in keys]
+    statements.execute(cursor, "review_signature_candidates", (
+        all_keys, max(item.review_id for item in items), DEDUP_MAX_CANDIDATES * len(items)
+    ))
+    index = LSHIndex()
+    candidates = 0
+    for review_id, movie_id, user_key, buckets, stored in cursor.fetchall():
+        index.add(Signed(review_id, movie_id, user_key, np.frombuffer(bytes(stored), dtype=np.uint32), None), buckets)
+        candidates += 1
+
+    flags, indexed = detect(items, index, threshold)
+
+    keys, owners = [], []
+    for review_id, review_keys in indexed.items():
+        keys.extend(review_keys)
+        owners.extend([review_id] * len(review_keys))
+    statements.execute(cursor, "review_signatures_insert", (
+        [item.review_id for item in items],
+        [item.movie_id for item in items],
+        [item.user_key for item in items],
+        [item.signature.tobytes() for item in items],
+        keys,
+        owners
+    ))
+    if flags:
+        statements.execute(cursor, "review_flags_insert", (
+            [flag.review_id for flag in flags],
+            [flag.movie_id for flag in flags],
+            [flag.duplicate_of for flag in flags],
+            [flag.duplicate_movie_id for flag in flags],
+            [flag.scope for flag in flags],
+            [flag.similarity for flag in flags]
+        ))
+    counters['candidates'] += candidates
+    counters['flagged'] += len(flags)
+    return flags
+
+
+def record_reviews(cursor, reviews):
+    """
+    Проверка новых отзывов при записи (add_review*). Ошибка проверки
+    откатывается до точки сохранения и не мешает записи отзыва
+    """
+    if not DEDUP_ENABLED:
+        return []
+    started = time.perf_counter()
+    cursor.execute("SAVEPOINT review_dedup")
+    try:
+        flags = check_reviews(cursor, reviews)
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT review_dedup")
+        counters['errors'] += 1
+        logger.warning("Проверка отзывов на дубликаты не выполнена: %s", e)
+        return []
+    cursor.execute("RELEASE SAVEPOINT review_dedup")
+    counters['checked'] += len(reviews)
+    counters['seconds'] += time.perf_counter() - started
+    if flags:
+        logger.info("Отзывы помечены как дубликаты", extra={
+            'reviews': [flag.review_id for flag in flags],
+            'duplicate_of': [flag.duplicate_of for flag in flags]
+        })
+    return flags
+
+
+def record_review(cursor, review_id, movie_id, user_key, review_text):
+    """Проверка одного нового отзыва"""
+    flags = record_reviews(cursor, [(review_id, movie_id, user_key, review_text)])
+    return flags[0] if flags else None
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE, after_id=0):
+    """
+    Подписи и флаги для существующих отзывов пачками по ID; транзакция на
+    пачку. Уже проверенные отзывы пропускаются, поэтому backfill можно
+    прервать и перезапустить (after_id) или запустить при работающем
+    приложении
+    """
+    started = time.perf_counter()
+    processed = flagged = 0
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            while True:
+                statements.execute(cursor, "reviews_for_dedup", (after_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                after_id = rows[-1][0]
+                flagged += len(check_reviews(cursor, rows))
+                connection.commit()
+                processed += len(rows)
+                logger.info("Отзывы проверены на дубликаты", extra={
+                    'last_id': after_id, 'reviews': processed, 'flagged': flagged,
+                    'reviews_per_second': round(processed / (time.perf_counter() - started))
+                })
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    seconds = time.perf_counter() - started
+    return {'reviews': processed, 'flagged': flagged, 'last_id': after_id, 'seconds': round(seconds, 2)}
+
+
+def stats():
+    checked = counters['checked']
+    return {
+        **counters,
+        'seconds': round(counters['seconds'], 3),
+        'avg_ms': round(counters['seconds'] * 1000 / checked, 3) if checked else 0.0
+    }
+
+
+# --- Замер пропускной способности ---
+
+_SYLLABLES = ["ка", "ро", "ми", "те", "на", "ст", "ль", "ва", "де", "зо", "ри", "пу", "ше", "ла", "бо", "ус"]
+
+
+def _synthetic_reviews(count, duplicate_share, movies, users, seed=1):
+    """
+    Отзывы со словами по Ципфу; часть - правленые копии более ранних
+    (тот же фильм или тот же пользователь). Возвращает отзывы и ID копий
+    """
+    generator = random.Random(seed)
+    vocabulary = sorted({
+        "".join(generator.choices(_SYLLABLES, k=generator.randint(2, 4)))
+        for _ in range(5000)
+    })
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    reviews, copies = [], set()
+    for review_id in range(1, count + 1):
+        if reviews and generator.random() < duplicate_share:
+            _, movie_id, user_key, text = generator.choice(reviews[-2000:])
+            words = text.split()
+            # Правка пары слов и регистра, как при ручной копипасте
+            for _ in range(generator.randint(0, 2)):
+                words[generator.randrange(len(words))] = generator.choice(vocabulary)
+            text = " ".join(words).capitalize() + generator.choice(["", "!", "!!", "."])
+            if generator.random() < 0.5:
+                user_key = f"user{generator.randrange(users)}"
+            else:
+                movie_id = generator.randrange(movies)
+            copies.add(review_id)
+        else:
+            movie_id = generator.randrange(movies)
+            user_key = f"user{generator.randrange(users)}"
+            text = " ".join(generator.choices(vocabulary, weights, k=generator.randint(15, 80)))
+        reviews.append((review_id, movie_id, user_key, text))
+    return reviews, copies
+
+
+def _bench(count, duplicate_share, movies, users, brute_force):
+    reviews, copies = _synthetic_reviews(count, duplicate_share, movies, users)
+
+    started = time.perf_counter()
+    items = [item for item in (sign(*review) for review in reviews) if item is not None]
+    sign_seconds = time.perf_counter() - started
+
+    index = LSHIndex()
+    started = time.perf_counter()
+    flags, _ = detect(items, index)
+    detect_seconds = time.perf_counter() - started
+
+    flagged = {flag.review_id for flag in flags}
+    found = len(flagged & copies)
+    print(f"Отзывов: {count}, подписано: {len(items)}, копий: {len(copies)}")
+    print(f"Подписи: {count / sign_seconds:,.0f} отзывов/с ({sign_seconds * 1e6 / count:.0f} мкс на отзыв)")
+    print(f"Поиск по LSH: {count / detect_seconds:,.0f} отзывов/с, корзин: {len(index.buckets)}")
+    print(f"Помечено: {len(flags)}, из них копий: {found} (полнота {found / max(len(copies), 1):.1%}, "
+          f"точность {found / max(len(flags), 1):.1%})")
+
+    # Попарное сравнение тех же подписей в пределах фильма - для сравнения
+    if brute_force:
+        sample = items[:brute_force]
+        started = time.perf_counter()
+        comparisons = 0
+        for position, item in enumerate(sample):
+            for other in sample[:position]:
+                if other.movie_id == item.movie_id or other.user_key == item.user_key:
+                    similarity(item.signature, other.signature)
+                    comparisons += 1
+        seconds = time.perf_counter() - started
+        lsh_per_review = detect_seconds / len(items)
+        print(f"Попарно ({len(sample)} отзывов, {comparisons} сравнений): {seconds:.2f} с, "
+              f"{seconds / len(sample) * 1e3:.2f} мс на отзыв против {lsh_per_review * 1e3:.3f} мс через LSH; "
+              f"растет с числом отзывов фильма и пользователя")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поиск почти одинаковых отзывов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="проверить существующие отзывы")
+    backfill_parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    backfill_parser.add_argument("--after-id", type=int, default=0, help="продолжить после этого ID")
+    bench_parser = subparsers.add_parser("bench", help="пропускная способность на синтетических отзывах")
+    bench_parser.add_argument("--reviews", type=int, default=20000)
+    bench_parser.add_argument("--duplicates", type=float, default=0.1, help="доля копий")
+    bench_parser.add_argument("--movies", type=int, default=200)
+    bench_parser.add_argument("--users", type=int, default=2000)
+    bench_parser.add_argument("--brute-force", type=int, default=5000, help="отзывов для попарного сравнения (0 - без него)")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        log.setup("dedup")
+        result = backfill(args.batch_size, args.after_id)
+        print(f"Проверено {result['reviews']} отзывов за {result['seconds']} с, помечено: {result['flagged']}")
+    elif args.command == "bench":
+        _bench(args.reviews, args.duplicates, args.movies, args.users, args.brute_force)
+
+
+if __name__ == "__main__":
+    main()
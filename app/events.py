@@ -0,0 +1,294 @@
+"""
+Поток изменений для живых обновлений (SSE и WebSocket).
+
+Триггеры PostgreSQL (migrations/006_change_feed.sql) отправляют JSON-события
+в канал movie_events. Каждый воркер держит одно LISTEN-подключение,
+читает уведомления в цикле событий (loop.add_reader, без потоков и
+опроса) и раздает их подписчикам.
+
+Подписчики хранятся по movie_id, поэтому событие фильма обходит только
+подписчиков этого фильма и глобальных подписчиков. Payload не
+перекодируется для каждого клиента: всем уходит исходная JSON-строка.
+У каждого подписчика своя ограниченная очередь - медленный клиент теряет
+самые старые события и не задерживает остальных.
+
+Задержка раздачи в зависимости от числа подписчиков:
+    python -m app.events bench
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import time
+from collections import namedtuple
+
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "movie_events"
+# Размер очереди событий одного подписчика
+BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', '100'))
+# Интервал пустых сообщений, по которым клиент и сервер видят обрыв, сек
+HEARTBEAT_INTERVAL = int(os.getenv('EVENTS_HEARTBEAT_INTERVAL', '15'))
+RECONNECT_INTERVAL = 5
+
+# Служебные события для воркеров приложения (например, warm_cache из
+# app/jobs.py): их получают listeners, но не клиенты SSE и WebSocket
+INTERNAL_EVENTS = {'warm_cache'}
+
+# data - исходный JSON из NOTIFY
+Event = namedtuple("Event", ["type", "movie_id", "data"])
+
+
+class Subscription:
+    """Очередь событий одного клиента"""
+
+    def __init__(self, movie_id=None, buffer_size=BUFFER_SIZE):
+        self.movie_id = movie_id
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def push(self, event):
+        """
+        Кладет событие в очередь; при переполнении выбрасывает самое
+        старое и возвращает False
+        """
+        delivered = True
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            delivered = False
+        self.queue.put_nowait(event)
+        return delivered
+
+    async def get(self, timeout=None):
+        """
+        Следующее событие или None, если за timeout секунд событий не было
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBus:
+    """
+    Раздача уведомлений LISTEN/NOTIFY подписчикам текущего процесса
+    """
+
+    def __init__(self, connect, channel=CHANNEL):
+        self.connect = connect
+        self.channel = channel
+        self._by_movie = {}
+        self._global = set()
+        # Функции процесса, вызываемые на каждое событие (сброс кешей и т.п.)
+        self.listeners = []
+        self._task = None
+        self.connected = False
+        self.published = 0
+        self.dropped = 0
+
+    @property
+    def subscriber_count(self):
+        return len(self._global) + sum(len(subscribers) for subscribers in self._by_movie.values())
+
+    def subscribe(self, movie_id=None, buffer_size=BUFFER_SIZE):
+        """
+        Подписка на события фильма или, без movie_id, на все события
+        """
+        subscription = Subscription(movie_id, buffer_size)
+        if movie_id is None:
+            self._global.add(subscription)
+        else:
+            self._by_movie.setdefault(movie_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription.movie_id is None:
+            self._global.discard(subscription)
+            return
+        subscribers = self._by_movie.get(subscription.movie_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._by_movie[subscription.movie_id]
+
+    def publish(self, event):
+        """
+        Раздает событие подписчикам фильма и глобальным подписчикам
+        """
+        self.published += 1
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.exception("Ошибка обработчика события %s", event.type)
+        if event.type in INTERNAL_EVENTS:
+            return
+        for subscription in self._by_movie.get(event.movie_id, ()):
+            if not subscription.push(event):
+                self.dropped += 1
+        for subscription in self._global:
+            if not subscription.push(event):
+                self.dropped += 1
+
+    def dispatch(self, payload):
+        """
+        Разбирает payload уведомления и публикует событие
+        """
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        self.publish(Event(message.get('type'), message.get('movie_id'), payload))
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка потока событий: %s", e)
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        connection = await asyncio.to_thread(self.connect)
+        lost = loop.create_future()
+
+        def on_readable():
+            try:
+                connection.poll()
+            except Exception as e:
+                if not lost.done():
+                    lost.set_exception(e)
+                return
+            notifies = list(connection.notifies)
+            connection.notifies.clear()
+            for notify in notifies:
+                self.dispatch(notify.payload)
+
+        fileno = connection.fileno()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+            loop.add_reader(fileno, on_readable)
+            self.connected = True
+            logger.info("Поток событий подключен", extra={'channel': self.channel})
+            await lost
+        finally:
+            self.connected = False
+            loop.remove_reader(fileno)
+            connection.close()
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'subscribers': self.subscriber_count,
+            'published': self.published,
+            'dropped': self.dropped
+        }
+
+
+# Шина событий процесса
+bus = EventBus(db.get_listen_connection)
+
+
+# --- Замер раздачи событий ---
+
+async def _bench_round(subscribers, movies, count, rate, global_share, seed=1):
+    """
+    Задержка от publish() до получения события подписчиком при заданном
+    числе подписчиков; подписчики читают очереди, как потоки SSE
+    """
+    generator = random.Random(seed)
+    local_bus = EventBus(connect=None)
+    sent = {}
+    latencies = []
+
+    async def consume(subscription):
+        while True:
+            event = await subscription.queue.get()
+            latencies.append(time.perf_counter() - sent[id(event)])
+
+    subscriptions = [
+        local_bus.subscribe(None if generator.random() < global_share else generator.randrange(movies))
+        for _ in range(subscribers)
+    ]
+    consumers = [asyncio.create_task(consume(subscription)) for subscription in subscriptions]
+    await asyncio.sleep(0)
+
+    publish_seconds = []
+    events = []
+    for number in range(count):
+        movie_id = generator.randrange(movies)
+        event = Event("review_created", movie_id, json.dumps({'type': 'review_created', 'movie_id': movie_id, 'number': number}))
+        # Событие должно жить до конца раунда, иначе id() может повториться
+        events.append(event)
+        started = time.perf_counter()
+        sent[id(event)] = started
+        local_bus.publish(event)
+        publish_seconds.append(time.perf_counter() - started)
+        await asyncio.sleep(1 / rate)
+    await asyncio.sleep(0.1)
+
+    for consumer in consumers:
+        consumer.cancel()
+    await asyncio.gather(*consumers, return_exceptions=True)
+
+    latencies.sort()
+    return {
+        'deliveries': len(latencies) / count,
+        'publish_us': statistics.median(publish_seconds) * 1e6,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0,
+        'dropped': local_bus.dropped
+    }
+
+
+async def _bench(subscriber_counts, movies, count, rate, global_share):
+    print(f"Событий: {count}, {rate}/с, фильмов: {movies}, глобальных подписчиков: {global_share:.0%}")
+    print(f"{'подписчиков':>12}{'доставок/событие':>18}{'publish, мкс':>14}{'p50, мс':>10}{'p99, мс':>10}{'потеряно':>10}")
+    for subscribers in subscriber_counts:
+        result = await _bench_round(subscribers, movies, count, rate, global_share)
+        print(f"{subscribers:>12}{result['deliveries']:>18.1f}{result['publish_us']:>14.0f}"
+              f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['dropped']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поток изменений")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="задержка раздачи событий от числа подписчиков")
+    bench_parser.add_argument("--subscribers", default="100,1000,10000,50000", help="число подписчиков через запятую")
+    bench_parser.add_argument("--movies", type=int, default=1000)
+    bench_parser.add_argument("--events", type=int, default=500)
+    bench_parser.add_argument("--rate", type=float, default=200, help="событий в секунду")
+    bench_parser.add_argument("--global-share", type=float, default=0.1, help="доля подписчиков на все события")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        counts = [int(value) for value in args.subscribers.split(",")]
+        asyncio.run(_bench(counts, args.movies, args.events, args.rate, args.global_share))
+
+
+if __name__ == "__main__":
+    main()
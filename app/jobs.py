@@ -0,0 +1,654 @@
+"""
+Фоновые задачи: очередь в PostgreSQL и asyncio-воркер.
+
+Задача - строка таблицы jobs (migrations/007_jobs.sql) с видом (kind)
+и JSON-параметрами. Воркер забирает задачи через FOR UPDATE SKIP LOCKED,
+выполняет обработчик в отдельном потоке и продлевает аренду задачи,
+пока она выполняется. Упавшая задача повторяется с экспоненциальной
+задержкой, пока не исчерпает max_attempts попыток.
+
+Воркер запускается внутри веб-приложения (JOBS_WORKER=1, по умолчанию)
+или отдельным процессом:
+
+    python -m app.jobs worker [--concurrency 2]
+    python -m app.jobs enqueue rebuild_aggregates [--payload '{}']
+
+Пропускная способность очереди и задержка выборки задач (на тестовой
+базе или с JOBS_WORKER=0: воркеры приложения не знают задач замера):
+
+    python -m app.jobs bench [--jobs 5000] [--concurrency 2,8,32]
+
+Вычисления, которые упираются в CPU, выполняются в пуле процессов
+(cpu_pool()), чтобы не занимать GIL процесса с веб-приложением.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import app.analytics as analytics
+import app.database as database
+import app.dedup as dedup
+import app.events as events
+import app.leaderboards as leaderboards
+import app.log as log
+import app.models as models
+import app.recommendations as recommendations
+import app.statements as statements
+import app.tracing as tracing
+
+logger = logging.getLogger(__name__)
+
+# Запускать воркер внутри веб-приложения
+RUN_IN_APP = os.getenv('JOBS_WORKER', '1') == '1'
+CONCURRENCY = int(os.getenv('JOBS_CONCURRENCY', '2'))
+POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', '2'))
+# Аренда задачи продлевается каждую треть срока, пока задача выполняется
+LEASE_SECONDS = int(os.getenv('JOBS_LEASE_SECONDS', '300'))
+MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = int(os.getenv('JOBS_RETRY_BASE_DELAY', '30'))
+RETRY_MAX_DELAY = 3600
+# Сколько дней хранить завершенные задачи
+RETENTION_DAYS = int(os.getenv('JOBS_RETENTION_DAYS', '7'))
+CPU_WORKERS = int(os.getenv('JOBS_CPU_WORKERS', '2'))
+EXPORT_DIR = os.getenv('JOBS_EXPORT_DIR', 'exports')
+# Удаление отзывов скрытого фильма: размер пачки и пауза между пачками, сек
+PURGE_BATCH_SIZE = int(os.getenv('JOBS_PURGE_BATCH_SIZE', '5000'))
+PURGE_BATCH_PAUSE = float(os.getenv('JOBS_PURGE_BATCH_PAUSE', '0.05'))
+# Период возврата задач с истекшей арендой и удаления старых задач, сек
+MAINTENANCE_INTERVAL = 60
+
+# Периодические задачи: вид -> интервал, сек (0 - не планировать).
+# Полный пересчет агрегатов блокирует запись отзывов, поэтому по
+# умолчанию запускается только вручную.
+SCHEDULE = {
+    'refresh_stats': int(os.getenv('JOBS_STATS_INTERVAL', '300')),
+    'warm_cache': int(os.getenv('JOBS_WARM_CACHE_INTERVAL', '600')),
+    'rebuild_aggregates': int(os.getenv('JOBS_REBUILD_INTERVAL', '0')),
+    'rebuild_recommendations': recommendations.REBUILD_INTERVAL,
+    # Страховка на случай пропущенных событий: проверка всех подписок
+    'notify_subscribers': int(os.getenv('JOBS_NOTIFY_INTERVAL', '300')),
+}
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """
+    Регистрирует обработчик задачи: функция принимает payload (dict)
+    и возвращает JSON-сериализуемый результат
+    """
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def _row_dict(cursor, row):
+    return dict(zip([desc[0] for desc in cursor.description], row))
+
+
+# --- Обработчики ---
+
+@handler("rebuild_aggregates")
+def rebuild_aggregates(payload):
+    """
+    Пересчитывает movie_stats и user_review_stats по таблице reviews.
+    На время пересчета запись отзывов блокируется (SHARE), чтобы счетчики
+    совпали с таблицей на момент фиксации
+    """
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("LOCK TABLE reviews IN SHARE MODE")
+            statements.execute(cursor, "movie_stats_rebuild")
+            movies_updated = cursor.rowcount
+            statements.execute(cursor, "user_stats_clear")
+            statements.execute(cursor, "user_stats_rebuild")
+            users = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    leaderboards.invalidate()
+    return {'movies_updated': movies_updated, 'users': users}
+
+
+@handler("rebuild_rollups")
+def rebuild_rollups(payload):
+    """
+    Пересчитывает дневные и недельные гистограммы оценок
+    """
+    analytics.backfill(payload.get('chunk_size', analytics.CHUNK_SIZE))
+    return {}
+
+
+@handler("refresh_stats")
+def refresh_stats(payload):
+    """
+    Пересчитывает общую статистику для /api/v1/stats
+    """
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "site_stats_refresh")
+            stats = _row_dict(cursor, cursor.fetchone())
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    logger.info("Статистика пересчитана", extra={'total_movies': stats['total_movies'], 'total_reviews': stats['total_reviews']})
+    return stats
+
+
+@handler("warm_cache")
+def warm_cache(payload):
+    """
+    Заново загружает рейтинги: прогревает буферы PostgreSQL и событием
+    warm_cache просит каждый воркер веб-приложения прогреть свои кеши
+    (задачу выполняет только один процесс, а кеши у каждого свои)
+    """
+    leaderboards.invalidate()
+    connection = database.get_read_connection()
+    try:
+        with connection.cursor() as cursor:
+            leaderboards.global_mean(cursor)
+            leaderboards.most_reviewed(cursor)
+            leaderboards.top_rated(cursor)
+            for genre in models.Genre:
+                leaderboards.top_rated(cursor, genre=genre.value)
+    finally:
+        connection.close()
+    
+    # NOTIFY отправляется только с primary
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (events.CHANNEL, json.dumps({'type': 'warm_cache'})))
+        connection.commit()
+    finally:
+        connection.close()
+    return {'genres': len(models.Genre)}
+
+
+@handler("rebuild_recommendations")
+def rebuild_recommendations(payload):
+    """
+    Строит индекс рекомендаций и сохраняет его в файл, который загружают
+    воркеры веб-приложения и бот (app/recommendations.py)
+    """
+    index, load_seconds = recommendations.rebuild(database.get_read_connection, cpu_pool())
+    return {
+        'movies': len(index),
+        'load_seconds': round(load_seconds, 2),
+        'build_seconds': round(index.build_seconds, 2),
+        'path': recommendations.INDEX_PATH
+    }
+
+
+@handler("export_reviews")
+def export_reviews(payload):
+    """
+    Выгружает отзывы (все или одного фильма, payload.movie_id) в CSV
+    в каталог JOBS_EXPORT_DIR
+    """
+    movie_id = payload.get('movie_id')
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"reviews_{movie_id or 'all'}_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+    connection = database.get_read_connection()
+    try:
+        with connection.cursor() as cursor, open(path + ".tmp", "w", encoding="utf-8") as output:
+            # COPY TO STDOUT не сообщает число строк (rowcount = -1): его
+            # считает отдельный запрос в том же снимке данных
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            condition = cursor.mogrify("%s::int IS NULL OR movie_id = %s::int", (movie_id, movie_id)).decode()
+            cursor.copy_expert(f"""
+                COPY (
+                    SELECT id, movie_id, user_name, rating, review_text, created_at
+                    FROM reviews
+                    WHERE {condition}
+                    ORDER BY id
+                ) TO STDOUT WITH CSV HEADER
+            """, output)
+            cursor.execute(f"SELECT COUNT(*) FROM reviews WHERE {condition}")
+            rows = cursor.fetchone()[0]
+        os.replace(path + ".tmp", path)
+    finally:
+        connection.close()
+    return {'path': path, 'rows': rows}
+
+
+@handler("purge_movie")
+def purge_movie(payload):
+    """
+    Удаляет отзывы скрытого фильма (payload.movie_id) пачками по одной
+    транзакции, затем сам фильм. Каждая пачка держит блокировки недолго,
+    а пауза между пачками дает репликам и autovacuum успеть за удалением.
+    Задачу можно перезапустить: она продолжает с оставшихся отзывов
+    """
+    movie_id = payload['movie_id']
+    batch_size = payload.get('batch_size', PURGE_BATCH_SIZE)
+    started = time.perf_counter()
+    deleted = 0
+    connection = database.get_db_connection()
+    try:
+        while True:
+            with connection.cursor() as cursor:
+                # Без события на каждый удаленный отзыв (migrations/009_soft_delete.sql)
+                cursor.execute("SET LOCAL app.bulk_delete = 'on'")
+                statements.execute(cursor, "movie_reviews_purge_batch", (movie_id, batch_size))
+                count = cursor.fetchone()[0]
+            connection.commit()
+            deleted += count
+            if count < batch_size:
+                break
+            time.sleep(PURGE_BATCH_PAUSE)
+
+        # Отзывы, добавленные после последней пачки, удалит каскад
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL app.bulk_delete = 'on'")
+            statements.execute(cursor, "movie_purge", (movie_id,))
+            statements.execute(cursor, "movie_deletion_finish", (movie_id,))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    seconds = time.perf_counter() - started
+    logger.info("Фильм удален", extra={'movie_id': movie_id, 'deleted_reviews': deleted, 'seconds': round(seconds, 2)})
+    return {'movie_id': movie_id, 'deleted_reviews': deleted, 'seconds': round(seconds, 2)}
+
+
+@handler("notify_subscribers")
+def notify_subscribers(payload):
+    """
+    Ставит уведомления бота подписчикам фильмов payload.movie_ids (или
+    всех фильмов), у которых изменились отзывы или рейтинг. Отправляет
+    их бот (bot/notify.py). Повторный запуск не дублирует уведомлений
+    """
+    movie_ids = payload.get('movie_ids')
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            if movie_ids is None:
+                statements.execute(cursor, "subscriptions_enqueue_all")
+                queued = cursor.rowcount
+                statements.execute(cursor, "notification_outbox_purge", (RETENTION_DAYS,))
+            else:
+                statements.execute(cursor, "subscriptions_enqueue", (movie_ids,))
+                queued = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return {'movies': len(movie_ids) if movie_ids is not None else None, 'queued': queued}
+
+
+@handler("dedup_backfill")
+def dedup_backfill(payload):
+    """
+    Подписи MinHash и пометки дубликатов для уже существующих отзывов
+    (payload.after_id - продолжить после этого ID)
+    """
+    return dedup.backfill(payload.get('batch_size', dedup.BACKFILL_BATCH_SIZE), payload.get('after_id', 0))
+
+
+# --- Очередь ---
+
+def enqueue(cursor, kind, payload=None, dedupe_key=None, delay=0, max_attempts=MAX_ATTEMPTS):
+    """
+    Ставит задачу в очередь в транзакции курсора. Возвращает ID задачи
+    или None, если задача с таким dedupe_key уже была поставлена
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Неизвестная задача: {kind}")
+    statements.execute(cursor, "job_enqueue", (kind, json.dumps(payload or {}), dedupe_key, max_attempts, delay))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def submit(kind, payload=None, **kwargs):
+    """
+    Ставит задачу в очередь в отдельной транзакции
+    """
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            job_id = enqueue(cursor, kind, payload, **kwargs)
+        connection.commit()
+        return job_id
+    finally:
+        connection.close()
+
+
+def get_job(cursor, job_id):
+    statements.execute(cursor, "job_by_id", (job_id,))
+    row = cursor.fetchone()
+    return _row_dict(cursor, row) if row else None
+
+
+def queue_depth(cursor):
+    """
+    Количество ожидающих и выполняемых задач по видам и возраст самой
+    старой из них, сек
+    """
+    statements.execute(cursor, "jobs_depth")
+    return [_row_dict(cursor, row) for row in cursor.fetchall()]
+
+
+def _execute(name, params=(), fetch=False):
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            statements.execute(cursor, name, params)
+            row = cursor.fetchone() if fetch else None
+        connection.commit()
+        return row
+    finally:
+        connection.close()
+
+
+class JobMetrics:
+    """Счетчики и длительность выполненных задач текущего процесса"""
+
+    def __init__(self):
+        self.kinds = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, outcome, seconds):
+        with self._lock:
+            entry = self.kinds.setdefault(kind, {
+                'succeeded': 0, 'retried': 0, 'failed': 0,
+                'total_seconds': 0.0, 'max_seconds': 0.0, 'last_seconds': 0.0
+            })
+            entry[outcome] += 1
+            entry['total_seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['last_seconds'] = seconds
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for kind, entry in self.kinds.items():
+                runs = entry['succeeded'] + entry['retried'] + entry['failed']
+                snapshot[kind] = dict(entry, avg_seconds=entry['total_seconds'] / runs if runs else 0.0)
+            return snapshot
+
+
+metrics = JobMetrics()
+
+
+class Worker:
+    """
+    Асинхронный воркер: concurrency циклов выборки задач, обслуживание
+    очереди и планировщик периодических задач
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, schedule=None):
+        self.concurrency = concurrency
+        self.schedule = {kind: interval for kind, interval in (SCHEDULE if schedule is None else schedule).items() if interval > 0}
+        self.running = {}
+        self._tasks = []
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+        if self.schedule:
+            self._tasks.append(asyncio.create_task(self._plan()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _consume(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(_execute, "job_claim", (LEASE_SECONDS,), True)
+                if job is None:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    continue
+                await self._run(*job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка воркера задач: %s", e)
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def _run(self, job_id, kind, payload, attempts, max_attempts):
+        func = HANDLERS.get(kind)
+        started = time.perf_counter()
+        self.running[job_id] = kind
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            if func is None:
+                raise ValueError(f"Неизвестная задача: {kind}")
+            with tracing.span(f"job {kind}", **{"job.id": job_id, "job.attempt": attempts}):
+                result = await asyncio.to_thread(func, payload or {})
+        except Exception as e:
+            delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+            status = await asyncio.to_thread(_execute, "job_fail", (job_id, f"{type(e).__name__}: {e}", delay), True)
+            outcome = 'retried' if status and status[0] == 'queued' else 'failed'
+            metrics.record(kind, outcome, time.perf_counter() - started)
+            logger.error("Задача %s #%s не выполнена: %s", kind, job_id, e,
+                         extra={'job_id': job_id, 'kind': kind, 'attempts': attempts, 'max_attempts': max_attempts, 'outcome': outcome})
+        else:
+            await asyncio.to_thread(_execute, "job_complete", (job_id, json.dumps(result, default=str)))
+            metrics.record(kind, 'succeeded', time.perf_counter() - started)
+        finally:
+            heartbeat.cancel()
+            self.running.pop(job_id, None)
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            try:
+                await asyncio.to_thread(_execute, "job_extend", (job_id, LEASE_SECONDS))
+            except Exception as e:
+                logger.error("Не удалось продлить аренду задачи #%s: %s", job_id, e)
+
+    async def _maintain(self):
+        while True:
+            try:
+                await asyncio.to_thread(_execute, "jobs_requeue_expired")
+                await asyncio.to_thread(_execute, "jobs_purge", (RETENTION_DAYS,))
+            except Exception as e:
+                logger.error("Ошибка обслуживания очереди задач: %s", e)
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+    async def _plan(self):
+        # Ключ включает номер интервала, поэтому за интервал задача
+        # ставится один раз, сколько бы процессов ни планировало
+        planned = {}
+        while True:
+            now = time.time()
+            for kind, interval in self.schedule.items():
+                dedupe_key = f"{kind}:{int(now // interval)}"
+                if planned.get(kind) == dedupe_key:
+                    continue
+                try:
+                    await asyncio.to_thread(submit, kind, dedupe_key=dedupe_key)
+                    planned[kind] = dedupe_key
+                except Exception as e:
+                    logger.error("Не удалось запланировать задачу %s: %s", kind, e)
+            await asyncio.sleep(min(10, min(self.schedule.values())))
+
+
+# Воркер процесса
+worker = Worker()
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+
+
+def cpu_pool():
+    """
+    Пул процессов для CPU-тяжелых вычислений. Процессы запускаются
+    через spawn: fork многопоточного процесса небезопасен
+    """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor(
+                max_workers=CPU_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _cpu_pool
+
+
+def shutdown_cpu_pool():
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is not None:
+            _cpu_pool.shutdown(cancel_futures=True)
+            _cpu_pool = None
+
+
+async def run_worker(concurrency):
+    standalone = Worker(concurrency)
+    await standalone.start()
+    logger.info("Воркер задач запущен", extra={'concurrency': concurrency, 'kinds': sorted(HANDLERS)})
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await standalone.stop()
+
+
+BENCH_KIND = "bench_noop"
+
+
+def _bench_noop(payload):
+    time.sleep(payload.get('seconds', 0))
+    return {}
+
+
+def _bench_query(sql, params=()):
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone() if cursor.description else None
+        connection.commit()
+        return row
+    finally:
+        connection.close()
+
+
+def _bench_enqueue(count, work_seconds):
+    _bench_query("""
+        INSERT INTO jobs (kind, payload, max_attempts)
+        SELECT %s, %s, 1 FROM generate_series(1, %s)
+    """, (BENCH_KIND, json.dumps({'seconds': work_seconds}), count))
+
+
+async def _bench_claims(concurrency):
+    """
+    Время выборки (job_claim) при concurrency параллельных воркерах,
+    пока очередь не опустеет
+    """
+    timings = []
+
+    async def claim():
+        while True:
+            started = time.perf_counter()
+            job = await asyncio.to_thread(_execute, "job_claim", (LEASE_SECONDS,), True)
+            if job is None:
+                return
+            timings.append((time.perf_counter() - started) * 1000)
+            await asyncio.to_thread(_execute, "job_complete", (job[0], "{}"))
+
+    await asyncio.gather(*(claim() for _ in range(concurrency)))
+    timings.sort()
+    return timings
+
+
+async def _bench_round(count, concurrency, work_seconds):
+    # Пропускная способность настоящего воркера
+    await asyncio.to_thread(_bench_enqueue, count, work_seconds)
+    bench_worker = Worker(concurrency, schedule={})
+    started = time.perf_counter()
+    await bench_worker.start()
+    try:
+        while True:
+            remaining = (await asyncio.to_thread(_bench_query, """
+                SELECT COUNT(*) FROM jobs WHERE kind = %s AND status IN ('queued', 'running')
+            """, (BENCH_KIND,)))[0]
+            if not remaining:
+                break
+            await asyncio.sleep(0.05)
+        seconds = time.perf_counter() - started
+    finally:
+        await bench_worker.stop()
+    failed = (await asyncio.to_thread(_bench_query, """
+        SELECT COUNT(*) FROM jobs WHERE kind = %s AND status = 'failed'
+    """, (BENCH_KIND,)))[0]
+    await asyncio.to_thread(_bench_query, "DELETE FROM jobs WHERE kind = %s", (BENCH_KIND,))
+
+    # Задержка выборки при той же конкуренции за очередь
+    await asyncio.to_thread(_bench_enqueue, count, 0)
+    timings = await _bench_claims(concurrency)
+    await asyncio.to_thread(_bench_query, "DELETE FROM jobs WHERE kind = %s", (BENCH_KIND,))
+    return {
+        'throughput': count / seconds,
+        'claim_p50_ms': timings[len(timings) // 2],
+        'claim_p99_ms': timings[int(len(timings) * 0.99) - 1],
+        'failed': failed,
+    }
+
+
+async def _bench(count, concurrency_values, work_seconds):
+    HANDLERS[BENCH_KIND] = _bench_noop
+    print(f"{'Воркеров':>10}{'Задач/с':>12}{'Выборка p50, мс':>18}{'p99, мс':>10}{'Ошибок':>8}")
+    try:
+        for concurrency in concurrency_values:
+            result = await _bench_round(count, concurrency, work_seconds)
+            print(f"{concurrency:>10}{result['throughput']:>12.0f}{result['claim_p50_ms']:>18.2f}"
+                  f"{result['claim_p99_ms']:>10.2f}{result['failed']:>8}")
+    finally:
+        await asyncio.to_thread(_bench_query, "DELETE FROM jobs WHERE kind = %s", (BENCH_KIND,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фоновые задачи")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker_parser = subparsers.add_parser("worker", help="запустить воркер")
+    worker_parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    enqueue_parser = subparsers.add_parser("enqueue", help="поставить задачу в очередь")
+    enqueue_parser.add_argument("kind", choices=sorted(HANDLERS))
+    enqueue_parser.add_argument("--payload", default="{}", help="параметры задачи в JSON")
+    bench_parser = subparsers.add_parser("bench", help="замерить пропускную способность очереди")
+    bench_parser.add_argument("--jobs", type=int, default=5000)
+    bench_parser.add_argument("--concurrency", default="1,2,8,32", help="число воркеров через запятую")
+    bench_parser.add_argument("--work-ms", type=float, default=0, help="длительность одной задачи, мс")
+    args = parser.parse_args()
+    log.setup("jobs")
+    tracing.setup("jobs")
+
+    if args.command == "worker":
+        asyncio.run(run_worker(args.concurrency))
+    elif args.command == "enqueue":
+        job_id = submit(args.kind, json.loads(args.payload))
+        print(f"✅ Задача {args.kind} #{job_id} поставлена в очередь")
+    elif args.command == "bench":
+        counts = [int(value) for value in args.concurrency.split(",")]
+        asyncio.run(_bench(args.jobs, counts, args.work_ms / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Рейтинги фильмов (лидерборды) на основе таблицы movie_stats.
+
+Лучшие фильмы ранжируются по байесовскому среднему: оценки фильма с малым
+числом отзывов "подтягиваются" к общему среднему, поэтому один отзыв
+на 10 не выводит фильм на первое место.
+
+Функции принимают любой DB-API курсор с параметрами в стиле %s
+(psycopg2 в веб-приложении, pg8000 в боте). Результаты кешируются
+в памяти процесса на LEADERBOARD_CACHE_TTL секунд.
+
+Запись отзыва кеш не трогает: в веб-приложении каждый воркер получает
+событие movie_stats (app/events.py) и обновляет запись фильма в
+загруженных рейтингах на месте - по счетчикам оценок из события.
+Рейтинг загружается заново, только если состав первых N мог
+измениться так, что его не восстановить по событию: фильм выпал из
+списка или, наоборот, может в него войти (названия и режиссера фильма
+вне списка в событии нет). Общее среднее одним отзывом почти не
+меняется и обновляется по TTL, как и весь кеш бота.
+"""
+
+import json
+import os
+
+from app.cache import TTLCache
+
+# Минимальное число отзывов для попадания в рейтинг
+MIN_REVIEWS = int(os.getenv('LEADERBOARD_MIN_REVIEWS', '3'))
+# Вес общего среднего в байесовской оценке (в "виртуальных" отзывах)
+PRIOR_WEIGHT = int(os.getenv('LEADERBOARD_PRIOR_WEIGHT', '10'))
+CACHE_TTL = int(os.getenv('LEADERBOARD_CACHE_TTL', '60'))
+MAX_LIMIT = 100
+
+_cache = TTLCache("leaderboards", CACHE_TTL)
+
+TOP_RATED_SQL = """
+WITH global AS (
+    SELECT COALESCE(SUM(rating_sum)::float / NULLIF(SUM(review_count), 0), 0) as mean
+    FROM movie_stats
+)
+SELECT m.id, m.title, m.director, m.release_year, m.genre,
+       s.review_count,
+       s.rating_sum::float / s.review_count as avg_rating,
+       (s.rating_sum + %s * g.mean) / (s.review_count + %s) as weighted_rating,
+       g.mean as prior_mean
+FROM movie_stats s
+JOIN movies m ON m.id = s.movie_id
+CROSS JOIN global g
+WHERE s.review_count >= %s
+  AND (%s::varchar IS NULL OR m.genre = %s::varchar)
+  AND (%s::int IS NULL OR (m.release_year >= %s::int AND m.release_year < %s::int + 10))
+ORDER BY weighted_rating DESC, s.review_count DESC, m.id
+LIMIT %s
+"""
+
+GLOBAL_MEAN_SQL = """
+SELECT COALESCE(SUM(rating_sum)::float / NULLIF(SUM(review_count), 0), 0)
+FROM movie_stats
+"""
+
+MOST_REVIEWED_SQL = """
+SELECT m.id, m.title, m.director, m.release_year, m.genre,
+       s.review_count,
+       s.rating_sum::float / s.review_count as avg_rating,
+       s.rating_sum::float / s.review_count as weighted_rating
+FROM movie_stats s
+JOIN movies m ON m.id = s.movie_id
+WHERE s.review_count > 0
+ORDER BY s.review_count DESC, m.title
+LIMIT %s
+"""
+
+
+class _Board:
+    """
+    Рейтинг в кеше: записи в порядке запроса и ключи их сортировки по
+    неокругленным значениям (меньше - выше) для обновления на месте.
+    Не изменяется: обновление создает новый рейтинг
+    """
+
+    def __init__(self, kind, limit, min_reviews, entries, keys, mean=0.0):
+        self.kind = kind
+        self.limit = limit
+        self.min_reviews = min_reviews
+        self.entries = entries
+        self.keys = keys
+        self.mean = mean
+
+    def rank_key(self, movie_id, review_count, weighted_rating, position=0):
+        if self.kind == "top_rated":
+            return (-weighted_rating, -review_count, movie_id)
+        # При равном числе отзывов - по названию в порядке сравнения
+        # строк PostgreSQL, который здесь не повторить: остается позиция
+        # из запроса
+        return (-review_count, position)
+
+    def may_enter(self, review_count, weighted_rating):
+        """
+        Фильм вне списка может оказаться в первых N: список не полон или
+        фильм не ниже последнего (равные значения - на всякий случай тоже)
+        """
+        if len(self.entries) < self.limit:
+            return True
+        last = self.keys[self.entries[-1]['id']]
+        if self.kind == "top_rated":
+            return (-weighted_rating, -review_count) <= last[:2]
+        return -review_count <= last[0]
+
+    def update(self, movie_id, review_count, rating_sum):
+        """
+        Рейтинг с новыми счетчиками фильма; None, если его нужно
+        загрузить заново, self - если он не изменился
+        """
+        eligible = review_count >= self.min_reviews and review_count > 0
+        if review_count > 0:
+            avg_rating = rating_sum / review_count
+        else:
+            avg_rating = 0.0
+        if self.kind == "top_rated":
+            weighted_rating = (rating_sum + PRIOR_WEIGHT * self.mean) / (review_count + PRIOR_WEIGHT)
+        else:
+            weighted_rating = avg_rating
+
+        old_key = self.keys.get(movie_id)
+        if old_key is None:
+            if eligible and self.may_enter(review_count, weighted_rating):
+                return None
+            return self
+
+        if not eligible:
+            return None
+        if self.kind == "most_reviewed" and any(
+                key[0] == -review_count for other, key in self.keys.items() if other != movie_id):
+            # Место среди фильмов с тем же числом отзывов зависит от названия
+            return None
+        position = next(i for i, entry in enumerate(self.entries) if entry['id'] == movie_id)
+        entry = dict(self.entries[position], review_count=review_count,
+                     avg_rating=round(avg_rating, 2), weighted_rating=round(weighted_rating, 2))
+        keys = dict(self.keys)
+        keys[movie_id] = new_key = self.rank_key(movie_id, review_count, weighted_rating)
+        entries = self.entries[:position] + self.entries[position + 1:] + [entry]
+        entries.sort(key=lambda item: keys[item['id']])
+        # Фильм опустился на последнее место полного списка: фильм вне
+        # списка мог его обойти
+        if new_key > old_key and len(entries) == self.limit and entries[-1] is entry:
+            return None
+        return _Board(self.kind, self.limit, self.min_reviews, entries, keys, self.mean)
+
+
+def _load_board(cursor, kind, sql, params, limit, min_reviews):
+    cursor.execute(sql, params)
+    columns = [desc[0] for desc in cursor.description]
+    board = _Board(kind, limit, min_reviews, [], {})
+    for row in cursor.fetchall():
+        entry = dict(zip(columns, row))
+        board.mean = float(entry.pop('prior_mean', 0) or 0)
+        weighted_rating = float(entry['weighted_rating'] or 0)
+        board.keys[entry['id']] = board.rank_key(
+            entry['id'], entry['review_count'], weighted_rating, len(board.entries)
+        )
+        entry['avg_rating'] = round(float(entry['avg_rating'] or 0), 2)
+        entry['weighted_rating'] = round(weighted_rating, 2)
+        board.entries.append(entry)
+    return board
+
+
+def _cached(key, loader):
+    return _cache.get_or_load(key, loader)
+
+
+def invalidate():
+    """
+    Сбрасывает кеш рейтингов текущего процесса
+    """
+    _cache.invalidate()
+
+
+def _matches(key, genre, decade):
+    # top_rated: фильтр по жанру и десятилетию, None - без фильтра
+    return key[0] == "most_reviewed" or (key[1] in (None, genre) and key[2] in (None, decade))
+
+
+def _stats_update(movie_id, genre, decade, review_count, rating_counts):
+    rating_sum = sum(rating * count for rating, count in enumerate(rating_counts, start=1))
+
+    def update(key, board):
+        if key[0] == "global_mean":
+            return board
+        if not _matches(key, genre, decade):
+            # Фильм в рейтинге чужого жанра или десятилетия - данные
+            # фильма изменились, список нужно собрать заново
+            return None if movie_id in board.keys else board
+        return board.update(movie_id, review_count, rating_sum)
+    return update
+
+
+def _movie_update(movie_id, genre, decade, event_type):
+    def update(key, board):
+        if key[0] == "global_mean":
+            return board
+        if movie_id in board.keys:
+            return None
+        # Фильм с новым жанром или годом может войти в отфильтрованный
+        # рейтинг; его счетчиков в событии нет
+        if event_type == "movie_updated" and key[0] == "top_rated" and (key[1], key[2]) != (None, None):
+            return None if _matches(key, genre, decade) else board
+        return board
+    return update
+
+
+def on_event(event):
+    """
+    Обработчик шины событий: обновляет запись фильма в рейтингах или
+    сбрасывает рейтинги, первые N которых по событию не восстановить
+    """
+    if event.type not in ("movie_stats", "movie_created", "movie_updated", "movie_deleted"):
+        return
+    message = json.loads(event.data)
+    movie = message.get('movie', message)
+    if 'genre' not in movie or (event.type == "movie_stats" and 'rating_counts' not in message):
+        # Событие без жанра (до migrations/012_stats_event_movie.sql)
+        _cache.invalidate()
+        return
+    year = movie.get('release_year')
+    decade = year // 10 * 10 if year else None
+    if event.type == "movie_stats":
+        _cache.update_where(_stats_update(
+            event.movie_id, movie['genre'], decade, message['review_count'], message['rating_counts']
+        ))
+    else:
+        _cache.update_where(_movie_update(event.movie_id, movie['genre'], decade, event.type))
+
+
+def top_rated(cursor, genre=None, decade=None, min_reviews=None, limit=10):
+    """
+    Лучшие фильмы по байесовскому рейтингу, с фильтром по жанру
+    и/или десятилетию выпуска (1990 - фильмы 1990-1999 годов)
+    """
+    min_reviews = MIN_REVIEWS if min_reviews is None else min_reviews
+    limit = min(limit, MAX_LIMIT)
+    params = (
+        PRIOR_WEIGHT, PRIOR_WEIGHT, min_reviews,
+        genre, genre,
+        decade, decade, decade,
+        limit
+    )
+    return _cached(
+        ("top_rated", genre, decade, min_reviews, limit),
+        lambda: _load_board(cursor, "top_rated", TOP_RATED_SQL, params, limit, min_reviews)
+    ).entries
+
+
+def most_reviewed(cursor, limit=10):
+    """
+    Фильмы с наибольшим количеством отзывов
+    """
+    limit = min(limit, MAX_LIMIT)
+    return _cached(
+        ("most_reviewed", limit),
+        lambda: _load_board(cursor, "most_reviewed", MOST_REVIEWED_SQL, (limit,), limit, 1)
+    ).entries
+
+
+def global_mean(cursor):
+    """
+    Средняя оценка по всем отзывам - априорное среднее байесовского рейтинга
+    """
+    def load():
+        cursor.execute(GLOBAL_MEAN_SQL)
+        return float(cursor.fetchone()[0] or 0)
+    return _cached(("global_mean",), load)
@@ -0,0 +1,264 @@
+"""
+Структурированные логи без блокировки обработчиков.
+
+Записи кладутся в ограниченную очередь (QueueHandler) и пишутся в stdout
+отдельным потоком (QueueListener), поэтому запись лога из обработчика
+запроса или бота не ждет вывода. При переполнении очереди новые записи
+отбрасываются и учитываются в счетчике, а не блокируют вызывающего.
+
+Каждая запись - одна строка JSON (LOG_FORMAT=json, по умолчанию) с
+идентификатором корреляции: X-Request-ID запроса веб-приложения или
+chat:<id>:<update> для бота. Поля из extra={...} попадают в JSON как есть.
+
+Частые события (журнал запросов и т.п.) прореживаются по имени логгера:
+LOG_SAMPLE="app.access=0.1" пропускает 10% записей уровня INFO и ниже;
+предупреждения и ошибки пишутся всегда.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json - строка JSON на запись, text - читаемый формат для разработки
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+
+def _parse_sample_rates(value):
+    # "app.access=0.1,app.events=0.01" -> {"app.access": 0.1, ...}
+    rates = {}
+    for item in (value or "").split(","):
+        name, _, rate = item.strip().partition("=")
+        if name and rate:
+            rates[name] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _parse_sample_rates(os.getenv('LOG_SAMPLE', 'app.access=0.1'))
+
+_correlation_id = ContextVar("correlation_id", default=None)
+
+# Атрибуты LogRecord, которые не являются полями extra
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "correlation_id"}
+
+counters = {'dropped': 0, 'sampled_out': 0}
+
+
+def set_correlation_id(value):
+    """
+    Задает идентификатор корреляции для текущего запроса или обновления бота
+    """
+    return _correlation_id.set(value)
+
+
+def get_correlation_id():
+    return _correlation_id.get()
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Добавляет в запись идентификатор корреляции из контекста; фильтр
+    выполняется в потоке вызова, до очереди
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "correlation_id"):
+            record.correlation_id = _correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю записей INFO и ниже для логгеров из rates
+    (и их потомков); WARNING и выше проходят всегда
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def _rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        counters['sampled_out'] += 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога как одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.correlation_id:
+            entry['correlation_id'] = record.correlation_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись"""
+
+    def prepare(self, record):
+        # Сообщение и трассировка вычисляются в потоке вызова (аргументы
+        # могут измениться позже), а форматирует запись поток вывода
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            counters['dropped'] += 1
+
+
+access_logger = logging.getLogger("app.access")
+
+
+class CorrelationMiddleware:
+    """
+    ASGI middleware: идентификатор корреляции запроса (X-Request-ID клиента
+    или новый), заголовок X-Request-ID в ответе и строка журнала запросов
+    """
+
+    def __init__(self, app, header="x-request-id"):
+        self.app = app
+        self.header = header.encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers") or ():
+            if name == self.header:
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = _correlation_id.set(request_id)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(self.header, request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            access_logger.log(
+                logging.WARNING if status >= 500 else logging.INFO,
+                "%s %s %s", scope["method"], scope["path"], status,
+                extra={
+                    'method': scope["method"],
+                    'path': scope["path"],
+                    'status': status,
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+                }
+            )
+            _correlation_id.reset(token)
+
+
+_listener = None
+_queue = None
+
+
+def setup(service):
+    """
+    Настраивает корневой логгер процесса: очередь, фоновый вывод,
+    формат и прореживание. Повторный вызов ничего не делает
+    """
+    global _listener, _queue
+    if _listener is not None:
+        return
+
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s')
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    _queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(_queue)
+    handler.addFilter(CorrelationFilter())
+    handler.addFilter(SamplingFilter(SAMPLE_RATES))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    # Сервис в каждой записи: веб-приложение и бот пишут в общий поток
+    logging.setLogRecordFactory(_record_factory(logging.getLogRecordFactory(), service))
+
+    _listener = logging.handlers.QueueListener(_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def _record_factory(factory, service):
+    def create(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.service = service
+        return record
+    return create
+
+
+def shutdown():
+    """
+    Дописывает оставшиеся в очереди записи и останавливает поток вывода
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats():
+    return {
+        'queued': _queue.qsize() if _queue is not None else 0,
+        'dropped': counters['dropped'],
+        'sampled_out': counters['sampled_out']
+    }
+
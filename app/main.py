@@ -2,10 +2,31 @@ from fastapi import FastAPI, Request, Form
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
+import asyncio
+import logging
 import os
+import time
 
-from app.routers import movies, reviews, users
-from app.database import init_db, test_connection, get_db_connection
+from app.routers import movies, reviews, users, leaderboards, recommendations, analytics, events, admin
+from app import aggregates, cache, catalogue, deadlines, dedup, jobs, log, memory, models, profiler, ratelimit, statements, subscriptions, tracing
+from app import leaderboards as leaderboard_cache
+from app import recommendations as recommendation_index
+from app.events import bus as event_bus
+from app.database import init_db, test_connection, get_db_connection, get_read_connection, prefer_primary, db
+
+# Сколько секунд после записи клиент читает с primary (read-your-writes)
+READ_YOUR_WRITES_SECONDS = int(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '10'))
+READ_YOUR_WRITES_COOKIE = "db_primary_until"
+# Размер HTML-страниц: фильмов на главной и последних отзывов на странице
+# фильма; память на запрос не зависит от размера каталога
+HOME_PAGE_MOVIES = int(os.getenv('HOME_PAGE_MOVIES', '100'))
+MOVIE_PAGE_REVIEWS = int(os.getenv('MOVIE_PAGE_REVIEWS', '50'))
+
+log.setup("web")
+tracing.setup("web")
+if memory.MEMORY_TRACKING:
+    memory.start()
+logger = logging.getLogger(__name__)
 
 os.makedirs("templates", exist_ok=True)
 os.makedirs("static/css", exist_ok=True)
@@ -18,44 +39,261 @@ app = FastAPI(
     docs_url="/api/docs",
     redoc_url="/api/redoc"
 )
+# Маршруты приложения и роутеров выполняются в спанах трассировки
+app.router.route_class = tracing.TracedRoute
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+templates = tracing.trace_templates(Jinja2Templates(directory="templates"))
+
+# Кеши HTML-страниц; страница фильма сбрасывается по событиям этого фильма
+home_cache = cache.TTLCache("home", cache.PAGE_TTL, max_entries=50)
+movie_page_cache = cache.TTLCache("movie_pages", cache.PAGE_TTL, max_entries=500)
+
+@app.middleware("http")
+async def read_your_writes_middleware(request: Request, call_next):
+    """
+    После изменяющего запроса клиент некоторое время читает с primary,
+    чтобы сразу видеть свои записи, даже если реплики отстают
+    """
+    try:
+        primary_until = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+    prefer_primary(primary_until > time.time())
+    
+    response = await call_next(request)
+    
+    if request.method not in ("GET", "HEAD", "OPTIONS") and db.replicas.endpoints:
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE,
+            str(time.time() + READ_YOUR_WRITES_SECONDS),
+            max_age=READ_YOUR_WRITES_SECONDS,
+            httponly=True
+        )
+    return response
+
+# Пути без ограничений: статика, документация и служебные эндпоинты
+UNLIMITED_PREFIXES = ("/static", "/api/docs", "/api/redoc", "/openapi.json", "/api/v1/admin")
+# Долгие потоки событий ограничиваются по частоте, но не занимают слот БД
+STREAMING_PREFIXES = ("/api/v1/events",)
+
+@app.middleware("http")
+async def protection_middleware(request: Request, call_next):
+    """
+    Ограничение частоты запросов клиента и контроль допуска к БД
+    """
+    path = request.url.path
+    if not ratelimit.RATE_LIMIT_ENABLED or path.startswith(UNLIMITED_PREFIXES):
+        return await call_next(request)
+    
+    group, priority = ratelimit.classify(request.method, path, request.headers.get("user-agent", ""))
+    retry_after = ratelimit.limiter.check(ratelimit.client_address(request), group)
+    if retry_after:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Слишком много запросов, повторите позже"},
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+    
+    if path.startswith(STREAMING_PREFIXES):
+        return await call_next(request)
+    
+    # Допуск на весь запрос, а не на подключение - см. app/ratelimit.py
+    try:
+        await ratelimit.admission.acquire(priority)
+    except ratelimit.Overloaded as e:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Сервер перегружен, повторите позже"},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    started = time.monotonic()
+    try:
+        return await call_next(request)
+    finally:
+        ratelimit.admission.release(time.monotonic() - started)
+
+# Срок запроса (включая ожидание допуска) и отмена запросов к БД при
+# отключении клиента; потоки событий живут долго и не ограничиваются
+app.add_middleware(deadlines.DeadlineMiddleware, skip_prefixes=("/static",) + STREAMING_PREFIXES)
+
+# Память по маршрутам (пока tracemalloc выключен, не делает ничего)
+app.add_middleware(memory.MemoryMiddleware, skip_prefixes=("/static",) + STREAMING_PREFIXES)
+
+# Корневой спан запроса охватывает все middleware ниже, включая ожидание допуска
+app.add_middleware(tracing.TracingMiddleware, skip_prefixes=("/static",) + STREAMING_PREFIXES)
+
+# Добавляется последним, поэтому выполняется первым: идентификатор
+# корреляции есть у всех записей лога запроса, включая отказы 429/503
+app.add_middleware(log.CorrelationMiddleware)
+
+async def check_replicas_periodically():
+    """Периодическая проверка реплик в фоне"""
+    while True:
+        await asyncio.to_thread(db.replicas.check)
+        await asyncio.sleep(db.replicas.retry_interval)
+
+async def refresh_recommendations_periodically():
+    """
+    Загрузка индекса рекомендаций, который строит задача
+    rebuild_recommendations; если файла еще нет, задача ставится сразу
+    """
+    if not os.path.exists(recommendation_index.INDEX_PATH):
+        try:
+            await asyncio.to_thread(jobs.submit, "rebuild_recommendations", dedupe_key="rebuild_recommendations:initial")
+        except Exception as e:
+            logger.error("Не удалось поставить построение индекса рекомендаций: %s", e)
+    loaded = None
+    while True:
+        try:
+            index = await asyncio.to_thread(recommendation_index.refresh)
+            if index is not None and index is not loaded:
+                loaded = index
+                logger.info("Индекс рекомендаций загружен", extra={'movies': len(index), 'built_at': index.built_at})
+        except Exception as e:
+            logger.error("Ошибка загрузки индекса рекомендаций: %s", e)
+        await asyncio.sleep(recommendation_index.RELOAD_INTERVAL)
+
+async def refresh_catalogue_periodically():
+    """Перезагрузка снимка каталога после изменений фильмов и по расписанию"""
+    while True:
+        if catalogue.needs_reload():
+            try:
+                snapshot = await asyncio.to_thread(catalogue.reload, get_read_connection)
+                home_cache.invalidate()
+                logger.info("Снимок каталога загружен", extra={'movies': len(snapshot), 'seconds': round(catalogue.counters['reload_seconds'], 2)})
+            except Exception as e:
+                logger.error("Ошибка загрузки снимка каталога: %s", e)
+                await asyncio.sleep(min(catalogue.REFRESH_INTERVAL, 30))
+        await asyncio.sleep(catalogue.RELOAD_DELAY)
+
+async def notify_subscribers_periodically():
+    """Задачи уведомлений подписчиков бота по изменившимся фильмам"""
+    while True:
+        await asyncio.sleep(subscriptions.NOTIFY_FLUSH_INTERVAL)
+        movie_ids = subscriptions.take()
+        if not movie_ids:
+            continue
+        try:
+            await asyncio.to_thread(subscriptions.submit, movie_ids)
+        except Exception as e:
+            subscriptions.restore(movie_ids)
+            logger.error("Не удалось поставить уведомления подписчикам: %s", e)
+
+def invalidate_movie_page(event):
+    if event.movie_id is not None:
+        movie_page_cache.invalidate(event.movie_id)
+
+def warm_up_on_event(event):
+    """
+    Прогрев кешей процесса по событию задачи warm_cache: задачу выполняет
+    один процесс, а событие получают все воркеры
+    """
+    if event.type != 'warm_cache' or not cache.WARMUP_ENABLED:
+        return
+    task = getattr(app.state, 'warm_up_task', None)
+    if task is not None and not task.done():
+        return
+    app.state.warm_up_task = asyncio.get_running_loop().create_task(warm_up_in_background())
+
+async def warm_up_in_background():
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception as e:
+        logger.warning("Прогрев кешей не завершен: %r", e)
+
+def warm_up():
+    """
+    Предзагрузка кешей до приема запросов: главная страница, статистика,
+    рейтинги и страницы самых обсуждаемых фильмов
+    """
+    started = time.perf_counter()
+    home_cache.get_or_load(1, load_home_movies)
+    users.stats_cache.get_or_load("stats", users.load_stats)
+    
+    connection = get_read_connection()
+    try:
+        with connection.cursor() as cursor:
+            leaderboard_cache.global_mean(cursor)
+            leaderboard_cache.top_rated(cursor)
+            hottest = leaderboard_cache.most_reviewed(cursor, limit=cache.WARMUP_MOVIES)
+    finally:
+        connection.close()
+    
+    for movie in hottest:
+        movie_page_cache.get_or_load(movie['id'], lambda movie_id=movie['id']: load_movie_page(movie_id))
+    logger.info("Кеши прогреты", extra={'seconds': round(time.perf_counter() - started, 2), 'movies': len(hottest)})
 
 @app.on_event("startup")
 async def startup_event():
-    print("Запуск Movie Reviews API...")
+    logger.info("Запуск Movie Reviews API")
+    # Профилирование: метки маршрутов в стеках и запуск по SIGUSR2
+    profiler.register_routes(app.routes)
+    profiler.install_signal_handler("web")
     if test_connection():
-        print("Подключение к базе данных успешно")
+        logger.info("Подключение к базе данных успешно")
         init_db()
     else:
-        print(" Не удалось подключиться к базе данных")
+        logger.error("Не удалось подключиться к базе данных")
+    
+    if db.replicas.endpoints:
+        logger.info("Реплики для чтения: %d", len(db.replicas.endpoints))
+        app.state.replica_check_task = asyncio.create_task(check_replicas_periodically())
+    
+    app.state.recommendations_task = asyncio.create_task(refresh_recommendations_periodically())
+    event_bus.listeners.append(invalidate_movie_page)
+    event_bus.listeners.append(leaderboard_cache.on_event)
+    event_bus.listeners.append(warm_up_on_event)
+    if catalogue.CATALOGUE_ENABLED:
+        event_bus.listeners.append(catalogue.on_event)
+        app.state.catalogue_task = asyncio.create_task(refresh_catalogue_periodically())
+    if subscriptions.NOTIFY_ENABLED:
+        event_bus.listeners.append(subscriptions.on_event)
+        app.state.notify_task = asyncio.create_task(notify_subscribers_periodically())
+    await event_bus.start()
+    
+    if cache.WARMUP_ENABLED:
+        try:
+            await asyncio.wait_for(asyncio.to_thread(warm_up), cache.WARMUP_TIMEOUT)
+        except Exception as e:
+            logger.warning("Прогрев кешей не завершен: %r", e)
     
-    print("Приложение готово к работе")
+    if jobs.RUN_IN_APP:
+        await jobs.worker.start()
+    
+    logger.info("Приложение готово к работе")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await event_bus.stop()
+    await jobs.worker.stop()
+    jobs.shutdown_cpu_pool()
 
 # Подключаем роутеры
 app.include_router(movies.router, prefix="/api/v1", tags=["movies"])
 app.include_router(reviews.router, prefix="/api/v1", tags=["reviews"])
 app.include_router(users.router, prefix="/api/v1", tags=["users"])
+app.include_router(leaderboards.router, prefix="/api/v1", tags=["leaderboards"])
+app.include_router(recommendations.router, prefix="/api/v1", tags=["recommendations"])
+app.include_router(analytics.router, prefix="/api/v1", tags=["analytics"])
+app.include_router(events.router, prefix="/api/v1", tags=["events"])
+app.include_router(admin.router, prefix="/api/v1", tags=["admin"])
 
 # Веб-эндпоинты для HTML страниц
-@app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request):
-    """Главная страница со списком фильмов"""
-    connection = None
+def load_home_movies(page=1):
+    """
+    Страница фильмов главной, отсортированных по рейтингу; на одну
+    строку больше размера страницы, чтобы знать, есть ли следующая
+    """
+    skip = (page - 1) * HOME_PAGE_MOVIES
+    snapshot = catalogue.get_snapshot()
+    if snapshot is not None:
+        return snapshot.summaries(snapshot.query(order="rating", skip=skip, limit=HOME_PAGE_MOVIES + 1))
+    
+    connection = get_read_connection()
     try:
-        connection = get_db_connection()
         with connection.cursor() as cursor:
-            sql = """
-            SELECT m.id, m.title, m.director, m.release_year, m.genre,
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            GROUP BY m.id, m.title, m.director, m.release_year, m.genre
-            ORDER BY avg_rating DESC
-            """
-            cursor.execute(sql)
+            statements.execute(cursor, "movies_summary_by_rating_page", (HOME_PAGE_MOVIES + 1, skip))
             movies_tuples = cursor.fetchall()
             
             # Преобразуем кортежи в словари
@@ -70,10 +308,22 @@ async def read_root(request: Request):
                     'avg_rating': round(float(movie[5] or 0), 1),
                     'review_count': movie[6]
                 })
-            
+        return movies_list
+    finally:
+        connection.close()
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request, page: int = 1):
+    """Главная страница со списком фильмов"""
+    try:
+        page = max(page, 1)
+        movies_list = await home_cache.aget_or_load(page, lambda: load_home_movies(page))
+        
         return templates.TemplateResponse("index.html", {
             "request": request, 
-            "movies": movies_list
+            "movies": movies_list[:HOME_PAGE_MOVIES],
+            "page": page,
+            "has_next": len(movies_list) > HOME_PAGE_MOVIES
         })
     
     except Exception as e:
@@ -81,10 +331,6 @@ async def read_root(request: Request):
             "request": request,
             "error": f"Ошибка сервера: {str(e)}"
         })
-    
-    finally:
-        if connection:
-            connection.close()
 
 @app.get("/add-movie", response_class=HTMLResponse)
 async def add_movie_form(request: Request):
@@ -94,7 +340,7 @@ async def add_movie_form(request: Request):
     })
 
 @app.post("/add-movie")
-async def add_movie_submit(
+def add_movie_submit(
     request: Request,
     title: str = Form(...),
     director: str = Form(...),
@@ -107,17 +353,13 @@ async def add_movie_submit(
     try:
         connection = get_db_connection()
         with connection.cursor() as cursor:
-            sql = """
-            INSERT INTO movies (title, director, release_year, genre, description)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-            """
-            cursor.execute(sql, (
+            statements.execute(cursor, "movie_insert", (
                 title.strip(),
                 director.strip(),
                 release_year,
                 genre if genre else None,
-                description.strip() if description else None
+                description.strip() if description else None,
+                None
             ))
             
             movie_id = cursor.fetchone()[0]
@@ -137,22 +379,17 @@ async def add_movie_submit(
         if connection:
             connection.close()
 
-@app.get("/movies/{movie_id}", response_class=HTMLResponse)
-async def get_movie_detail(request: Request, movie_id: int):
-    """Страница фильма с детальной информацией и отзывами"""
-    connection = None
+def load_movie_page(movie_id):
+    """Фильм с распределением оценок и его отзывы или None, если фильма нет"""
+    connection = get_read_connection()
     try:
-        connection = get_db_connection()
         with connection.cursor() as cursor:
             # Получаем информацию о фильме
-            cursor.execute("SELECT * FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_by_id", (movie_id,))
             movie_tuple = cursor.fetchone()
             
             if not movie_tuple:
-                return templates.TemplateResponse("error.html", {
-                    "request": request,
-                    "error": "Фильм не найден"
-                })
+                return None
             
             # Преобразуем кортеж в словарь
             movie = {
@@ -164,12 +401,8 @@ async def get_movie_detail(request: Request, movie_id: int):
                 'description': movie_tuple[5]
             }
             
-            # Получаем отзывы
-            cursor.execute("""
-                SELECT * FROM reviews 
-                WHERE movie_id = %s 
-                ORDER BY created_at DESC
-            """, (movie_id,))
+            # Последние отзывы; остальные доступны через API с пагинацией
+            statements.execute(cursor, "reviews_by_movie_latest", (movie_id, MOVIE_PAGE_REVIEWS))
             reviews_tuples = cursor.fetchall()
             
             # Преобразуем отзывы
@@ -184,15 +417,32 @@ async def get_movie_detail(request: Request, movie_id: int):
                     'created_at': review[5]
                 })
             
-            # Средний рейтинг и количество отзывов
-            cursor.execute("""
-                SELECT AVG(rating) as avg_rating, COUNT(*) as review_count 
-                FROM reviews WHERE movie_id = %s
-            """, (movie_id,))
-            stats = cursor.fetchone()
-            movie['avg_rating'] = round(float(stats[0] or 0), 1)
-            movie['review_count'] = stats[1]
+            # Распределение оценок из счетчиков movie_stats
+            statements.execute(cursor, "movie_rating_counts", (movie_id,))
+            ratings = aggregates.rating_summary(
+                cursor.fetchone()[0], leaderboard_cache.global_mean(cursor)
+            )
+            movie['avg_rating'] = round(ratings['avg_rating'], 1)
+            movie['review_count'] = ratings['review_count']
+            movie['ratings'] = ratings
             
+        return movie, reviews_list
+    finally:
+        connection.close()
+
+@app.get("/movies/{movie_id}", response_class=HTMLResponse)
+async def get_movie_detail(request: Request, movie_id: int):
+    """Страница фильма с детальной информацией и отзывами"""
+    try:
+        page = await movie_page_cache.aget_or_load(movie_id, lambda: load_movie_page(movie_id))
+        
+        if page is None:
+            return templates.TemplateResponse("error.html", {
+                "request": request,
+                "error": "Фильм не найден"
+            })
+        
+        movie, reviews_list = page
         return templates.TemplateResponse("movie_detail.html", {
             "request": request,
             "movie": movie,
@@ -204,14 +454,10 @@ async def get_movie_detail(request: Request, movie_id: int):
             "request": request,
             "error": f"Ошибка сервера: {str(e)}"
         })
-    
-    finally:
-        if connection:
-            connection.close()
 
 # Исправленный эндпоинт для добавления отзыва
 @app.post("/movies/{movie_id}/review")
-async def add_review_web(
+def add_review_web(
     request: Request,
     movie_id: int,
     user_name: str = Form(...),
@@ -224,7 +470,7 @@ async def add_review_web(
         connection = get_db_connection()
         with connection.cursor() as cursor:
             # Проверяем существование фильма
-            cursor.execute("SELECT id FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_exists", (movie_id,))
             if not cursor.fetchone():
                 return templates.TemplateResponse("error.html", {
                     "request": request,
@@ -232,18 +478,22 @@ async def add_review_web(
                 })
             
             # Добавляем отзыв
-            sql = """
-            INSERT INTO reviews (movie_id, user_name, rating, review_text) 
-            VALUES (%s, %s, %s, %s)
-            """
-            cursor.execute(sql, (
+            user_key = models.normalize_user_key(user_name)
+            review_text = review_text.strip() or None
+            statements.execute(cursor, "review_insert", (
                 movie_id, 
                 user_name.strip(), 
                 rating, 
-                review_text.strip() or None
+                review_text,
+                user_key
             ))
+            review_id = cursor.fetchone()[0]
+            aggregates.record_review(cursor, movie_id, rating, user_key)
+            dedup.record_review(cursor, review_id, movie_id, user_key, review_text)
             connection.commit()
-            
+        
+        # Автор сразу видит свой отзыв, не дожидаясь уведомления
+        movie_page_cache.invalidate(movie_id)
         return RedirectResponse(url=f"/movies/{movie_id}", status_code=303)
     
     except Exception as e:
@@ -0,0 +1,372 @@
+"""
+Наблюдение за памятью воркера.
+
+- Пиковое выделение памяти по маршрутам (tracemalloc): для каждого
+  запроса - рост пика относительно начала запроса и остаток после него.
+  Пик процесса общий, поэтому при параллельных запросах значение - оценка
+  сверху: пик сбрасывается, только когда других запросов нет.
+- Количество объектов по типам, строк фильмов и отзывов (словари из
+  кешей страниц) и моделей pydantic.
+- Снимки tracemalloc и их сравнение через /api/v1/admin/memory.
+
+tracemalloc замедляет выделение памяти, поэтому по умолчанию выключен:
+MEMORY_TRACKING=1 включает его при запуске, первый снимок через admin -
+во время работы.
+
+Проверка, что страницы не растут вместе с каталогом:
+
+    python -m app.memory check [--movies 1000,100000] [--reviews 100000]
+
+Код выхода 1, если пиковая память запроса растет с размером данных.
+"""
+
+import argparse
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from pydantic import BaseModel
+
+MEMORY_TRACKING = os.getenv('MEMORY_TRACKING', '0') == '1'
+# Глубина стека выделений: 1 - только строка, больше - медленнее
+MEMORY_TRACE_FRAMES = int(os.getenv('MEMORY_TRACE_FRAMES', '5'))
+# Сколько снимков хранить для сравнения
+MEMORY_SNAPSHOTS = int(os.getenv('MEMORY_SNAPSHOTS', '5'))
+
+# Выделения самого tracemalloc и импорта не интересны
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def start():
+    """
+    Включает tracemalloc, если он еще не включен
+    """
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(MEMORY_TRACE_FRAMES)
+    return True
+
+
+def rss_kb():
+    """
+    Текущий и максимальный RSS процесса, КБ
+    """
+    current = None
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в КБ на Linux и в байтах на macOS
+    if sys.platform == "darwin":
+        peak //= 1024
+    return current, peak
+
+
+class RouteMemory:
+    """
+    Пиковое выделение памяти по маршрутам
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            if self.in_flight == 0:
+                tracemalloc.reset_peak()
+            self.in_flight += 1
+            return tracemalloc.get_traced_memory()[0]
+
+    def end(self, route, base):
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            self.in_flight -= 1
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {'requests': 0, 'peak_max': 0, 'peak_total': 0, 'retained_total': 0}
+            stats['requests'] += 1
+            stats['peak_max'] = max(stats['peak_max'], peak - base)
+            stats['peak_total'] += peak - base
+            stats['retained_total'] += current - base
+
+    def stats(self):
+        with self._lock:
+            routes = {route: dict(stats) for route, stats in self.routes.items()}
+        return {
+            route: {
+                'requests': stats['requests'],
+                'peak_max_kb': round(stats['peak_max'] / 1024, 1),
+                'peak_avg_kb': round(stats['peak_total'] / stats['requests'] / 1024, 1),
+                'retained_avg_kb': round(stats['retained_total'] / stats['requests'] / 1024, 1)
+            }
+            for route, stats in sorted(routes.items(), key=lambda item: item[1]['peak_max'], reverse=True)
+        }
+
+
+routes = RouteMemory()
+
+
+class MemoryMiddleware:
+    """
+    ASGI middleware: выделение памяти запросами по шаблону маршрута.
+    Пока tracemalloc выключен, ничего не делает
+    """
+
+    def __init__(self, app, skip_prefixes=()):
+        self.app = app
+        self.skip_prefixes = tuple(skip_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not tracemalloc.is_tracing()
+                or scope["path"].startswith(self.skip_prefixes)):
+            await self.app(scope, receive, send)
+            return
+
+        base = routes.begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "(не найден)"
+            routes.end(f"{scope['method']} {path}", base)
+
+
+def _row_kind(item):
+    if 'id' in item:
+        if 'title' in item:
+            return 'movie'
+        if 'rating' in item:
+            return 'review'
+    return None
+
+
+def object_counts(limit=30):
+    """
+    Количество объектов, отслеживаемых сборщиком мусора, по типам, моделей
+    pydantic и строк фильмов и отзывов (словари с id и title/rating).
+    Словари только из чисел и строк сборщик не отслеживает, поэтому
+    строки ищутся еще и в списках (результаты запросов, кеши страниц)
+    """
+    types = Counter()
+    rows = Counter()
+    models = Counter()
+    seen = set()
+
+    def count_row(item):
+        kind = _row_kind(item)
+        if kind is not None and id(item) not in seen:
+            seen.add(id(item))
+            rows[kind] += 1
+
+    for item in gc.get_objects():
+        kind = type(item)
+        types[kind.__qualname__] += 1
+        if kind is dict:
+            count_row(item)
+        elif kind is list:
+            for element in item:
+                if type(element) is dict:
+                    count_row(element)
+        elif isinstance(item, BaseModel):
+            models[kind.__qualname__] += 1
+    return {
+        'types': dict(types.most_common(limit)),
+        'row_dicts': dict(rows),
+        'models': dict(models.most_common(limit))
+    }
+
+
+def _trace_line(trace):
+    frame = trace.traceback[0]
+    return f"{frame.filename}:{frame.lineno}"
+
+
+class Snapshots:
+    """
+    Последние снимки tracemalloc для сравнения
+    """
+
+    def __init__(self, keep=MEMORY_SNAPSHOTS):
+        self.keep = keep
+        self.items = {}
+        self.next_id = 1
+        self._lock = threading.Lock()
+
+    def take(self, limit=20):
+        started = start()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        with self._lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            self.items[snapshot_id] = (time.time(), snapshot)
+            for old in sorted(self.items)[:-self.keep]:
+                del self.items[old]
+        stats = snapshot.statistics("lineno")
+        return {
+            'id': snapshot_id,
+            'tracing_started': started,
+            'traced_kb': round(sum(stat.size for stat in stats) / 1024, 1),
+            'top': [
+                {'line': _trace_line(stat), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                for stat in stats[:limit]
+            ]
+        }
+
+    def list(self):
+        with self._lock:
+            return [{'id': snapshot_id, 'taken_at': taken_at} for snapshot_id, (taken_at, _) in sorted(self.items.items())]
+
+    def diff(self, first, second, key="lineno", limit=20):
+        """
+        Разница между снимками: строки кода с наибольшим ростом памяти.
+        None, если снимка уже нет
+        """
+        with self._lock:
+            old = self.items.get(first)
+            new = self.items.get(second)
+        if old is None or new is None:
+            return None
+        stats = new[1].compare_to(old[1], key)
+        return {
+            'first': first,
+            'second': second,
+            'size_diff_kb': round(sum(stat.size_diff for stat in stats) / 1024, 1),
+            'top': [
+                {
+                    'line': _trace_line(stat),
+                    'size_diff_kb': round(stat.size_diff / 1024, 1),
+                    'count_diff': stat.count_diff,
+                    'size_kb': round(stat.size / 1024, 1)
+                }
+                for stat in stats[:limit]
+            ]
+        }
+
+
+snapshots = Snapshots()
+
+
+def stats():
+    current, peak = rss_kb()
+    result = {
+        'tracing': tracemalloc.is_tracing(),
+        'rss_kb': current,
+        'rss_peak_kb': peak,
+        'routes': routes.stats()
+    }
+    if tracemalloc.is_tracing():
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        result['traced_kb'] = round(traced / 1024, 1)
+        result['traced_peak_kb'] = round(traced_peak / 1024, 1)
+    return result
+
+
+# --- Проверка ограниченной памяти страниц ---
+
+def _synthetic_catalogue(movies):
+    from app import catalogue
+    from app.models import Genre
+
+    genres = [genre.value for genre in Genre]
+    rows = [
+        (i, f"Фильм {i}", f"Режиссер {i % 500}", 1950 + i % 75, genres[i % len(genres)],
+         "Описание " * 20, 90 + i % 60, None, i % 300, (i % 300) * 7)
+        for i in range(1, movies + 1)
+    ]
+    return catalogue.CatalogueSnapshot(rows)
+
+
+def _peak(func):
+    gc.collect()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    return tracemalloc.get_traced_memory()[1] - base
+
+
+def check(catalogue_sizes, reviews, tolerance):
+    """
+    Пиковая память главной страницы и страницы фильма при разных размерах
+    каталога и числе отзывов: рост больше tolerance раз - ошибка
+    """
+    import jinja2
+    from datetime import datetime
+    from app import aggregates, main
+
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"), autoescape=True)
+    index = environment.get_template("index.html")
+    detail = environment.get_template("movie_detail.html")
+    # Снимки строятся до включения tracemalloc: они общие для всех
+    # запросов процесса, проверяется память одного запроса
+    catalogues = [(size, _synthetic_catalogue(size)) for size in catalogue_sizes]
+    start()
+
+    def home(snapshot):
+        movies = snapshot.summaries(snapshot.query(order="rating", limit=main.HOME_PAGE_MOVIES + 1))
+        index.render(request=None, movies=movies[:main.HOME_PAGE_MOVIES], page=1, has_next=len(movies) > main.HOME_PAGE_MOVIES)
+
+    def movie_page(total_reviews):
+        # Страница получает не больше MOVIE_PAGE_REVIEWS строк (LIMIT в запросе)
+        reviews_list = [
+            {'id': i, 'movie_id': 1, 'user_name': f"user{i}", 'rating': i % 10 + 1,
+             'review_text': "Текст отзыва " * 10, 'created_at': datetime.now()}
+            for i in range(min(total_reviews, main.MOVIE_PAGE_REVIEWS))
+        ]
+        ratings = aggregates.rating_summary([total_reviews // 10] * 10, 7.0)
+        movie = {'id': 1, 'title': "Фильм", 'director': "Режиссер", 'release_year': 2000, 'genre': "Драма",
+                 'description': "Описание", 'avg_rating': ratings['avg_rating'],
+                 'review_count': ratings['review_count'], 'ratings': ratings}
+        detail.render(request=None, movie=movie, reviews=reviews_list)
+
+    results = []
+    for size, snapshot in catalogues:
+        # Первый запрос после изменения рейтингов сортирует каталог
+        # (CatalogueSnapshot.rating_order), следующие - нет
+        home(snapshot)
+        results.append(("главная", size, _peak(lambda: home(snapshot))))
+    for total in (max(reviews // 100, 1), reviews):
+        results.append(("страница фильма", total, _peak(lambda: movie_page(total))))
+
+    failed = False
+    for name in ("главная", "страница фильма"):
+        peaks = [(size, peak) for page, size, peak in results if page == name]
+        smallest, largest = peaks[0][1], peaks[-1][1]
+        ratio = largest / max(smallest, 1)
+        status = "ok" if ratio <= tolerance else "РОСТ"
+        failed |= ratio > tolerance
+        sizes = ", ".join(f"{size}: {peak / 1024:.1f} КБ" for size, peak in peaks)
+        print(f"{name}: {sizes}; x{ratio:.2f} [{status}]")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Память воркера")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check_parser = subparsers.add_parser("check", help="память страниц не растет с размером каталога")
+    check_parser.add_argument("--movies", default="1000,100000", help="размеры каталога через запятую")
+    check_parser.add_argument("--reviews", type=int, default=100000, help="отзывов у фильма")
+    check_parser.add_argument("--tolerance", type=float, default=1.5, help="допустимый рост пика, раз")
+    args = parser.parse_args()
+
+    if args.command == "check":
+        sizes = [int(size) for size in args.movies.split(",")]
+        if not check(sizes, args.reviews, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, validator, Field
-from typing import Optional, List
-from datetime import datetime
+from typing import Any, Optional, List, Dict
+from datetime import date, datetime
 from enum import Enum
 
 class Genre(str, Enum):
@@ -17,6 +17,15 @@ class Genre(str, Enum):
     ANIMATION = "Анимация"
     DOCUMENTARY = "Документальный"
 
+def normalize_user_key(user_name: str) -> str:
+    """Ключ пользователя для поиска отзывов: без пробелов по краям, в нижнем регистре"""
+    return user_name.strip().lower()
+
+class RollupBucket(str, Enum):
+    """Период агрегации оценок"""
+    DAY = "day"
+    WEEK = "week"
+
 class ReviewBase(BaseModel):
     """Базовая модель отзыва"""
     user_name: str = Field(..., min_length=1, max_length=100, description="Имя пользователя")
@@ -89,6 +98,19 @@ class Movie(MovieBase):
             datetime: lambda v: v.isoformat()
         }
 
+class RatingSummary(BaseModel):
+    """Распределение оценок фильма и производные показатели"""
+    rating_counts: List[int] = Field(..., description="Количество оценок 1, 2, ..., 10")
+    review_count: int
+    avg_rating: float
+    median_rating: Optional[int] = None
+    percentiles: Dict[str, int] = {}
+    bayesian_rating: Optional[float] = None
+
+class MovieInfo(Movie):
+    """Модель фильма с распределением оценок"""
+    ratings: RatingSummary
+
 class MovieWithReviews(Movie):
     """Модель фильма с отзывами"""
     reviews: List[Review] = []
@@ -128,8 +150,115 @@ class StatsResponse(BaseModel):
     most_reviewed_movie: Optional[str]
     total_users: int
 
+class BrowseSort(str, Enum):
+    """Сортировка списка фильмов"""
+    TITLE = "title"
+    RATING = "rating"
+    YEAR = "year"
+    REVIEWS = "reviews"
+
+class BrowseFacets(BaseModel):
+    """Количество фильмов по жанрам и десятилетиям с учетом остальных фильтров"""
+    genres: Dict[str, int]
+    decades: Dict[int, int]
+
+class BrowseResponse(BaseModel):
+    """Страница фильмов с фасетами"""
+    results: List[Movie]
+    total_count: int
+    facets: BrowseFacets
+
 class SearchResponse(BaseModel):
     """Модель для ответа поиска"""
     query: str
     results: List[Movie]
-    total_count: int
\ No newline at end of file
+    total_count: int
+
+class LeaderboardEntry(BaseModel):
+    """Позиция фильма в рейтинге"""
+    id: int
+    title: str
+    director: str
+    release_year: Optional[int] = None
+    genre: Optional[str] = None
+    avg_rating: float
+    weighted_rating: float
+    review_count: int
+
+class Leaderboard(BaseModel):
+    """Модель рейтинга фильмов"""
+    kind: str
+    genre: Optional[str] = None
+    decade: Optional[int] = None
+    min_reviews: Optional[int] = None
+    entries: List[LeaderboardEntry]
+
+class RecommendedMovie(BaseModel):
+    """Фильм в списке рекомендаций"""
+    id: int
+    title: str
+    director: str
+    release_year: Optional[int] = None
+    genre: Optional[str] = None
+    score: float
+
+class RecommendationsResponse(BaseModel):
+    """Модель ответа с рекомендациями"""
+    movie_id: Optional[int] = None
+    user_name: Optional[str] = None
+    results: List[RecommendedMovie]
+
+class UserReviewsPage(BaseModel):
+    """Страница истории отзывов пользователя"""
+    user_name: str
+    review_count: int
+    avg_rating: Optional[float] = None
+    reviews: List[Review]
+    next_cursor: Optional[str] = Field(None, description="Курсор следующей страницы")
+
+class RatingPoint(BaseModel):
+    """Гистограмма оценок за период"""
+    bucket_start: date
+    rating_counts: List[int] = Field(..., description="Количество оценок 1, 2, ..., 10")
+    review_count: int
+    avg_rating: Optional[float] = None
+
+class RatingSeries(BaseModel):
+    """Ряд гистограмм оценок фильма или жанра"""
+    movie_id: Optional[int] = None
+    genre: Optional[str] = None
+    bucket: RollupBucket
+    points: List[RatingPoint]
+
+class JobCreate(BaseModel):
+    """Модель постановки фоновой задачи"""
+    kind: str = Field(..., description="Вид задачи, например refresh_stats")
+    payload: Dict[str, Any] = Field(default_factory=dict)
+    delay_seconds: int = Field(0, ge=0, le=86400, description="Отложить выполнение, сек")
+
+class MovieDeletion(BaseModel):
+    """Прогресс удаления фильма и его отзывов"""
+    movie_id: int
+    title: Optional[str] = None
+    total_reviews: int
+    deleted_reviews: int
+    batches: int
+    job_id: Optional[int] = None
+    requested_at: datetime
+    finished_at: Optional[datetime] = None
+    progress: float = Field(..., description="Доля удаленных отзывов, 0-1")
+
+class JobInfo(BaseModel):
+    """Модель состояния фоновой задачи"""
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    status: str
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+    result: Optional[Any] = None
@@ -0,0 +1,166 @@
+"""
+Замер секционирования reviews (migrations/001_partition_reviews.sql).
+
+В отдельной схеме создаются две копии отзывов одного объема: обычная
+таблица и 16 хэш-секций по movie_id с индексами из миграции. На обеих
+выполняются запросы приложения и сравнивается время выполнения.
+Схема удаляется после замера.
+
+Запуск (по умолчанию 5 млн отзывов, несколько минут и ~2 ГБ на диске):
+    python -m app.partitioning bench --reviews 5000000
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+import app.database as database
+
+SCHEMA = "bench_partitioning"
+
+_SETUP_SQL = f"""
+DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+CREATE SCHEMA {SCHEMA};
+
+CREATE TABLE {SCHEMA}.reviews_plain (
+    id INTEGER NOT NULL PRIMARY KEY,
+    movie_id INTEGER NOT NULL,
+    user_name VARCHAR(100) NOT NULL,
+    rating INTEGER NOT NULL,
+    review_text TEXT,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE {SCHEMA}.reviews_partitioned (
+    LIKE {SCHEMA}.reviews_plain INCLUDING DEFAULTS,
+    PRIMARY KEY (id, movie_id)
+) PARTITION BY HASH (movie_id);
+"""
+
+_PARTITION_SQL = f"""
+CREATE TABLE {SCHEMA}.reviews_p{{remainder}} PARTITION OF {SCHEMA}.reviews_partitioned
+    FOR VALUES WITH (MODULUS 16, REMAINDER {{remainder}})
+"""
+
+_FILL_SQL = f"""
+INSERT INTO {SCHEMA}.{{table}} (id, movie_id, user_name, rating, review_text, created_at)
+SELECT g, 1 + (hashint4(g) & 2147483647) %% %(movies)s, 'user' || g %% 100000,
+       1 + g %% 10, repeat('отзыв ', 10 + g %% 20),
+       TIMESTAMP '2020-01-01' + (g * INTERVAL '20 seconds')
+FROM generate_series(%(first)s, %(last)s) AS g
+"""
+
+_INDEX_SQL = [
+    "CREATE INDEX ON {schema}.{table} (movie_id, created_at DESC)",
+    "CREATE INDEX ON {schema}.{table} (created_at DESC)",
+]
+
+# Запросы приложения; %(movie_id)s и %(review_id)s подставляются на каждом повторе
+QUERIES = {
+    "page_by_movie": """
+        SELECT * FROM {table} WHERE movie_id = %(movie_id)s
+        ORDER BY created_at DESC LIMIT 20
+    """,
+    "stats_by_movie": """
+        SELECT COUNT(*), AVG(rating) FROM {table} WHERE movie_id = %(movie_id)s
+    """,
+    "latest": """
+        SELECT * FROM {table} ORDER BY created_at DESC LIMIT 10
+    """,
+    "by_id_and_movie": """
+        SELECT * FROM {table} WHERE id = %(review_id)s AND movie_id = %(movie_id)s
+    """,
+}
+
+
+def _fill(cursor, table, reviews, movies, batch_size=500000):
+    for first in range(1, reviews + 1, batch_size):
+        last = min(first + batch_size - 1, reviews)
+        cursor.execute(_FILL_SQL.format(table=table), {'movies': movies, 'first': first, 'last': last})
+        cursor.connection.commit()
+
+
+def _sample(cursor, table, count, seed=1):
+    """Пары (review_id, movie_id) существующих отзывов для запросов"""
+    generator = random.Random(seed)
+    cursor.execute(f"SELECT MAX(id) FROM {SCHEMA}.{table}")
+    max_id = cursor.fetchone()[0]
+    ids = [generator.randint(1, max_id) for _ in range(count)]
+    cursor.execute(f"SELECT id, movie_id FROM {SCHEMA}.{table} WHERE id = ANY(%s)", (ids,))
+    return cursor.fetchall()
+
+
+def _time_query(cursor, sql, samples):
+    timings = []
+    for review_id, movie_id in samples:
+        started = time.perf_counter()
+        cursor.execute(sql, {'review_id': review_id, 'movie_id': movie_id})
+        cursor.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def bench(reviews, movies, repeats, keep):
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(_SETUP_SQL)
+            for remainder in range(16):
+                cursor.execute(_PARTITION_SQL.format(remainder=remainder))
+            connection.commit()
+
+            for table in ("reviews_plain", "reviews_partitioned"):
+                started = time.perf_counter()
+                _fill(cursor, table, reviews, movies)
+                for index_sql in _INDEX_SQL:
+                    cursor.execute(index_sql.format(schema=SCHEMA, table=table))
+                cursor.execute(f"ANALYZE {SCHEMA}.{table}")
+                connection.commit()
+                print(f"{table}: {reviews:,} отзывов загружено за {time.perf_counter() - started:.1f} с")
+
+            samples = _sample(cursor, "reviews_plain", repeats)
+            print(f"\nЗапрос, мс (медиана / p95, {len(samples)} повторов)   обычная    секции")
+            for name, sql in QUERIES.items():
+                results = []
+                for table in ("reviews_plain", "reviews_partitioned"):
+                    query = sql.format(table=f"{SCHEMA}.{table}")
+                    # Прогрев кеша страниц, чтобы сравнивались сами планы
+                    _time_query(cursor, query, samples[:10])
+                    results.append(_time_query(cursor, query, samples))
+                print(f"{name:<44}" + "".join(f"{median:>7.2f} / {p95:<7.2f}" for median, p95 in results))
+
+            for table in ("reviews_plain", "reviews_partitioned"):
+                # У секционированной таблицы данные и индексы лежат в секциях
+                cursor.execute(f"""
+                    SELECT pg_total_relation_size('{SCHEMA}.{table}')
+                         + COALESCE(SUM(pg_total_relation_size(relid)), 0)
+                    FROM pg_partition_tree('{SCHEMA}.{table}') WHERE isleaf
+                """)
+                print(f"Размер {table}: {cursor.fetchone()[0] / 2**20:,.0f} МБ")
+    finally:
+        if not keep:
+            with connection.cursor() as cursor:
+                connection.rollback()
+                cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+                connection.commit()
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Секционирование таблицы reviews")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="сравнить запросы на обычной и секционированной таблице")
+    bench_parser.add_argument("--reviews", type=int, default=5000000)
+    bench_parser.add_argument("--movies", type=int, default=20000)
+    bench_parser.add_argument("--repeats", type=int, default=500)
+    bench_parser.add_argument("--keep", action="store_true", help=f"не удалять схему {SCHEMA}")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench(args.reviews, args.movies, args.repeats, args.keep)
+
+
+if __name__ == "__main__":
+    main()
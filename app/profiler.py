@@ -0,0 +1,283 @@
+"""
+Сэмплирующий профилировщик для работающих процессов.
+
+Отдельный поток с заданной частотой снимает стеки всех потоков процесса
+(sys._current_frames) и считает одинаковые стеки. Код приложения не
+инструментируется, поэтому накладные расходы есть только во время
+профилирования и пропорциональны частоте.
+
+Результат - collapsed stacks ("корень;...;лист число" на строку), из
+которых flamegraph.pl, speedscope или inferno строят flamegraph. Первый
+элемент стека - метка: маршрут ("GET /movies/{movie_id}") или команда
+бота, если их функция есть в стеке, иначе имя потока.
+
+Запуск профилирования:
+
+    POST /api/v1/admin/profile?seconds=10          # воркер, принявший запрос
+    python -m app.profiler signal <pid> --seconds 10  # веб-воркер или бот по PID
+    python -m app.profiler top profiles/<файл>.collapsed
+"""
+
+import argparse
+import inspect
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '60'))
+# Каталог результатов профилирования по сигналу
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SIGNAL = signal.SIGUSR2
+
+# Функции, в которых поток ждет (select цикла событий, пустая очередь
+# пула потоков): такие стеки по умолчанию не учитываются
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+    ("ssl.py", "read"),
+}
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Код функции -> метка (маршрут или команда бота)
+_labels = {}
+
+
+class Busy(Exception):
+    """Профилирование уже идет"""
+
+
+def register(func, label):
+    """
+    Отмечает функцию меткой: стеки, в которых она есть, помечаются ей
+    """
+    func = inspect.unwrap(getattr(func, "__func__", func))
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        _labels[code] = label
+
+
+def register_routes(routes):
+    """
+    Метки для функций маршрутов FastAPI: "GET /api/v1/movies/{movie_id}"
+    """
+    for route in routes:
+        endpoint = getattr(route, "endpoint", None)
+        methods = getattr(route, "methods", None)
+        if endpoint is not None and methods:
+            register(endpoint, f"{'|'.join(sorted(methods))} {route.path}")
+
+
+def _frame_name(code):
+    path = code.co_filename
+    if path.startswith(_ROOT):
+        path = os.path.relpath(path, _ROOT)
+    else:
+        path = "/".join(path.split(os.sep)[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """
+    Сэмплирование стеков всех потоков процесса
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, include_idle=False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks = Counter()
+        self.samples = 0
+        self.seconds = 0.0
+        self._names = {}
+
+    def sample(self, skip):
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            code = frame.f_code
+            if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            names = []
+            label = None
+            while frame is not None:
+                code = frame.f_code
+                name = self._names.get(code)
+                if name is None:
+                    name = self._names[code] = _frame_name(code)
+                names.append(name)
+                if code in _labels:
+                    label = _labels[code]
+                frame = frame.f_back
+            names.append(label or f"thread {threads.get(ident, ident)}")
+            self.stacks[";".join(reversed(names))] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        """
+        Сэмплирует seconds секунд в текущем потоке
+        """
+        skip = threading.get_ident()
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_sample = started
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if now < next_sample:
+                time.sleep(next_sample - now)
+            self.sample(skip)
+            next_sample += self.interval
+        self.seconds = time.perf_counter() - started
+        return self
+
+    def collapsed(self):
+        """
+        Collapsed stacks: строка "кадр;кадр;... количество" на стек
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_lock = threading.Lock()
+counters = {'profiles': 0, 'samples': 0, 'last_seconds': 0.0}
+
+
+def profile(seconds, interval=PROFILE_INTERVAL, include_idle=False):
+    """
+    Профилирует процесс seconds секунд; одновременно идет не больше
+    одного профилирования. Блокирует вызывающий поток
+    """
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    if not _lock.acquire(blocking=False):
+        raise Busy("Профилирование уже идет")
+    try:
+        profiler = Profiler(interval, include_idle).run(seconds)
+    finally:
+        _lock.release()
+    counters['profiles'] += 1
+    counters['samples'] += profiler.samples
+    counters['last_seconds'] = round(profiler.seconds, 2)
+    return profiler
+
+
+def stats():
+    return {**counters, 'running': _lock.locked()}
+
+
+# --- Профилирование по сигналу ---
+
+def _request_path(pid):
+    return os.path.join(PROFILE_DIR, f"request-{pid}")
+
+
+def _on_signal(service):
+    def handle(signum, frame):
+        # Параметры кладет в файл запроса команда signal
+        seconds, interval = 10, PROFILE_INTERVAL
+        try:
+            with open(_request_path(os.getpid())) as request:
+                seconds, interval = (float(value) for value in request.read().split())
+            os.remove(_request_path(os.getpid()))
+        except (OSError, ValueError):
+            pass
+
+        def run():
+            try:
+                profiler = profile(seconds, interval)
+            except Busy:
+                return
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{service}-{os.getpid()}-{int(time.time())}.collapsed")
+            with open(path + ".tmp", "w", encoding="utf-8") as output:
+                output.write(profiler.collapsed())
+            os.replace(path + ".tmp", path)
+
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+
+    return handle
+
+
+def install_signal_handler(service):
+    """
+    Профилирование по SIGUSR2: результат пишется в PROFILE_DIR.
+    Вызывается из главного потока процесса
+    """
+    try:
+        signal.signal(PROFILE_SIGNAL, _on_signal(service))
+    except ValueError:
+        # Не главный поток: профилирование доступно только через эндпоинт
+        pass
+
+
+def request_profile(pid, seconds, interval=PROFILE_INTERVAL, timeout=None):
+    """
+    Запрашивает профилирование процесса pid сигналом и ждет результат
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    existing = set(os.listdir(PROFILE_DIR))
+    with open(_request_path(pid), "w") as request:
+        request.write(f"{seconds} {interval}")
+    os.kill(pid, PROFILE_SIGNAL)
+
+    deadline = time.monotonic() + (timeout or seconds + 30)
+    suffix = f"-{pid}-"
+    while time.monotonic() < deadline:
+        for name in set(os.listdir(PROFILE_DIR)) - existing:
+            if suffix in name and name.endswith(".collapsed"):
+                return os.path.join(PROFILE_DIR, name)
+        time.sleep(0.5)
+    raise TimeoutError(f"Процесс {pid} не записал профиль")
+
+
+def top(lines, limit=20):
+    """
+    Метки и функции с наибольшим собственным и общим временем
+    """
+    own, total, labels = Counter(), Counter(), Counter()
+    samples = 0
+    for line in lines:
+        stack, _, count = line.rstrip("\n").rpartition(" ")
+        if not stack:
+            continue
+        count = int(count)
+        frames = stack.split(";")
+        samples += count
+        labels[frames[0]] += count
+        own[frames[-1]] += count
+        for name in set(frames[1:]):
+            total[name] += count
+    return samples, labels.most_common(limit), own.most_common(limit), total.most_common(limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сэмплирующий профилировщик")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    signal_parser = subparsers.add_parser("signal", help="профилировать процесс по PID (веб-воркер или бот)")
+    signal_parser.add_argument("pid", type=int)
+    signal_parser.add_argument("--seconds", type=float, default=10)
+    signal_parser.add_argument("--interval", type=float, default=PROFILE_INTERVAL)
+    top_parser = subparsers.add_parser("top", help="сводка по файлу collapsed stacks")
+    top_parser.add_argument("file")
+    top_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "signal":
+        print(request_profile(args.pid, args.seconds, args.interval))
+    elif args.command == "top":
+        with open(args.file, encoding="utf-8") as source:
+            samples, labels, own, total = top(source, args.limit)
+        for title, rows in (("Метки", labels), ("Собственное время", own), ("Общее время", total)):
+            print(f"\n{title}:")
+            for name, count in rows:
+                print(f"{100 * count / max(samples, 1):6.1f}%  {count:7}  {name}")
+
+
+if __name__ == "__main__":
+    main()
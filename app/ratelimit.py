@@ -0,0 +1,417 @@
+"""
+Защита PostgreSQL от всплесков нагрузки.
+
+1. Ограничение частоты (token bucket) по клиенту и группе маршрутов:
+   поиск и краулеры получают меньше запросов в секунду, чем страницы
+   и запись. Превышение - 429 с Retry-After.
+
+2. Контроль допуска: не больше ADMISSION_MAX_CONCURRENT запросов
+   процесса одновременно работают с БД, остальные ждут в очереди
+   с приоритетами (запись, затем страницы, API, поиск, краулеры).
+   Если ожидаемое ожидание больше допустимого для приоритета, запрос
+   сразу получает 503 с Retry-After, а не занимает очередь зря; при
+   переполнении очереди вытесняется заявка с самым низким приоритетом.
+
+   Допуск выдается на весь запрос, а не на взятие подключения из пула
+   (app/database.py), потому что:
+   - очередь работает в цикле событий, а подключения берутся в потоках
+     обработчиков: ожидание допуска там заняло бы поток пула на каждую
+     заявку, и очередь из краулеров оставила бы без потоков запись;
+   - запрос может брать несколько подключений подряд (запись на primary,
+     затем чтение с реплики); отказ на втором оставил бы запрос
+     выполненным наполовину, а 503 до начала обработки безопасно повторить.
+   Цена - слот занят и на ответах из кеша, но такие ответы занимают его
+   на доли миллисекунды, и скользящее среднее времени обработки это
+   учитывает.
+
+Клиент определяется по IP подключения. За прокси (nginx и т.п.) это
+адрес прокси, и все клиенты делят одну корзину - нужно включить
+RATE_LIMIT_TRUST_PROXY=1, тогда IP берется из X-Forwarded-For. Без
+прокси переменную включать нельзя: заголовок подделывается клиентом.
+
+Стоимость проверок и поведение очереди под перегрузкой:
+    python -m app.ratelimit bench
+"""
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+# Брать IP клиента из X-Forwarded-For (только за доверенным прокси)
+TRUST_PROXY = os.getenv('RATE_LIMIT_TRUST_PROXY', '0') == '1'
+# Сколько корзин клиентов хранить в памяти
+MAX_BUCKETS = 10000
+
+PRIORITY_WRITE = 0
+PRIORITY_PAGE = 1
+PRIORITY_API = 2
+PRIORITY_SEARCH = 3
+PRIORITY_CRAWLER = 4
+PRIORITY_NAMES = {
+    PRIORITY_WRITE: 'write',
+    PRIORITY_PAGE: 'page',
+    PRIORITY_API: 'api',
+    PRIORITY_SEARCH: 'search',
+    PRIORITY_CRAWLER: 'crawler'
+}
+
+
+def _parse_limit(name, default):
+    # "5,20" - 5 запросов в секунду, всплеск до 20
+    rate, _, burst = os.getenv(f'RATE_LIMIT_{name.upper()}', default).partition(",")
+    return float(rate), float(burst or rate)
+
+
+# Группа маршрутов -> (запросов в секунду, размер всплеска)
+ROUTE_LIMITS = {
+    name: _parse_limit(name, default)
+    for name, default in (
+        ('write', '2,10'),
+        ('page', '10,30'),
+        ('api', '20,50'),
+        ('search', '2,10'),
+        ('crawler', '1,5')
+    )
+}
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', os.getenv('DB_POOL_MAX', '10')))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '100'))
+# Сколько запрос готов ждать допуска, сек
+ADMISSION_MAX_WAIT = {
+    PRIORITY_WRITE: 10.0,
+    PRIORITY_PAGE: 3.0,
+    PRIORITY_API: 2.0,
+    PRIORITY_SEARCH: 0.5,
+    PRIORITY_CRAWLER: 0.5
+}
+
+# Известные поисковые и SEO-краулеры по токену в User-Agent. Общие слова
+# (bot, crawl) и HTTP-клиенты (curl, wget, python-requests) сюда не
+# входят: это скрипты и интеграции пользователей API, они идут в группу api
+CRAWLER_TOKENS = [
+    token.strip()
+    for token in os.getenv(
+        'RATE_LIMIT_CRAWLERS',
+        'Googlebot,bingbot,YandexBot,YandexImages,Baiduspider,DuckDuckBot,Yahoo! Slurp,'
+        'Applebot,AhrefsBot,SemrushBot,MJ12bot,DotBot,PetalBot,facebookexternalhit'
+    ).split(",")
+    if token.strip()
+]
+CRAWLER_PATTERN = re.compile("|".join(re.escape(token) for token in CRAWLER_TOKENS) or r"(?!)", re.IGNORECASE)
+
+
+def classify(method, path, user_agent=""):
+    """
+    Группа ограничения частоты и приоритет запроса
+    """
+    if method not in ("GET", "HEAD", "OPTIONS"):
+        return 'write', PRIORITY_WRITE
+    if CRAWLER_PATTERN.search(user_agent or ""):
+        return 'crawler', PRIORITY_CRAWLER
+    if "/search" in path:
+        return 'search', PRIORITY_SEARCH
+    if path.startswith("/api/"):
+        return 'api', PRIORITY_API
+    return 'page', PRIORITY_PAGE
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """
+        Забирает токен; возвращает 0 или время до появления токена, сек
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Корзины по ключу (клиент, группа); давно не использованные
+    корзины вытесняются сверх max_buckets
+    """
+
+    def __init__(self, limits=None, max_buckets=MAX_BUCKETS):
+        self.limits = limits or ROUTE_LIMITS
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = {}
+        self.limited = {}
+
+    def check(self, client, group):
+        """
+        0, если запрос разрешен, иначе через сколько секунд повторить
+        """
+        key = (client, group)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(*self.limits[group])
+                while len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            retry_after = bucket.take()
+            counters = self.limited if retry_after else self.allowed
+            counters[group] = counters.get(group, 0) + 1
+        return retry_after
+
+    def stats(self):
+        return {'clients': len(self._buckets), 'allowed': dict(self.allowed), 'limited': dict(self.limited)}
+
+
+class Overloaded(Exception):
+    """Запрос не допущен: reason - deadline, queue_full или evicted"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class AdmissionController:
+    """
+    Ограничение числа одновременных запросов к БД с очередью по
+    приоритетам (меньше число - выше приоритет)
+    """
+
+    def __init__(self, limit=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE, max_wait=None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait or ADMISSION_MAX_WAIT
+        self.active = 0
+        self.queued = 0
+        self._heap = []
+        self._seq = itertools.count()
+        # Скользящее среднее времени обработки запроса, сек
+        self.service_time = 0.05
+        self.admitted = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.shed = {}
+
+    def expected_wait(self, priority):
+        ahead = sum(1 for entry in self._heap if entry[0] <= priority and not entry[2].done())
+        return (ahead + 1) * self.service_time / self.limit
+
+    def _shed(self, priority, reason, retry_after):
+        key = f"{PRIORITY_NAMES.get(priority, priority)}:{reason}"
+        self.shed[key] = self.shed.get(key, 0) + 1
+        return Overloaded(reason, retry_after)
+
+    def _evict_lower_than(self, priority):
+        # Вытесняем последнюю заявку с самым низким приоритетом, если он ниже нового
+        live = [entry for entry in self._heap if not entry[2].done()]
+        if not live:
+            return True
+        worst = max(live, key=lambda entry: (entry[0], entry[1]))
+        if worst[0] <= priority:
+            return False
+        worst[2].set_exception(self._shed(worst[0], 'evicted', self.expected_wait(worst[0])))
+        self.queued -= 1
+        return True
+
+    def _expire(self, priority, future):
+        if not future.done():
+            future.set_exception(self._shed(priority, 'deadline', self.expected_wait(priority)))
+            self.queued -= 1
+
+    async def acquire(self, priority):
+        """
+        Ждет свободный слот или бросает Overloaded
+        """
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        max_wait = self.max_wait.get(priority, 1.0)
+        expected = self.expected_wait(priority)
+        if expected > max_wait:
+            raise self._shed(priority, 'deadline', expected)
+        if self.queued >= self.max_queue and not self._evict_lower_than(priority):
+            raise self._shed(priority, 'queue_full', expected)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self.queued += 1
+        self.waited += 1
+        started = time.monotonic()
+        timer = loop.call_later(max_wait, self._expire, priority, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.queued -= 1
+            else:
+                # Слот уже передан, но клиент ушел
+                self.release(0.0)
+            raise
+        finally:
+            timer.cancel()
+            self.wait_seconds += time.monotonic() - started
+        self.admitted += 1
+
+    def release(self, elapsed):
+        """
+        Освобождает слот; elapsed - время обработки запроса
+        """
+        if elapsed:
+            self.service_time = 0.9 * self.service_time + 0.1 * elapsed
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                # Слот переходит ожидающему без уменьшения active
+                future.set_result(None)
+                self.queued -= 1
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'waited': self.waited,
+            'avg_wait_seconds': self.wait_seconds / self.waited if self.waited else 0.0,
+            'service_time_seconds': round(self.service_time, 4),
+            'shed': dict(self.shed)
+        }
+
+
+_proxy_warned = False
+
+
+def client_address(request):
+    """
+    IP клиента с учетом доверенного прокси. Берется последний адрес
+    X-Forwarded-For - его добавил наш прокси; начало заголовка
+    присылает сам клиент
+    """
+    global _proxy_warned
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        if TRUST_PROXY:
+            return forwarded.rsplit(",", 1)[-1].strip()
+        if not _proxy_warned:
+            _proxy_warned = True
+            logger.warning("Запросы приходят через прокси, но RATE_LIMIT_TRUST_PROXY=0: "
+                           "ограничение частоты общее для всех клиентов прокси")
+    return request.client.host if request.client else "unknown"
+
+
+limiter = RateLimiter()
+admission = AdmissionController()
+
+
+def _bench_limiter(clients, checks, seed=1):
+    generator = random.Random(seed)
+    keys = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(clients)]
+    groups = list(ROUTE_LIMITS)
+    local_limiter = RateLimiter()
+    requests = [(generator.choice(keys), generator.choice(groups)) for _ in range(checks)]
+    started = time.perf_counter()
+    for client, group in requests:
+        local_limiter.check(client, group)
+    seconds = time.perf_counter() - started
+    stats = local_limiter.stats()
+    return {
+        'check_us': seconds / checks * 1e6,
+        'buckets': stats['clients'],
+        'limited': sum(stats['limited'].values()) / checks
+    }
+
+
+async def _bench_admission(load, requests, service_time, limit, seed=1):
+    """
+    requests запросов с пуассоновским потоком load * limit / service_time
+    в секунду (load > 1 - перегрузка)
+    """
+    generator = random.Random(seed)
+    controller = AdmissionController(limit=limit)
+    controller.service_time = service_time
+    rate = load * limit / service_time
+    waits = {priority: [] for priority in PRIORITY_NAMES}
+
+    async def handle(priority):
+        started = time.monotonic()
+        try:
+            await controller.acquire(priority)
+        except Overloaded:
+            return
+        waits[priority].append(time.monotonic() - started)
+        await asyncio.sleep(generator.expovariate(1 / service_time))
+        controller.release(time.monotonic() - started)
+
+    tasks = []
+    for _ in range(requests):
+        tasks.append(asyncio.create_task(handle(generator.choice(list(PRIORITY_NAMES)))))
+        await asyncio.sleep(generator.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return controller, waits
+
+
+async def _bench(load_values, requests, service_time, limit):
+    print(f"Допуск: {limit} слотов, обработка {service_time * 1000:.0f} мс, {requests} запросов")
+    print(f"{'нагрузка':>9}" + "".join(f"{name + ' p99, мс':>16}" for name in PRIORITY_NAMES.values()) + f"{'отклонено':>11}")
+    for load in load_values:
+        controller, waits = await _bench_admission(load, requests, service_time, limit)
+        shed = sum(controller.shed.values())
+        row = ""
+        for priority in PRIORITY_NAMES:
+            values = sorted(waits[priority])
+            row += f"{values[int(len(values) * 0.99) - 1] * 1000 if values else 0:>16.1f}"
+        print(f"{load:>9.1f}{row}{shed / requests:>11.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ограничение частоты и контроль допуска")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="замерить проверки и очередь допуска")
+    bench_parser.add_argument("--clients", default="100,10000,100000", help="число клиентов через запятую")
+    bench_parser.add_argument("--checks", type=int, default=200000)
+    bench_parser.add_argument("--load", default="0.5,0.9,1.5,3", help="нагрузка относительно пропускной способности")
+    bench_parser.add_argument("--requests", type=int, default=5000)
+    bench_parser.add_argument("--service-ms", type=float, default=20)
+    bench_parser.add_argument("--limit", type=int, default=ADMISSION_MAX_CONCURRENT)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        print(f"{'клиентов':>10}{'check, мкс':>12}{'корзин':>10}{'ограничено':>12}")
+        for clients in (int(value) for value in args.clients.split(",")):
+            result = _bench_limiter(clients, args.checks)
+            print(f"{clients:>10}{result['check_us']:>12.2f}{result['buckets']:>10}{result['limited']:>12.1%}")
+        print()
+        loads = [float(value) for value in args.load.split(",")]
+        asyncio.run(_bench(loads, args.requests, args.service_ms / 1000, args.limit))
+
+
+if __name__ == "__main__":
+    main()
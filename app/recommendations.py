@@ -0,0 +1,346 @@
+"""
+Рекомендации фильмов по матрице оценок пользователей.
+
+Индекс строится по отзывам (пользователь, movie_id, rating): оценки каждого
+пользователя центрируются относительно его среднего, после чего для всех
+пар фильмов считается косинусное сходство (adjusted cosine) разреженным
+умножением матриц. Для каждого фильма хранится только top-K соседей
+в плотных массивах NumPy, поэтому поиск похожих фильмов - это один
+бинарный поиск и срез массива.
+
+Индекс строит одна фоновая задача rebuild_recommendations (app/jobs.py)
+и сохраняет его в файл RECOMMENDATIONS_PATH. Воркеры веб-приложения и
+бот только загружают файл, когда он обновился; файл должен быть им
+доступен (общий каталог или том).
+
+Замер построения: python -m app.recommendations bench
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+# Количество соседей, хранимых для каждого фильма
+NEIGHBOURS = int(os.getenv('RECOMMENDATIONS_NEIGHBOURS', '50'))
+# Период перестроения индекса, сек
+REBUILD_INTERVAL = int(os.getenv('RECOMMENDATIONS_REBUILD_INTERVAL', '600'))
+# Файл индекса, общий для задачи, воркеров и бота
+INDEX_PATH = os.getenv('RECOMMENDATIONS_PATH', 'data/recommendations.npz')
+# Как часто процессы проверяют, не обновился ли файл индекса, сек
+RELOAD_INTERVAL = int(os.getenv('RECOMMENDATIONS_RELOAD_INTERVAL', '30'))
+# Оценка, которая считается нейтральной для пользователя с одним отзывом
+NEUTRAL_RATING = 5.5
+# Сколько ячеек плотного блока матрицы сходства считается за раз (~64 МБ)
+BLOCK_CELLS = 16 * 1024 * 1024
+FETCH_SIZE = 50000
+
+
+class RecommendationIndex:
+    """Top-K похожих фильмов для каждого фильма"""
+
+    def __init__(self, movie_ids, neighbours, scores, built_at=None, build_seconds=0.0):
+        # movie_ids отсортированы; neighbours хранит позиции в movie_ids (-1 - пусто)
+        self.movie_ids = movie_ids
+        self.neighbours = neighbours
+        self.scores = scores
+        self.built_at = built_at or time.time()
+        self.build_seconds = build_seconds
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def _positions(self, movie_ids):
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        positions = np.searchsorted(self.movie_ids, movie_ids)
+        positions = np.minimum(positions, len(self.movie_ids) - 1)
+        found = self.movie_ids[positions] == movie_ids
+        return positions, found
+
+    def similar(self, movie_id, limit=10):
+        """
+        Похожие фильмы: список (movie_id, score) по убыванию сходства
+        """
+        if not len(self.movie_ids):
+            return []
+        positions, found = self._positions([movie_id])
+        if not found[0]:
+            return []
+        row = self.neighbours[positions[0]]
+        valid = row >= 0
+        ids = self.movie_ids[row[valid]][:limit]
+        scores = self.scores[positions[0]][valid][:limit]
+        return [(int(i), float(s)) for i, s in zip(ids, scores)]
+
+    def recommend(self, user_ratings, limit=10):
+        """
+        Рекомендации по оценкам пользователя {movie_id: rating}:
+        взвешенная сумма сходств с оцененными фильмами, без уже оцененных
+        """
+        if not user_ratings or not len(self.movie_ids):
+            return []
+        rated_ids = np.fromiter(user_ratings.keys(), dtype=np.int64)
+        ratings = np.fromiter(user_ratings.values(), dtype=np.float32)
+        positions, found = self._positions(rated_ids)
+        positions, ratings = positions[found], ratings[found]
+        if not len(positions):
+            return []
+
+        center = ratings.mean() if len(ratings) > 1 and ratings.std() > 0 else NEUTRAL_RATING
+        weights = ratings - center
+
+        neighbours = self.neighbours[positions]
+        valid = neighbours >= 0
+        flat_neighbours = neighbours[valid]
+        flat_scores = self.scores[positions][valid]
+        flat_weights = np.repeat(weights, valid.sum(axis=1))
+
+        size = len(self.movie_ids)
+        numerator = np.bincount(flat_neighbours, weights=flat_scores * flat_weights, minlength=size)
+        denominator = np.bincount(flat_neighbours, weights=np.abs(flat_scores), minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            predicted = np.where(denominator > 0, numerator / denominator, -np.inf)
+        predicted[positions] = -np.inf
+
+        candidates = np.flatnonzero(np.isfinite(predicted) & (predicted > 0))
+        if not len(candidates):
+            return []
+        top = candidates[np.argsort(-predicted[candidates], kind='stable')[:limit]]
+        return [(int(self.movie_ids[p]), float(predicted[p])) for p in top]
+
+
+def build_index(users, movies, ratings, neighbours=NEIGHBOURS):
+    """
+    Строит индекс по параллельным массивам: номер пользователя (0..n-1),
+    movie_id и оценка
+    """
+    started = time.perf_counter()
+    if not len(ratings):
+        empty = np.empty((0, neighbours))
+        return RecommendationIndex(np.empty(0, dtype=np.int64), empty.astype(np.int32), empty.astype(np.float32))
+
+    users = np.asarray(users, dtype=np.int32)
+    ratings = np.asarray(ratings, dtype=np.float32)
+    movie_ids, movie_positions = np.unique(np.asarray(movies, dtype=np.int64), return_inverse=True)
+    n_users, n_movies = int(users.max()) + 1, len(movie_ids)
+
+    # Повторные оценки одного фильма одним пользователем усредняются
+    matrix = sparse.coo_matrix((ratings, (users, movie_positions)), shape=(n_users, n_movies)).tocsr()
+    counts = sparse.coo_matrix((np.ones_like(ratings), (users, movie_positions)), shape=(n_users, n_movies)).tocsr()
+    matrix.data /= counts.data
+
+    # Центрирование по среднему пользователя
+    user_means = np.asarray(matrix.sum(axis=1)).ravel() / np.maximum(np.diff(matrix.indptr), 1)
+    matrix.data -= np.repeat(user_means, np.diff(matrix.indptr)).astype(np.float32)
+
+    # Нормировка столбцов: скалярное произведение столбцов = косинусное сходство
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.csc_matrix(matrix.multiply(1 / norms).astype(np.float32))
+    matrix_t = matrix.T.tocsr()
+
+    k = min(neighbours, max(n_movies - 1, 1))
+    neighbour_positions = np.full((n_movies, neighbours), -1, dtype=np.int32)
+    neighbour_scores = np.zeros((n_movies, neighbours), dtype=np.float32)
+
+    block_size = max(1, BLOCK_CELLS // n_movies)
+    for start in range(0, n_movies, block_size):
+        stop = min(start + block_size, n_movies)
+        block = (matrix_t[start:stop] @ matrix).toarray()
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        top[top_scores <= 0] = -1
+        neighbour_positions[start:stop, :top.shape[1]] = top
+        neighbour_scores[start:stop, :top.shape[1]] = np.maximum(top_scores, 0)
+
+    return RecommendationIndex(
+        movie_ids, neighbour_positions, neighbour_scores,
+        build_seconds=time.perf_counter() - started
+    )
+
+
+RATINGS_SQL = """
+    SELECT COALESCE(user_key, lower(btrim(user_name))), movie_id, rating FROM reviews
+"""
+
+
+def load_ratings(connection, fetch_size=FETCH_SIZE):
+    """
+    Читает оценки именованным (серверным) курсором пачками по fetch_size
+    строк и складывает их сразу в массивы NumPy: в памяти процесса нет
+    списка всех строк. Возвращает (users, movies, ratings); пользователи
+    пронумерованы с 0
+    """
+    user_codes = {}
+    chunks = []
+    with connection.cursor(name="recommendations_ratings") as cursor:
+        cursor.itersize = fetch_size
+        cursor.execute(RATINGS_SQL)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            user_keys, movie_ids, ratings = zip(*rows)
+            chunks.append((
+                np.fromiter((user_codes.setdefault(key, len(user_codes)) for key in user_keys),
+                            dtype=np.int32, count=len(rows)),
+                np.fromiter(movie_ids, dtype=np.int64, count=len(rows)),
+                np.fromiter(ratings, dtype=np.float32, count=len(rows)),
+            ))
+    connection.rollback()
+    if not chunks:
+        return np.empty(0, np.int32), np.empty(0, np.int64), np.empty(0, np.float32)
+    return tuple(np.concatenate(column) for column in zip(*chunks))
+
+
+def save(index, path=INDEX_PATH):
+    """
+    Записывает индекс в файл атомарно: читатели видят старый или новый
+    файл целиком
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as output:
+        np.savez(
+            output, movie_ids=index.movie_ids, neighbours=index.neighbours, scores=index.scores,
+            built_at=np.float64(index.built_at), build_seconds=np.float64(index.build_seconds)
+        )
+    os.replace(temporary, path)
+
+
+def load(path=INDEX_PATH):
+    with np.load(path) as data:
+        return RecommendationIndex(
+            data['movie_ids'], data['neighbours'], data['scores'],
+            built_at=float(data['built_at']), build_seconds=float(data['build_seconds'])
+        )
+
+
+_index = None
+_loaded_mtime = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Текущий индекс процесса или None, если он еще не загружен
+    """
+    return _index
+
+
+def refresh(path=INDEX_PATH):
+    """
+    Загружает индекс из файла, если файл изменился с прошлой загрузки.
+    Возвращает текущий индекс процесса (None, пока файла нет)
+    """
+    global _index, _loaded_mtime
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return _index
+    with _lock:
+        if mtime != _loaded_mtime:
+            _index = load(path)
+            _loaded_mtime = mtime
+    return _index
+
+
+def rebuild(connection_factory, executor=None, path=INDEX_PATH):
+    """
+    Строит индекс и сохраняет его в файл; вызывается задачей
+    rebuild_recommendations. connection_factory возвращает подключение
+    psycopg2, которое закрывается после загрузки.
+
+    С executor (пул процессов) матрица сходства считается в другом
+    процессе; туда передаются только три массива оценок
+    """
+    connection = connection_factory()
+    try:
+        started = time.perf_counter()
+        columns = load_ratings(connection)
+        load_seconds = time.perf_counter() - started
+    finally:
+        connection.close()
+    if executor is None:
+        index = build_index(*columns)
+    else:
+        index = executor.submit(build_index, *columns).result()
+    save(index, path)
+    refresh(path)
+    return index, load_seconds
+
+
+# --- Замер построения ---
+
+def _synthetic_ratings(users, movies, ratings, seed=1):
+    """
+    Оценки с популярностью фильмов по Ципфу и вкусом пользователя:
+    пользователь оценивает выше фильмы своего "жанра" (movie_id % 20)
+    """
+    generator = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, movies + 1)
+    popularity /= popularity.sum()
+    user_codes = generator.integers(0, users, ratings, dtype=np.int32)
+    movie_ids = generator.choice(movies, ratings, p=popularity).astype(np.int64) + 1
+    taste = (user_codes % 20) == (movie_ids % 20)
+    values = np.clip(np.rint(generator.normal(5.5 + 3 * taste, 1.5)), 1, 10).astype(np.float32)
+    return user_codes, movie_ids, values
+
+
+def _bench(users, movies, ratings, neighbours):
+    started = time.perf_counter()
+    columns = _synthetic_ratings(users, movies, ratings)
+    print(f"Оценок: {ratings:,}, пользователей: {users:,}, фильмов: {movies:,} "
+          f"(генерация {time.perf_counter() - started:.1f} с, "
+          f"{sum(column.nbytes for column in columns) / 2**20:.0f} МБ в массивах)")
+
+    index = build_index(*columns, neighbours=neighbours)
+    print(f"Построение индекса: {index.build_seconds:.2f} с, "
+          f"{(index.neighbours.nbytes + index.scores.nbytes + index.movie_ids.nbytes) / 2**20:.0f} МБ")
+
+    path = f"bench_recommendations.{os.getpid()}.npz"
+    try:
+        started = time.perf_counter()
+        save(index, path)
+        save_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        load(path)
+        print(f"Файл индекса: запись {save_seconds:.2f} с, загрузка {time.perf_counter() - started:.3f} с, "
+              f"{os.path.getsize(path) / 2**20:.0f} МБ")
+    finally:
+        os.remove(path)
+
+    sample = index.movie_ids[:1000]
+    started = time.perf_counter()
+    for movie_id in sample:
+        index.similar(movie_id)
+    print(f"Похожие фильмы: {(time.perf_counter() - started) / len(sample) * 1e6:.0f} мкс на запрос")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс рекомендаций")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="построение индекса на синтетических оценках")
+    bench_parser.add_argument("--users", type=int, default=200000)
+    bench_parser.add_argument("--movies", type=int, default=20000)
+    bench_parser.add_argument("--ratings", type=int, default=5000000)
+    bench_parser.add_argument("--neighbours", type=int, default=NEIGHBOURS)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        _bench(args.users, args.movies, args.ratings, args.neighbours)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,14 @@
 from .movies import router as movies_router
 from .reviews import router as reviews_router 
 from .users import router as users_router
+from .leaderboards import router as leaderboards_router
+from .recommendations import router as recommendations_router
+from .analytics import router as analytics_router
+from .events import router as events_router
+from .admin import router as admin_router
 
-__all__ = ["movies_router", "reviews_router", "users_router"]
\ No newline at end of file
+__all__ = [
+    "movies_router", "reviews_router", "users_router",
+    "leaderboards_router", "recommendations_router", "analytics_router",
+    "events_router", "admin_router"
+]
\ No newline at end of file
@@ -0,0 +1,223 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+import asyncio
+import os
+import secrets
+import time
+import app.cache as cache
+import app.catalogue as catalogue
+import app.database as database
+import app.deadlines as deadlines
+import app.dedup as dedup
+import app.events as events
+import app.jobs as jobs
+import app.log as log
+import app.memory as memory
+import app.models as models
+import app.profiler as profiler
+import app.statements as statements
+import app.ratelimit as ratelimit
+import app.subscriptions as subscriptions
+import app.tracing as tracing
+
+# Токен администратора; без него служебные эндпоинты отключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """
+    Проверка заголовка X-Admin-Token
+    """
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+router = APIRouter(prefix="/admin", route_class=tracing.TracedRoute, dependencies=[Depends(require_admin)])
+
+@router.get("/metrics", response_model=dict)
+def get_metrics():
+    """
+    Метрики фоновых задач (глубина очереди, длительность), потока событий,
+    кешей процесса, снимка каталога, схлопывания одинаковых чтений,
+    ограничения частоты, контроля допуска и сроков запросов
+    """
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            queue = jobs.queue_depth(cursor)
+
+        return {
+            "jobs": {
+                "queue": queue,
+                "running": list(jobs.worker.running.values()),
+                "completed": jobs.metrics.snapshot()
+            },
+            "events": events.bus.stats(),
+            "caches": cache.stats(),
+            "catalogue": catalogue.stats(),
+            "coalescing": cache.flight_stats(),
+            "rate_limit": ratelimit.limiter.stats(),
+            "admission": ratelimit.admission.stats(),
+            "deadlines": deadlines.stats(),
+            "logging": log.stats(),
+            "tracing": tracing.stats(),
+            "profiler": profiler.stats(),
+            "memory": memory.stats(),
+            "subscriptions": subscriptions.stats(),
+            "dedup": dedup.stats()
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения метрик: {str(e)}")
+
+    finally:
+        if connection:
+            connection.close()
+
+@router.post("/jobs", response_model=dict)
+def create_job(job: models.JobCreate):
+    """
+    Поставить фоновую задачу в очередь
+    """
+    if job.kind not in jobs.HANDLERS:
+        raise HTTPException(status_code=400, detail=f"Неизвестная задача. Доступны: {', '.join(sorted(jobs.HANDLERS))}")
+
+    connection = None
+    try:
+        connection = database.get_db_connection()
+        with connection.cursor() as cursor:
+            job_id = jobs.enqueue(cursor, job.kind, job.payload, delay=job.delay_seconds)
+            connection.commit()
+
+        return {"message": "Задача поставлена в очередь", "job_id": job_id}
+
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise HTTPException(status_code=500, detail=f"Ошибка постановки задачи: {str(e)}")
+
+    finally:
+        if connection:
+            connection.close()
+
+@router.get("/jobs/{job_id}", response_model=models.JobInfo)
+def get_job(job_id: int):
+    """
+    Состояние фоновой задачи
+    """
+    connection = None
+    try:
+        connection = database.get_db_connection()
+        with connection.cursor() as cursor:
+            job = jobs.get_job(cursor, job_id)
+
+            if not job:
+                raise HTTPException(status_code=404, detail="Задача не найдена")
+
+        return job
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+
+    finally:
+        if connection:
+            connection.close()
+
+@router.get("/reviews/flags", response_model=list)
+def get_review_flags(
+    movie_id: Optional[int] = Query(None, gt=0),
+    limit: int = Query(50, ge=1, le=500)
+):
+    """
+    Последние отзывы, помеченные как почти одинаковые с более ранним
+    отзывом того же фильма или пользователя
+    """
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "review_flags", (movie_id, limit))
+            columns = [desc[0] for desc in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения пометок: {str(e)}")
+
+    finally:
+        if connection:
+            connection.close()
+
+@router.post("/profile", response_class=PlainTextResponse)
+async def create_profile(
+    seconds: float = Query(10, gt=0, le=profiler.PROFILE_MAX_SECONDS),
+    interval: float = Query(profiler.PROFILE_INTERVAL, ge=0.001, le=1),
+    idle: bool = Query(False, description="учитывать ожидающие потоки")
+):
+    """
+    Профилирование воркера, принявшего запрос: collapsed stacks за
+    seconds секунд для flamegraph.pl, speedscope или inferno
+    """
+    try:
+        result = await asyncio.to_thread(profiler.profile, seconds, interval, idle)
+    except profiler.Busy:
+        raise HTTPException(status_code=409, detail="Профилирование уже идет")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка профилирования: {str(e)}")
+
+    filename = f"web-{os.getpid()}-{int(time.time())}.collapsed"
+    return PlainTextResponse(result.collapsed(), headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Profile-Samples": str(result.samples)
+    })
+
+@router.get("/memory", response_model=dict)
+async def get_memory():
+    """
+    RSS процесса и пиковое выделение памяти по маршрутам (при включенном
+    tracemalloc)
+    """
+    return memory.stats()
+
+@router.get("/memory/objects", response_model=dict)
+async def get_memory_objects(limit: int = Query(30, ge=1, le=200)):
+    """
+    Количество объектов по типам, строк фильмов и отзывов и моделей pydantic
+    """
+    return await asyncio.to_thread(memory.object_counts, limit)
+
+@router.get("/memory/snapshots", response_model=list)
+async def list_memory_snapshots():
+    """
+    Сохраненные снимки tracemalloc
+    """
+    return memory.snapshots.list()
+
+@router.post("/memory/snapshots", response_model=dict)
+async def create_memory_snapshot(limit: int = Query(20, ge=1, le=200)):
+    """
+    Снимок tracemalloc; если трассировка была выключена, она включается,
+    и снимок служит точкой отсчета
+    """
+    try:
+        return await asyncio.to_thread(memory.snapshots.take, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка снимка памяти: {str(e)}")
+
+@router.get("/memory/snapshots/{first}/diff/{second}", response_model=dict)
+async def diff_memory_snapshots(
+    first: int,
+    second: int,
+    key: str = Query("lineno", description="lineno, filename или traceback"),
+    limit: int = Query(20, ge=1, le=200)
+):
+    """
+    Рост памяти между двумя снимками по строкам кода
+    """
+    if key not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="key: lineno, filename или traceback")
+    diff = await asyncio.to_thread(memory.snapshots.diff, first, second, key, limit)
+    if diff is None:
+        raise HTTPException(status_code=404, detail="Снимок не найден")
+    return diff
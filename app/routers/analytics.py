@@ -0,0 +1,59 @@
+from fastapi import APIRouter, HTTPException, Query
+from datetime import date, timedelta
+import app.analytics as analytics
+import app.database as database
+import app.models as models
+import app.statements as statements
+import app.tracing as tracing
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+@router.get("/analytics/movies/{movie_id}/ratings", response_model=models.RatingSeries)
+def get_movie_rating_series(
+    movie_id: int,
+    bucket: models.RollupBucket = Query(models.RollupBucket.DAY, description="Период: day или week"),
+    days: int = Query(90, ge=1, le=3650, description="Глубина ряда в днях")
+):
+    """
+    Гистограммы оценок фильма по дням или неделям
+    """
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "movie_rollup_series", (movie_id, bucket.value, date.today() - timedelta(days=days)))
+            rows = cursor.fetchall()
+            
+        return models.RatingSeries(movie_id=movie_id, bucket=bucket, points=analytics.to_points(rows))
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения статистики: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
+
+@router.get("/analytics/genres/{genre}/ratings", response_model=models.RatingSeries)
+def get_genre_rating_series(
+    genre: models.Genre,
+    bucket: models.RollupBucket = Query(models.RollupBucket.DAY, description="Период: day или week"),
+    days: int = Query(90, ge=1, le=3650, description="Глубина ряда в днях")
+):
+    """
+    Гистограммы оценок жанра по дням или неделям
+    """
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "genre_rollup_series", (genre.value, bucket.value, date.today() - timedelta(days=days)))
+            rows = cursor.fetchall()
+            
+        return models.RatingSeries(genre=genre.value, bucket=bucket, points=analytics.to_points(rows))
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения статистики: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
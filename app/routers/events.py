@@ -0,0 +1,105 @@
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import json
+import app.database as database
+import app.events as events
+import app.statements as statements
+import app.tracing as tracing
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    # nginx не должен буферизовать поток
+    "X-Accel-Buffering": "no"
+}
+
+async def _event_stream(request: Request, movie_id: Optional[int] = None):
+    """
+    Поток Server-Sent Events по подписке на фильм или, без movie_id, на
+    все события; если клиент не успевал читать и часть событий потеряна,
+    отправляется событие overflow.
+
+    Подписка создается в самом генераторе: если ответ не начнет
+    отправляться (клиент отключился раньше), генератор не запустится и
+    подписка не останется в шине
+    """
+    subscription = events.bus.subscribe(movie_id)
+    try:
+        yield "retry: 3000\n\n"
+        reported_drops = 0
+        while not await request.is_disconnected():
+            event = await subscription.get(events.HEARTBEAT_INTERVAL)
+            if subscription.dropped != reported_drops:
+                reported_drops = subscription.dropped
+                yield f"event: overflow\ndata: {json.dumps({'dropped': reported_drops})}\n\n"
+            if event is None:
+                yield ": ping\n\n"
+            else:
+                yield f"event: {event.type}\ndata: {event.data}\n\n"
+    finally:
+        events.bus.unsubscribe(subscription)
+
+@router.get("/events")
+async def stream_all_events(request: Request):
+    """
+    Поток всех изменений (новые отзывы, агрегаты, фильмы) в формате SSE
+    """
+    return StreamingResponse(
+        _event_stream(request),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+@router.get("/events/movies/{movie_id}")
+async def stream_movie_events(request: Request, movie_id: int):
+    """
+    Поток изменений одного фильма в формате SSE
+    """
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "movie_exists", (movie_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Фильм не найден")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+
+    finally:
+        if connection:
+            connection.close()
+
+    return StreamingResponse(
+        _event_stream(request, movie_id),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+@router.websocket("/events/ws")
+async def events_websocket(websocket: WebSocket, movie_id: Optional[int] = None):
+    """
+    Изменения через WebSocket: все или, с параметром movie_id, одного фильма.
+    Каждое сообщение - JSON-событие с полем type
+    """
+    await websocket.accept()
+    subscription = events.bus.subscribe(movie_id)
+    try:
+        reported_drops = 0
+        while True:
+            event = await subscription.get(events.HEARTBEAT_INTERVAL)
+            if subscription.dropped != reported_drops:
+                reported_drops = subscription.dropped
+                await websocket.send_text(json.dumps({'type': 'overflow', 'dropped': reported_drops}))
+            if event is None:
+                await websocket.send_text('{"type": "ping"}')
+            else:
+                await websocket.send_text(event.data)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        events.bus.unsubscribe(subscription)
@@ -0,0 +1,80 @@
+from fastapi import APIRouter, HTTPException, Path, Query
+import app.database as database
+import app.leaderboards as leaderboards
+import app.models as models
+import app.tracing as tracing
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+def _load(kind, loader, **fields):
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            entries = loader(cursor)
+        return models.Leaderboard(kind=kind, entries=entries, **fields)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения рейтинга: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
+
+@router.get("/leaderboards/top", response_model=models.Leaderboard)
+def get_top_rated(
+    min_reviews: int = Query(leaderboards.MIN_REVIEWS, ge=1, description="Минимум отзывов"),
+    limit: int = Query(10, ge=1, le=leaderboards.MAX_LIMIT, description="Размер рейтинга")
+):
+    """
+    Лучшие фильмы по байесовскому рейтингу
+    """
+    return _load(
+        "top_rated",
+        lambda cursor: leaderboards.top_rated(cursor, min_reviews=min_reviews, limit=limit),
+        min_reviews=min_reviews
+    )
+
+@router.get("/leaderboards/genres/{genre}", response_model=models.Leaderboard)
+def get_top_rated_by_genre(
+    genre: models.Genre,
+    min_reviews: int = Query(leaderboards.MIN_REVIEWS, ge=1, description="Минимум отзывов"),
+    limit: int = Query(10, ge=1, le=leaderboards.MAX_LIMIT, description="Размер рейтинга")
+):
+    """
+    Лучшие фильмы жанра
+    """
+    return _load(
+        "top_rated",
+        lambda cursor: leaderboards.top_rated(cursor, genre=genre.value, min_reviews=min_reviews, limit=limit),
+        genre=genre.value,
+        min_reviews=min_reviews
+    )
+
+@router.get("/leaderboards/decades/{decade}", response_model=models.Leaderboard)
+def get_top_rated_by_decade(
+    decade: int = Path(..., ge=1880, le=2100, description="Десятилетие, например 1990"),
+    min_reviews: int = Query(leaderboards.MIN_REVIEWS, ge=1, description="Минимум отзывов"),
+    limit: int = Query(10, ge=1, le=leaderboards.MAX_LIMIT, description="Размер рейтинга")
+):
+    """
+    Лучшие фильмы десятилетия
+    """
+    if decade % 10:
+        raise HTTPException(status_code=400, detail="Десятилетие должно быть кратно 10, например 1990")
+    
+    return _load(
+        "top_rated",
+        lambda cursor: leaderboards.top_rated(cursor, decade=decade, min_reviews=min_reviews, limit=limit),
+        decade=decade,
+        min_reviews=min_reviews
+    )
+
+@router.get("/leaderboards/most-reviewed", response_model=models.Leaderboard)
+def get_most_reviewed(
+    limit: int = Query(10, ge=1, le=leaderboards.MAX_LIMIT, description="Размер рейтинга")
+):
+    """
+    Фильмы с наибольшим количеством отзывов
+    """
+    return _load("most_reviewed", lambda cursor: leaderboards.most_reviewed(cursor, limit=limit))
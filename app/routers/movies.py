@@ -1,39 +1,54 @@
 from fastapi import APIRouter, HTTPException, Request, Query
 from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
 from typing import List, Optional
+import os
+import app.aggregates as aggregates
+import app.catalogue as catalogue
 import app.database as database
+import app.jobs as jobs
+import app.leaderboards as leaderboards
 import app.models as models
+import app.statements as statements
+import app.tracing as tracing
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
+templates = tracing.trace_templates(Jinja2Templates(directory="templates"))
+
+# Максимальное количество ID в одном запросе /movies/batch
+MAX_BATCH_IDS = 100
+# Размеры HTML-страниц те же, что у страниц app/main.py
+HOME_PAGE_MOVIES = int(os.getenv('HOME_PAGE_MOVIES', '100'))
+MOVIE_PAGE_REVIEWS = int(os.getenv('MOVIE_PAGE_REVIEWS', '50'))
 
 @router.get("/", response_class=HTMLResponse)
-async def read_root(request: Request):
+def read_root(request: Request, page: int = Query(1, ge=1, description="Номер страницы")):
     """
-    Главная страница - список всех фильмов
+    Главная страница - фильмы по рейтингу, HOME_PAGE_MOVIES на страницу
     """
+    skip = (page - 1) * HOME_PAGE_MOVIES
+    connection = None
     try:
-        connection = database.get_db_connection()
-        with connection.cursor() as cursor:
-            sql = """
-            SELECT m.*, 
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            GROUP BY m.id
-            ORDER BY avg_rating DESC NULLS LAST
-            """
-            cursor.execute(sql)
-            movies = cursor.fetchall()
+        # На одну строку больше страницы, чтобы знать, есть ли следующая
+        snapshot = catalogue.get_snapshot()
+        if snapshot is not None:
+            movies = snapshot.movies(snapshot.query(order="rating", skip=skip, limit=HOME_PAGE_MOVIES + 1))
+        else:
+            connection = database.get_read_connection()
+            with connection.cursor() as cursor:
+                statements.execute(cursor, "movies_by_rating", (HOME_PAGE_MOVIES + 1, skip))
+                movies = database.fetch_dicts(cursor)
+        
+        for movie in movies:
+            movie['avg_rating'] = round(float(movie['avg_rating'] or 0), 1)
+            movie['release_year'] = movie['release_year'] or 'Не указан'
+            movie['duration_minutes'] = movie['duration_minutes'] or 'Не указана'
             
-            for movie in movies:
-                movie['avg_rating'] = round(float(movie['avg_rating'] or 0), 1)
-                movie['release_year'] = movie['release_year'] or 'Не указан'
-                movie['duration_minutes'] = movie['duration_minutes'] or 'Не указана'
-            
-        return models.templates.TemplateResponse("index.html", {
+        return templates.TemplateResponse("index.html", {
             "request": request, 
-            "movies": movies
+            "movies": movies[:HOME_PAGE_MOVIES],
+            "page": page,
+            "has_next": len(movies) > HOME_PAGE_MOVIES
         })
     
     except Exception as e:
@@ -44,7 +59,7 @@ async def read_root(request: Request):
             connection.close()
 
 @router.get("/movies", response_model=List[models.Movie])
-async def get_movies(
+def get_movies(
     skip: int = Query(0, ge=0, description="Пропустить записей"),
     limit: int = Query(100, ge=1, le=1000, description="Лимит записей"),
     genre: Optional[models.Genre] = Query(None, description="Фильтр по жанру")
@@ -54,26 +69,20 @@ async def get_movies(
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        # Список строится по снимку каталога процесса, пока он загружен
+        snapshot = catalogue.get_snapshot()
+        if snapshot is not None:
+            return snapshot.movies(snapshot.query(genre.value if genre else None, skip=skip, limit=limit))
+        
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            where_clause = "WHERE m.genre = %s" if genre else ""
-            params = [genre.value] if genre else []
-            
-            sql = f"""
-            SELECT m.*, 
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            {where_clause}
-            GROUP BY m.id
-            ORDER BY m.title
-            LIMIT %s OFFSET %s
-            """
-            params.extend([limit, skip])
-            
-            cursor.execute(sql, params)
-            movies = cursor.fetchall()
+            # Сначала выбираем страницу фильмов, затем считаем рейтинг
+            # только для них: каждый подзапрос читает одну секцию reviews
+            if genre:
+                statements.execute(cursor, "movies_page_by_genre", (genre.value, limit, skip))
+            else:
+                statements.execute(cursor, "movies_page", (limit, skip))
+            movies = database.fetch_dicts(cursor)
             
             for movie in movies:
                 movie['avg_rating'] = float(movie['avg_rating'])
@@ -88,7 +97,7 @@ async def get_movies(
             connection.close()
 
 @router.get("/movies/search", response_model=models.SearchResponse)
-async def search_movies(
+def search_movies(
     q: str = Query(..., min_length=2, max_length=100, description="Поисковый запрос"),
     limit: int = Query(20, ge=1, le=100, description="Лимит результатов")
 ):
@@ -97,33 +106,17 @@ async def search_movies(
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            sql = """
-            SELECT m.*, 
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            WHERE m.title ILIKE %s OR m.director ILIKE %s OR m.genre ILIKE %s
-            GROUP BY m.id
-            ORDER BY avg_rating DESC NULLS LAST
-            LIMIT %s
-            """
             search_term = f"%{q}%"
-            cursor.execute(sql, (search_term, search_term, search_term, limit))
-            movies = cursor.fetchall()
+            statements.execute(cursor, "movies_search", (search_term, limit))
+            movies = database.fetch_dicts(cursor)
             
             for movie in movies:
                 movie['avg_rating'] = float(movie['avg_rating'])
             
-            count_sql = """
-            SELECT COUNT(DISTINCT m.id) as total_count
-            FROM movies m
-            WHERE m.title ILIKE %s OR m.director ILIKE %s OR m.genre ILIKE %s
-            """
-            cursor.execute(count_sql, (search_term, search_term, search_term))
-            total_count = cursor.fetchone()['total_count']
+            statements.execute(cursor, "movies_search_count", (search_term,))
+            total_count = cursor.fetchone()[0]
             
         return models.SearchResponse(
             query=q,
@@ -138,33 +131,155 @@ async def search_movies(
         if connection:
             connection.close()
 
-@router.get("/movies/{movie_id}", response_class=HTMLResponse)
-async def get_movie_detail(request: Request, movie_id: int):
+@router.get("/movies/browse", response_model=models.BrowseResponse)
+def browse_movies(
+    genre: Optional[List[models.Genre]] = Query(None, description="Жанры (можно указать несколько)"),
+    year_from: Optional[int] = Query(None, ge=1888, le=2100, description="Год выпуска от"),
+    year_to: Optional[int] = Query(None, ge=1888, le=2100, description="Год выпуска до"),
+    duration_min: Optional[int] = Query(None, ge=1, le=500, description="Длительность от, мин"),
+    duration_max: Optional[int] = Query(None, ge=1, le=500, description="Длительность до, мин"),
+    min_rating: Optional[float] = Query(None, ge=1, le=10, description="Минимальный средний рейтинг"),
+    min_reviews: Optional[int] = Query(None, ge=0, description="Минимальное количество отзывов"),
+    sort: models.BrowseSort = Query(models.BrowseSort.TITLE, description="Сортировка"),
+    skip: int = Query(0, ge=0, description="Пропустить записей"),
+    limit: int = Query(20, ge=1, le=100, description="Лимит записей")
+):
     """
-    Страница фильма с детальной информацией и отзывами
+    Подбор фильмов по жанрам, годам, длительности и рейтингу.
+
+    Вместе со страницей возвращаются фасеты: количество фильмов по жанрам
+    (с учетом всех фильтров, кроме жанра) и по десятилетиям (всех, кроме года).
     """
+    if year_from is not None and year_to is not None and year_from > year_to:
+        raise HTTPException(status_code=400, detail="year_from больше year_to")
+    if duration_min is not None and duration_max is not None and duration_min > duration_max:
+        raise HTTPException(status_code=400, detail="duration_min больше duration_max")
+    
+    genres = [item.value for item in genre] if genre else None
+    connection = None
     try:
-        connection = database.get_db_connection()
+        snapshot = catalogue.get_snapshot()
+        if snapshot is not None:
+            positions, total_count, genre_counts, decade_counts = snapshot.browse(
+                genres, year_from, year_to, duration_min, duration_max,
+                min_rating, min_reviews, sort.value, skip, limit
+            )
+            return models.BrowseResponse(
+                results=snapshot.movies(positions),
+                total_count=total_count,
+                facets=models.BrowseFacets(genres=genre_counts, decades=decade_counts)
+            )
+        
+        filters = (genres, year_from, year_to, duration_min, duration_max, min_rating, min_reviews)
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT * FROM movies WHERE id = %s", (movie_id,))
-            movie = cursor.fetchone()
+            statements.execute(cursor, "movies_browse", filters + (sort.value, limit, skip))
+            movies = database.fetch_dicts(cursor)
+            for movie in movies:
+                movie['avg_rating'] = float(movie['avg_rating'])
+            
+            # Строки фасетов: (facet, value, count)
+            statements.execute(cursor, "movies_browse_facets", filters)
+            facets = cursor.fetchall()
+        
+        return models.BrowseResponse(
+            results=movies,
+            total_count=next((count for facet, _, count in facets if facet == 'total'), 0),
+            facets=models.BrowseFacets(
+                genres={value: count for facet, value, count in facets if facet == 'genre'},
+                decades={int(value): count for facet, value, count in facets if facet == 'decade'}
+            )
+        )
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
+
+@router.get("/movies/batch", response_model=List[models.Movie])
+def get_movies_batch(
+    ids: str = Query(..., description=f"ID фильмов через запятую (не более {MAX_BATCH_IDS})")
+):
+    """
+    Получить несколько фильмов с рейтингом одним запросом (API).
+
+    Принимает до MAX_BATCH_IDS идентификаторов, дубликаты игнорируются.
+    Фильмы возвращаются в порядке переданных ID, отсутствующие пропускаются.
+    """
+    try:
+        movie_ids = list(dict.fromkeys(int(part) for part in ids.split(",") if part.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ID фильмов должны быть целыми числами")
+    
+    if not movie_ids:
+        raise HTTPException(status_code=400, detail="Не указаны ID фильмов")
+    if len(movie_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Можно запросить не более {MAX_BATCH_IDS} фильмов")
+    
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "movies_batch", (movie_ids,))
+            movies = {movie['id']: movie for movie in database.fetch_dicts(cursor)}
+            
+            for movie in movies.values():
+                movie['avg_rating'] = float(movie['avg_rating'])
+            
+        return [movies[movie_id] for movie_id in movie_ids if movie_id in movies]
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
+
+def load_movie_detail(movie_id):
+    """
+    Фильм с распределением оценок и его последние MOVIE_PAGE_REVIEWS
+    отзывов или None, если фильма нет
+    """
+    connection = database.get_read_connection()
+    try:
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "movie_by_id", (movie_id,))
+            movie = database.fetch_dict(cursor)
             
             if not movie:
-                raise HTTPException(status_code=404, detail="Фильм не найден")
+                return None
             
-            cursor.execute("""
-                SELECT * FROM reviews 
-                WHERE movie_id = %s 
-                ORDER BY created_at DESC
-            """, (movie_id,))
-            reviews = cursor.fetchall()
+            statements.execute(cursor, "reviews_by_movie_latest", (movie_id, MOVIE_PAGE_REVIEWS))
+            reviews = database.fetch_dicts(cursor)
             
-            cursor.execute("SELECT AVG(rating) as avg_rating FROM reviews WHERE movie_id = %s", (movie_id,))
-            avg_result = cursor.fetchone()
-            movie['avg_rating'] = round(float(avg_result['avg_rating'] or 0), 1)
-            movie['review_count'] = len(reviews)
+            statements.execute(cursor, "movie_rating_counts", (movie_id,))
+            ratings = aggregates.rating_summary(
+                cursor.fetchone()[0], leaderboards.global_mean(cursor)
+            )
+            movie['avg_rating'] = round(ratings['avg_rating'], 1)
+            movie['review_count'] = ratings['review_count']
+            movie['ratings'] = ratings
             
-        return models.templates.TemplateResponse("movie_detail.html", {
+        return movie, reviews
+    finally:
+        connection.close()
+
+@router.get("/movies/{movie_id}", response_class=HTMLResponse)
+async def get_movie_detail(request: Request, movie_id: int):
+    """
+    Страница фильма с детальной информацией и отзывами
+    """
+    try:
+        # Одновременные запросы одного фильма читают БД один раз
+        page = await database.reads.do(("movie_detail", movie_id), load_movie_detail, movie_id)
+        
+        if page is None:
+            raise HTTPException(status_code=404, detail="Фильм не найден")
+        
+        movie, reviews = page
+        return templates.TemplateResponse("movie_detail.html", {
             "request": request,
             "movie": movie,
             "reviews": reviews
@@ -174,38 +289,52 @@ async def get_movie_detail(request: Request, movie_id: int):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
-    
-    finally:
-        if connection:
-            connection.close()
 
-@router.get("/movies/{movie_id}/info", response_model=models.Movie)
-async def get_movie_info(movie_id: int):
+def load_movie_info(movie_id):
     """
-    Получить информацию о фильме по ID (API)
+    Фильм с распределением оценок или None, если фильма нет
     """
-    connection = None
+    connection = database.get_read_connection()
     try:
-        connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            sql = """
-            SELECT m.*, 
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            WHERE m.id = %s
-            GROUP BY m.id
-            """
-            cursor.execute(sql, (movie_id,))
-            movie = cursor.fetchone()
+            statements.execute(cursor, "movie_info", (movie_id,))
+            movie = database.fetch_dict(cursor)
             
             if not movie:
-                raise HTTPException(status_code=404, detail="Фильм не найден")
+                return None
             
-            movie['avg_rating'] = float(movie['avg_rating'])
+            ratings = aggregates.rating_summary(
+                movie.pop('rating_counts'), leaderboards.global_mean(cursor)
+            )
+            movie['avg_rating'] = ratings['avg_rating']
+            movie['review_count'] = ratings['review_count']
+            movie['ratings'] = ratings
             
         return movie
+    finally:
+        connection.close()
+
+@router.get("/movies/{movie_id}/deletion", response_model=models.MovieDeletion)
+def get_movie_deletion(movie_id: int):
+    """
+    Прогресс удаления фильма: сколько отзывов уже удалено
+    """
+    connection = None
+    try:
+        connection = database.get_db_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "movie_deletion", (movie_id,))
+            deletion = database.fetch_dict(cursor)
+            
+            if not deletion:
+                raise HTTPException(status_code=404, detail="Удаление фильма не найдено")
+        
+        total = deletion['total_reviews']
+        if deletion['finished_at'] or not total:
+            progress = 1.0 if deletion['finished_at'] else 0.0
+        else:
+            progress = min(1.0, deletion['deleted_reviews'] / total)
+        return models.MovieDeletion(**deletion, progress=progress)
     
     except HTTPException:
         raise
@@ -216,8 +345,26 @@ async def get_movie_info(movie_id: int):
         if connection:
             connection.close()
 
+@router.get("/movies/{movie_id}/info", response_model=models.MovieInfo)
+async def get_movie_info(movie_id: int):
+    """
+    Получить информацию о фильме по ID с распределением оценок (API)
+    """
+    try:
+        movie = await database.reads.do(("movie_info", movie_id), load_movie_info, movie_id)
+        
+        if movie is None:
+            raise HTTPException(status_code=404, detail="Фильм не найден")
+        
+        return movie
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
+
 @router.post("/movies", response_model=dict)
-async def create_movie(movie: models.MovieCreate):
+def create_movie(movie: models.MovieCreate):
     """
     Создать новый фильм
     """
@@ -225,12 +372,7 @@ async def create_movie(movie: models.MovieCreate):
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            sql = """
-            INSERT INTO movies (title, director, release_year, genre, description, duration_minutes)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-            """
-            cursor.execute(sql, (
+            statements.execute(cursor, "movie_insert", (
                 movie.title,
                 movie.director,
                 movie.release_year,
@@ -238,7 +380,7 @@ async def create_movie(movie: models.MovieCreate):
                 movie.description,
                 movie.duration_minutes
             ))
-            movie_id = cursor.fetchone()['id']
+            movie_id = cursor.fetchone()[0]
             connection.commit()
             
         return {"message": "Фильм успешно создан", "movie_id": movie_id}
@@ -253,7 +395,7 @@ async def create_movie(movie: models.MovieCreate):
             connection.close()
 
 @router.put("/movies/{movie_id}", response_model=dict)
-async def update_movie(movie_id: int, movie_update: models.MovieUpdate):
+def update_movie(movie_id: int, movie_update: models.MovieUpdate):
     """
     Обновить информацию о фильме
     """
@@ -261,40 +403,23 @@ async def update_movie(movie_id: int, movie_update: models.MovieUpdate):
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_exists", (movie_id,))
             if not cursor.fetchone():
                 raise HTTPException(status_code=404, detail="Фильм не найден")
             
-            update_fields = []
-            params = []
-            
-            if movie_update.title is not None:
-                update_fields.append("title = %s")
-                params.append(movie_update.title)
-            if movie_update.director is not None:
-                update_fields.append("director = %s")
-                params.append(movie_update.director)
-            if movie_update.release_year is not None:
-                update_fields.append("release_year = %s")
-                params.append(movie_update.release_year)
-            if movie_update.genre is not None:
-                update_fields.append("genre = %s")
-                params.append(movie_update.genre.value)
-            if movie_update.description is not None:
-                update_fields.append("description = %s")
-                params.append(movie_update.description)
-            if movie_update.duration_minutes is not None:
-                update_fields.append("duration_minutes = %s")
-                params.append(movie_update.duration_minutes)
-            
-            if not update_fields:
+            fields = movie_update.dict(exclude_none=True)
+            if not fields:
                 raise HTTPException(status_code=400, detail="Нет данных для обновления")
             
-            update_fields.append("updated_at = CURRENT_TIMESTAMP")
-            params.append(movie_id)
-            
-            sql = f"UPDATE movies SET {', '.join(update_fields)} WHERE id = %s"
-            cursor.execute(sql, params)
+            statements.execute(cursor, "movie_update", (
+                movie_id,
+                movie_update.title,
+                movie_update.director,
+                movie_update.release_year,
+                movie_update.genre.value if movie_update.genre else None,
+                movie_update.description,
+                movie_update.duration_minutes
+            ))
             connection.commit()
             
         return {"message": "Фильм успешно обновлен"}
@@ -311,22 +436,36 @@ async def update_movie(movie_id: int, movie_update: models.MovieUpdate):
             connection.close()
 
 @router.delete("/movies/{movie_id}", response_model=dict)
-async def delete_movie(movie_id: int):
+def delete_movie(movie_id: int):
     """
-    Удалить фильм
+    Удалить фильм.
+
+    Фильм сразу скрывается, его рейтинг и гистограммы снимаются в той же
+    транзакции, а отзывы удаляет фоновая задача purge_movie пачками.
+    Прогресс - GET /movies/{movie_id}/deletion
     """
     connection = None
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id FROM movies WHERE id = %s", (movie_id,))
-            if not cursor.fetchone():
+            statements.execute(cursor, "movie_hide", (movie_id,))
+            movie = cursor.fetchone()
+            if not movie:
                 raise HTTPException(status_code=404, detail="Фильм не найден")
             
-            cursor.execute("DELETE FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_stats_detach", (movie_id,))
+            stats = cursor.fetchone()
+            statements.execute(cursor, "movie_rollups_detach", (movie_id,))
+            job_id = jobs.enqueue(cursor, "purge_movie", {'movie_id': movie_id}, dedupe_key=f"purge_movie:{movie_id}")
+            statements.execute(
+                cursor, "movie_deletion_start",
+                (movie_id, movie[0], stats[0] if stats else 0, job_id)
+            )
             connection.commit()
-            
-        return {"message": "Фильм успешно удален"}
+        
+        # Страница фильма, снимок каталога и рейтинги сбрасываются
+        # в каждом воркере по событию movie_updated (скрытие фильма)
+        return {"message": "Фильм удален, отзывы удаляются в фоне", "job_id": job_id}
     
     except HTTPException:
         raise
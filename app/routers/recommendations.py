@@ -0,0 +1,75 @@
+from fastapi import APIRouter, HTTPException, Query
+import app.database as database
+import app.models as models
+import app.recommendations as recommendations
+import app.statements as statements
+import app.tracing as tracing
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+def _get_index():
+    index = recommendations.get_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="Индекс рекомендаций еще строится")
+    return index
+
+def _with_movies(cursor, scored):
+    """Дополняет пары (movie_id, score) данными фильмов, сохраняя порядок"""
+    if not scored:
+        return []
+    statements.execute(cursor, "movies_summary_batch", ([movie_id for movie_id, _ in scored],))
+    movies = {movie['id']: movie for movie in database.fetch_dicts(cursor)}
+    return [
+        {**movies[movie_id], 'score': round(score, 4)}
+        for movie_id, score in scored if movie_id in movies
+    ]
+
+@router.get("/movies/{movie_id}/similar", response_model=models.RecommendationsResponse)
+def get_similar_movies(
+    movie_id: int,
+    limit: int = Query(10, ge=1, le=recommendations.NEIGHBOURS, description="Количество фильмов")
+):
+    """
+    Похожие фильмы по оценкам пользователей
+    """
+    index = _get_index()
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            results = _with_movies(cursor, index.similar(movie_id, limit))
+            
+        return models.RecommendationsResponse(movie_id=movie_id, results=results)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения рекомендаций: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
+
+@router.get("/users/{user_name}/recommendations", response_model=models.RecommendationsResponse)
+def get_user_recommendations(
+    user_name: str,
+    limit: int = Query(10, ge=1, le=50, description="Количество фильмов")
+):
+    """
+    Рекомендации пользователю по его оценкам
+    """
+    index = _get_index()
+    connection = None
+    try:
+        connection = database.get_read_connection()
+        with connection.cursor() as cursor:
+            statements.execute(cursor, "ratings_by_user", (models.normalize_user_key(user_name),))
+            user_ratings = dict(cursor.fetchall())
+            results = _with_movies(cursor, index.recommend(user_ratings, limit))
+            
+        return models.RecommendationsResponse(user_name=user_name, results=results)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения рекомендаций: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
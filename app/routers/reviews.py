@@ -1,13 +1,34 @@
 from fastapi import APIRouter, HTTPException, Request, Form, Query
 from fastapi.responses import RedirectResponse
 from typing import List, Optional
+from datetime import datetime
+import base64
+import app.aggregates as aggregates
 import app.database as database
+import app.dedup as dedup
 import app.models as models
+import app.statements as statements
+import app.tracing as tracing
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
+
+# Максимальное количество отзывов в одном запросе /reviews/bulk
+MAX_BULK_REVIEWS = 500
+
+def encode_cursor(review):
+    """Курсор страницы: дата и ID последнего отзыва на странице"""
+    value = f"{review['created_at'].isoformat()}|{review['id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+def decode_cursor(cursor_value):
+    try:
+        created_at, review_id = base64.urlsafe_b64decode(cursor_value.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(review_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
 
 @router.post("/movies/{movie_id}/reviews", response_model=dict)
-async def add_review(movie_id: int, review: models.ReviewCreate):
+def add_review(movie_id: int, review: models.ReviewCreate):
     """
     Добавить отзыв к фильму (API)
     """
@@ -15,29 +36,28 @@ async def add_review(movie_id: int, review: models.ReviewCreate):
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id, title FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_title_by_id", (movie_id,))
             movie = cursor.fetchone()
             if not movie:
                 raise HTTPException(status_code=404, detail="Фильм не найден")
             
-            sql = """
-            INSERT INTO reviews (movie_id, user_name, rating, review_text) 
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            """
-            cursor.execute(sql, (
+            user_key = models.normalize_user_key(review.user_name)
+            statements.execute(cursor, "review_insert", (
                 movie_id,
                 review.user_name,
                 review.rating,
-                review.review_text
+                review.review_text,
+                user_key
             ))
-            review_id = cursor.fetchone()['id']
+            review_id = cursor.fetchone()[0]
+            aggregates.record_review(cursor, movie_id, review.rating, user_key)
+            dedup.record_review(cursor, review_id, movie_id, user_key, review.review_text)
             connection.commit()
             
         return {
             "message": "Отзыв успешно добавлен",
             "review_id": review_id,
-            "movie_title": movie['title']
+            "movie_title": movie[1]
         }
     
     except HTTPException:
@@ -52,7 +72,7 @@ async def add_review(movie_id: int, review: models.ReviewCreate):
             connection.close()
 
 @router.post("/movies/{movie_id}/reviews/web")
-async def add_review_web(
+def add_review_web(
     request: Request,
     movie_id: int,
     user_name: str = Form(..., min_length=1, max_length=100),
@@ -65,15 +85,16 @@ async def add_review_web(
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_exists", (movie_id,))
             if not cursor.fetchone():
                 raise HTTPException(status_code=404, detail="Фильм не найден")
             
-            sql = """
-            INSERT INTO reviews (movie_id, user_name, rating, review_text) 
-            VALUES (%s, %s, %s, %s)
-            """
-            cursor.execute(sql, (movie_id, user_name.strip(), rating, review_text.strip() or None))
+            user_key = models.normalize_user_key(user_name)
+            review_text = review_text.strip() or None
+            statements.execute(cursor, "review_insert", (movie_id, user_name.strip(), rating, review_text, user_key))
+            review_id = cursor.fetchone()[0]
+            aggregates.record_review(cursor, movie_id, rating, user_key)
+            dedup.record_review(cursor, review_id, movie_id, user_key, review_text)
             connection.commit()
             
         return RedirectResponse(url=f"/movies/{movie_id}", status_code=303)
@@ -89,8 +110,73 @@ async def add_review_web(
         if connection:
             connection.close()
 
+@router.post("/reviews/bulk", response_model=dict)
+def add_reviews_bulk(reviews: List[models.ReviewCreate]):
+    """
+    Добавить несколько отзывов в одной транзакции (API).
+
+    Каждый элемент проверяется моделью ReviewCreate. Принимается не более
+    MAX_BULK_REVIEWS отзывов; если хотя бы один фильм не найден,
+    не добавляется ни один отзыв.
+    """
+    if not reviews:
+        raise HTTPException(status_code=400, detail="Список отзывов пуст")
+    if len(reviews) > MAX_BULK_REVIEWS:
+        raise HTTPException(status_code=400, detail=f"Можно добавить не более {MAX_BULK_REVIEWS} отзывов за раз")
+    
+    connection = None
+    try:
+        connection = database.get_db_connection()
+        with connection.cursor() as cursor:
+            movie_ids = list({review.movie_id for review in reviews})
+            statements.execute(cursor, "movies_existing", (movie_ids,))
+            found_ids = {row[0] for row in cursor.fetchall()}
+            missing_ids = sorted(set(movie_ids) - found_ids)
+            if missing_ids:
+                raise HTTPException(status_code=404, detail=f"Фильмы не найдены: {missing_ids}")
+            
+            user_keys = [models.normalize_user_key(review.user_name) for review in reviews]
+            statements.execute(cursor, "reviews_insert_many", (
+                [review.movie_id for review in reviews],
+                [review.user_name for review in reviews],
+                [review.rating for review in reviews],
+                [review.review_text for review in reviews],
+                user_keys
+            ))
+            # ID сопоставляются с отзывами по номеру во входном списке
+            review_ids = [None] * len(reviews)
+            for review_id, position in cursor.fetchall():
+                review_ids[position - 1] = review_id
+            aggregates.record_reviews(
+                cursor,
+                [review.movie_id for review in reviews],
+                [review.rating for review in reviews],
+                user_keys
+            )
+            dedup.record_reviews(cursor, [
+                (review_id, review.movie_id, user_key, review.review_text)
+                for review_id, review, user_key in zip(review_ids, reviews, user_keys)
+            ])
+            connection.commit()
+            
+        return {
+            "message": "Отзывы успешно добавлены",
+            "review_ids": review_ids
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise HTTPException(status_code=500, detail=f"Ошибка добавления отзывов: {str(e)}")
+    
+    finally:
+        if connection:
+            connection.close()
+
 @router.get("/movies/{movie_id}/reviews", response_model=List[models.Review])
-async def get_movie_reviews(
+def get_movie_reviews(
     movie_id: int,
     skip: int = Query(0, ge=0, description="Пропустить записей"),
     limit: int = Query(50, ge=1, le=100, description="Лимит записей"),
@@ -101,27 +187,16 @@ async def get_movie_reviews(
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id FROM movies WHERE id = %s", (movie_id,))
+            statements.execute(cursor, "movie_exists", (movie_id,))
             if not cursor.fetchone():
                 raise HTTPException(status_code=404, detail="Фильм не найден")
             
-            order_by = {
-                "newest": "created_at DESC",
-                "oldest": "created_at ASC",
-                "highest": "rating DESC, created_at DESC",
-                "lowest": "rating ASC, created_at DESC"
-            }.get(sort, "created_at DESC")
-            
-            sql = f"""
-            SELECT * FROM reviews 
-            WHERE movie_id = %s 
-            ORDER BY {order_by}
-            LIMIT %s OFFSET %s
-            """
-            cursor.execute(sql, (movie_id, limit, skip))
-            reviews = cursor.fetchall()
+            if sort not in statements.REVIEW_SORTS:
+                sort = "newest"
+            statements.execute(cursor, f"reviews_by_movie_{sort}", (movie_id, limit, skip))
+            reviews = database.fetch_dicts(cursor)
             
         return reviews
     
@@ -135,23 +210,16 @@ async def get_movie_reviews(
             connection.close()
 
 @router.get("/reviews/latest", response_model=List[models.Review])
-async def get_latest_reviews(limit: int = Query(10, ge=1, le=50)):
+def get_latest_reviews(limit: int = Query(10, ge=1, le=50)):
     """
     Получить последние отзывы
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            sql = """
-            SELECT r.*, m.title as movie_title
-            FROM reviews r
-            JOIN movies m ON r.movie_id = m.id
-            ORDER BY r.created_at DESC
-            LIMIT %s
-            """
-            cursor.execute(sql, (limit,))
-            reviews = cursor.fetchall()
+            statements.execute(cursor, "reviews_latest", (limit,))
+            reviews = database.fetch_dicts(cursor)
             
         return reviews
     
@@ -162,26 +230,42 @@ async def get_latest_reviews(limit: int = Query(10, ge=1, le=50)):
         if connection:
             connection.close()
 
-@router.get("/reviews/user/{user_name}", response_model=List[models.Review])
-async def get_user_reviews(user_name: str):
+@router.get("/reviews/user/{user_name}", response_model=models.UserReviewsPage)
+def get_user_reviews(
+    user_name: str,
+    limit: int = Query(20, ge=1, le=100, description="Лимит записей"),
+    cursor: Optional[str] = Query(None, description="Курсор из next_cursor предыдущей страницы")
+):
     """
-    Получить все отзывы пользователя
+    Получить историю отзывов пользователя постранично (от новых к старым)
+    вместе с количеством отзывов и средней оценкой
     """
+    user_key = models.normalize_user_key(user_name)
+    after = decode_cursor(cursor) if cursor else None
+    
     connection = None
     try:
-        connection = database.get_db_connection()
-        with connection.cursor() as cursor:
-            sql = """
-            SELECT r.*, m.title as movie_title
-            FROM reviews r
-            JOIN movies m ON r.movie_id = m.id
-            WHERE r.user_name ILIKE %s
-            ORDER BY r.created_at DESC
-            """
-            cursor.execute(sql, (user_name,))
-            reviews = cursor.fetchall()
+        connection = database.get_read_connection()
+        with connection.cursor() as db_cursor:
+            if after:
+                statements.execute(db_cursor, "reviews_by_user_after", (user_key, after[0], after[1], limit + 1))
+            else:
+                statements.execute(db_cursor, "reviews_by_user_first", (user_key, limit + 1))
+            reviews = database.fetch_dicts(db_cursor)
             
-        return reviews
+            statements.execute(db_cursor, "user_stats", (user_key,))
+            review_count, rating_sum = db_cursor.fetchone() or (0, 0)
+            
+        has_more = len(reviews) > limit
+        reviews = reviews[:limit]
+        
+        return models.UserReviewsPage(
+            user_name=user_name,
+            review_count=review_count,
+            avg_rating=round(rating_sum / review_count, 2) if review_count else None,
+            reviews=reviews,
+            next_cursor=encode_cursor(reviews[-1]) if has_more else None
+        )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения отзывов: {str(e)}")
@@ -190,20 +274,21 @@ async def get_user_reviews(user_name: str):
         if connection:
             connection.close()
 
-@router.delete("/reviews/{review_id}", response_model=dict)
-async def delete_review(review_id: int):
-    """
-    Удалить отзыв
-    """
+def _delete_review(review_id, movie_id=None):
     connection = None
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id FROM reviews WHERE id = %s", (review_id,))
-            if not cursor.fetchone():
+            if movie_id is None:
+                statements.execute(cursor, "review_delete_any_movie", (review_id,))
+            else:
+                statements.execute(cursor, "review_delete", (review_id, movie_id))
+            review = cursor.fetchone()
+            # Нет строки - отзыва нет или его уже удалил параллельный запрос
+            if not review:
                 raise HTTPException(status_code=404, detail="Отзыв не найден")
             
-            cursor.execute("DELETE FROM reviews WHERE id = %s", (review_id,))
+            aggregates.forget_review(cursor, *review)
             connection.commit()
             
         return {"message": "Отзыв успешно удален"}
@@ -217,4 +302,21 @@ async def delete_review(review_id: int):
     
     finally:
         if connection:
-            connection.close()
\ No newline at end of file
+            connection.close()
+
+@router.delete("/movies/{movie_id}/reviews/{review_id}", response_model=dict)
+def delete_movie_review(movie_id: int, review_id: int):
+    """
+    Удалить отзыв фильма: поиск и удаление читают одну секцию reviews
+    """
+    return _delete_review(review_id, movie_id)
+
+@router.delete("/reviews/{review_id}", response_model=dict)
+def delete_review(
+    review_id: int,
+    movie_id: Optional[int] = Query(None, description="ID фильма отзыва: поиск в одной секции вместо всех")
+):
+    """
+    Удалить отзыв
+    """
+    return _delete_review(review_id, movie_id)
@@ -1,12 +1,15 @@
 from fastapi import APIRouter, HTTPException, Query
 from typing import List
+import app.cache as cache
 import app.database as database
 import app.models as models
+import app.statements as statements
+import app.tracing as tracing
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 @router.get("/users", response_model=List[models.User])
-async def get_users(
+def get_users(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000)
 ):
@@ -15,15 +18,10 @@ async def get_users(
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            sql = """
-            SELECT * FROM users 
-            ORDER BY created_at DESC
-            LIMIT %s OFFSET %s
-            """
-            cursor.execute(sql, (limit, skip))
-            users = cursor.fetchall()
+            statements.execute(cursor, "users_page", (limit, skip))
+            users = database.fetch_dicts(cursor)
             
         return users
     
@@ -35,7 +33,7 @@ async def get_users(
             connection.close()
 
 @router.post("/users", response_model=dict)
-async def create_user(user: models.UserCreate):
+def create_user(user: models.UserCreate):
     """
     Создать нового пользователя
     """
@@ -43,19 +41,13 @@ async def create_user(user: models.UserCreate):
     try:
         connection = database.get_db_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id FROM users WHERE username = %s OR email = %s", 
-                         (user.username, user.email))
+            statements.execute(cursor, "user_by_username_or_email", (user.username, user.email))
             existing_user = cursor.fetchone()
             if existing_user:
                 raise HTTPException(status_code=400, detail="Пользователь с таким username или email уже существует")
             
-            sql = """
-            INSERT INTO users (username, email)
-            VALUES (%s, %s)
-            RETURNING id
-            """
-            cursor.execute(sql, (user.username, user.email))
-            user_id = cursor.fetchone()['id']
+            statements.execute(cursor, "user_insert", (user.username, user.email))
+            user_id = cursor.fetchone()[0]
             connection.commit()
             
         return {"message": "Пользователь успешно создан", "user_id": user_id}
@@ -72,16 +64,16 @@ async def create_user(user: models.UserCreate):
             connection.close()
 
 @router.get("/users/{user_id}", response_model=models.User)
-async def get_user(user_id: int):
+def get_user(user_id: int):
     """
     Получить пользователя по ID
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-            user = cursor.fetchone()
+            statements.execute(cursor, "user_by_id", (user_id,))
+            user = database.fetch_dict(cursor)
             
             if not user:
                 raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -97,48 +89,48 @@ async def get_user(user_id: int):
         if connection:
             connection.close()
 
-@router.get("/stats", response_model=models.StatsResponse)
-async def get_stats():
+# Статистика меняется медленно, поэтому воркер держит ее в кеше
+stats_cache = cache.TTLCache("stats", cache.PAGE_TTL)
+
+def load_stats():
     """
-    Получить статистику по фильмам и отзывам
+    Статистика из site_stats (пересчитывает фоновая задача refresh_stats);
+    пока задача ни разу не выполнялась, статистика считается по таблицам
     """
     connection = None
     try:
-        connection = database.get_db_connection()
+        connection = database.get_read_connection()
         with connection.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) as total_movies FROM movies")
-            total_movies = cursor.fetchone()['total_movies']
+            statements.execute(cursor, "site_stats")
+            stats = database.fetch_dict(cursor)
+            if stats:
+                return models.StatsResponse(
+                    total_movies=stats['total_movies'],
+                    total_reviews=stats['total_reviews'],
+                    average_rating=round(float(stats['average_rating'] or 0), 2),
+                    top_genre=stats['top_genre'],
+                    most_reviewed_movie=stats['most_reviewed_movie'],
+                    total_users=stats['total_users']
+                )
             
-            cursor.execute("SELECT COUNT(*) as total_reviews FROM reviews")
-            total_reviews = cursor.fetchone()['total_reviews']
+            statements.execute(cursor, "stats_movies")
+            total_movies = cursor.fetchone()[0]
             
-            cursor.execute("SELECT COUNT(*) as total_users FROM users")
-            total_users = cursor.fetchone()['total_users']
+            # Количество и средний рейтинг за один проход по reviews
+            statements.execute(cursor, "stats_reviews")
+            total_reviews, avg_rating = cursor.fetchone()
             
-            cursor.execute("SELECT AVG(rating) as avg_rating FROM reviews")
-            avg_rating = cursor.fetchone()['avg_rating']
+            statements.execute(cursor, "stats_users")
+            total_users = cursor.fetchone()[0]
             
-            cursor.execute("""
-                SELECT genre, COUNT(*) as count 
-                FROM movies 
-                WHERE genre IS NOT NULL 
-                GROUP BY genre 
-                ORDER BY count DESC 
-                LIMIT 1
-            """)
+            statements.execute(cursor, "stats_top_genre")
             top_genre_result = cursor.fetchone()
-            top_genre = top_genre_result['genre'] if top_genre_result else None
+            top_genre = top_genre_result[0] if top_genre_result else None
             
-            cursor.execute("""
-                SELECT m.title, COUNT(r.id) as review_count
-                FROM movies m
-                LEFT JOIN reviews r ON m.id = r.movie_id
-                GROUP BY m.id, m.title
-                ORDER BY review_count DESC
-                LIMIT 1
-            """)
+            # Группировка по movie_id выполняется отдельно в каждой секции
+            statements.execute(cursor, "stats_most_reviewed")
             most_reviewed = cursor.fetchone()
-            most_reviewed_movie = most_reviewed['title'] if most_reviewed else None
+            most_reviewed_movie = most_reviewed[0] if most_reviewed else None
             
         return models.StatsResponse(
             total_movies=total_movies,
@@ -149,9 +141,17 @@ async def get_stats():
             total_users=total_users
         )
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка получения статистики: {str(e)}")
-    
     finally:
         if connection:
-            connection.close()
\ No newline at end of file
+            connection.close()
+
+@router.get("/stats", response_model=models.StatsResponse)
+async def get_stats():
+    """
+    Получить статистику по фильмам и отзывам
+    """
+    try:
+        return await stats_cache.aget_or_load("stats", load_stats)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения статистики: {str(e)}")
@@ -0,0 +1,967 @@
+"""
+Реестр именованных SQL-запросов.
+
+Каждый запрос подготавливается (PREPARE) один раз на подключение из пула
+и далее выполняется через EXECUTE, поэтому PostgreSQL не разбирает и не
+планирует его текст заново при каждом вызове. Параметры запросов
+типизированы и передаются как $1, $2, ...
+
+Время планирования текста запроса и EXECUTE на данных текущей базы:
+    python -m app.statements bench
+"""
+
+import argparse
+import json
+import re
+import statistics
+import time
+
+from app import tracing
+
+
+class Statement:
+    """Именованный запрос с типами параметров"""
+
+    def __init__(self, name, param_types, sql):
+        self.name = name
+        self.param_types = tuple(param_types)
+        self.sql = sql
+
+    def prepare_sql(self):
+        types = f" ({', '.join(self.param_types)})" if self.param_types else ""
+        return f"PREPARE {self.name}{types} AS {self.sql}"
+
+    def execute_sql(self):
+        if not self.param_types:
+            return f"EXECUTE {self.name}"
+        placeholders = ", ".join(["%s"] * len(self.param_types))
+        return f"EXECUTE {self.name} ({placeholders})"
+
+
+STATEMENTS = {}
+
+
+def register(name, param_types, sql):
+    """
+    Регистрирует именованный запрос
+    """
+    if name in STATEMENTS:
+        raise ValueError(f"Запрос {name} уже зарегистрирован")
+    STATEMENTS[name] = Statement(name, param_types, sql)
+    return STATEMENTS[name]
+
+
+def execute(cursor, name, params=()):
+    """
+    Выполняет именованный запрос, подготавливая его на подключении
+    курсора при первом использовании
+    """
+    statement = STATEMENTS[name]
+    if len(params) != len(statement.param_types):
+        raise ValueError(
+            f"Запрос {name} ожидает {len(statement.param_types)} параметров, передано {len(params)}"
+        )
+
+    with tracing.span("db.query", **{"db.statement": name}) as current:
+        connection = cursor.connection
+        prepared = getattr(connection, "prepared", None)
+        if prepared is None:
+            prepared = connection.prepared = set()
+        if name not in prepared:
+            current.set_attribute("db.prepare", True)
+            cursor.execute(statement.prepare_sql())
+            prepared.add(name)
+
+        cursor.execute(statement.execute_sql(), tuple(params))
+
+
+# --- Фильмы ---
+
+# Скрытые фильмы (deleted_at) не показываются нигде, пока фоновая задача
+# purge_movie удаляет их отзывы (migrations/009_soft_delete.sql)
+
+# Сортировка по рейтингу читает готовые агрегаты из movie_stats. При
+# равном рейтинге - по названию и id, как CatalogueSnapshot.rating_order:
+# страницы из снимка и из базы совпадают
+register("movies_by_rating", ["integer", "integer"], """
+    SELECT m.*,
+           COALESCE(s.rating_sum::float / NULLIF(s.review_count, 0), 0) as avg_rating,
+           COALESCE(s.review_count, 0) as review_count
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.deleted_at IS NULL
+    ORDER BY avg_rating DESC, m.title, m.id
+    LIMIT $1 OFFSET $2
+""")
+
+register("movies_summary_by_rating", [], """
+    SELECT m.id, m.title, m.director, m.release_year, m.genre,
+           COALESCE(s.rating_sum::float / NULLIF(s.review_count, 0), 0) as avg_rating,
+           COALESCE(s.review_count, 0) as review_count
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.deleted_at IS NULL
+    ORDER BY avg_rating DESC, m.title, m.id
+""")
+
+# Страница главной: память воркера не растет с размером каталога
+register("movies_summary_by_rating_page", ["integer", "integer"], """
+    SELECT m.id, m.title, m.director, m.release_year, m.genre,
+           COALESCE(s.rating_sum::float / NULLIF(s.review_count, 0), 0) as avg_rating,
+           COALESCE(s.review_count, 0) as review_count
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.deleted_at IS NULL
+    ORDER BY avg_rating DESC, m.title, m.id
+    LIMIT $1 OFFSET $2
+""")
+
+# Снимок каталога в памяти процесса (app/catalogue.py)
+register("catalogue_snapshot", [], """
+    SELECT m.id, m.title, m.director, m.release_year, m.genre, m.description,
+           m.duration_minutes, m.created_at,
+           COALESCE(s.review_count, 0), COALESCE(s.rating_sum, 0)
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.deleted_at IS NULL
+    ORDER BY m.title, m.id
+""")
+
+# Фильтры /movies/browse: NULL - фильтр не задан. Жанры и год не входят
+# в общий список, потому что фасеты по ним считаются без своего фильтра
+_BROWSE_GENRE = "($1::varchar[] IS NULL OR m.genre = ANY($1))"
+_BROWSE_YEAR = "($2::integer IS NULL OR m.release_year >= $2) AND ($3::integer IS NULL OR m.release_year <= $3)"
+_BROWSE_FILTERS = """
+    m.deleted_at IS NULL
+    AND ($4::integer IS NULL OR m.duration_minutes >= $4)
+    AND ($5::integer IS NULL OR m.duration_minutes <= $5)
+    AND ($6::float8 IS NULL OR s.rating_sum::float8 / NULLIF(s.review_count, 0) >= $6)
+    AND ($7::integer IS NULL OR COALESCE(s.review_count, 0) >= $7)
+"""
+_BROWSE_TYPES = ["varchar[]", "integer", "integer", "integer", "integer", "float8", "integer"]
+
+register("movies_browse", _BROWSE_TYPES + ["varchar", "integer", "integer"], f"""
+    SELECT m.*,
+           COALESCE(s.rating_sum::float8 / NULLIF(s.review_count, 0), 0) as avg_rating,
+           COALESCE(s.review_count, 0) as review_count
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE {_BROWSE_GENRE} AND {_BROWSE_YEAR} AND {_BROWSE_FILTERS}
+    ORDER BY
+        CASE WHEN $8 = 'rating' THEN COALESCE(s.rating_sum::float8 / NULLIF(s.review_count, 0), 0) END DESC,
+        CASE WHEN $8 = 'year' THEN m.release_year END DESC NULLS LAST,
+        CASE WHEN $8 = 'reviews' THEN COALESCE(s.review_count, 0) END DESC,
+        m.title, m.id
+    LIMIT $9 OFFSET $10
+""")
+
+# Фасеты жанров (без фильтра по жанру), десятилетий (без фильтра по году)
+# и общее количество найденных фильмов
+register("movies_browse_facets", _BROWSE_TYPES, f"""
+    SELECT 'genre' as facet, m.genre as value, COUNT(*) as count
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.genre IS NOT NULL AND {_BROWSE_YEAR} AND {_BROWSE_FILTERS}
+    GROUP BY m.genre
+    UNION ALL
+    SELECT 'decade', ((m.release_year / 10) * 10)::text, COUNT(*)
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.release_year IS NOT NULL AND {_BROWSE_GENRE} AND {_BROWSE_FILTERS}
+    GROUP BY m.release_year / 10
+    UNION ALL
+    SELECT 'total', NULL, COUNT(*)
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE {_BROWSE_GENRE} AND {_BROWSE_YEAR} AND {_BROWSE_FILTERS}
+""")
+
+register("movies_page", ["integer", "integer"], """
+    SELECT m.*, r.avg_rating, r.review_count
+    FROM (
+        SELECT * FROM movies
+        WHERE deleted_at IS NULL
+        ORDER BY title
+        LIMIT $1 OFFSET $2
+    ) m
+    LEFT JOIN LATERAL (
+        SELECT COALESCE(AVG(rating), 0) as avg_rating,
+               COUNT(*) as review_count
+        FROM reviews
+        WHERE movie_id = m.id
+    ) r ON true
+    ORDER BY m.title
+""")
+
+register("movies_page_by_genre", ["varchar", "integer", "integer"], """
+    SELECT m.*, r.avg_rating, r.review_count
+    FROM (
+        SELECT * FROM movies
+        WHERE genre = $1 AND deleted_at IS NULL
+        ORDER BY title
+        LIMIT $2 OFFSET $3
+    ) m
+    LEFT JOIN LATERAL (
+        SELECT COALESCE(AVG(rating), 0) as avg_rating,
+               COUNT(*) as review_count
+        FROM reviews
+        WHERE movie_id = m.id
+    ) r ON true
+    ORDER BY m.title
+""")
+
+register("movies_search", ["text", "integer"], """
+    SELECT m.*,
+           COALESCE(AVG(r.rating), 0) as avg_rating,
+           COUNT(r.id) as review_count
+    FROM movies m
+    LEFT JOIN reviews r ON m.id = r.movie_id
+    WHERE (m.title ILIKE $1 OR m.director ILIKE $1 OR m.genre ILIKE $1)
+      AND m.deleted_at IS NULL
+    GROUP BY m.id
+    ORDER BY avg_rating DESC NULLS LAST
+    LIMIT $2
+""")
+
+register("movies_search_count", ["text"], """
+    SELECT COUNT(DISTINCT m.id) as total_count
+    FROM movies m
+    WHERE (m.title ILIKE $1 OR m.director ILIKE $1 OR m.genre ILIKE $1)
+      AND m.deleted_at IS NULL
+""")
+
+register("movies_batch", ["integer[]"], """
+    SELECT m.*,
+           COALESCE(AVG(r.rating), 0) as avg_rating,
+           COUNT(r.id) as review_count
+    FROM movies m
+    LEFT JOIN reviews r ON m.id = r.movie_id AND r.movie_id = ANY($1)
+    WHERE m.id = ANY($1) AND m.deleted_at IS NULL
+    GROUP BY m.id
+""")
+
+register("movies_summary_batch", ["integer[]"], """
+    SELECT id, title, director, release_year, genre
+    FROM movies WHERE id = ANY($1) AND deleted_at IS NULL
+""")
+
+register("movies_existing", ["integer[]"], """
+    SELECT id FROM movies WHERE id = ANY($1) AND deleted_at IS NULL
+""")
+
+register("movie_by_id", ["integer"], """
+    SELECT * FROM movies WHERE id = $1 AND deleted_at IS NULL
+""")
+
+register("movie_exists", ["integer"], """
+    SELECT id FROM movies WHERE id = $1 AND deleted_at IS NULL
+""")
+
+register("movie_title_by_id", ["integer"], """
+    SELECT id, title FROM movies WHERE id = $1 AND deleted_at IS NULL
+""")
+
+# Счетчики оценок 1-10 фильма; среднее и прочее считает app/aggregates.py
+register("movie_info", ["integer"], """
+    SELECT m.*,
+           COALESCE(s.rating_counts, '{0,0,0,0,0,0,0,0,0,0}') as rating_counts
+    FROM movies m
+    LEFT JOIN movie_stats s ON s.movie_id = m.id
+    WHERE m.id = $1 AND m.deleted_at IS NULL
+""")
+
+register("movie_rating_counts", ["integer"], """
+    SELECT COALESCE(
+        (SELECT rating_counts FROM movie_stats WHERE movie_id = $1),
+        '{0,0,0,0,0,0,0,0,0,0}'
+    ) as rating_counts
+""")
+
+register("movie_insert", ["varchar", "varchar", "integer", "varchar", "text", "integer"], """
+    INSERT INTO movies (title, director, release_year, genre, description, duration_minutes)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    RETURNING id
+""")
+
+# NULL в параметре означает "оставить поле без изменений"
+register("movie_update", ["integer", "varchar", "varchar", "integer", "varchar", "text", "integer"], """
+    UPDATE movies SET
+        title = COALESCE($2, title),
+        director = COALESCE($3, director),
+        release_year = COALESCE($4, release_year),
+        genre = COALESCE($5, genre),
+        description = COALESCE($6, description),
+        duration_minutes = COALESCE($7, duration_minutes),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = $1 AND deleted_at IS NULL
+""")
+
+# Удаление фильма: скрытие и снятие его агрегатов в одной транзакции,
+# отзывы удаляет задача purge_movie (app/jobs.py)
+register("movie_hide", ["integer"], """
+    UPDATE movies SET deleted_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    WHERE id = $1 AND deleted_at IS NULL
+    RETURNING title
+""")
+
+register("movie_stats_detach", ["integer"], """
+    DELETE FROM movie_stats WHERE movie_id = $1
+    RETURNING review_count
+""")
+
+# Гистограммы жанра уменьшаются на гистограммы фильма за те же периоды
+register("movie_rollups_detach", ["integer"], """
+    WITH removed AS (
+        DELETE FROM movie_rating_rollups WHERE movie_id = $1
+        RETURNING bucket, bucket_start, rating_counts
+    )
+    UPDATE genre_rating_rollups g
+    SET rating_counts = rating_counts_sub(g.rating_counts, r.rating_counts)
+    FROM removed r, movies m
+    WHERE m.id = $1 AND g.genre = m.genre
+      AND g.bucket = r.bucket AND g.bucket_start = r.bucket_start
+""")
+
+register("movie_deletion_start", ["integer", "varchar", "bigint", "bigint"], """
+    INSERT INTO movie_deletions (movie_id, title, total_reviews, job_id)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (movie_id) DO NOTHING
+""")
+
+# Одна пачка отзывов скрытого фильма: удаление, статистика пользователей
+# и прогресс в одной транзакции
+register("movie_reviews_purge_batch", ["integer", "integer"], """
+    WITH batch AS (
+        SELECT id FROM reviews WHERE movie_id = $1 LIMIT $2
+    ), deleted AS (
+        DELETE FROM reviews r USING batch b
+        WHERE r.movie_id = $1 AND r.id = b.id
+        RETURNING COALESCE(r.user_key, lower(btrim(r.user_name))) as user_key, r.rating
+    ), users AS (
+        UPDATE user_review_stats s SET
+            review_count = s.review_count - d.review_count,
+            rating_sum = s.rating_sum - d.rating_sum,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT user_key, COUNT(*) as review_count, SUM(rating) as rating_sum
+            FROM deleted GROUP BY user_key
+        ) d
+        WHERE s.user_key = d.user_key
+    ), progress AS (
+        UPDATE movie_deletions SET
+            deleted_reviews = deleted_reviews + (SELECT COUNT(*) FROM deleted),
+            batches = batches + 1
+        WHERE movie_id = $1
+    )
+    SELECT COUNT(*) FROM deleted
+""")
+
+register("movie_purge", ["integer"], """
+    DELETE FROM movies WHERE id = $1 AND deleted_at IS NOT NULL
+""")
+
+register("movie_deletion_finish", ["integer"], """
+    UPDATE movie_deletions SET finished_at = CURRENT_TIMESTAMP WHERE movie_id = $1
+""")
+
+register("movie_deletion", ["integer"], """
+    SELECT * FROM movie_deletions WHERE movie_id = $1
+""")
+
+# --- Отзывы ---
+
+register("review_insert", ["integer", "varchar", "integer", "text", "varchar"], """
+    INSERT INTO reviews (movie_id, user_name, rating, review_text, user_key)
+    VALUES ($1, $2, $3, $4, $5)
+    RETURNING id
+""")
+
+# Массовая вставка: параллельные массивы значений разворачиваются unnest.
+# Порядок строк RETURNING не гарантирован, поэтому ID берутся из
+# последовательности заранее и возвращаются вместе с номером отзыва
+# во входных массивах (с 1)
+register("reviews_insert_many", ["integer[]", "varchar[]", "integer[]", "text[]", "varchar[]"], """
+    WITH input AS MATERIALIZED (
+        SELECT nextval('reviews_id_seq')::integer as id, t.*
+        FROM unnest($1, $2, $3, $4, $5)
+            WITH ORDINALITY AS t(movie_id, user_name, rating, review_text, user_key, position)
+    ), inserted AS (
+        INSERT INTO reviews (id, movie_id, user_name, rating, review_text, user_key)
+        SELECT id, movie_id, user_name, rating, review_text, user_key FROM input
+        RETURNING id
+    )
+    SELECT i.id, t.position
+    FROM inserted i
+    JOIN input t ON t.id = i.id
+    ORDER BY t.position
+""")
+
+# Последние отзывы для HTML-страниц фильма; все отзывы - через API с пагинацией
+register("reviews_by_movie_latest", ["integer", "integer"], """
+    SELECT * FROM reviews
+    WHERE movie_id = $1
+    ORDER BY created_at DESC
+    LIMIT $2
+""")
+
+# Отдельный запрос на каждый вариант сортировки вместо подстановки ORDER BY
+REVIEW_SORTS = {
+    "newest": "created_at DESC",
+    "oldest": "created_at ASC",
+    "highest": "rating DESC, created_at DESC",
+    "lowest": "rating ASC, created_at DESC",
+}
+
+for _sort, _order_by in REVIEW_SORTS.items():
+    register(f"reviews_by_movie_{_sort}", ["integer", "integer", "integer"], f"""
+        SELECT * FROM reviews
+        WHERE movie_id = $1
+        ORDER BY {_order_by}
+        LIMIT $2 OFFSET $3
+    """)
+
+register("reviews_latest", ["integer"], """
+    SELECT r.*, m.title as movie_title
+    FROM reviews r
+    JOIN movies m ON r.movie_id = m.id
+    WHERE m.deleted_at IS NULL
+    ORDER BY r.created_at DESC
+    LIMIT $1
+""")
+
+# История пользователя: keyset-пагинация по индексу (user_key, created_at, id)
+register("reviews_by_user_first", ["varchar", "integer"], """
+    SELECT r.*, m.title as movie_title
+    FROM reviews r
+    JOIN movies m ON r.movie_id = m.id
+    WHERE r.user_key = $1 AND m.deleted_at IS NULL
+    ORDER BY r.created_at DESC, r.id DESC
+    LIMIT $2
+""")
+
+register("reviews_by_user_after", ["varchar", "timestamp", "integer", "integer"], """
+    SELECT r.*, m.title as movie_title
+    FROM reviews r
+    JOIN movies m ON r.movie_id = m.id
+    WHERE r.user_key = $1 AND (r.created_at, r.id) < ($2, $3) AND m.deleted_at IS NULL
+    ORDER BY r.created_at DESC, r.id DESC
+    LIMIT $4
+""")
+
+register("ratings_by_user", ["varchar"], """
+    SELECT movie_id, rating FROM reviews WHERE user_key = $1
+""")
+
+# Удаление возвращает строку только тому из одновременных запросов,
+# который ее действительно удалил: агрегаты уменьшаются один раз.
+# С movie_id читается одна секция reviews; только по ID - индекс каждой
+# из 16 секций
+_REVIEW_DELETE = """
+    DELETE FROM reviews WHERE {condition}
+    RETURNING movie_id, rating, COALESCE(user_key, lower(btrim(user_name))) as user_key, created_at
+"""
+
+register("review_delete", ["integer", "integer"], _REVIEW_DELETE.format(condition="id = $1 AND movie_id = $2"))
+
+register("review_delete_any_movie", ["integer"], _REVIEW_DELETE.format(condition="id = $1"))
+
+# --- Пользователи и статистика ---
+
+register("users_page", ["integer", "integer"], """
+    SELECT * FROM users
+    ORDER BY created_at DESC
+    LIMIT $1 OFFSET $2
+""")
+
+register("user_by_id", ["integer"], """
+    SELECT * FROM users WHERE id = $1
+""")
+
+register("user_by_username_or_email", ["varchar", "varchar"], """
+    SELECT id FROM users WHERE username = $1 OR email = $2
+""")
+
+register("user_insert", ["varchar", "varchar"], """
+    INSERT INTO users (username, email)
+    VALUES ($1, $2)
+    RETURNING id
+""")
+
+register("stats_movies", [], """
+    SELECT COUNT(*) as total_movies FROM movies WHERE deleted_at IS NULL
+""")
+
+register("stats_reviews", [], """
+    SELECT COUNT(*) as total_reviews, AVG(rating) as avg_rating FROM reviews
+""")
+
+register("stats_users", [], """
+    SELECT COUNT(*) as total_users FROM users
+""")
+
+register("stats_top_genre", [], """
+    SELECT genre, COUNT(*) as count
+    FROM movies
+    WHERE genre IS NOT NULL AND deleted_at IS NULL
+    GROUP BY genre
+    ORDER BY count DESC
+    LIMIT 1
+""")
+
+register("stats_most_reviewed", [], """
+    SELECT m.title, s.review_count
+    FROM movie_stats s
+    JOIN movies m ON m.id = s.movie_id
+    ORDER BY s.review_count DESC
+    LIMIT 1
+""")
+
+# --- Агрегаты (app/aggregates.py) ---
+
+register("movie_stats_add", ["integer[]", "integer[]"], """
+    INSERT INTO movie_stats (movie_id, review_count, rating_sum, rating_counts)
+    SELECT movie_id, COUNT(*), SUM(rating), rating_histogram(array_agg(rating))
+    FROM unnest($1, $2) AS t(movie_id, rating)
+    GROUP BY movie_id
+    ON CONFLICT (movie_id) DO UPDATE SET
+        review_count = movie_stats.review_count + EXCLUDED.review_count,
+        rating_sum = movie_stats.rating_sum + EXCLUDED.rating_sum,
+        rating_counts = rating_counts_add(movie_stats.rating_counts, EXCLUDED.rating_counts),
+        updated_at = CURRENT_TIMESTAMP
+""")
+
+register("user_stats_add", ["varchar[]", "integer[]"], """
+    INSERT INTO user_review_stats (user_key, review_count, rating_sum)
+    SELECT user_key, COUNT(*), SUM(rating)
+    FROM unnest($1, $2) AS t(user_key, rating)
+    GROUP BY user_key
+    ON CONFLICT (user_key) DO UPDATE SET
+        review_count = user_review_stats.review_count + EXCLUDED.review_count,
+        rating_sum = user_review_stats.rating_sum + EXCLUDED.rating_sum,
+        updated_at = CURRENT_TIMESTAMP
+""")
+
+register("user_stats_remove", ["varchar", "integer"], """
+    UPDATE user_review_stats SET
+        review_count = review_count - 1,
+        rating_sum = rating_sum - $2,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE user_key = $1
+""")
+
+register("user_stats", ["varchar"], """
+    SELECT review_count, rating_sum FROM user_review_stats WHERE user_key = $1
+""")
+
+register("movie_stats_remove", ["integer", "integer"], """
+    UPDATE movie_stats SET
+        review_count = review_count - 1,
+        rating_sum = rating_sum - $2,
+        rating_counts[$2] = rating_counts[$2] - 1,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE movie_id = $1
+""")
+
+# Гистограммы оценок за день и неделю (migrations/004_rating_rollups.sql)
+register("movie_rollups_add", ["integer[]", "integer[]"], """
+    INSERT INTO movie_rating_rollups (movie_id, bucket, bucket_start, rating_counts)
+    SELECT t.movie_id, b.bucket, b.bucket_start, rating_histogram(array_agg(t.rating))
+    FROM unnest($1, $2) AS t(movie_id, rating)
+    CROSS JOIN (VALUES
+        ('day', CURRENT_DATE),
+        ('week', date_trunc('week', CURRENT_DATE)::date)
+    ) AS b(bucket, bucket_start)
+    GROUP BY t.movie_id, b.bucket, b.bucket_start
+    ON CONFLICT (movie_id, bucket, bucket_start) DO UPDATE SET
+        rating_counts = rating_counts_add(movie_rating_rollups.rating_counts, EXCLUDED.rating_counts)
+""")
+
+register("genre_rollups_add", ["integer[]", "integer[]"], """
+    INSERT INTO genre_rating_rollups (genre, bucket, bucket_start, rating_counts)
+    SELECT m.genre, b.bucket, b.bucket_start, rating_histogram(array_agg(t.rating))
+    FROM unnest($1, $2) AS t(movie_id, rating)
+    JOIN movies m ON m.id = t.movie_id
+    CROSS JOIN (VALUES
+        ('day', CURRENT_DATE),
+        ('week', date_trunc('week', CURRENT_DATE)::date)
+    ) AS b(bucket, bucket_start)
+    WHERE m.genre IS NOT NULL
+    GROUP BY m.genre, b.bucket, b.bucket_start
+    ON CONFLICT (genre, bucket, bucket_start) DO UPDATE SET
+        rating_counts = rating_counts_add(genre_rating_rollups.rating_counts, EXCLUDED.rating_counts)
+""")
+
+register("movie_rollups_remove", ["integer", "integer", "timestamp"], """
+    UPDATE movie_rating_rollups SET rating_counts[$2] = rating_counts[$2] - 1
+    WHERE movie_id = $1
+      AND ((bucket = 'day' AND bucket_start = $3::date)
+        OR (bucket = 'week' AND bucket_start = date_trunc('week', $3)::date))
+""")
+
+# Гистограммы скрытого фильма уже вычтены из жанра (movie_rollups_detach)
+register("genre_rollups_remove", ["integer", "integer", "timestamp"], """
+    UPDATE genre_rating_rollups SET rating_counts[$2] = rating_counts[$2] - 1
+    WHERE genre = (SELECT genre FROM movies WHERE id = $1 AND deleted_at IS NULL)
+      AND ((bucket = 'day' AND bucket_start = $3::date)
+        OR (bucket = 'week' AND bucket_start = date_trunc('week', $3)::date))
+""")
+
+register("movie_rollup_series", ["integer", "varchar", "date"], """
+    SELECT bucket_start, rating_counts
+    FROM movie_rating_rollups
+    WHERE movie_id = $1 AND bucket = $2 AND bucket_start >= $3
+    ORDER BY bucket_start
+""")
+
+register("genre_rollup_series", ["varchar", "varchar", "date"], """
+    SELECT bucket_start, rating_counts
+    FROM genre_rating_rollups
+    WHERE genre = $1 AND bucket = $2 AND bucket_start >= $3
+    ORDER BY bucket_start
+""")
+
+# Пересчет гистограмм по диапазону ID отзывов (app/analytics.py)
+register("movie_rollups_backfill", ["integer", "integer"], """
+    INSERT INTO movie_rating_rollups (movie_id, bucket, bucket_start, rating_counts)
+    SELECT r.movie_id, b.bucket, b.bucket_start, rating_histogram(array_agg(r.rating))
+    FROM reviews r
+    JOIN movies m ON m.id = r.movie_id
+    CROSS JOIN LATERAL (VALUES
+        ('day', r.created_at::date),
+        ('week', date_trunc('week', r.created_at)::date)
+    ) AS b(bucket, bucket_start)
+    WHERE r.id > $1 AND r.id <= $2 AND m.deleted_at IS NULL
+    GROUP BY r.movie_id, b.bucket, b.bucket_start
+    ON CONFLICT (movie_id, bucket, bucket_start) DO UPDATE SET
+        rating_counts = rating_counts_add(movie_rating_rollups.rating_counts, EXCLUDED.rating_counts)
+""")
+
+register("genre_rollups_backfill", ["integer", "integer"], """
+    INSERT INTO genre_rating_rollups (genre, bucket, bucket_start, rating_counts)
+    SELECT m.genre, b.bucket, b.bucket_start, rating_histogram(array_agg(r.rating))
+    FROM reviews r
+    JOIN movies m ON m.id = r.movie_id
+    CROSS JOIN LATERAL (VALUES
+        ('day', r.created_at::date),
+        ('week', date_trunc('week', r.created_at)::date)
+    ) AS b(bucket, bucket_start)
+    WHERE r.id > $1 AND r.id <= $2 AND m.genre IS NOT NULL AND m.deleted_at IS NULL
+    GROUP BY m.genre, b.bucket, b.bucket_start
+    ON CONFLICT (genre, bucket, bucket_start) DO UPDATE SET
+        rating_counts = rating_counts_add(genre_rating_rollups.rating_counts, EXCLUDED.rating_counts)
+""")
+
+# --- Фоновые задачи (app/jobs.py, migrations/007_jobs.sql) ---
+
+register("job_enqueue", ["varchar", "jsonb", "varchar", "integer", "integer"], """
+    INSERT INTO jobs (kind, payload, dedupe_key, max_attempts, run_at)
+    VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP + make_interval(secs => $5))
+    ON CONFLICT (dedupe_key) DO NOTHING
+    RETURNING id
+""")
+
+register("job_claim", ["integer"], """
+    UPDATE jobs SET
+        status = 'running',
+        attempts = attempts + 1,
+        started_at = CURRENT_TIMESTAMP,
+        locked_until = CURRENT_TIMESTAMP + make_interval(secs => $1)
+    WHERE id = (
+        SELECT id FROM jobs
+        WHERE status = 'queued' AND run_at <= CURRENT_TIMESTAMP
+        ORDER BY run_at, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload, attempts, max_attempts
+""")
+
+register("job_extend", ["bigint", "integer"], """
+    UPDATE jobs SET locked_until = CURRENT_TIMESTAMP + make_interval(secs => $2)
+    WHERE id = $1 AND status = 'running'
+""")
+
+register("job_complete", ["bigint", "jsonb"], """
+    UPDATE jobs SET
+        status = 'done',
+        result = $2,
+        finished_at = CURRENT_TIMESTAMP,
+        locked_until = NULL
+    WHERE id = $1
+""")
+
+register("job_fail", ["bigint", "text", "integer"], """
+    UPDATE jobs SET
+        status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+        run_at = CURRENT_TIMESTAMP + make_interval(secs => $3),
+        finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE CURRENT_TIMESTAMP END,
+        last_error = $2,
+        locked_until = NULL
+    WHERE id = $1
+    RETURNING status
+""")
+
+register("jobs_requeue_expired", [], """
+    UPDATE jobs SET
+        status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+        run_at = CURRENT_TIMESTAMP,
+        last_error = 'Истекла аренда задачи',
+        locked_until = NULL
+    WHERE status = 'running' AND locked_until < CURRENT_TIMESTAMP
+""")
+
+register("jobs_purge", ["integer"], """
+    DELETE FROM jobs
+    WHERE status IN ('done', 'failed')
+      AND finished_at < CURRENT_TIMESTAMP - make_interval(days => $1)
+""")
+
+register("job_by_id", ["bigint"], """
+    SELECT id, kind, payload, status, attempts, max_attempts, run_at,
+           created_at, started_at, finished_at, last_error, result
+    FROM jobs WHERE id = $1
+""")
+
+register("jobs_depth", [], """
+    SELECT kind, status, COUNT(*) as count,
+           EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(run_at)) as oldest_seconds
+    FROM jobs
+    WHERE status IN ('queued', 'running')
+    GROUP BY kind, status
+    ORDER BY kind, status
+""")
+
+# Полный пересчет агрегатов; меняются только разошедшиеся строки
+register("movie_stats_rebuild", [], """
+    INSERT INTO movie_stats (movie_id, review_count, rating_sum, rating_counts)
+    SELECT m.id, COUNT(r.id), COALESCE(SUM(r.rating), 0),
+           rating_histogram(COALESCE(array_agg(r.rating) FILTER (WHERE r.id IS NOT NULL), '{}'))
+    FROM movies m
+    LEFT JOIN reviews r ON r.movie_id = m.id
+    WHERE m.deleted_at IS NULL
+    GROUP BY m.id
+    ON CONFLICT (movie_id) DO UPDATE SET
+        review_count = EXCLUDED.review_count,
+        rating_sum = EXCLUDED.rating_sum,
+        rating_counts = EXCLUDED.rating_counts,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE (movie_stats.review_count, movie_stats.rating_sum, movie_stats.rating_counts)
+        IS DISTINCT FROM (EXCLUDED.review_count, EXCLUDED.rating_sum, EXCLUDED.rating_counts)
+""")
+
+register("user_stats_clear", [], """
+    DELETE FROM user_review_stats
+""")
+
+register("user_stats_rebuild", [], """
+    INSERT INTO user_review_stats (user_key, review_count, rating_sum)
+    SELECT COALESCE(user_key, lower(btrim(user_name))), COUNT(*), SUM(rating)
+    FROM reviews
+    GROUP BY 1
+""")
+
+register("site_stats_refresh", [], """
+    INSERT INTO site_stats (id, total_movies, total_reviews, average_rating,
+                            total_users, top_genre, most_reviewed_movie, updated_at)
+    SELECT TRUE,
+           (SELECT COUNT(*) FROM movies WHERE deleted_at IS NULL),
+           r.total_reviews,
+           r.average_rating,
+           (SELECT COUNT(*) FROM users),
+           (SELECT genre FROM movies WHERE genre IS NOT NULL AND deleted_at IS NULL
+            GROUP BY genre ORDER BY COUNT(*) DESC LIMIT 1),
+           (SELECT m.title FROM movie_stats s JOIN movies m ON m.id = s.movie_id
+            ORDER BY s.review_count DESC LIMIT 1),
+           CURRENT_TIMESTAMP
+    FROM (SELECT COUNT(*) as total_reviews, AVG(rating)::float as average_rating FROM reviews) r
+    ON CONFLICT (id) DO UPDATE SET
+        total_movies = EXCLUDED.total_movies,
+        total_reviews = EXCLUDED.total_reviews,
+        average_rating = EXCLUDED.average_rating,
+        total_users = EXCLUDED.total_users,
+        top_genre = EXCLUDED.top_genre,
+        most_reviewed_movie = EXCLUDED.most_reviewed_movie,
+        updated_at = EXCLUDED.updated_at
+    RETURNING total_movies, total_reviews, average_rating, total_users, top_genre, most_reviewed_movie
+""")
+
+register("site_stats", [], """
+    SELECT total_movies, total_reviews, average_rating, total_users,
+           top_genre, most_reviewed_movie, updated_at
+    FROM site_stats
+""")
+
+# --- Подписки бота (migrations/010_subscriptions.sql) ---
+
+# Уведомление подписчикам, для которых movie_stats изменились; уже
+# ожидающее отправки уведомление не дублируется
+_SUBSCRIPTIONS_ENQUEUE = """
+    INSERT INTO notification_outbox (chat_id, movie_id)
+    SELECT s.chat_id, s.movie_id
+    FROM movie_subscriptions s
+    JOIN movie_stats st ON st.movie_id = s.movie_id
+    WHERE {condition}
+      AND (s.notified_review_count, s.notified_rating_sum)
+          IS DISTINCT FROM (st.review_count, st.rating_sum)
+    ON CONFLICT (chat_id, movie_id) WHERE sent_at IS NULL DO NOTHING
+"""
+
+register("subscriptions_enqueue", ["integer[]"], _SUBSCRIPTIONS_ENQUEUE.format(condition="s.movie_id = ANY($1)"))
+
+register("subscriptions_enqueue_all", [], _SUBSCRIPTIONS_ENQUEUE.format(condition="TRUE"))
+
+register("notification_outbox_purge", ["integer"], """
+    DELETE FROM notification_outbox
+    WHERE sent_at < CURRENT_TIMESTAMP - make_interval(days => $1)
+""")
+
+# --- Дубликаты отзывов (app/dedup.py, migrations/011_review_dedup.sql) ---
+
+register("review_signature_candidates", ["bigint[]", "integer", "integer"], """
+    SELECT review_id, movie_id, user_key, buckets, signature
+    FROM review_signatures
+    WHERE buckets && $1 AND review_id < $2
+    LIMIT $3
+""")
+
+# Ключи корзин приходят плоским массивом с параллельным массивом ID отзывов
+register("review_signatures_insert", ["integer[]", "integer[]", "varchar[]", "bytea[]", "bigint[]", "integer[]"], """
+    WITH keys AS (
+        SELECT review_id, array_agg(key) as buckets
+        FROM unnest($5, $6) AS k(key, review_id)
+        GROUP BY review_id
+    )
+    INSERT INTO review_signatures (review_id, movie_id, user_key, signature, buckets)
+    SELECT r.review_id, r.movie_id, r.user_key, r.signature, COALESCE(keys.buckets, '{}')
+    FROM unnest($1, $2, $3, $4) AS r(review_id, movie_id, user_key, signature)
+    LEFT JOIN keys ON keys.review_id = r.review_id
+    ON CONFLICT (review_id) DO NOTHING
+""")
+
+register("review_flags_insert", ["integer[]", "integer[]", "integer[]", "integer[]", "varchar[]", "real[]"], """
+    INSERT INTO review_flags (review_id, movie_id, duplicate_of, duplicate_movie_id, scope, similarity)
+    SELECT * FROM unnest($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (review_id) DO NOTHING
+""")
+
+register("reviews_for_dedup", ["integer", "integer"], """
+    SELECT r.id, r.movie_id, COALESCE(r.user_key, lower(btrim(r.user_name))), r.review_text
+    FROM reviews r
+    WHERE r.id > $1
+      AND NOT EXISTS (SELECT 1 FROM review_signatures s WHERE s.review_id = r.id)
+    ORDER BY r.id
+    LIMIT $2
+""")
+
+register("review_flags", ["integer", "integer"], """
+    SELECT f.review_id, f.movie_id, f.scope, f.similarity, f.created_at,
+           r.user_name, r.rating, r.review_text,
+           f.duplicate_of, f.duplicate_movie_id, o.user_name as duplicate_user_name
+    FROM review_flags f
+    JOIN reviews r ON r.id = f.review_id AND r.movie_id = f.movie_id
+    LEFT JOIN reviews o ON o.id = f.duplicate_of AND o.movie_id = f.duplicate_movie_id
+    WHERE $1::integer IS NULL OR f.movie_id = $1
+    ORDER BY f.created_at DESC, f.review_id DESC
+    LIMIT $2
+""")
+
+
+# --- Замер: подготовленные запросы против текста запроса ---
+
+def _sample_params(cursor):
+    """Параметры запросов замера по данным текущей базы"""
+    cursor.execute("""
+        SELECT m.id, (SELECT user_key FROM reviews r WHERE r.movie_id = m.id AND r.user_key IS NOT NULL LIMIT 1)
+        FROM movies m JOIN movie_stats s ON s.movie_id = m.id
+        WHERE m.deleted_at IS NULL
+        ORDER BY s.review_count DESC LIMIT 1
+    """)
+    movie_id, user_key = cursor.fetchone() or (1, None)
+    no_filters = (None,) * len(_BROWSE_TYPES)
+    return {
+        "movies_page": (20, 0),
+        "movies_search": ("%the%", 20),
+        "movie_info": (movie_id,),
+        "reviews_by_movie_newest": (movie_id, 20, 0),
+        "reviews_by_user_first": (user_key or "", 21),
+        "movies_browse": no_filters + ("rating", 20, 0),
+        "movies_browse_facets": no_filters,
+    }
+
+
+def _inline_sql(statement):
+    """Текст запроса с параметрами psycopg2 вместо $1, $2, ..."""
+    return re.sub(
+        r"\$(\d+)",
+        lambda match: f"%(p{match.group(1)})s::{statement.param_types[int(match.group(1)) - 1]}",
+        statement.sql
+    )
+
+
+def _planning_ms(cursor, sql, params):
+    cursor.execute(f"EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {sql}", params)
+    plan = cursor.fetchone()[0]
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return plan[0]["Planning Time"], plan[0]["Execution Time"]
+
+
+def bench(repeats):
+    import app.database as database
+
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            samples = _sample_params(cursor)
+            print(f"{'Запрос':<26}{'планирование, мс':>22}{'вызов целиком, мс':>24}")
+            print(f"{'':<26}{'текст':>11}{'EXECUTE':>11}{'текст':>12}{'EXECUTE':>12}")
+            for name, params in samples.items():
+                statement = STATEMENTS[name]
+                inline = _inline_sql(statement)
+                named = {f"p{position}": value for position, value in enumerate(params, 1)}
+
+                # Первые пять EXECUTE используют custom-план, дальше PostgreSQL
+                # может перейти на generic-план без планирования
+                for _ in range(6):
+                    execute(cursor, name, params)
+                    cursor.fetchall()
+
+                planning = {"text": [], "prepared": []}
+                calls = {"text": [], "prepared": []}
+                for _ in range(repeats):
+                    planning["text"].append(_planning_ms(cursor, inline, named)[0])
+                    planning["prepared"].append(
+                        _planning_ms(cursor, statement.execute_sql(), tuple(params))[0]
+                    )
+
+                    started = time.perf_counter()
+                    cursor.execute(inline, named)
+                    cursor.fetchall()
+                    calls["text"].append((time.perf_counter() - started) * 1000)
+
+                    started = time.perf_counter()
+                    execute(cursor, name, params)
+                    cursor.fetchall()
+                    calls["prepared"].append((time.perf_counter() - started) * 1000)
+
+                print(f"{name:<26}" + "".join(
+                    f"{statistics.median(values[mode]):>11.3f}"
+                    for values in (planning, calls) for mode in ("text", "prepared")
+                ))
+            connection.rollback()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Реестр подготовленных запросов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="время планирования: текст запроса против EXECUTE")
+    bench_parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench(args.repeats)
+
+
+if __name__ == "__main__":
+    main()
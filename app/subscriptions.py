@@ -0,0 +1,67 @@
+"""
+Уведомления подписчикам бота: сбор изменившихся фильмов в веб-приложении.
+
+Запись отзыва про подписки ничего не знает. Шина событий (app/events.py)
+передает события movie_stats в on_event, который только запоминает фильм.
+Раз в NOTIFY_FLUSH_INTERVAL секунд накопленные фильмы уходят одной
+задачей notify_subscribers (app/jobs.py): она ставит строки в
+notification_outbox, а отправляет их бот (bot/notify.py).
+
+Событие получает каждый воркер, поэтому задачи разных воркеров за один
+интервал совпадают по dedupe_key; задача все равно идемпотентна.
+"""
+
+import os
+import time
+import zlib
+
+import app.jobs as jobs
+
+NOTIFY_ENABLED = os.getenv('NOTIFY_ENABLED', '1') == '1'
+NOTIFY_FLUSH_INTERVAL = float(os.getenv('NOTIFY_FLUSH_INTERVAL', '10'))
+
+# Фильмы с изменившимися отзывами с последней отправки задачи
+_changed = set()
+
+counters = {'events': 0, 'jobs': 0, 'movies': 0}
+
+
+def on_event(event):
+    """
+    Обработчик шины событий: запоминает фильм, у которого изменились
+    количество отзывов или рейтинг
+    """
+    if event.type == 'movie_stats' and event.movie_id is not None:
+        _changed.add(event.movie_id)
+        counters['events'] += 1
+
+
+def take():
+    """
+    Забирает накопленные фильмы; вызывается в цикле событий, как и on_event
+    """
+    global _changed
+    movie_ids, _changed = _changed, set()
+    return sorted(movie_ids)
+
+
+def restore(movie_ids):
+    """Возвращает фильмы, задачу по которым поставить не удалось"""
+    _changed.update(movie_ids)
+
+
+def submit(movie_ids):
+    """
+    Ставит задачу notify_subscribers по фильмам; выполняется в потоке
+    """
+    window = int(time.time() // NOTIFY_FLUSH_INTERVAL)
+    digest = zlib.crc32(",".join(map(str, movie_ids)).encode())
+    job_id = jobs.submit("notify_subscribers", {'movie_ids': movie_ids},
+                         dedupe_key=f"notify_subscribers:{window}:{digest:08x}")
+    counters['jobs'] += 1
+    counters['movies'] += len(movie_ids)
+    return job_id
+
+
+def stats():
+    return {**counters, 'pending_movies': len(_changed)}
@@ -0,0 +1,555 @@
+"""
+Трассировка запросов: спаны веб-запросов, обработчиков маршрутов,
+подключений и запросов к БД, рендеринга шаблонов, задач и команд бота.
+
+Текущий спан хранится в ContextVar, поэтому вложенность сохраняется
+в asyncio-задачах и в asyncio.to_thread (они копируют контекст).
+Между процессами контекст передается в формате W3C traceparent:
+заголовком HTTP-запроса и переменной окружения TRACEPARENT для
+подпроцесса бота (run.py).
+
+Завершенные спаны отправляет фоновый поток пачками в формате OTLP/JSON:
+строкой в файл TRACE_FILE (по умолчанию) или POST на TRACE_OTLP_ENDPOINT.
+По умолчанию трассируется 1% запросов. Файл ротируется по размеру
+(TRACE_FILE_MAX_BYTES, хранится TRACE_FILE_BACKUPS старых файлов);
+процессы, пишущие в один файл, ротируют его под общей блокировкой.
+Для просмотра без коллектора:
+
+    python -m app.tracing show [--file traces.jsonl] [--trace ID] [--slowest 10]
+    python -m app.tracing collect --port 4318   # замена OTLP-коллектора
+"""
+
+import argparse
+import atexit
+import fcntl
+import functools
+import inspect
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jinja2
+from fastapi.routing import APIRoute
+
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '1') == '1'
+# Доля трассируемых корневых спанов; вложенные наследуют решение
+TRACE_SAMPLE = float(os.getenv('TRACE_SAMPLE', '0.01'))
+# file - строки OTLP/JSON в TRACE_FILE, otlp - POST на TRACE_OTLP_ENDPOINT
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'file')
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+# Размер файла, после которого он переименовывается в TRACE_FILE.1, байт
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', str(100 * 2**20)))
+TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', '3'))
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', '10000'))
+TRACE_BATCH_SIZE = 512
+TRACE_EXPORT_INTERVAL = 2
+
+# Вид спана в OTLP
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# Контекст родителя из другого процесса
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id", "sampled"])
+
+_current = ContextVar("trace_span", default=None)
+
+counters = {'started': 0, 'exported': 0, 'dropped': 0, 'export_errors': 0}
+
+
+class Span:
+    """
+    Спан: операция с временем начала и окончания внутри трассы.
+    Используется как контекстный менеджер; на время блока становится
+    текущим, по выходу отправляется экспортеру
+    """
+
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "sampled",
+                 "attributes", "start_ns", "end_ns", "error", "_token")
+
+    def __init__(self, name, parent=None, kind=KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.kind = kind
+        if parent is None:
+            self.trace_id = os.urandom(16).hex()
+            self.parent_id = None
+            self.sampled = TRACING_ENABLED and random.random() < TRACE_SAMPLE
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.sampled = parent.sampled
+        self.span_id = os.urandom(8).hex()
+        self.attributes = attributes or {}
+        self.start_ns = None
+        self.end_ns = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current.set(self)
+        counters['started'] += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _current.reset(self._token)
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            self.error = f"{exc_type.__name__}: {exc}"
+        if self.sampled and _exporter is not None:
+            _exporter.submit(self)
+        return False
+
+
+def current():
+    """
+    Текущий спан или None
+    """
+    return _current.get()
+
+
+def span(name, parent=None, kind=KIND_INTERNAL, **attributes):
+    """
+    Новый спан, вложенный в текущий (или в parent из другого процесса)
+    """
+    return Span(name, parent or _current.get(), kind, attributes)
+
+
+def traced(name=None):
+    """
+    Декоратор: вызов функции (обычной или async) выполняется в спане
+    """
+    def decorate(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def run_async(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return run
+
+    return decorate
+
+
+def traceparent(value=None):
+    """
+    Заголовок traceparent для спана (по умолчанию текущего) или None
+    """
+    value = value or _current.get()
+    if value is None:
+        return None
+    return f"00-{value.trace_id}-{value.span_id}-{'01' if value.sampled else '00'}"
+
+
+def parse_traceparent(header):
+    """
+    SpanContext из заголовка traceparent или None, если заголовок некорректен
+    """
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return SpanContext(parts[1], parts[2], TRACING_ENABLED and bool(flags & 1))
+
+
+def child_env(env=None):
+    """
+    Окружение подпроцесса с TRACEPARENT текущего спана
+    """
+    env = dict(os.environ if env is None else env)
+    header = traceparent()
+    if header:
+        env['TRACEPARENT'] = header
+    return env
+
+
+def parent_from_env():
+    """
+    Родитель, переданный процессу через TRACEPARENT, или None
+    """
+    return parse_traceparent(os.getenv('TRACEPARENT'))
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware: корневой спан HTTP-запроса, продолжающий трассу
+    клиента из заголовка traceparent. Имя спана - шаблон маршрута
+    ("GET /movies/{movie_id}"), а не конкретный путь
+    """
+
+    def __init__(self, app, skip_prefixes=()):
+        self.app = app
+        self.skip_prefixes = tuple(skip_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        parent = None
+        for name, value in scope.get("headers") or ():
+            if name == b"traceparent":
+                parent = parse_traceparent(value.decode("latin-1"))
+                break
+
+        method = scope["method"]
+        with span(f"{method} {scope['path']}", parent=parent, kind=KIND_SERVER) as root:
+            root.set_attribute("http.method", method)
+            root.set_attribute("http.target", scope["path"])
+
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    root.set_attribute("http.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = scope.get("route")
+                if route is not None and getattr(route, "path", None):
+                    root.name = f"{method} {route.path}"
+                    root.set_attribute("http.route", route.path)
+
+
+class TracedRoute(APIRoute):
+    """
+    Маршрут FastAPI, обработчик которого (разбор параметров, функция
+    маршрута и сериализация ответа) выполняется в отдельном спане
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        name = f"route {self.endpoint.__module__.rpartition('.')[2]}.{self.endpoint.__name__}"
+        path = self.path
+
+        async def traced_handler(request):
+            with span(name, **{"http.route": path}):
+                return await handler(request)
+
+        return traced_handler
+
+
+class TracedTemplate(jinja2.Template):
+    """Шаблон Jinja, рендеринг которого выполняется в спане"""
+
+    def render(self, *args, **kwargs):
+        with span("template.render", **{"template": self.name}):
+            return super().render(*args, **kwargs)
+
+
+def trace_templates(templates):
+    """
+    Включает спаны рендеринга для Jinja2Templates
+    """
+    templates.env.template_class = TracedTemplate
+    return templates
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+def _encode(item):
+    encoded = {
+        "traceId": item.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        "kind": item.kind,
+        "startTimeUnixNano": str(item.start_ns),
+        "endTimeUnixNano": str(item.end_ns),
+        "attributes": [_attribute(key, value) for key, value in item.attributes.items()],
+        "status": {"code": 2, "message": item.error} if item.error else {"code": 1}
+    }
+    if item.parent_id:
+        encoded["parentSpanId"] = item.parent_id
+    return encoded
+
+
+class Exporter:
+    """
+    Отправка спанов фоновым потоком: очередь ограничена, при
+    переполнении спаны отбрасываются, а не задерживают запрос
+    """
+
+    def __init__(self, service, mode=TRACE_EXPORT):
+        self.service = service
+        self.mode = mode
+        self.queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            counters['dropped'] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(TRACE_EXPORT_INTERVAL * 2)
+        self._flush()
+
+    def _run(self):
+        while not self._stop.wait(TRACE_EXPORT_INTERVAL):
+            self._flush()
+
+    def _flush(self):
+        while True:
+            batch = []
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self._send(batch)
+                counters['exported'] += len(batch)
+            except Exception:
+                counters['export_errors'] += 1
+
+    def payload(self, batch):
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_attribute("service.name", self.service)]},
+                "scopeSpans": [{
+                    "scope": {"name": "app.tracing"},
+                    "spans": [_encode(item) for item in batch]
+                }]
+            }]
+        }
+
+    def _send(self, batch):
+        body = json.dumps(self.payload(batch), ensure_ascii=False, default=str)
+        if self.mode == 'otlp':
+            request = urllib.request.Request(
+                TRACE_OTLP_ENDPOINT, data=body.encode("utf-8"),
+                headers={"Content-Type": "application/json"}, method="POST"
+            )
+            with urllib.request.urlopen(request, timeout=5):
+                pass
+        else:
+            # Одна запись на пачку: строки разных процессов не перемешиваются
+            append_line(TRACE_FILE, body)
+
+
+def append_line(path, line, max_bytes=None, backups=None):
+    """
+    Дописывает строку в файл; если файл превысит max_bytes, он сначала
+    переименовывается в path.1 (path.1 - в path.2 и т.д., не больше
+    backups файлов). Блокировка path.lock общая для всех процессов
+    """
+    max_bytes = TRACE_FILE_MAX_BYTES if max_bytes is None else max_bytes
+    backups = TRACE_FILE_BACKUPS if backups is None else backups
+    data = (line + "\n").encode("utf-8")
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if max_bytes and size and size + len(data) > max_bytes:
+            for number in range(backups - 1, 0, -1):
+                if os.path.exists(f"{path}.{number}"):
+                    os.replace(f"{path}.{number}", f"{path}.{number + 1}")
+            if backups:
+                os.replace(path, f"{path}.1")
+            else:
+                os.remove(path)
+        with open(path, "ab") as output:
+            output.write(data)
+
+
+_exporter = None
+
+
+def setup(service):
+    """
+    Запускает экспорт спанов процесса. Без вызова спаны создаются
+    (контекст передается дальше), но никуда не отправляются
+    """
+    global _exporter
+    if _exporter is not None or not TRACING_ENABLED:
+        return
+    _exporter = Exporter(service)
+    _exporter.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    global _exporter
+    if _exporter is not None:
+        exporter, _exporter = _exporter, None
+        exporter.stop()
+
+
+def stats():
+    return {
+        **counters,
+        'queued': _exporter.queue.qsize() if _exporter is not None else 0,
+        'sample': TRACE_SAMPLE,
+        'export': TRACE_EXPORT if _exporter is not None else None
+    }
+
+
+# --- Просмотр и замена коллектора ---
+
+def read_spans(path):
+    """
+    Спаны из файла OTLP/JSON: список словарей с service, id и временем в мс
+    """
+    spans = []
+    with open(path, encoding="utf-8") as source:
+        for line in source:
+            if not line.strip():
+                continue
+            for resource in json.loads(line).get("resourceSpans", ()):
+                service = next(
+                    (a["value"].get("stringValue") for a in resource.get("resource", {}).get("attributes", ())
+                     if a["key"] == "service.name"),
+                    None
+                )
+                for scope_spans in resource.get("scopeSpans", ()):
+                    for item in scope_spans.get("spans", ()):
+                        start = int(item["startTimeUnixNano"])
+                        spans.append({
+                            'service': service,
+                            'trace_id': item["traceId"],
+                            'span_id': item["spanId"],
+                            'parent_id': item.get("parentSpanId"),
+                            'name': item["name"],
+                            'start': start,
+                            'duration_ms': (int(item["endTimeUnixNano"]) - start) / 1e6,
+                            'error': item.get("status", {}).get("message"),
+                            'attributes': {a["key"]: next(iter(a["value"].values())) for a in item.get("attributes", ())}
+                        })
+    return spans
+
+
+def print_trace(spans, trace_id):
+    trace = sorted((s for s in spans if s['trace_id'] == trace_id), key=lambda s: s['start'])
+    if not trace:
+        print(f"Трасса {trace_id} не найдена")
+        return
+    ids = {s['span_id'] for s in trace}
+    children = {}
+    for item in trace:
+        parent = item['parent_id'] if item['parent_id'] in ids else None
+        children.setdefault(parent, []).append(item)
+    origin = trace[0]['start']
+
+    def walk(parent, depth):
+        for item in children.get(parent, ()):
+            offset = (item['start'] - origin) / 1e6
+            error = f"  ! {item['error']}" if item['error'] else ""
+            print(f"{offset:9.1f} {item['duration_ms']:9.1f} ms  {'  ' * depth}{item['name']} [{item['service']}]{error}")
+            walk(item['span_id'], depth + 1)
+
+    print(f"Трасса {trace_id}")
+    print(f"{'начало':>9} {'длит.':>9}")
+    walk(None, 0)
+
+
+def show(path, trace_id=None, slowest=10):
+    spans = read_spans(path)
+    if trace_id:
+        print_trace(spans, trace_id)
+        return
+    ids = {s['span_id'] for s in spans}
+    roots = [s for s in spans if s['parent_id'] not in ids]
+    roots.sort(key=lambda s: s['duration_ms'], reverse=True)
+    for item in roots[:slowest]:
+        print(f"{item['duration_ms']:9.1f} ms  {item['trace_id']}  {item['name']} [{item['service']}]")
+
+
+def collect(port, path):
+    """
+    Минимальная замена OTLP/HTTP-коллектора: принимает POST /v1/traces
+    в JSON и дописывает тела запросов в файл
+    """
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                line = json.dumps(json.loads(body), ensure_ascii=False)
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            with lock:
+                append_line(path, line)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    print(f"Коллектор трасс: http://0.0.0.0:{port}/v1/traces -> {path}")
+    ThreadingHTTPServer(("0.0.0.0", port), Handler).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Трассы запросов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show_parser = subparsers.add_parser("show", help="самые долгие трассы или дерево одной трассы")
+    show_parser.add_argument("--file", default=TRACE_FILE)
+    show_parser.add_argument("--trace", help="ID трассы")
+    show_parser.add_argument("--slowest", type=int, default=10)
+    collect_parser = subparsers.add_parser("collect", help="принимать спаны по OTLP/HTTP JSON")
+    collect_parser.add_argument("--port", type=int, default=4318)
+    collect_parser.add_argument("--file", default=TRACE_FILE)
+    args = parser.parse_args()
+
+    if args.command == "show":
+        show(args.file, args.trace, args.slowest)
+    elif args.command == "collect":
+        collect(args.port, args.file)
+
+
+if __name__ == "__main__":
+    main()
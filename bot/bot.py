@@ -1,19 +1,100 @@
 import os
+import sys
+import time
+import asyncio
+import html
 import logging
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CommandHandler, InlineQueryHandler, MessageHandler, TypeHandler,
+    filters, ContextTypes
+)
 import pg8000
 from dotenv import load_dotenv
 
+# Бот запускается как скрипт (python bot/bot.py), поэтому добавляем корень
+# проекта в путь поиска модулей, чтобы использовать общий код из app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import cache, leaderboards, log, profiler, ratelimit, recommendations, tracing
+from app.database import ReplicaSet, parse_endpoints
+from app.models import Genre
+from bot import inline, notify
+
 load_dotenv()
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+log.setup("bot")
+tracing.setup("bot")
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Сообщений в секунду и всплеск от одного пользователя: "1,5"
+BOT_RATE_LIMIT = os.getenv('BOT_RATE_LIMIT', '1,5')
+# Inline-запросы приходят на каждое нажатие клавиши, поэтому лимит выше
+BOT_INLINE_RATE_LIMIT = os.getenv('BOT_INLINE_RATE_LIMIT', '10,30')
+# Таймаут SQL-запроса бота, мс: пользователь не ждет ответа дольше
+BOT_STATEMENT_TIMEOUT = int(os.getenv('BOT_STATEMENT_TIMEOUT', '3000'))
+# Подписок на фильмы у одного чата: ограничивает рассылку уведомлений
+BOT_MAX_SUBSCRIPTIONS = int(os.getenv('BOT_MAX_SUBSCRIPTIONS', '50'))
+
+MOVIE_CARD_SQL = """
+SELECT m.id, m.title, m.director, m.release_year, m.genre, m.description,
+       COALESCE(s.rating_sum::float / NULLIF(s.review_count, 0), 0) as avg_rating,
+       COALESCE(s.review_count, 0) as review_count
+FROM movies m
+LEFT JOIN movie_stats s ON s.movie_id = m.id
+WHERE m.id = %s AND m.deleted_at IS NULL
+"""
+
+LATEST_REVIEWS_SQL = """
+SELECT rating, review_text, created_at, user_name
+FROM reviews 
+WHERE movie_id = %s 
+ORDER BY created_at DESC 
+LIMIT 3
+"""
+
+# Точное совпадение названия важнее частичного
+SUBSCRIPTION_MOVIE_SQL = """
+SELECT id, title FROM movies
+WHERE title ILIKE %s AND deleted_at IS NULL
+ORDER BY lower(title) = lower(%s) DESC, title
+LIMIT 1
+"""
+
+# Подписчик узнает только об изменениях после подписки
+FOLLOW_SQL = """
+INSERT INTO movie_subscriptions (chat_id, movie_id, notified_review_count, notified_rating_sum)
+SELECT %s, m.id, COALESCE(s.review_count, 0), COALESCE(s.rating_sum, 0)
+FROM movies m
+LEFT JOIN movie_stats s ON s.movie_id = m.id
+WHERE m.id = %s
+ON CONFLICT (chat_id, movie_id) DO NOTHING
+RETURNING movie_id
+"""
+
+UNFOLLOW_SQL = """
+DELETE FROM movie_subscriptions s
+USING movies m
+WHERE s.chat_id = %s AND m.id = s.movie_id AND m.title ILIKE %s
+RETURNING m.title
+"""
+
+FOLLOWING_SQL = """
+SELECT m.title,
+       COALESCE(st.rating_sum::float / NULLIF(st.review_count, 0), 0) as avg_rating,
+       COALESCE(st.review_count, 0) as review_count
+FROM movie_subscriptions s
+JOIN movies m ON m.id = s.movie_id AND m.deleted_at IS NULL
+LEFT JOIN movie_stats st ON st.movie_id = s.movie_id
+WHERE s.chat_id = %s
+ORDER BY s.created_at
+"""
+
+def _parse_limit(value):
+    # "запросов в секунду,всплеск" -> (rate, burst)
+    rate, _, burst = value.partition(",")
+    return float(rate), float(burst or rate)
 
 class MovieBot:
     def __init__(self):
@@ -22,21 +103,60 @@ class MovieBot:
             'port': int(os.getenv('DB_PORT', '5432')),
             'user': os.getenv('DB_USER', 'postgres'),
             'password': os.getenv('DB_PASSWORD', ''),
-            'database': os.getenv('DB_NAME', 'movie_reviews')
+            'database': os.getenv('DB_NAME', 'movie_reviews'),
+            # Зависший запрос отменяет сервер, а обрыв сети - таймаут сокета
+            'startup_params': {'statement_timeout': str(BOT_STATEMENT_TIMEOUT)},
+            'timeout': BOT_STATEMENT_TIMEOUT / 1000 + 5
         }
+        # Бот только читает данные, поэтому запросы идут на реплики, если они есть
+        self.replicas = ReplicaSet(
+            parse_endpoints(os.getenv('DB_REPLICA_HOSTS', '')),
+            lambda host, port: pg8000.connect(**{**self.db_config, 'host': host, 'port': port}),
+            retry_interval=int(os.getenv('DB_REPLICA_RETRY_INTERVAL', '30')),
+            max_lag=float(os.getenv('DB_REPLICA_MAX_LAG', '10'))
+        )
+        self.replica_check_task = None
+        # Карточки фильмов: одновременные запросы одного фильма читают БД один раз
+        self.movie_cards = cache.TTLCache("movie_cards", cache.PAGE_TTL, max_entries=500)
+        self.lookups = cache.AsyncSingleFlight("bot_lookups")
+        self.limiter = ratelimit.RateLimiter({
+            'user': _parse_limit(BOT_RATE_LIMIT),
+            'inline': _parse_limit(BOT_INLINE_RATE_LIMIT)
+        })
+        # Inline-подсказки по индексу в памяти (bot/inline.py)
+        self.suggester = inline.InlineSuggester(self.load_inline_rows)
+        # Уведомления подписчикам (bot/notify.py); создается при запуске,
+        # когда известен Bot для отправки
+        self.notifier = None
     
     def get_db_connection(self):
-        try:
-            connection = pg8000.connect(**self.db_config)
-            return connection
-        except Exception as e:
-            logger.error(f"Database connection error: {e}")
-            return None
+        with tracing.span("db.connect"):
+            if self.replicas.endpoints:
+                connection = self.replicas.get_connection()
+                if connection:
+                    return connection
+                logger.warning("No healthy replicas, falling back to primary")
+            try:
+                connection = pg8000.connect(**self.db_config)
+                return connection
+            except Exception as e:
+                logger.error(f"Database connection error: {e}")
+                return None
+
+    def get_primary_connection(self):
+        """Подключение к основному серверу: для записи подписок"""
+        with tracing.span("db.connect"):
+            try:
+                return pg8000.connect(**self.db_config)
+            except Exception as e:
+                logger.error(f"Database connection error: {e}")
+                return None
 
     def get_movie_data(self, cursor, sql, params=None):
         try:
-            cursor.execute(sql, params or ())
-            rows = cursor.fetchall()
+            with tracing.span("db.query", **{"db.statement": "movie_data"}):
+                cursor.execute(sql, params or ())
+                rows = cursor.fetchall()
             if not rows:
                 return []
             columns = [desc[0] for desc in cursor.description]
@@ -45,6 +165,23 @@ class MovieBot:
             logger.error(f"Database query error: {e}")
             return []
     
+    async def rate_limit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ограничение частоты запросов одного пользователя до обработчиков"""
+        # Обработчики обновления выполняются в той же задаче, поэтому
+        # идентификатор корреляции виден во всех их записях лога
+        chat = update.effective_chat
+        log.set_correlation_id(f"chat:{chat.id if chat else '-'}:{update.update_id}")
+        user = update.effective_user
+        if user is None:
+            return
+        retry_after = self.limiter.check(user.id, 'inline' if update.inline_query else 'user')
+        if retry_after:
+            if update.effective_message:
+                await update.effective_message.reply_text(
+                    f"⏳ Слишком много запросов, повторите через {max(1, round(retry_after))} с"
+                )
+            raise ApplicationHandlerStop
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         
@@ -62,7 +199,9 @@ class MovieBot:
 Доступные команды:
 /start - показать это сообщение
 /search <запрос> - поиск фильмов по названию
-/top - топ фильмов
+/top [жанр|десятилетие] - топ фильмов
+/similar <название> - похожие фильмы
+/follow <название> - следить за отзывами о фильме
 /help - помощь
 
 Напиши /search чтобы начать поиск!
@@ -77,8 +216,19 @@ class MovieBot:
 Пример: /search начало
 
 /top - показать топ-5 фильмов
+Пример: /top Драма или /top 1990
+
+/similar <название> - фильмы, похожие по оценкам зрителей
+Пример: /similar начало
+
+/follow <название> - уведомления о новых отзывах и рейтинге фильма
+/unfollow <название> - перестать следить
+/following - фильмы, за которыми вы следите
+
 /help - эта справка
 
+@имя_бота <название> в любом чате - подсказки фильмов по мере ввода
+
 Просто напиши название фильма для быстрого поиска!
         """
         await update.message.reply_text(help_text)
@@ -104,7 +254,7 @@ class MovieBot:
                    COUNT(r.id) as review_count
             FROM movies m
             LEFT JOIN reviews r ON m.id = r.movie_id
-            WHERE m.title ILIKE %s
+            WHERE m.title ILIKE %s AND m.deleted_at IS NULL
             GROUP BY m.id, m.title, m.director, m.release_year, m.genre
             ORDER BY avg_rating DESC
             LIMIT 10
@@ -148,143 +298,401 @@ class MovieBot:
     async def show_movie_details(self, update: Update, context: ContextTypes.DEFAULT_TYPE, movie_id=None):
         if movie_id is None:
             text = update.message.text.strip()
-            connection = self.get_db_connection()
-            if not connection:
-                await update.message.reply_text("❌ Ошибка подключения к базе данных")
-                return
-            
             try:
-                cursor = connection.cursor()
-                sql = "SELECT id FROM movies WHERE title ILIKE %s"
-                cursor.execute(sql, (text,))
-                result = cursor.fetchone()
-                if result:
-                    movie_id = result[0]
-                else:
-                    await update.message.reply_text(f"😔 Фильм '{text}' не найден. Используйте /search для поиска.")
-                    return
+                # Одинаковые одновременные поиски по названию выполняются один раз
+                movie_id = await self.lookups.do(("title", text.lower()), self.find_movie_id, text)
             except Exception as e:
                 logger.error(f"Movie ID search error: {e}")
                 await update.message.reply_text("❌ Произошла ошибка при поиске фильма")
                 return
-            finally:
-                connection.close()
+            
+            if movie_id is None:
+                await update.message.reply_text(f"😔 Фильм '{text}' не найден. Используйте /search для поиска.")
+                return
+        
+        try:
+            card = await self.movie_cards.aget_or_load(movie_id, lambda: self.load_movie_card(movie_id))
+        except Exception as e:
+            logger.error(f"Movie details error: {e}")
+            await update.message.reply_text(f"❌ Произошла ошибка при получении информации о фильме: {str(e)}")
+            return
+        
+        if card is None:
+            await update.message.reply_text("❌ Фильм не найден")
+            return
+        
+        movie, reviews = card
+        response = f"🎬 <b>{movie['title']}</b>\n"
+        response += f"📀 Режиссер: {movie['director']}\n"
+        response += f"⭐ Средний рейтинг: {round(float(movie['avg_rating']), 1)}/10\n"
+        response += f"📊 Всего отзывов: {movie['review_count']}\n"
+        
+        if movie['release_year']:
+            response += f"📅 Год выпуска: {movie['release_year']}\n"
+        
+        if movie['genre']:
+            response += f"🎭 Жанр: {movie['genre']}\n"
+        
+        response += "\n🎞️ Последние отзывы:\n"
+        
+        if reviews:
+            for i, review in enumerate(reviews, 1):
+                response += f"\n{i}. ⭐ {review['rating']}/10"
+                if review.get('user_name'):
+                    response += f" от {review['user_name']}"
+                response += "\n"
+                if review['review_text']:
+                    review_text = review['review_text']
+                    if len(review_text) > 100:
+                        review_text = review_text[:100] + "..."
+                    response += f"   {review_text}\n"
+        else:
+            response += "\n😔 Отзывов пока нет\n"
+        
+        await update.message.reply_text(response, parse_mode='HTML')
+
+    def find_movie_id(self, title):
+        """ID фильма по точному названию без учета регистра или None"""
+        connection = self.get_db_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
+        
+        try:
+            cursor = connection.cursor()
+            with tracing.span("db.query", **{"db.statement": "movie_by_title"}):
+                cursor.execute("SELECT id FROM movies WHERE title ILIKE %s AND deleted_at IS NULL", (title,))
+                result = cursor.fetchone()
+            return result[0] if result else None
+        finally:
+            connection.close()
+
+    def load_movie_card(self, movie_id):
+        """Фильм с рейтингом и три последних отзыва или None, если фильма нет"""
+        connection = self.get_db_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
         
+        try:
+            cursor = connection.cursor()
+            with tracing.span("db.query", **{"db.statement": "movie_card"}):
+                cursor.execute(MOVIE_CARD_SQL, (movie_id,))
+                row = cursor.fetchone()
+            if not row:
+                return None
+            movie = dict(zip([desc[0] for desc in cursor.description], row))
+            
+            with tracing.span("db.query", **{"db.statement": "latest_reviews"}):
+                cursor.execute(LATEST_REVIEWS_SQL, (movie_id,))
+                columns = [desc[0] for desc in cursor.description]
+                reviews = [dict(zip(columns, review)) for review in cursor.fetchall()]
+            return movie, reviews
+        finally:
+            connection.close()
+
+    async def top_movies(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         connection = self.get_db_connection()
         
         if not connection:
             await update.message.reply_text("❌ Ошибка подключения к базе данных")
             return
         
+        # /top, /top <жанр> или /top <десятилетие>, например /top 1990
+        genre = None
+        decade = None
+        title = "🏆 ТОП-5 фильмов по рейтингу"
+        if context.args:
+            arg = " ".join(context.args).strip()
+            if arg.isdigit():
+                decade = int(arg) // 10 * 10
+                title += f" {decade}-х"
+            else:
+                genre = arg.capitalize()
+                title += f" в жанре {genre}"
+        
         try:
             cursor = connection.cursor()
-            
-            sql_movie = """
-            SELECT m.id, m.title, m.director, m.release_year, m.genre, m.description,
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            WHERE m.id = %s
-            GROUP BY m.id, m.title, m.director, m.release_year, m.genre, m.description
-            """
-            cursor.execute(sql_movie, (movie_id,))
-            movies = self.get_movie_data(cursor, sql_movie, (movie_id,))
+            movies = leaderboards.top_rated(cursor, genre=genre, decade=decade, limit=5)
             
             if not movies:
-                await update.message.reply_text("❌ Фильм не найден")
+                await update.message.reply_text("😔 В базе пока нет фильмов с отзывами")
                 return
             
-            movie = movies[0]
-            
-            sql_reviews = """
-            SELECT rating, review_text, created_at, user_name
-            FROM reviews 
-            WHERE movie_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT 3
-            """
-            cursor.execute(sql_reviews, (movie_id,))
-            reviews = self.get_movie_data(cursor, sql_reviews, (movie_id,))
-            
-            response = f"🎬 <b>{movie['title']}</b>\n"
-            response += f"📀 Режиссер: {movie['director']}\n"
-            response += f"⭐ Средний рейтинг: {round(float(movie['avg_rating']), 1)}/10\n"
-            response += f"📊 Всего отзывов: {movie['review_count']}\n"
-            
-            if movie['release_year']:
-                response += f"📅 Год выпуска: {movie['release_year']}\n"
-            
-            if movie['genre']:
-                response += f"🎭 Жанр: {movie['genre']}\n"
-            
-            response += "\n🎞️ Последние отзывы:\n"
+            response = f"{title}:\n\n"
             
-            if reviews:
-                for i, review in enumerate(reviews, 1):
-                    response += f"\n{i}. ⭐ {review['rating']}/10"
-                    if review.get('user_name'):
-                        response += f" от {review['user_name']}"
-                    response += "\n"
-                    if review['review_text']:
-                        review_text = review['review_text']
-                        if len(review_text) > 100:
-                            review_text = review_text[:100] + "..."
-                        response += f"   {review_text}\n"
-            else:
-                response += "\n😔 Отзывов пока нет\n"
+            for i, movie in enumerate(movies, 1):
+                rating = round(float(movie['weighted_rating'] or 0), 1)
+                response += f"{i}. <b>{movie['title']}</b>\n"
+                response += f"   ⭐ {rating}/10 ({movie['review_count']} отзывов)\n"
+                response += f"   📀 {movie['director']}\n\n"
             
             await update.message.reply_text(response, parse_mode='HTML')
             
         except Exception as e:
-            logger.error(f"Movie details error: {e}")
-            await update.message.reply_text(f"❌ Произошла ошибка при получении информации о фильме: {str(e)}")
+            logger.error(f"Top movies error: {e}")
+            await update.message.reply_text("❌ Произошла ошибка")
         finally:
             connection.close()
+    
+    async def get_recommendations(self):
+        """
+        Индекс рекомендаций из файла, который строит задача
+        rebuild_recommendations веб-приложения; файл перечитывается,
+        когда обновился
+        """
+        try:
+            return await asyncio.to_thread(recommendations.refresh)
+        except Exception as e:
+            logger.error(f"Recommendations load error: {e}")
+            return recommendations.get_index()
 
-    async def top_movies(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def load_inline_rows(self):
+        """Строки индекса inline-подсказок: все фильмы с рейтингом"""
         connection = self.get_db_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
         
+        try:
+            cursor = connection.cursor()
+            with tracing.span("db.query", **{"db.statement": "inline_index"}):
+                cursor.execute(inline.INLINE_INDEX_SQL)
+                return cursor.fetchall()
+        finally:
+            connection.close()
+
+    def load_warm_up(self):
+        """Рейтинги и карточки самых обсуждаемых фильмов"""
+        connection = self.get_db_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
+        
+        try:
+            cursor = connection.cursor()
+            leaderboards.top_rated(cursor, limit=5)
+            for genre in Genre:
+                leaderboards.top_rated(cursor, genre=genre.value, limit=5)
+            hottest = leaderboards.most_reviewed(cursor, limit=cache.WARMUP_MOVIES)
+        finally:
+            connection.close()
+        
+        for movie in hottest:
+            self.movie_cards.get_or_load(movie['id'], lambda movie_id=movie['id']: self.load_movie_card(movie_id))
+        return len(hottest)
+
+    async def warm_up(self, application):
+        """Прогрев кешей до начала обработки сообщений"""
+        if not cache.WARMUP_ENABLED:
+            return
+        started = time.perf_counter()
+        try:
+            # Прогрев продолжает трассу запуска из run.py (TRACEPARENT)
+            with tracing.span("bot.warm_up", parent=tracing.parent_from_env()):
+                movies = await asyncio.wait_for(asyncio.to_thread(self.load_warm_up), cache.WARMUP_TIMEOUT)
+                await self.get_recommendations()
+                await self.suggester.get_index()
+            logger.info(f"Caches warmed up in {time.perf_counter() - started:.2f}s, movies: {movies}")
+        except Exception as e:
+            logger.warning(f"Cache warm-up incomplete: {e!r}")
+
+    async def similar_movies(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not context.args:
+            await update.message.reply_text("🔍 Укажите название фильма:\n/similar <название>")
+            return
+        
+        title = " ".join(context.args)
+        index = await self.get_recommendations()
+        if index is None:
+            await update.message.reply_text("❌ Рекомендации временно недоступны")
+            return
+        
+        connection = self.get_db_connection()
         if not connection:
             await update.message.reply_text("❌ Ошибка подключения к базе данных")
             return
         
         try:
             cursor = connection.cursor()
-            sql = """
-            SELECT m.id, m.title, m.director, m.release_year, m.genre,
-                   COALESCE(AVG(r.rating), 0) as avg_rating,
-                   COUNT(r.id) as review_count
-            FROM movies m
-            LEFT JOIN reviews r ON m.id = r.movie_id
-            GROUP BY m.id, m.title, m.director, m.release_year, m.genre
-            HAVING COUNT(r.id) > 0
-            ORDER BY avg_rating DESC
-            LIMIT 5
-            """
-            cursor.execute(sql)
-            movies = self.get_movie_data(cursor, sql)
-            
+            movies = self.get_movie_data(
+                cursor, "SELECT id, title FROM movies WHERE title ILIKE %s AND deleted_at IS NULL LIMIT 1", (f"%{title}%",)
+            )
             if not movies:
-                await update.message.reply_text("😔 В базе пока нет фильмов с отзывами")
+                await update.message.reply_text(f"😔 Фильм '{title}' не найден")
                 return
             
-            response = "🏆 ТОП-5 фильмов по рейтингу:\n\n"
+            movie = movies[0]
+            similar = index.similar(movie['id'], limit=5)
+            if not similar:
+                await update.message.reply_text(f"😔 Пока недостаточно оценок, чтобы подобрать фильмы, похожие на «{movie['title']}»")
+                return
             
-            for i, movie in enumerate(movies, 1):
-                rating = round(float(movie['avg_rating'] or 0), 1)
-                response += f"{i}. <b>{movie['title']}</b>\n"
-                response += f"   ⭐ {rating}/10 ({movie['review_count']} отзывов)\n"
-                response += f"   📀 {movie['director']}\n\n"
+            similar_ids = [movie_id for movie_id, _ in similar]
+            rows = self.get_movie_data(
+                cursor, "SELECT id, title, director FROM movies WHERE id = ANY(%s) AND deleted_at IS NULL", (similar_ids,)
+            )
+            by_id = {row['id']: row for row in rows}
+            
+            response = f"🎯 Похоже на <b>{movie['title']}</b>:\n\n"
+            for i, movie_id in enumerate(similar_ids, 1):
+                if movie_id not in by_id:
+                    continue
+                response += f"{i}. <b>{by_id[movie_id]['title']}</b>\n"
+                response += f"   📀 {by_id[movie_id]['director']}\n\n"
             
             await update.message.reply_text(response, parse_mode='HTML')
             
         except Exception as e:
-            logger.error(f"Top movies error: {e}")
+            logger.error(f"Similar movies error: {e}")
             await update.message.reply_text("❌ Произошла ошибка")
         finally:
             connection.close()
     
+    async def check_replicas_periodically(self):
+        """
+        Проверка реплик в фоне, как в веб-приложении: отстающая больше
+        max_lag реплика выводится из ротации, догнавшая - возвращается
+        """
+        while True:
+            await asyncio.to_thread(self.replicas.check)
+            await asyncio.sleep(self.replicas.retry_interval)
+
+    def follow(self, chat_id, title):
+        """
+        Подписывает чат на фильм; возвращает (название, подписан ли теперь)
+        или None, если фильма нет. Лимит подписок дает ValueError
+        """
+        connection = self.get_primary_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
+        
+        try:
+            cursor = connection.cursor()
+            with tracing.span("db.query", **{"db.statement": "subscription_movie"}):
+                cursor.execute(SUBSCRIPTION_MOVIE_SQL, (f"%{title}%", title))
+                movie = cursor.fetchone()
+            if not movie:
+                return None
+            
+            with tracing.span("db.query", **{"db.statement": "follow"}):
+                cursor.execute("SELECT COUNT(*) FROM movie_subscriptions WHERE chat_id = %s", (chat_id,))
+                if cursor.fetchone()[0] >= BOT_MAX_SUBSCRIPTIONS:
+                    raise ValueError(f"Можно следить не больше чем за {BOT_MAX_SUBSCRIPTIONS} фильмами")
+                cursor.execute(FOLLOW_SQL, (chat_id, movie[0]))
+                added = cursor.fetchone() is not None
+            connection.commit()
+            return movie[1], added
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def unfollow(self, chat_id, title):
+        """Отписывает чат от фильмов с таким названием; возвращает их названия"""
+        connection = self.get_primary_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
+        
+        try:
+            cursor = connection.cursor()
+            with tracing.span("db.query", **{"db.statement": "unfollow"}):
+                cursor.execute(UNFOLLOW_SQL, (chat_id, f"%{title}%"))
+                titles = [row[0] for row in cursor.fetchall()]
+            connection.commit()
+            return titles
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def load_following(self, chat_id):
+        """Фильмы, за которыми следит чат; с основного сервера, чтобы
+        только что добавленная подписка была в списке"""
+        connection = self.get_primary_connection()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
+        
+        try:
+            cursor = connection.cursor()
+            return self.get_movie_data(cursor, FOLLOWING_SQL, (chat_id,))
+        finally:
+            connection.close()
+
+    async def follow_movie(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not context.args:
+            await update.message.reply_text("🔔 Укажите название фильма:\n/follow <название>")
+            return
+        
+        title = " ".join(context.args)
+        try:
+            result = await asyncio.to_thread(self.follow, update.effective_chat.id, title)
+        except ValueError as e:
+            await update.message.reply_text(f"⚠️ {e}. Отпишитесь от ненужных: /unfollow <название>")
+            return
+        except Exception as e:
+            logger.error(f"Follow error: {e}")
+            await update.message.reply_text("❌ Произошла ошибка")
+            return
+        
+        if result is None:
+            await update.message.reply_text(f"😔 Фильм '{title}' не найден. Используйте /search для поиска.")
+            return
+        
+        movie_title, added = result
+        if added:
+            await update.message.reply_text(f"🔔 Вы следите за «{movie_title}»: сообщу о новых отзывах и изменении рейтинга")
+        else:
+            await update.message.reply_text(f"ℹ️ Вы уже следите за «{movie_title}»")
+
+    async def unfollow_movie(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not context.args:
+            await update.message.reply_text("🔕 Укажите название фильма:\n/unfollow <название>")
+            return
+        
+        title = " ".join(context.args)
+        try:
+            titles = await asyncio.to_thread(self.unfollow, update.effective_chat.id, title)
+        except Exception as e:
+            logger.error(f"Unfollow error: {e}")
+            await update.message.reply_text("❌ Произошла ошибка")
+            return
+        
+        if not titles:
+            await update.message.reply_text(f"😔 Вы не следите за фильмом '{title}'. Список: /following")
+            return
+        await update.message.reply_text("🔕 Вы больше не следите за: " + ", ".join(f"«{t}»" for t in titles))
+
+    async def following(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            movies = await asyncio.to_thread(self.load_following, update.effective_chat.id)
+        except Exception as e:
+            logger.error(f"Following error: {e}")
+            await update.message.reply_text("❌ Произошла ошибка")
+            return
+        
+        if not movies:
+            await update.message.reply_text("🔕 Вы ни за чем не следите. Подписаться: /follow <название>")
+            return
+        
+        response = "🔔 Вы следите за фильмами:\n\n"
+        for i, movie in enumerate(movies, 1):
+            response += f"{i}. <b>{html.escape(movie['title'])}</b> - ⭐ {round(float(movie['avg_rating']), 1)}/10, "
+            response += f"отзывов: {movie['review_count']}\n"
+        await update.message.reply_text(response, parse_mode='HTML')
+
+    async def post_init(self, application):
+        """Запуск проверки реплик, отправки уведомлений и прогрев кешей"""
+        if self.replicas.endpoints:
+            self.replica_check_task = asyncio.create_task(self.check_replicas_periodically())
+        self.notifier = notify.Sender(notify.OutboxStore(self.get_primary_connection), application.bot.send_message)
+        self.notifier.start()
+        await self.warm_up(application)
+
+    async def post_shutdown(self, application):
+        if self.replica_check_task is not None:
+            self.replica_check_task.cancel()
+        if self.notifier is not None:
+            await self.notifier.stop()
+
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text.strip()
         
@@ -294,21 +702,50 @@ class MovieBot:
         await update.message.reply_text(f"🔍 Ищу фильм: '{text}'...")
         await self.show_movie_details(update, context)
 
+def traced_handler(name, callback):
+    """
+    Обработчик бота, выполняемый в корневом спане: каждое обновление -
+    отдельная трасса с чатом и номером обновления в атрибутах
+    """
+    profiler.register(callback, name)
+
+    async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        with tracing.span(name, kind=tracing.KIND_SERVER, **{
+            "telegram.chat_id": chat.id if chat else 0,
+            "telegram.update_id": update.update_id
+        }):
+            return await callback(update, context)
+    return run
+
 def main():
     if not BOT_TOKEN:
-        print("❌ TELEGRAM_BOT_TOKEN не установлен")
+        logger.error("TELEGRAM_BOT_TOKEN не установлен")
         return
     
-    application = Application.builder().token(BOT_TOKEN).build()
     bot = MovieBot()
+    application = (
+        Application.builder().token(BOT_TOKEN)
+        .post_init(bot.post_init)
+        .post_shutdown(bot.post_shutdown)
+        .build()
+    )
     
-    application.add_handler(CommandHandler("start", bot.start))
-    application.add_handler(CommandHandler("help", bot.help_command))
-    application.add_handler(CommandHandler("search", bot.search_movies))
-    application.add_handler(CommandHandler("top", bot.top_movies))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text))
+    application.add_handler(TypeHandler(Update, bot.rate_limit), group=-1)
+    application.add_handler(CommandHandler("start", traced_handler("bot /start", bot.start)))
+    application.add_handler(CommandHandler("help", traced_handler("bot /help", bot.help_command)))
+    application.add_handler(CommandHandler("search", traced_handler("bot /search", bot.search_movies)))
+    application.add_handler(CommandHandler("top", traced_handler("bot /top", bot.top_movies)))
+    application.add_handler(CommandHandler("similar", traced_handler("bot /similar", bot.similar_movies)))
+    application.add_handler(CommandHandler("follow", traced_handler("bot /follow", bot.follow_movie)))
+    application.add_handler(CommandHandler("unfollow", traced_handler("bot /unfollow", bot.unfollow_movie)))
+    application.add_handler(CommandHandler("following", traced_handler("bot /following", bot.following)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, traced_handler("bot text", bot.handle_text)))
+    # Без блокировки: ожидание следующего символа не задерживает другие обновления
+    application.add_handler(InlineQueryHandler(traced_handler("bot inline", bot.suggester.handle), block=False))
     
-    print("🤖 Бот запускается...")
+    profiler.install_signal_handler("bot")
+    logger.info("Бот запускается")
     application.run_polling()
 
 if __name__ == '__main__':
@@ -0,0 +1,356 @@
+"""
+Inline-режим бота: подсказки фильмов по мере ввода (@bot запрос).
+
+Telegram присылает запрос на каждое нажатие клавиши, поэтому подсказки
+не обращаются к БД:
+
+- поиск идет по префиксному индексу в памяти (отсортированные слова
+  названий и режиссеров), который перестраивается из БД в фоне раз в
+  INLINE_INDEX_REFRESH секунд;
+- ответы кешируются по нормализованному тексту запроса;
+- при промахе кеша запрос ждет INLINE_DEBOUNCE секунд и не выполняется,
+  если пользователь за это время ввел следующий символ.
+
+Замер задержки на синтетическом каталоге и поддельных inline-обновлениях:
+
+    python -m bot.inline bench [--movies 50000] [--users 50]
+"""
+
+import argparse
+import asyncio
+import bisect
+import heapq
+import html
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import cache
+
+INLINE_RESULTS = int(os.getenv('BOT_INLINE_RESULTS', '10'))
+INLINE_DEBOUNCE = float(os.getenv('BOT_INLINE_DEBOUNCE', '0.3'))
+INLINE_CACHE_TTL = int(os.getenv('BOT_INLINE_CACHE_TTL', '60'))
+INLINE_INDEX_REFRESH = int(os.getenv('BOT_INLINE_INDEX_REFRESH', '300'))
+# Сколько секунд Telegram может сам отдавать наш ответ на тот же запрос
+INLINE_CACHE_TIME = 30
+# Совпадений по префиксам слов в памяти индекса
+PREFIX_CACHE_SIZE = 10000
+
+INLINE_INDEX_SQL = """
+SELECT m.id, m.title, m.director, m.release_year, m.genre,
+       COALESCE(s.rating_sum::float / NULLIF(s.review_count, 0), 0) as avg_rating,
+       COALESCE(s.review_count, 0) as review_count
+FROM movies m
+LEFT JOIN movie_stats s ON s.movie_id = m.id
+WHERE m.deleted_at IS NULL
+"""
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    """
+    Текст для поиска: нижний регистр, ё как е, слова через пробел
+    """
+    return " ".join(_WORD.findall((text or "").lower().replace("ё", "е")))
+
+
+class PrefixIndex:
+    """
+    Префиксный индекс слов названий и режиссеров.
+
+    Слова хранятся отсортированными, поэтому все слова с префиксом -
+    непрерывный диапазон, который находится бинарным поиском. Фильмы
+    ранжируются так: название начинается с запроса, затем все слова
+    запроса найдены в названии, затем совпадение по режиссеру; внутри
+    группы - по числу отзывов и рейтингу.
+    """
+
+    def __init__(self, rows):
+        # rows: (id, title, director, release_year, genre, avg_rating, review_count)
+        self.movies = [
+            {
+                'id': row[0],
+                'title': row[1],
+                'director': row[2],
+                'release_year': row[3],
+                'genre': row[4],
+                'avg_rating': round(float(row[5] or 0), 1),
+                'review_count': row[6] or 0
+            }
+            for row in rows
+        ]
+        self.titles = [normalize(movie['title']) for movie in self.movies]
+        pairs = set()
+        for position, movie in enumerate(self.movies):
+            for word in self.titles[position].split():
+                pairs.add((word, position, True))
+            for word in normalize(movie['director']).split():
+                pairs.add((word, position, False))
+        pairs = sorted(pairs)
+        self.words = [word for word, _, _ in pairs]
+        self.postings = [(position, in_title) for _, position, in_title in pairs]
+        # Совпадения по префиксам: соседние нажатия клавиш разных
+        # пользователей повторяют одни и те же слова
+        self._prefixes = {}
+        # Пустой запрос: самые обсуждаемые фильмы
+        self.popular = heapq.nsmallest(INLINE_RESULTS, range(len(self.movies)), key=self._popularity)
+        self.built_at = time.time()
+
+    def __len__(self):
+        return len(self.movies)
+
+    def _popularity(self, position):
+        movie = self.movies[position]
+        return (-movie['review_count'], -movie['avg_rating'], self.titles[position])
+
+    def _matches(self, prefix):
+        """
+        Позиция фильма -> найден ли префикс в названии
+        """
+        matches = self._prefixes.get(prefix)
+        if matches is not None:
+            return matches
+        matches = {}
+        start = bisect.bisect_left(self.words, prefix)
+        for index in range(start, len(self.words)):
+            if not self.words[index].startswith(prefix):
+                break
+            position, in_title = self.postings[index]
+            matches[position] = matches.get(position, False) or in_title
+        if len(self._prefixes) >= PREFIX_CACHE_SIZE:
+            self._prefixes.clear()
+        self._prefixes[prefix] = matches
+        return matches
+
+    def search(self, query, limit=INLINE_RESULTS):
+        """
+        Фильмы, у которых каждое слово запроса - префикс слова названия
+        или режиссера. query должен быть нормализован (normalize)
+        """
+        if not query:
+            return [self.movies[position] for position in self.popular[:limit]]
+
+        # Сначала самые редкие слова: пересечение быстро сужается
+        found = sorted((self._matches(word) for word in query.split()), key=len)
+        candidates = found[0]
+        for matches in found[1:]:
+            candidates = {
+                position: in_title and matches[position]
+                for position, in_title in candidates.items() if position in matches
+            }
+            if not candidates:
+                return []
+
+        def rank(position):
+            if self.titles[position].startswith(query):
+                group = 0
+            elif candidates[position]:
+                group = 1
+            else:
+                group = 2
+            return (group,) + self._popularity(position)
+
+        return [self.movies[position] for position in heapq.nsmallest(limit, candidates, key=rank)]
+
+
+def article(movie):
+    """
+    Подсказка Telegram: карточка фильма, которая отправится в чат
+    """
+    details = [f"⭐ {movie['avg_rating']}/10", f"📊 {movie['review_count']} отзывов"]
+    if movie['release_year']:
+        details.append(str(movie['release_year']))
+    if movie['genre']:
+        details.append(movie['genre'])
+
+    text = f"🎬 <b>{html.escape(movie['title'])}</b>\n"
+    if movie['director']:
+        text += f"📀 Режиссер: {html.escape(movie['director'])}\n"
+    text += " · ".join(details)
+    return InlineQueryResultArticle(
+        id=str(movie['id']),
+        title=movie['title'],
+        description=" · ".join(filter(None, [movie['director']] + details)),
+        input_message_content=InputTextMessageContent(text, parse_mode='HTML')
+    )
+
+
+class InlineSuggester:
+    """
+    Обработчик inline-запросов: индекс, кеш ответов и отбрасывание
+    устаревших запросов пользователя
+    """
+
+    def __init__(self, load_rows, debounce=INLINE_DEBOUNCE, limit=INLINE_RESULTS,
+                 refresh_interval=INLINE_INDEX_REFRESH):
+        # load_rows() выполняется в потоке и возвращает строки INLINE_INDEX_SQL
+        self.load_rows = load_rows
+        self.debounce = debounce
+        self.limit = limit
+        self.refresh_interval = refresh_interval
+        self.index = None
+        self.results = cache.TTLCache("inline_results", INLINE_CACHE_TTL, max_entries=5000)
+        # Пользователь -> id его последнего inline-запроса
+        self._latest = {}
+        self._building = None
+        self.counters = {'queries': 0, 'answered': 0, 'debounced': 0, 'cache_hits': 0}
+
+    def _build(self):
+        return PrefixIndex(self.load_rows())
+
+    async def get_index(self):
+        """
+        Индекс; устаревший перестраивается в фоне, а первый запрос ждет
+        построения
+        """
+        stale = self.index is None or time.time() - self.index.built_at > self.refresh_interval
+        if stale and self._building is None:
+            self._building = asyncio.ensure_future(asyncio.to_thread(self._build))
+            self._building.add_done_callback(self._built)
+        if self.index is None:
+            await asyncio.shield(self._building)
+        return self.index
+
+    def _built(self, task):
+        self._building = None
+        if not task.cancelled() and task.exception() is None:
+            self.index = task.result()
+            # Рейтинги в подсказках берутся из нового индекса
+            self.results.invalidate()
+
+    async def handle(self, update, context):
+        query = update.inline_query
+        user_id = query.from_user.id
+        text = normalize(query.query)
+        self.counters['queries'] += 1
+        self._latest[user_id] = query.id
+
+        movies = self.results.get(text)
+        if movies is None:
+            if self.debounce:
+                await asyncio.sleep(self.debounce)
+            if self._latest.get(user_id) != query.id:
+                # Пользователь уже ввел следующий символ
+                self.counters['debounced'] += 1
+                return
+            index = await self.get_index()
+            movies = index.search(text, self.limit)
+            self.results.set(text, movies)
+        else:
+            self.counters['cache_hits'] += 1
+
+        if self._latest.get(user_id) == query.id:
+            del self._latest[user_id]
+        await query.answer([article(movie) for movie in movies], cache_time=INLINE_CACHE_TIME)
+        self.counters['answered'] += 1
+
+    def stats(self):
+        return {
+            **self.counters,
+            'movies': len(self.index) if self.index is not None else 0,
+            'cache': self.results.stats()
+        }
+
+
+# --- Замер задержки ---
+
+_SYLLABLES = ["ка", "ро", "ми", "те", "на", "ст", "ль", "ва", "де", "зо", "ри", "пу", "ше", "ла", "бо", "ус"]
+
+
+def _synthetic_rows(count, seed=1):
+    # Слова названий распределены по Ципфу, как в настоящем каталоге
+    generator = random.Random(seed)
+    vocabulary = sorted({
+        "".join(generator.choices(_SYLLABLES, k=generator.randint(2, 5))).capitalize()
+        for _ in range(max(count // 10, 100))
+    })
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    return [
+        (i, " ".join(generator.choices(vocabulary, weights, k=generator.randint(1, 4))) + f" {i}",
+         f"Режиссер {generator.randint(1, 2000)}", generator.randint(1950, 2024), "Драма",
+         generator.uniform(1, 10), generator.randint(0, 5000))
+        for i in range(1, count + 1)
+    ]
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0.0
+
+
+async def _bench(movies, users, keystroke, debounce):
+    rows = _synthetic_rows(movies)
+    suggester = InlineSuggester(lambda: rows, debounce=debounce)
+    started = time.perf_counter()
+    await suggester.get_index()
+    print(f"Индекс: {movies} фильмов за {time.perf_counter() - started:.2f} с")
+
+    latencies = []
+    update_ids = iter(range(1, 10 ** 9))
+
+    def fake_update(user_id, text):
+        sent = time.perf_counter()
+
+        async def answer(results, cache_time=None):
+            latencies.append((time.perf_counter() - sent) * 1000)
+
+        inline_query = SimpleNamespace(
+            id=str(next(update_ids)), query=text, answer=answer, from_user=SimpleNamespace(id=user_id)
+        )
+        return SimpleNamespace(inline_query=inline_query, update_id=0)
+
+    async def type_title(user_id, title):
+        # Пользователь печатает название по символу, каждый символ - обновление
+        tasks = []
+        for length in range(1, len(title) + 1):
+            tasks.append(asyncio.ensure_future(suggester.handle(fake_update(user_id, title[:length]), None)))
+            await asyncio.sleep(keystroke)
+        await asyncio.gather(*tasks)
+
+    generator = random.Random(2)
+    titles = [row[1].rsplit(" ", 1)[0] for row in generator.sample(rows, users)]
+    started = time.perf_counter()
+    await asyncio.gather(*(type_title(user_id, title) for user_id, title in enumerate(titles)))
+    elapsed = time.perf_counter() - started
+
+    # Задержка самого поиска без ожидания и кеша
+    lookups = []
+    for title in titles:
+        text = normalize(title)
+        lookup_started = time.perf_counter()
+        suggester.index.search(text)
+        lookups.append((time.perf_counter() - lookup_started) * 1000)
+
+    counters = suggester.counters
+    print(f"Обновлений: {counters['queries']} за {elapsed:.1f} с, ответов: {counters['answered']}, "
+          f"отброшено: {counters['debounced']}, из кеша: {counters['cache_hits']}")
+    print(f"Задержка ответа, мс: p50 {_percentile(latencies, 50):.1f}, p95 {_percentile(latencies, 95):.1f}, "
+          f"p99 {_percentile(latencies, 99):.1f} (ожидание {debounce * 1000:.0f} мс)")
+    print(f"Поиск по индексу, мс: медиана {statistics.median(lookups):.3f}, макс {max(lookups):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inline-подсказки бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="задержка на поддельных inline-обновлениях")
+    bench_parser.add_argument("--movies", type=int, default=50000)
+    bench_parser.add_argument("--users", type=int, default=50)
+    bench_parser.add_argument("--keystroke", type=float, default=0.12, help="пауза между символами, с")
+    bench_parser.add_argument("--debounce", type=float, default=INLINE_DEBOUNCE)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        asyncio.run(_bench(args.movies, args.users, args.keystroke, args.debounce))
+
+
+if __name__ == "__main__":
+    main()
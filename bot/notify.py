@@ -0,0 +1,538 @@
+"""
+Уведомления подписчикам фильмов (/follow): отправка из очереди в БД.
+
+Запись отзыва уведомлений не ждет: веб-приложение по событиям movie_stats
+ставит задачу notify_subscribers (app/jobs.py), которая добавляет строки
+в notification_outbox (migrations/010_subscriptions.sql). Бот забирает
+их пачками и отправляет:
+
+- уведомления одного чата объединяются в одно сообщение, а текст
+  собирается при отправке по текущим отзывам и рейтингу;
+- общий поток сообщений ограничен корзиной токенов BOT_NOTIFY_RATE,
+  сообщения одному чату - BOT_NOTIFY_CHAT_RATE в секунду (лимиты
+  Telegram: около 30 сообщений в секунду и 1 в секунду одному чату);
+- RetryAfter от Telegram приостанавливает всю отправку на указанное
+  время, остальные ошибки повторяются с экспоненциальной задержкой;
+- чат, заблокировавший бота, теряет подписки.
+
+Строки забираются через FOR UPDATE SKIP LOCKED и до отправки "арендуются"
+сдвигом next_attempt_at, поэтому упавший бот не теряет уведомлений.
+
+Прогон на поддельном Telegram API и очереди в памяти:
+
+    python -m bot.notify simulate [--chats 300] [--changes 3000]
+"""
+
+import argparse
+import asyncio
+import html
+import logging
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import ratelimit, tracing
+
+logger = logging.getLogger(__name__)
+
+# Сообщений в секунду всем чатам и одному чату
+NOTIFY_RATE = float(os.getenv('BOT_NOTIFY_RATE', '25'))
+NOTIFY_CHAT_RATE = float(os.getenv('BOT_NOTIFY_CHAT_RATE', '1'))
+# Чатов в одной пачке
+NOTIFY_BATCH_SIZE = int(os.getenv('BOT_NOTIFY_BATCH_SIZE', '100'))
+NOTIFY_POLL_INTERVAL = float(os.getenv('BOT_NOTIFY_POLL_INTERVAL', '5'))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('BOT_NOTIFY_MAX_ATTEMPTS', '5'))
+# Фильмов в одном сообщении; остальные уходят следующим
+NOTIFY_MAX_MOVIES = 10
+# На сколько секунд забранные строки скрыты от других отправителей
+NOTIFY_LEASE = 300
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 3600
+
+CLAIM_SQL = """
+WITH claimed AS (
+    UPDATE notification_outbox
+    SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+    WHERE id IN (
+        SELECT id FROM notification_outbox
+        WHERE sent_at IS NULL AND next_attempt_at <= CURRENT_TIMESTAMP
+          AND chat_id IN (
+              SELECT chat_id FROM notification_outbox
+              WHERE sent_at IS NULL AND next_attempt_at <= CURRENT_TIMESTAMP
+              ORDER BY next_attempt_at, id
+              LIMIT %s
+          )
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, chat_id, movie_id, attempts
+)
+SELECT c.id, c.chat_id, c.movie_id, c.attempts, m.title,
+       COALESCE(st.review_count, 0) as review_count,
+       COALESCE(st.rating_sum, 0) as rating_sum,
+       s.notified_review_count, s.notified_rating_sum
+FROM claimed c
+LEFT JOIN movies m ON m.id = c.movie_id AND m.deleted_at IS NULL
+LEFT JOIN movie_stats st ON st.movie_id = c.movie_id
+LEFT JOIN movie_subscriptions s ON s.chat_id = c.chat_id AND s.movie_id = c.movie_id
+ORDER BY c.id
+"""
+
+MARK_SENT_SQL = """
+UPDATE notification_outbox SET sent_at = CURRENT_TIMESTAMP, last_error = NULL
+WHERE id = ANY(%s)
+"""
+
+# Подписчик теперь знает о показанных ему значениях
+MARK_NOTIFIED_SQL = """
+UPDATE movie_subscriptions s SET
+    notified_review_count = v.review_count,
+    notified_rating_sum = v.rating_sum
+FROM unnest(%s::bigint[], %s::int[], %s::int[], %s::bigint[]) AS v(chat_id, movie_id, review_count, rating_sum)
+WHERE s.chat_id = v.chat_id AND s.movie_id = v.movie_id
+"""
+
+DEFER_SQL = """
+UPDATE notification_outbox SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+WHERE id = ANY(%s)
+"""
+
+# Исчерпавшее попытки уведомление считается отправленным с ошибкой
+FAIL_SQL = """
+UPDATE notification_outbox SET
+    attempts = attempts + 1,
+    last_error = %s,
+    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+    sent_at = CASE WHEN attempts + 1 >= %s THEN CURRENT_TIMESTAMP END
+WHERE id = ANY(%s)
+"""
+
+UNSUBSCRIBE_CHATS_SQL = """
+DELETE FROM movie_subscriptions WHERE chat_id = ANY(%s)
+"""
+
+CLOSE_CHATS_SQL = """
+UPDATE notification_outbox SET sent_at = CURRENT_TIMESTAMP, last_error = %s
+WHERE chat_id = ANY(%s) AND sent_at IS NULL
+"""
+
+
+class OutboxStore:
+    """
+    notification_outbox в PostgreSQL; методы выполняются в потоке
+    """
+
+    def __init__(self, connect):
+        # connect() - подключение pg8000 к основному серверу
+        self.connect = connect
+
+    def _execute(self, queries, fetch=False):
+        connection = self.connect()
+        if not connection:
+            raise ConnectionError("Ошибка подключения к базе данных")
+        try:
+            cursor = connection.cursor()
+            rows = None
+            for sql, params in queries:
+                with tracing.span("db.query", **{"db.statement": "notification_outbox"}):
+                    cursor.execute(sql, params)
+                if fetch:
+                    columns = [desc[0] for desc in cursor.description]
+                    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            connection.commit()
+            return rows
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def claim(self, limit, lease=NOTIFY_LEASE):
+        """
+        Все готовые к отправке строки не более чем limit чатов (чтобы
+        уведомления чата ушли одним сообщением) с текущей статистикой
+        фильма и тем, что подписчик уже видел; строки скрываются на
+        lease секунд
+        """
+        return self._execute([(CLAIM_SQL, (lease, limit))], fetch=True)
+
+    def mark_sent(self, items):
+        queries = [(MARK_SENT_SQL, ([item['id'] for item in items],))]
+        notified = [item for item in items if item['notified_review_count'] is not None]
+        if notified:
+            queries.append((MARK_NOTIFIED_SQL, (
+                [item['chat_id'] for item in notified],
+                [item['movie_id'] for item in notified],
+                [item['review_count'] for item in notified],
+                [item['rating_sum'] for item in notified]
+            )))
+        self._execute(queries)
+
+    def defer(self, ids, delay):
+        self._execute([(DEFER_SQL, (delay, ids))])
+
+    def fail(self, ids, delay, error, max_attempts=NOTIFY_MAX_ATTEMPTS):
+        self._execute([(FAIL_SQL, (error, delay, max_attempts, ids))])
+
+    def close_chats(self, chat_ids, error):
+        """Снимает подписки чатов, недоступных боту, и их уведомления"""
+        self._execute([(UNSUBSCRIBE_CHATS_SQL, (chat_ids,)), (CLOSE_CHATS_SQL, (error, chat_ids))])
+
+
+def _average(rating_sum, review_count):
+    return rating_sum / review_count if review_count else None
+
+
+def describe(item):
+    """
+    Строка уведомления о фильме или None, если подписчик уже знает
+    текущие значения, отписался или фильм скрыт
+    """
+    if item['notified_review_count'] is None or item['title'] is None:
+        return None
+    count, seen_count = item['review_count'], item['notified_review_count']
+    rating = _average(item['rating_sum'], count)
+    seen_rating = _average(item['notified_rating_sum'], seen_count)
+    changes = []
+    if count != seen_count:
+        changes.append(f"отзывов: {count} ({count - seen_count:+d})")
+    if rating is not None and (seen_rating is None or round(rating, 1) != round(seen_rating, 1)):
+        was = f" (было {seen_rating:.1f})" if seen_rating is not None else ""
+        changes.append(f"⭐ {rating:.1f}{was}")
+    if not changes:
+        return None
+    return f"🎬 <b>{html.escape(item['title'])}</b>\n   " + " · ".join(changes)
+
+
+def message_text(lines):
+    return "🔔 Новое о фильмах, за которыми вы следите:\n\n" + "\n\n".join(lines)
+
+
+def _retry_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Sender:
+    """
+    Отправка уведомлений из очереди с ограничением частоты
+    """
+
+    def __init__(self, store, send_message, rate=NOTIFY_RATE, chat_rate=NOTIFY_CHAT_RATE,
+                 batch_size=NOTIFY_BATCH_SIZE, poll_interval=NOTIFY_POLL_INTERVAL):
+        self.store = store
+        # send_message(chat_id=..., text=..., parse_mode=...) - метод Bot
+        # из python-telegram-bot или его подделка
+        self.send_message = send_message
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.bucket = ratelimit.TokenBucket(rate, max(rate, 1))
+        self.chats = ratelimit.RateLimiter({'chat': (chat_rate, 1)})
+        self.chat_interval = 1 / chat_rate
+        self._gate = asyncio.Lock()
+        self._paused_until = 0.0
+        self._task = None
+        self.counters = {'batches': 0, 'messages': 0, 'notifications': 0, 'skipped': 0,
+                         'deferred': 0, 'failed': 0, 'retry_after': 0, 'closed_chats': 0}
+
+    async def _acquire(self):
+        # Сообщения ждут токена по очереди, поэтому общий лимит соблюдается
+        # при любом числе одновременно отправляемых чатов
+        async with self._gate:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait <= 0:
+                    wait = self.bucket.take()
+                    if not wait:
+                        return
+                await asyncio.sleep(wait)
+
+    async def _deliver(self, chat_id, items):
+        """
+        Отправляет одно сообщение чату; возвращает (исход, строки, задержка, ошибка)
+        """
+        lines, current, later = [], [], []
+        for item in items:
+            line = describe(item)
+            if line is None:
+                current.append(item)
+            elif len(lines) < NOTIFY_MAX_MOVIES:
+                lines.append(line)
+                current.append(item)
+            else:
+                later.append(item)
+        outcomes = [('deferred', later, self.chat_interval, None)] if later else []
+        if not lines:
+            self.counters['skipped'] += len(current)
+            return outcomes + [('sent', current, 0, None)]
+
+        # Чатовый лимит проверяется непосредственно перед отправкой: до
+        # этого сообщение могло долго ждать общего токена
+        await self._acquire()
+        retry_after = self.chats.check(chat_id, 'chat')
+        if retry_after:
+            return [('deferred', items, retry_after, None)]
+        try:
+            await self.send_message(chat_id=chat_id, text=message_text(lines), parse_mode='HTML')
+        except RetryAfter as e:
+            seconds = _retry_seconds(e)
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.counters['retry_after'] += 1
+            logger.warning("Telegram ограничил отправку на %.0f с", seconds)
+            return [('deferred', items, seconds, None)]
+        except Forbidden as e:
+            return [('closed', items, 0, str(e))]
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return [('closed', items, 0, str(e))]
+            return outcomes + [('failed', current, 0, str(e))]
+        except Exception as e:
+            return outcomes + [('failed', current, 0, str(e))]
+        self.counters['messages'] += 1
+        self.counters['notifications'] += len(lines)
+        return outcomes + [('sent', current, 0, None)]
+
+    async def run_once(self):
+        """
+        Забирает и отправляет одну пачку; возвращает число чатов
+        """
+        items = await asyncio.to_thread(self.store.claim, self.batch_size)
+        if not items:
+            return 0
+        by_chat = {}
+        for item in items:
+            by_chat.setdefault(item['chat_id'], []).append(item)
+
+        with tracing.span("bot.notify", **{"notify.chats": len(by_chat), "notify.rows": len(items)}):
+            results = await asyncio.gather(*(self._deliver(chat_id, rows) for chat_id, rows in by_chat.items()))
+            sent, deferred, failed, closed = [], {}, {}, {}
+            for outcomes in results:
+                for outcome, rows, delay, error in outcomes:
+                    if not rows:
+                        continue
+                    if outcome == 'sent':
+                        sent.extend(rows)
+                    elif outcome == 'deferred':
+                        deferred.setdefault(max(1, round(delay)), []).extend(row['id'] for row in rows)
+                    elif outcome == 'failed':
+                        attempts = rows[0]['attempts']
+                        delay = min(RETRY_BASE_DELAY * 2 ** attempts, RETRY_MAX_DELAY)
+                        failed.setdefault((error, delay), []).extend(row['id'] for row in rows)
+                        logger.warning("Уведомление чату %s не отправлено: %s", rows[0]['chat_id'], error)
+                    else:
+                        closed.setdefault(error, []).append(rows[0]['chat_id'])
+
+            if sent:
+                await asyncio.to_thread(self.store.mark_sent, sent)
+            for delay, ids in deferred.items():
+                await asyncio.to_thread(self.store.defer, ids, delay)
+                self.counters['deferred'] += len(ids)
+            for (error, delay), ids in failed.items():
+                await asyncio.to_thread(self.store.fail, ids, delay, error)
+                self.counters['failed'] += len(ids)
+            for error, chat_ids in closed.items():
+                await asyncio.to_thread(self.store.close_chats, chat_ids, error)
+                self.counters['closed_chats'] += len(chat_ids)
+        self.counters['batches'] += 1
+        return len(by_chat)
+
+    async def run(self):
+        while True:
+            try:
+                claimed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка отправки уведомлений: %s", e)
+                claimed = 0
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {**self.counters, 'paused_seconds': round(max(0.0, self._paused_until - time.monotonic()), 1)}
+
+
+# --- Прогон на поддельном Telegram API ---
+
+class MemoryStore:
+    """
+    Очередь уведомлений и подписки в памяти с семантикой OutboxStore
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.subscriptions = {}
+        self.stats = {}
+        self.titles = {}
+        self._ids = iter(range(1, 10 ** 9))
+
+    def subscribe(self, chat_id, movie_id):
+        count, rating_sum = self.stats.get(movie_id, (0, 0))
+        self.subscriptions[(chat_id, movie_id)] = (count, rating_sum)
+
+    def change(self, movie_id, rating):
+        # Новый отзыв и работа задачи notify_subscribers
+        count, rating_sum = self.stats.get(movie_id, (0, 0))
+        self.stats[movie_id] = (count + 1, rating_sum + rating)
+        pending = {(row['chat_id'], row['movie_id']) for row in self.rows.values() if row['sent_at'] is None}
+        for chat_id, subscribed_movie in self.subscriptions:
+            if subscribed_movie == movie_id and (chat_id, movie_id) not in pending:
+                row_id = next(self._ids)
+                self.rows[row_id] = {'id': row_id, 'chat_id': chat_id, 'movie_id': movie_id, 'attempts': 0,
+                                     'next_attempt_at': 0.0, 'sent_at': None, 'last_error': None}
+
+    def pending(self):
+        return sum(1 for row in self.rows.values() if row['sent_at'] is None)
+
+    def claim(self, limit, lease=NOTIFY_LEASE):
+        now = time.monotonic()
+        due = sorted((row for row in self.rows.values() if row['sent_at'] is None and row['next_attempt_at'] <= now),
+                     key=lambda row: (row['next_attempt_at'], row['id']))
+        chats = set()
+        for row in due:
+            if len(chats) >= limit:
+                break
+            chats.add(row['chat_id'])
+        due = [row for row in due if row['chat_id'] in chats]
+        items = []
+        for row in due:
+            row['next_attempt_at'] = now + lease
+            count, rating_sum = self.stats.get(row['movie_id'], (0, 0))
+            seen = self.subscriptions.get((row['chat_id'], row['movie_id']))
+            items.append({
+                'id': row['id'], 'chat_id': row['chat_id'], 'movie_id': row['movie_id'], 'attempts': row['attempts'],
+                'title': self.titles.get(row['movie_id'], f"Фильм {row['movie_id']}"),
+                'review_count': count, 'rating_sum': rating_sum,
+                'notified_review_count': seen[0] if seen else None,
+                'notified_rating_sum': seen[1] if seen else None
+            })
+        return items
+
+    def mark_sent(self, items):
+        for item in items:
+            self.rows[item['id']]['sent_at'] = time.monotonic()
+            key = (item['chat_id'], item['movie_id'])
+            if key in self.subscriptions:
+                self.subscriptions[key] = (item['review_count'], item['rating_sum'])
+
+    def defer(self, ids, delay):
+        for row_id in ids:
+            self.rows[row_id]['next_attempt_at'] = time.monotonic() + delay
+
+    def fail(self, ids, delay, error, max_attempts=NOTIFY_MAX_ATTEMPTS):
+        for row_id in ids:
+            row = self.rows[row_id]
+            row['attempts'] += 1
+            row['last_error'] = error
+            row['next_attempt_at'] = time.monotonic() + delay
+            if row['attempts'] >= max_attempts:
+                row['sent_at'] = time.monotonic()
+
+    def close_chats(self, chat_ids, error):
+        for key in [key for key in self.subscriptions if key[0] in chat_ids]:
+            del self.subscriptions[key]
+        for row in self.rows.values():
+            if row['chat_id'] in chat_ids and row['sent_at'] is None:
+                row['sent_at'] = time.monotonic()
+                row['last_error'] = error
+
+
+class FakeTelegram:
+    """
+    Поддельный Bot.send_message с лимитами Telegram: при превышении
+    общего или чатового лимита отвечает RetryAfter, заблокировавшим
+    бота чатам - Forbidden
+    """
+
+    def __init__(self, rate=30, chat_rate=1, latency=0.05, blocked=()):
+        self.global_bucket = ratelimit.TokenBucket(rate, rate)
+        self.chat_buckets = ratelimit.RateLimiter({'chat': (chat_rate, 1)})
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.messages = []
+        self.rejected = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await asyncio.sleep(self.latency)
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        retry_after = self.chat_buckets.check(chat_id, 'chat') or self.global_bucket.take()
+        if retry_after:
+            self.rejected += 1
+            raise RetryAfter(max(1, round(retry_after)))
+        self.messages.append((time.monotonic(), chat_id, text))
+
+
+async def _simulate(chats, movies, changes, follows, blocked, rate, chat_rate):
+    generator = random.Random(3)
+    store = MemoryStore()
+    for chat_id in range(1, chats + 1):
+        for movie_id in generator.sample(range(1, movies + 1), min(follows, movies)):
+            store.subscribe(chat_id, movie_id)
+    # Отзывы чаще пишут к популярным фильмам
+    weights = [1 / rank for rank in range(1, movies + 1)]
+    for movie_id in generator.choices(range(1, movies + 1), weights, k=changes):
+        store.change(movie_id, generator.randint(1, 10))
+    queued = store.pending()
+
+    telegram = FakeTelegram(blocked=generator.sample(range(1, chats + 1), blocked))
+    sender = Sender(store, telegram.send_message, rate=rate, chat_rate=chat_rate, poll_interval=0.2)
+    started = time.perf_counter()
+    sender.start()
+    while store.pending():
+        await asyncio.sleep(0.2)
+    await sender.stop()
+    elapsed = time.perf_counter() - started
+
+    per_second = {}
+    for sent_at, _, _ in telegram.messages:
+        second = int(sent_at)
+        per_second[second] = per_second.get(second, 0) + 1
+    counters = sender.counters
+    print(f"Изменений: {changes}, уведомлений в очереди: {queued}, чатов: {chats}")
+    print(f"Сообщений: {counters['messages']} ({counters['notifications']} фильмов) за {elapsed:.1f} с, "
+          f"в среднем {counters['messages'] / elapsed:.1f}/с, максимум {max(per_second.values(), default=0)} за секунду")
+    print(f"RetryAfter от API: {telegram.rejected}, отложено: {counters['deferred']}, "
+          f"ошибок: {counters['failed']}, закрыто чатов: {counters['closed_chats']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Уведомления подписчикам")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    simulate_parser = subparsers.add_parser("simulate", help="отправка на поддельном Telegram API")
+    simulate_parser.add_argument("--chats", type=int, default=300)
+    simulate_parser.add_argument("--movies", type=int, default=200)
+    simulate_parser.add_argument("--changes", type=int, default=3000, help="новых отзывов")
+    simulate_parser.add_argument("--follows", type=int, default=5, help="подписок на чат")
+    simulate_parser.add_argument("--blocked", type=int, default=5, help="чатов, заблокировавших бота")
+    simulate_parser.add_argument("--rate", type=float, default=NOTIFY_RATE)
+    simulate_parser.add_argument("--chat-rate", type=float, default=NOTIFY_CHAT_RATE)
+    args = parser.parse_args()
+
+    if args.command == "simulate":
+        asyncio.run(_simulate(args.chats, args.movies, args.changes, args.follows, args.blocked,
+                              args.rate, args.chat_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+-- Миграция 001: секционирование таблицы reviews по хэшу movie_id
+--
+-- Почти все запросы к reviews фильтруют по movie_id, поэтому таблица делится
+-- на 16 хэш-секций по movie_id: запросы по одному фильму читают одну секцию,
+-- а сортировка по created_at использует индексы секций (Merge Append).
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/001_partition_reviews.sql
+--
+-- Данные копируются пачками по 50 000 строк с COMMIT после каждой пачки,
+-- поэтому старая таблица остается доступной для чтения и записи.
+-- Отзывы, добавленные и удаленные во время копирования, триггер записывает
+-- в reviews_migration_changes; журнал разбирается пачками до блокировки,
+-- а под ACCESS EXCLUSIVE остаются только изменения за последние секунды.
+-- Замер на большой таблице: python -m app.partitioning bench
+
+-- 1. Новая секционированная таблица
+CREATE TABLE IF NOT EXISTS reviews_partitioned (
+    id INTEGER NOT NULL DEFAULT nextval('reviews_id_seq'),
+    movie_id INTEGER NOT NULL REFERENCES movies(id) ON DELETE CASCADE,
+    user_name VARCHAR(100) NOT NULL,
+    rating INTEGER NOT NULL CHECK (rating BETWEEN 1 AND 10),
+    review_text TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, movie_id)
+) PARTITION BY HASH (movie_id);
+
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS reviews_p%s PARTITION OF reviews_partitioned
+             FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i
+        );
+    END LOOP;
+END $$;
+
+-- Индексы создаются на родительской таблице и наследуются секциями
+CREATE INDEX IF NOT EXISTS idx_reviews_part_movie_created
+    ON reviews_partitioned (movie_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_reviews_part_created
+    ON reviews_partitioned (created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_reviews_part_id
+    ON reviews_partitioned (id);
+
+-- 2. Журнал изменений старой таблицы. CREATE TRIGGER дожидается
+-- незавершенных транзакций записи, поэтому все, что не попало в журнал,
+-- уже видно копированию
+CREATE TABLE IF NOT EXISTS reviews_migration_changes (
+    id INTEGER NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION log_reviews_migration_change() RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO reviews_migration_changes (id) VALUES (OLD.id);
+    ELSE
+        INSERT INTO reviews_migration_changes (id) VALUES (NEW.id);
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS reviews_migration_changes ON reviews;
+CREATE TRIGGER reviews_migration_changes
+    AFTER INSERT OR UPDATE OR DELETE ON reviews
+    FOR EACH ROW EXECUTE FUNCTION log_reviews_migration_change();
+
+-- 3. Перенос данных пачками
+CREATE OR REPLACE PROCEDURE copy_reviews_to_partitioned(batch_size INTEGER DEFAULT 50000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_id INTEGER;
+    max_id INTEGER;
+BEGIN
+    SELECT COALESCE(MAX(id), 0) INTO last_id FROM reviews_partitioned;
+    SELECT COALESCE(MAX(id), 0) INTO max_id FROM reviews;
+    WHILE last_id < max_id LOOP
+        INSERT INTO reviews_partitioned (id, movie_id, user_name, rating, review_text, created_at)
+        SELECT id, movie_id, user_name, rating, review_text, created_at
+        FROM reviews
+        WHERE id > last_id AND id <= last_id + batch_size
+        ON CONFLICT DO NOTHING;
+        last_id := last_id + batch_size;
+        COMMIT;
+    END LOOP;
+END $$;
+
+-- Разбор журнала: строка с ID из журнала копируется заново из reviews,
+-- а удаленная там исчезает и из новой таблицы. Возвращает число
+-- разобранных записей журнала
+CREATE OR REPLACE FUNCTION apply_reviews_migration_changes(batch_size INTEGER)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    applied INTEGER;
+BEGIN
+    CREATE TEMP TABLE IF NOT EXISTS reviews_migration_batch (id INTEGER) ON COMMIT DROP;
+    WITH taken AS (
+        DELETE FROM reviews_migration_changes
+        WHERE ctid IN (SELECT ctid FROM reviews_migration_changes LIMIT batch_size)
+        RETURNING id
+    )
+    INSERT INTO reviews_migration_batch SELECT DISTINCT id FROM taken;
+    GET DIAGNOSTICS applied = ROW_COUNT;
+
+    DELETE FROM reviews_partitioned rp
+    USING reviews_migration_batch b WHERE rp.id = b.id;
+
+    INSERT INTO reviews_partitioned (id, movie_id, user_name, rating, review_text, created_at)
+    SELECT r.id, r.movie_id, r.user_name, r.rating, r.review_text, r.created_at
+    FROM reviews r JOIN reviews_migration_batch b ON b.id = r.id;
+
+    TRUNCATE reviews_migration_batch;
+    RETURN applied;
+END $$;
+
+CREATE OR REPLACE PROCEDURE catch_up_reviews_migration(batch_size INTEGER DEFAULT 10000)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    LOOP
+        EXIT WHEN apply_reviews_migration_changes(batch_size) < batch_size;
+        COMMIT;
+    END LOOP;
+    COMMIT;
+END $$;
+
+CALL copy_reviews_to_partitioned();
+CALL catch_up_reviews_migration();
+-- Второй проход забирает то, что накопилось за время первого
+CALL catch_up_reviews_migration();
+
+-- 4. Переключение: под блокировкой разбирается только остаток журнала
+BEGIN;
+LOCK TABLE reviews IN ACCESS EXCLUSIVE MODE;
+
+SELECT apply_reviews_migration_changes(2147483647);
+
+DROP TRIGGER reviews_migration_changes ON reviews;
+ALTER SEQUENCE reviews_id_seq OWNED BY reviews_partitioned.id;
+ALTER TABLE reviews RENAME TO reviews_unpartitioned;
+ALTER TABLE reviews_partitioned RENAME TO reviews;
+COMMIT;
+
+DROP PROCEDURE copy_reviews_to_partitioned(INTEGER);
+DROP PROCEDURE catch_up_reviews_migration(INTEGER);
+DROP FUNCTION apply_reviews_migration_changes(INTEGER);
+DROP FUNCTION log_reviews_migration_change();
+DROP TABLE reviews_migration_changes;
+
+-- 5. После проверки старую таблицу можно удалить:
+--   DROP TABLE reviews_unpartitioned;
+
+ANALYZE reviews;
@@ -0,0 +1,31 @@
+-- Миграция 002: агрегаты отзывов по фильмам для рейтингов (лидербордов)
+--
+-- movie_stats хранит количество отзывов и сумму оценок по каждому фильму.
+-- Таблица обновляется приложением в той же транзакции, что и запись
+-- отзыва (app/aggregates.py), поэтому рейтинги не требуют группировки
+-- по всей таблице reviews.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/002_movie_stats.sql
+
+CREATE TABLE IF NOT EXISTS movie_stats (
+    movie_id INTEGER PRIMARY KEY REFERENCES movies(id) ON DELETE CASCADE,
+    review_count INTEGER NOT NULL DEFAULT 0,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_movie_stats_review_count
+    ON movie_stats (review_count DESC);
+
+-- Заполнение по существующим отзывам
+INSERT INTO movie_stats (movie_id, review_count, rating_sum)
+SELECT movie_id, COUNT(*), SUM(rating)
+FROM reviews
+GROUP BY movie_id
+ON CONFLICT (movie_id) DO UPDATE SET
+    review_count = EXCLUDED.review_count,
+    rating_sum = EXCLUDED.rating_sum,
+    updated_at = CURRENT_TIMESTAMP;
+
+ANALYZE movie_stats;
@@ -0,0 +1,59 @@
+-- Миграция 003: нормализованный ключ пользователя в отзывах
+--
+-- reviews.user_key хранит имя пользователя без пробелов по краям и в нижнем
+-- регистре. По нему строится индекс для постраничной истории отзывов
+-- пользователя (вместо сканирования с ILIKE), а user_review_stats хранит
+-- количество и сумму оценок пользователя.
+--
+-- Порядок применения:
+--   1. Выкатить версию приложения, которая заполняет user_key при записи.
+--   2. psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/003_review_user_key.sql
+--
+-- Колонка добавляется без значения по умолчанию (без перезаписи таблицы),
+-- существующие строки заполняются пачками с COMMIT после каждой пачки.
+
+ALTER TABLE reviews ADD COLUMN IF NOT EXISTS user_key VARCHAR(100);
+
+CREATE TABLE IF NOT EXISTS user_review_stats (
+    user_key VARCHAR(100) PRIMARY KEY,
+    review_count INTEGER NOT NULL DEFAULT 0,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE PROCEDURE backfill_review_user_key(batch_size INTEGER DEFAULT 50000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_id INTEGER := 0;
+    max_id INTEGER;
+BEGIN
+    SELECT COALESCE(MAX(id), 0) INTO max_id FROM reviews;
+    WHILE last_id < max_id LOOP
+        UPDATE reviews
+        SET user_key = lower(btrim(user_name))
+        WHERE id > last_id AND id <= last_id + batch_size
+          AND user_key IS NULL;
+        last_id := last_id + batch_size;
+        COMMIT;
+    END LOOP;
+END $$;
+
+CALL backfill_review_user_key();
+DROP PROCEDURE backfill_review_user_key(INTEGER);
+
+CREATE INDEX IF NOT EXISTS idx_reviews_user_key_created
+    ON reviews (user_key, created_at DESC, id DESC);
+
+-- Статистика пользователей по всем отзывам
+INSERT INTO user_review_stats (user_key, review_count, rating_sum)
+SELECT user_key, COUNT(*), SUM(rating)
+FROM reviews
+WHERE user_key IS NOT NULL
+GROUP BY user_key
+ON CONFLICT (user_key) DO UPDATE SET
+    review_count = EXCLUDED.review_count,
+    rating_sum = EXCLUDED.rating_sum,
+    updated_at = CURRENT_TIMESTAMP;
+
+ANALYZE reviews;
@@ -0,0 +1,47 @@
+-- Миграция 004: дневные и недельные гистограммы оценок по фильмам и жанрам
+--
+-- rating_counts - массив из 10 счетчиков: сколько оценок 1, 2, ..., 10
+-- поставлено за период. Строки обновляются приложением инкрементально
+-- при записи и удалении отзывов (app/aggregates.py), а ряд за период
+-- читается одним проходом по первичному ключу.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/004_rating_rollups.sql
+--   python -m app.analytics backfill
+
+-- Гистограмма массива оценок 1-10
+CREATE OR REPLACE FUNCTION rating_histogram(ratings INTEGER[])
+RETURNS INTEGER[]
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT array_agg(
+        (SELECT COUNT(*) FROM unnest(ratings) AS r(rating) WHERE r.rating = g)::INTEGER
+        ORDER BY g
+    )
+    FROM generate_series(1, 10) AS g
+$$;
+
+-- Поэлементная сумма двух гистограмм
+CREATE OR REPLACE FUNCTION rating_counts_add(a INTEGER[], b INTEGER[])
+RETURNS INTEGER[]
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT array_agg(x + y ORDER BY i)
+    FROM unnest(a, b) WITH ORDINALITY AS u(x, y, i)
+$$;
+
+CREATE TABLE IF NOT EXISTS movie_rating_rollups (
+    movie_id INTEGER NOT NULL REFERENCES movies(id) ON DELETE CASCADE,
+    bucket VARCHAR(5) NOT NULL CHECK (bucket IN ('day', 'week')),
+    bucket_start DATE NOT NULL,
+    rating_counts INTEGER[] NOT NULL,
+    PRIMARY KEY (movie_id, bucket, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS genre_rating_rollups (
+    genre VARCHAR(50) NOT NULL,
+    bucket VARCHAR(5) NOT NULL CHECK (bucket IN ('day', 'week')),
+    bucket_start DATE NOT NULL,
+    rating_counts INTEGER[] NOT NULL,
+    PRIMARY KEY (genre, bucket, bucket_start)
+);
@@ -0,0 +1,27 @@
+-- Миграция 005: счетчики оценок 1-10 в movie_stats
+--
+-- rating_counts хранит количество оценок каждого значения, из которого
+-- приложение за O(1) вычисляет среднее, медиану, перцентили и байесовский
+-- рейтинг без группировки по reviews. Требует миграций 002 и 004.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/005_movie_rating_counts.sql
+
+-- Колонка с постоянным значением по умолчанию добавляется без перезаписи таблицы
+ALTER TABLE movie_stats
+    ADD COLUMN IF NOT EXISTS rating_counts INTEGER[] NOT NULL DEFAULT '{0,0,0,0,0,0,0,0,0,0}';
+
+UPDATE movie_stats s
+SET rating_counts = h.rating_counts,
+    review_count = h.review_count,
+    rating_sum = h.rating_sum,
+    updated_at = CURRENT_TIMESTAMP
+FROM (
+    SELECT movie_id,
+           rating_histogram(array_agg(rating)) as rating_counts,
+           COUNT(*) as review_count,
+           SUM(rating) as rating_sum
+    FROM reviews
+    GROUP BY movie_id
+) h
+WHERE h.movie_id = s.movie_id;
@@ -0,0 +1,105 @@
+-- Миграция 006: поток изменений через LISTEN/NOTIFY
+--
+-- Триггеры на reviews, movies и movie_stats отправляют JSON-события
+-- в канал movie_events. NOTIFY доставляется только после фиксации
+-- транзакции, поэтому слушатели (app/events.py) видят лишь
+-- зафиксированные изменения - в том числе сделанные ботом.
+--
+-- Размер payload в PostgreSQL ограничен 8000 байтами, поэтому текст
+-- отзыва в событии обрезается.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/006_change_feed.sql
+
+CREATE OR REPLACE FUNCTION notify_review_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('movie_events', json_build_object(
+            'type', 'review_deleted',
+            'movie_id', OLD.movie_id,
+            'review_id', OLD.id
+        )::text);
+        RETURN OLD;
+    END IF;
+
+    PERFORM pg_notify('movie_events', json_build_object(
+        'type', 'review_created',
+        'movie_id', NEW.movie_id,
+        'review', json_build_object(
+            'id', NEW.id,
+            'movie_id', NEW.movie_id,
+            'user_name', NEW.user_name,
+            'rating', NEW.rating,
+            'review_text', left(NEW.review_text, 1000),
+            'created_at', NEW.created_at
+        )
+    )::text);
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION notify_movie_stats_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('movie_events', json_build_object(
+        'type', 'movie_stats',
+        'movie_id', NEW.movie_id,
+        'review_count', NEW.review_count,
+        'avg_rating', round(NEW.rating_sum::numeric / NULLIF(NEW.review_count, 0), 2),
+        'rating_counts', NEW.rating_counts
+    )::text);
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION notify_movie_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    movie movies%ROWTYPE;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        movie := OLD;
+    ELSE
+        movie := NEW;
+    END IF;
+
+    PERFORM pg_notify('movie_events', json_build_object(
+        'type', CASE TG_OP
+            WHEN 'INSERT' THEN 'movie_created'
+            WHEN 'UPDATE' THEN 'movie_updated'
+            ELSE 'movie_deleted'
+        END,
+        'movie_id', movie.id,
+        'movie', json_build_object(
+            'id', movie.id,
+            'title', movie.title,
+            'director', movie.director,
+            'release_year', movie.release_year,
+            'genre', movie.genre
+        )
+    )::text);
+    RETURN movie;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS reviews_notify ON reviews;
+CREATE TRIGGER reviews_notify
+    AFTER INSERT OR DELETE ON reviews
+    FOR EACH ROW EXECUTE FUNCTION notify_review_change();
+
+DROP TRIGGER IF EXISTS movie_stats_notify ON movie_stats;
+CREATE TRIGGER movie_stats_notify
+    AFTER INSERT OR UPDATE ON movie_stats
+    FOR EACH ROW EXECUTE FUNCTION notify_movie_stats_change();
+
+DROP TRIGGER IF EXISTS movies_notify ON movies;
+CREATE TRIGGER movies_notify
+    AFTER INSERT OR UPDATE OR DELETE ON movies
+    FOR EACH ROW EXECUTE FUNCTION notify_movie_change();
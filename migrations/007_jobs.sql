@@ -0,0 +1,55 @@
+-- Миграция 007: очередь фоновых задач и предрасчитанная статистика
+--
+-- jobs - очередь задач для app/jobs.py. Воркеры забирают задачи через
+-- SELECT ... FOR UPDATE SKIP LOCKED, поэтому несколько процессов не
+-- мешают друг другу. Задача в статусе running держит аренду
+-- (locked_until), которую воркер продлевает; задача с истекшей арендой
+-- (воркер упал) возвращается в очередь.
+--
+-- dedupe_key уникален: периодические задачи ставятся с ключом вида
+-- "refresh_stats:<номер интервала>", чтобы несколько процессов
+-- не поставили одну и ту же задачу дважды.
+--
+-- site_stats - одна строка со статистикой для /api/v1/stats, которую
+-- пересчитывает задача refresh_stats.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/007_jobs.sql
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(10) NOT NULL DEFAULT 'queued'
+        CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    dedupe_key VARCHAR(100) UNIQUE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    last_error TEXT,
+    result JSONB
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_queued
+    ON jobs (run_at, id) WHERE status = 'queued';
+
+CREATE INDEX IF NOT EXISTS idx_jobs_running
+    ON jobs (locked_until) WHERE status = 'running';
+
+CREATE INDEX IF NOT EXISTS idx_jobs_finished
+    ON jobs (finished_at) WHERE status IN ('done', 'failed');
+
+CREATE TABLE IF NOT EXISTS site_stats (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    total_movies INTEGER NOT NULL,
+    total_reviews BIGINT NOT NULL,
+    average_rating DOUBLE PRECISION,
+    total_users INTEGER NOT NULL,
+    top_genre VARCHAR(50),
+    most_reviewed_movie VARCHAR(255),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
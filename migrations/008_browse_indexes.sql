@@ -0,0 +1,22 @@
+-- Миграция 008: индексы для /api/v1/movies/browse
+--
+-- Обычно список строит снимок каталога в памяти воркера (app/catalogue.py);
+-- эти индексы нужны запросам movies_browse* из app/statements.py, пока
+-- снимок не загружен. Составные индексы покрывают фильтры по жанру, году
+-- и длительности и сортировку по названию без чтения строк таблицы,
+-- индекс по выражению - фильтр по минимальному рейтингу. Требует миграции 002.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/008_browse_indexes.sql
+
+CREATE INDEX IF NOT EXISTS idx_movies_genre_year
+    ON movies (genre, release_year) INCLUDE (duration_minutes, title);
+
+CREATE INDEX IF NOT EXISTS idx_movies_year_duration
+    ON movies (release_year, duration_minutes) INCLUDE (genre, title);
+
+CREATE INDEX IF NOT EXISTS idx_movies_title
+    ON movies (title, id);
+
+CREATE INDEX IF NOT EXISTS idx_movie_stats_avg_rating
+    ON movie_stats ((rating_sum::float8 / NULLIF(review_count, 0))) INCLUDE (review_count);
@@ -0,0 +1,112 @@
+-- Миграция 009: мягкое удаление фильмов и удаление отзывов пачками
+--
+-- DELETE фильма с миллионом отзывов каскадом удаляет все отзывы в одной
+-- транзакции: держит блокировки, раздувает WAL и отставание реплик.
+-- Теперь удаление фильма только помечает его (deleted_at) и снимает его
+-- агрегаты, а отзывы удаляет фоновая задача purge_movie (app/jobs.py)
+-- пачками по одной транзакции. Прогресс хранится в movie_deletions.
+--
+-- Требует миграций 004, 006 и 007.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/009_soft_delete.sql
+
+ALTER TABLE movies ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+-- Скрытые фильмы, отзывы которых еще удаляются
+CREATE INDEX IF NOT EXISTS idx_movies_deleted
+    ON movies (deleted_at) WHERE deleted_at IS NOT NULL;
+
+-- Строка остается после окончательного удаления фильма как журнал
+CREATE TABLE IF NOT EXISTS movie_deletions (
+    movie_id INTEGER PRIMARY KEY,
+    title VARCHAR(255),
+    total_reviews BIGINT NOT NULL DEFAULT 0,
+    deleted_reviews BIGINT NOT NULL DEFAULT 0,
+    batches INTEGER NOT NULL DEFAULT 0,
+    job_id BIGINT,
+    requested_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Поэлементная разность двух гистограмм
+CREATE OR REPLACE FUNCTION rating_counts_sub(a INTEGER[], b INTEGER[])
+RETURNS INTEGER[]
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT array_agg(x - y ORDER BY i)
+    FROM unnest(a, b) WITH ORDINALITY AS u(x, y, i)
+$$;
+
+-- Пачки удаляются с SET LOCAL app.bulk_delete = 'on': событие на каждый
+-- удаленный отзыв не нужно подписчикам скрытого фильма
+CREATE OR REPLACE FUNCTION notify_review_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        IF current_setting('app.bulk_delete', true) = 'on' THEN
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('movie_events', json_build_object(
+            'type', 'review_deleted',
+            'movie_id', OLD.movie_id,
+            'review_id', OLD.id
+        )::text);
+        RETURN OLD;
+    END IF;
+
+    PERFORM pg_notify('movie_events', json_build_object(
+        'type', 'review_created',
+        'movie_id', NEW.movie_id,
+        'review', json_build_object(
+            'id', NEW.id,
+            'movie_id', NEW.movie_id,
+            'user_name', NEW.user_name,
+            'rating', NEW.rating,
+            'review_text', left(NEW.review_text, 1000),
+            'created_at', NEW.created_at
+        )
+    )::text);
+    RETURN NEW;
+END;
+$$;
+
+-- Скрытие фильма для подписчиков - удаление; окончательный DELETE
+-- скрытого фильма событий не отправляет
+CREATE OR REPLACE FUNCTION notify_movie_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    movie movies%ROWTYPE;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        movie := OLD;
+        IF OLD.deleted_at IS NOT NULL THEN
+            RETURN movie;
+        END IF;
+    ELSE
+        movie := NEW;
+    END IF;
+
+    PERFORM pg_notify('movie_events', json_build_object(
+        'type', CASE
+            WHEN TG_OP = 'INSERT' THEN 'movie_created'
+            WHEN TG_OP = 'UPDATE' AND NEW.deleted_at IS NOT NULL THEN 'movie_deleted'
+            WHEN TG_OP = 'UPDATE' THEN 'movie_updated'
+            ELSE 'movie_deleted'
+        END,
+        'movie_id', movie.id,
+        'movie', json_build_object(
+            'id', movie.id,
+            'title', movie.title,
+            'director', movie.director,
+            'release_year', movie.release_year,
+            'genre', movie.genre
+        )
+    )::text);
+    RETURN movie;
+END;
+$$;
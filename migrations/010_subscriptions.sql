@@ -0,0 +1,47 @@
+-- Миграция 010: подписки на фильмы и очередь уведомлений бота
+--
+-- movie_subscriptions - фильмы, за которыми следит чат (/follow в боте).
+-- notified_review_count и notified_rating_sum - значения movie_stats,
+-- о которых чат уже знает: уведомление сообщает разницу с ними.
+--
+-- notification_outbox - исходящие уведомления. Строку ставит задача
+-- notify_subscribers (app/jobs.py), когда movie_stats фильма отличается
+-- от того, что видел подписчик, а отправляет бот (bot/notify.py).
+-- Неотправленная строка на пару (чат, фильм) одна: повторные изменения
+-- до отправки не добавляют строк, а текст собирается при отправке по
+-- текущим данным. Поэтому задачу можно запускать сколько угодно раз.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/010_subscriptions.sql
+
+CREATE TABLE IF NOT EXISTS movie_subscriptions (
+    chat_id BIGINT NOT NULL,
+    movie_id INTEGER NOT NULL REFERENCES movies(id) ON DELETE CASCADE,
+    notified_review_count INTEGER NOT NULL DEFAULT 0,
+    notified_rating_sum BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, movie_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_movie_subscriptions_movie
+    ON movie_subscriptions (movie_id);
+
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    movie_id INTEGER NOT NULL REFERENCES movies(id) ON DELETE CASCADE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    last_error TEXT
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_notification_outbox_pending
+    ON notification_outbox (chat_id, movie_id) WHERE sent_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due
+    ON notification_outbox (next_attempt_at, id) WHERE sent_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_sent
+    ON notification_outbox (sent_at) WHERE sent_at IS NOT NULL;
@@ -0,0 +1,50 @@
+-- Миграция 011: подписи MinHash отзывов и пометки почти одинаковых
+--
+-- review_signatures - подпись MinHash текста отзыва (128 значений uint32,
+-- 512 байт) и ключи корзин LSH (app/dedup.py). Ключи включают фильм или
+-- пользователя, поэтому поиск кандидатов (buckets && ключи нового
+-- отзыва) находит только отзывы того же фильма или того же пользователя.
+-- GIN-индекс по buckets делает поиск независимым от числа отзывов.
+--
+-- review_flags - отзывы, почти совпадающие с более ранним (duplicate_of)
+-- в пределах фильма или пользователя (scope), с оценкой коэффициента
+-- Жаккара. Пометки пишутся в транзакции записи отзыва; агрегаты и
+-- рейтинги они не меняют.
+--
+-- Существующие отзывы: python -m app.dedup backfill
+-- (или python -m app.jobs enqueue dedup_backfill)
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/011_review_dedup.sql
+
+CREATE TABLE IF NOT EXISTS review_signatures (
+    review_id INTEGER PRIMARY KEY,
+    movie_id INTEGER NOT NULL,
+    user_key VARCHAR(100),
+    signature BYTEA NOT NULL,
+    buckets BIGINT[] NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (review_id, movie_id) REFERENCES reviews (id, movie_id) ON DELETE CASCADE
+);
+
+-- Новые отзывы добавляются в список ожидания GIN и не перестраивают
+-- дерево при каждой вставке
+CREATE INDEX IF NOT EXISTS idx_review_signatures_buckets
+    ON review_signatures USING GIN (buckets) WITH (fastupdate = on);
+
+CREATE TABLE IF NOT EXISTS review_flags (
+    review_id INTEGER PRIMARY KEY,
+    movie_id INTEGER NOT NULL,
+    duplicate_of INTEGER NOT NULL,
+    duplicate_movie_id INTEGER NOT NULL,
+    scope VARCHAR(10) NOT NULL CHECK (scope IN ('movie', 'user')),
+    similarity REAL NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (review_id, movie_id) REFERENCES reviews (id, movie_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_review_flags_created
+    ON review_flags (created_at DESC);
+
+CREATE INDEX IF NOT EXISTS idx_review_flags_movie
+    ON review_flags (movie_id, created_at DESC);
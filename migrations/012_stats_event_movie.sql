@@ -0,0 +1,35 @@
+-- Миграция 012: жанр и год фильма в событии movie_stats
+--
+-- Кеш рейтингов (app/leaderboards.py) в каждом воркере сбрасывает по
+-- событию movie_stats только рейтинги, в которые фильм может попасть:
+-- общий, его жанра и его десятилетия. Для этого событию нужны жанр и
+-- год выпуска; без них кеш сбрасывается целиком.
+--
+-- Требует миграции 006.
+--
+-- Применение:
+--   psql -h <DB_HOST> -U <USER> -d movie_reviews -f migrations/012_stats_event_movie.sql
+
+CREATE OR REPLACE FUNCTION notify_movie_stats_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    movie_genre VARCHAR;
+    movie_year INTEGER;
+BEGIN
+    SELECT genre, release_year INTO movie_genre, movie_year
+    FROM movies WHERE id = NEW.movie_id;
+
+    PERFORM pg_notify('movie_events', json_build_object(
+        'type', 'movie_stats',
+        'movie_id', NEW.movie_id,
+        'review_count', NEW.review_count,
+        'avg_rating', round(NEW.rating_sum::numeric / NULLIF(NEW.review_count, 0), 2),
+        'rating_counts', NEW.rating_counts,
+        'genre', movie_genre,
+        'release_year', movie_year
+    )::text);
+    RETURN NEW;
+END;
+$$;
@@ -1,4 +1,5 @@
 import uvicorn
+import logging
 import threading
 import subprocess
 import os
@@ -7,43 +8,57 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from app import log, tracing
+
+logger = logging.getLogger("run")
+
 def run_bot():
     try:
-        print("🤖 Запускаем Telegram бота...")
+        logger.info("Запускаем Telegram бота")
         current_dir = os.path.dirname(os.path.abspath(__file__))
         bot_path = os.path.join(current_dir, "bot", "bot.py")
         
         if os.path.exists(bot_path):
-            print(f"✅ Найден файл бота: {bot_path}")
-            subprocess.run([sys.executable, bot_path], check=True)
+            logger.info("Найден файл бота: %s", bot_path)
+            # Запуск бота продолжает трассу этого процесса через TRACEPARENT
+            with tracing.span("bot.launch", **{"process.executable": bot_path}):
+                process = subprocess.Popen([sys.executable, bot_path], env=tracing.child_env())
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, process.args)
         else:
-            print("❌ Файл bot.py не найден")
+            logger.error("Файл bot.py не найден")
             
     except Exception as e:
-        print(f"❌ Ошибка в боте: {e}")
+        logger.error("Ошибка в боте: %s", e)
 
 def run_website():
     try:
-        print("🌐 Запускаем веб-сайт...")
+        logger.info("Запускаем веб-сайт")
         uvicorn.run(
             "app.main:app",
             host="0.0.0.0", 
             port=8000,
-            reload=False
+            reload=False,
+            # Логи uvicorn идут через очередь app/log.py; журнал запросов
+            # пишет log.CorrelationMiddleware
+            log_config=None,
+            access_log=False
         )
     except Exception as e:
-        print(f"❌ Ошибка запуска сайта: {e}")
+        logger.error("Ошибка запуска сайта: %s", e)
 
 if __name__ == "__main__":
-    print("🚀 Запускаем приложение...")
+    log.setup("web")
+    tracing.setup("web")
+    logger.info("Запускаем приложение")
     
     bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
     
     if not bot_token:
-        print("⚠️ TELEGRAM_BOT_TOKEN не найден. Запускаем только веб-сайт...")
+        logger.warning("TELEGRAM_BOT_TOKEN не найден, запускаем только веб-сайт")
         run_website()
     else:
-        print("✅ TELEGRAM_BOT_TOKEN найден")
+        logger.info("TELEGRAM_BOT_TOKEN найден")
         
         bot_thread = threading.Thread(target=run_bot, daemon=True)
         bot_thread.start()
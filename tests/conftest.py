@@ -0,0 +1,61 @@
+"""
+Общие фикстуры тестов.
+
+db_transaction - все подключения приложения на время теста заменяются
+одним подключением в транзакции REPEATABLE READ, которая откатывается в
+конце теста: фильмы, отзывы, агрегаты и задачи теста не остаются в базе,
+а чужие записи, зафиксированные во время теста, не видны.
+"""
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import app.database as database
+
+
+class TransactionConnection:
+    """
+    Подключение теста: commit() и rollback() приложения работают с точкой
+    сохранения внутри общей транзакции, close() ничего не делает
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        with connection.cursor() as cursor:
+            cursor.execute("SAVEPOINT test")
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def commit(self):
+        with self._connection.cursor() as cursor:
+            cursor.execute("RELEASE SAVEPOINT test; SAVEPOINT test")
+
+    def rollback(self):
+        with self._connection.cursor() as cursor:
+            cursor.execute("ROLLBACK TO SAVEPOINT test")
+
+    def apply_timeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def db_transaction(monkeypatch):
+    if not database.test_connection():
+        pytest.skip("PostgreSQL недоступен")
+
+    db = database.db
+    raw = psycopg2.connect(**db._connection_params(db.host, db.port, 10))
+    raw.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+    connection = TransactionConnection(raw)
+    monkeypatch.setattr(db, "get_connection", lambda: connection)
+    monkeypatch.setattr(db, "get_read_connection", lambda: connection)
+    try:
+        yield connection
+    finally:
+        raw.rollback()
+        raw.close()
@@ -0,0 +1,27 @@
+"""
+Порядок по рейтингу в снимке каталога совпадает с запросом
+movies_by_rating (app/catalogue.py, app/statements.py).
+
+Тест читает базу из DB_* и пропускается, если она недоступна.
+"""
+
+import pytest
+
+import app.catalogue as catalogue
+import app.database as database
+import app.statements as statements
+
+pytestmark = pytest.mark.skipif(not database.test_connection(), reason="PostgreSQL недоступен")
+
+
+def test_rating_order_matches_sql():
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            snapshot = catalogue.load(cursor)
+            statements.execute(cursor, "movies_by_rating", (len(snapshot.ids), 0))
+            expected = [row['id'] for row in database.fetch_dicts(cursor)]
+    finally:
+        connection.close()
+
+    assert [int(movie_id) for movie_id in snapshot.ids[snapshot.rating_order()]] == expected
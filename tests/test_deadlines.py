@@ -0,0 +1,149 @@
+"""
+Отмена запросов к БД по сроку и при отключении клиента (app/deadlines.py).
+
+Тесты только берут подключения и выполняют pg_sleep на базе из DB_*,
+ничего в нее не записывая, и пропускаются, если она недоступна.
+"""
+
+import asyncio
+import threading
+import time
+
+import psycopg2.errors
+import psycopg2.pool
+import pytest
+from fastapi import FastAPI
+
+import app.database as database
+import app.deadlines as deadlines
+
+pytestmark = pytest.mark.skipif(not database.test_connection(), reason="PostgreSQL недоступен")
+
+
+def _sleep(seconds):
+    connection = database.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_sleep(%s)", (seconds,))
+    finally:
+        connection.close()
+
+
+def _in_scope(scope, func, *args):
+    """Выполняет func в контексте срока scope, как обработчик запроса"""
+    token = deadlines._scope.set(scope)
+    try:
+        return func(*args)
+    finally:
+        deadlines._scope.reset(token)
+
+
+def test_statement_timeout_follows_deadline():
+    started = time.monotonic()
+    with pytest.raises(psycopg2.errors.QueryCanceled):
+        _in_scope(deadlines.Scope(0.5), _sleep, 10)
+    assert time.monotonic() - started < 3
+
+
+def test_expired_deadline_does_not_take_connection():
+    scope = deadlines.Scope(0)
+    with pytest.raises(deadlines.DeadlineExceeded):
+        _in_scope(scope, _sleep, 0)
+
+
+def test_cancel_interrupts_running_statement():
+    scope = deadlines.Scope(30)
+    errors = []
+
+    def run():
+        try:
+            _in_scope(scope, _sleep, 10)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    started = time.monotonic()
+    thread.start()
+    time.sleep(0.5)
+    assert scope.cancel() == 1
+    thread.join(5)
+    assert not thread.is_alive()
+    assert time.monotonic() - started < 3
+    assert isinstance(errors[0], psycopg2.errors.QueryCanceled)
+
+
+def _connect_in_scope(scope):
+    return _in_scope(scope, database.get_db_connection)
+
+
+def test_closed_connection_not_cancelled():
+    scope = deadlines.Scope(30)
+    connection = _connect_in_scope(scope)
+    connection.close()
+    # Подключение вернулось в пул и может принадлежать другому запросу
+    assert scope.cancel() == 0
+
+
+def test_overflow_connection_detached_on_close(monkeypatch):
+    pool = database.db._get_pool(database.db.host, database.db.port, 10)
+
+    def exhausted():
+        raise psycopg2.pool.PoolError("connection pool exhausted")
+
+    monkeypatch.setattr(pool, "getconn", exhausted)
+    scope = deadlines.Scope(30)
+    connection = _connect_in_scope(scope)
+    raw = connection._connection
+    connection.close()
+    assert raw.closed
+    assert scope.cancel() == 0
+
+
+def _app():
+    app = FastAPI()
+    finished = threading.Event()
+
+    @app.get("/api/v1/sleep")
+    def sleep_handler():
+        try:
+            _sleep(10)
+        finally:
+            finished.set()
+        return {}
+
+    return deadlines.DeadlineMiddleware(app), finished
+
+
+async def _request_and_disconnect(app, path, disconnect_after):
+    scope = {
+        "type": "http", "method": "GET", "path": path, "raw_path": path.encode(),
+        "root_path": "", "scheme": "http", "query_string": b"", "headers": [],
+        "client": ("127.0.0.1", 1), "server": ("testserver", 80), "http_version": "1.1",
+    }
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent
+
+
+def test_disconnect_cancels_sync_handler_statement():
+    app, finished = _app()
+    cancelled = deadlines.counters['cancelled_statements']
+    started = time.monotonic()
+    sent = asyncio.run(_request_and_disconnect(app, "/api/v1/sleep", 0.5))
+    # Цикл событий свободен, пока обработчик ждет pg_sleep в потоке,
+    # поэтому отключение замечено и запрос к БД отменен
+    assert finished.wait(5)
+    assert time.monotonic() - started < 3
+    assert deadlines.counters['cancelled_statements'] == cancelled + 1
+    assert not any(message["type"] == "http.response.body" for message in sent)
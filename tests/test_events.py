@@ -0,0 +1,37 @@
+"""
+Подписки SSE не остаются в шине событий (app/routers/events.py):
+ни после отключения клиента, ни если поток так и не начал отправляться.
+"""
+
+import asyncio
+
+from starlette.requests import Request
+
+import app.events as events
+import app.routers.events as events_router
+
+
+def _request():
+    return Request({"type": "http", "method": "GET", "path": "/api/v1/events", "query_string": b"", "headers": []})
+
+
+def test_stream_not_started_leaves_no_subscription():
+    before = events.bus.subscriber_count
+    response = asyncio.run(events_router.stream_all_events(_request()))
+    assert events.bus.subscriber_count == before
+    # Ответ отброшен без отправки - генератор не запускался
+    asyncio.run(response.body_iterator.aclose())
+    assert events.bus.subscriber_count == before
+
+
+def test_stream_unsubscribes_on_close():
+    before = events.bus.subscriber_count
+
+    async def stream():
+        response = await events_router.stream_all_events(_request())
+        assert await response.body_iterator.__anext__() == "retry: 3000\n\n"
+        assert events.bus.subscriber_count == before + 1
+        await response.body_iterator.aclose()
+
+    asyncio.run(stream())
+    assert events.bus.subscriber_count == before
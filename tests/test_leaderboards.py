@@ -0,0 +1,119 @@
+"""
+Обновление рейтингов в кеше по событиям movie_stats (app/leaderboards.py):
+запись фильма меняется на месте, рейтинг загружается заново, только
+если фильм выпал из первых N или может в них войти.
+
+Вместо базы - курсор, который отдает заранее заданные строки запроса.
+"""
+
+import json
+
+import pytest
+
+import app.leaderboards as leaderboards
+from app.events import Event
+
+MEAN = 7.0
+COLUMNS = ["id", "title", "director", "release_year", "genre",
+           "review_count", "avg_rating", "weighted_rating", "prior_mean"]
+
+
+class RowsCursor:
+    """Курсор DB-API с результатом TOP_RATED_SQL"""
+
+    def __init__(self, stats):
+        # stats: id -> (review_count, rating_sum)
+        self.stats = stats
+        self.executed = 0
+        self.description = [(name,) for name in COLUMNS]
+
+    def execute(self, sql, params):
+        self.executed += 1
+        self.limit = params[-1]
+
+    def fetchall(self):
+        rows = []
+        for movie_id, (count, total) in self.stats.items():
+            weighted = (total + leaderboards.PRIOR_WEIGHT * MEAN) / (count + leaderboards.PRIOR_WEIGHT)
+            rows.append((movie_id, f"Фильм {movie_id}", "Режиссер", 2001, "Драма",
+                         count, total / count, weighted, MEAN))
+        rows.sort(key=lambda row: (-row[7], -row[5], row[0]))
+        return rows[:self.limit]
+
+
+def _stats_event(movie_id, ratings):
+    counts = [0] * 10
+    for rating in ratings:
+        counts[rating - 1] += 1
+    return Event("movie_stats", movie_id, json.dumps({
+        'type': 'movie_stats', 'movie_id': movie_id, 'review_count': len(ratings),
+        'rating_counts': counts, 'genre': "Драма", 'release_year': 2001
+    }))
+
+
+@pytest.fixture
+def cursor():
+    leaderboards.invalidate()
+    # Фильмы 1-4 по 10 отзывов с оценками 9, 8, 7, 6
+    cursor = RowsCursor({movie_id: (10, 10 * (10 - movie_id)) for movie_id in range(1, 5)})
+    yield cursor
+    leaderboards.invalidate()
+
+
+def _top(cursor):
+    return [entry['id'] for entry in leaderboards.top_rated(cursor, limit=3)]
+
+
+def test_movie_in_list_updated_in_place(cursor):
+    assert _top(cursor) == [1, 2, 3]
+    cursor.stats[2] = (11, 90)
+    leaderboards.on_event(_stats_event(2, [9] * 9 + [8, 1]))
+
+    entries = leaderboards.top_rated(cursor, limit=3)
+    assert [entry['id'] for entry in entries] == [1, 2, 3]
+    assert entries[1]['review_count'] == 11
+    assert entries[1]['avg_rating'] == round(90 / 11, 2)
+    assert cursor.executed == 1
+
+
+def test_movie_moving_up_reorders_without_reload(cursor):
+    assert _top(cursor) == [1, 2, 3]
+    cursor.stats[3] = (20, 200)
+    leaderboards.on_event(_stats_event(3, [10] * 20))
+
+    assert _top(cursor) == [3, 1, 2]
+    assert cursor.executed == 1
+
+
+def test_movie_dropping_to_last_place_reloads(cursor):
+    assert _top(cursor) == [1, 2, 3]
+    cursor.stats[2] = (20, 100)
+    leaderboards.on_event(_stats_event(2, [5] * 20))
+
+    assert _top(cursor) == [1, 3, 4]
+    assert cursor.executed == 2
+
+
+def test_movie_outside_list(cursor):
+    assert _top(cursor) == [1, 2, 3]
+    # Ниже последнего места - рейтинг не меняется
+    cursor.stats[4] = (11, 66)
+    leaderboards.on_event(_stats_event(4, [6] * 11))
+    assert _top(cursor) == [1, 2, 3]
+    assert cursor.executed == 1
+
+    # Может войти в первые N - загрузка заново
+    cursor.stats[4] = (30, 300)
+    leaderboards.on_event(_stats_event(4, [10] * 30))
+    assert _top(cursor) == [4, 1, 2]
+    assert cursor.executed == 2
+
+
+def test_other_genre_list_not_touched(cursor):
+    assert [entry['id'] for entry in leaderboards.top_rated(cursor, genre="Комедия", limit=3)] == [1, 2, 3]
+    leaderboards.on_event(Event("movie_stats", 9, json.dumps({
+        'type': 'movie_stats', 'movie_id': 9, 'review_count': 50,
+        'rating_counts': [0] * 9 + [50], 'genre': "Драма", 'release_year': 2001
+    })))
+    leaderboards.top_rated(cursor, genre="Комедия", limit=3)
+    assert cursor.executed == 1
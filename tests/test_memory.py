@@ -0,0 +1,105 @@
+"""
+Пиковая память HTML-страниц не растет с размером данных
+(app/main.py: read_root, get_movie_detail; app/memory.py).
+
+Главная проверяется на синтетических снимках каталога, страница фильма -
+на фильмах с малым и большим числом отзывов в базе из DB_*, в транзакции
+теста (db_transaction); эта часть пропускается, если база недоступна.
+"""
+
+import asyncio
+import tracemalloc
+
+import pytest
+from starlette.requests import Request
+
+import app.catalogue as catalogue
+import app.main as main
+import app.memory as memory
+
+# Допустимый рост пика, раз (как в python -m app.memory check)
+TOLERANCE = 1.5
+
+
+def _request(path):
+    return Request({
+        "type": "http", "method": "GET", "path": path, "query_string": b"",
+        "headers": [], "app": main.app, "router": main.app.router
+    })
+
+
+@pytest.fixture
+def tracing():
+    started = memory.start()
+    yield
+    if started:
+        tracemalloc.stop()
+
+
+def _assert_bounded(peaks):
+    (small, small_peak), (large, large_peak) = peaks
+    assert large_peak <= small_peak * TOLERANCE, (
+        f"{small}: {small_peak} Б, {large}: {large_peak} Б"
+    )
+
+
+def test_home_page_peak_does_not_grow_with_catalogue(monkeypatch, tracing):
+    monkeypatch.setattr(catalogue, "CATALOGUE_ENABLED", True)
+    snapshots = [(size, memory._synthetic_catalogue(size)) for size in (1000, 100000)]
+
+    def home():
+        main.home_cache.invalidate()
+        response = asyncio.run(main.read_root(_request("/"), 1))
+        assert response.template.name == "index.html"
+
+    peaks = []
+    try:
+        for size, snapshot in snapshots:
+            monkeypatch.setattr(catalogue, "_snapshot", snapshot)
+            # Первый запрос сортирует каталог по рейтингу, следующие - нет
+            home()
+            peaks.append((size, memory._peak(home)))
+    finally:
+        main.home_cache.invalidate()
+    _assert_bounded(peaks)
+
+
+@pytest.fixture
+def movies_with_reviews(db_transaction):
+    """
+    Два фильма: с полной страницей отзывов и в двести раз большим
+    числом отзывов
+    """
+    sizes = (main.MOVIE_PAGE_REVIEWS, main.MOVIE_PAGE_REVIEWS * 200)
+    movie_ids = []
+    with db_transaction.cursor() as cursor:
+        for size in sizes:
+            cursor.execute("""
+                INSERT INTO movies (title, director, release_year, genre)
+                VALUES (%s, 'Режиссер', 2001, 'Драма')
+                RETURNING id
+            """, (f"Тест памяти {size}",))
+            movie_id = cursor.fetchone()[0]
+            movie_ids.append(movie_id)
+            cursor.execute("""
+                INSERT INTO reviews (movie_id, user_name, rating, review_text)
+                SELECT %s, 'memory' || i, i %% 10 + 1, repeat('Текст отзыва ', 10)
+                FROM generate_series(1, %s) AS i
+            """, (movie_id, size))
+    yield list(zip(sizes, movie_ids))
+    for movie_id in movie_ids:
+        main.movie_page_cache.invalidate(movie_id)
+
+
+def test_movie_page_peak_does_not_grow_with_reviews(movies_with_reviews, tracing):
+    def movie_page(movie_id):
+        main.movie_page_cache.invalidate(movie_id)
+        response = asyncio.run(main.get_movie_detail(_request(f"/movies/{movie_id}"), movie_id))
+        assert response.template.name == "movie_detail.html"
+        assert len(response.context["reviews"]) == main.MOVIE_PAGE_REVIEWS
+
+    peaks = []
+    for size, movie_id in movies_with_reviews:
+        movie_page(movie_id)
+        peaks.append((size, memory._peak(lambda: movie_page(movie_id))))
+    _assert_bounded(peaks)
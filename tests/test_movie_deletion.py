@@ -0,0 +1,79 @@
+"""
+Удаление фильма и его отзывов: агрегаты жанра не уменьшаются дважды
+(app/routers/movies.py, app/routers/reviews.py).
+
+Тесты выполняются в транзакции на базе из DB_* (фикстура db_transaction),
+которая откатывается в конце теста, и пропускаются, если база недоступна.
+"""
+
+import pytest
+
+import app.models as models
+import app.routers.movies as movies
+import app.routers.reviews as reviews
+
+GENRE = models.Genre.DRAMA
+RATING = 7
+
+
+def _genre_rating_count(connection):
+    """
+    Оценки RATING жанра в сегодняшней гистограмме: в транзакции теста
+    видны только его собственные изменения
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE((
+                SELECT rating_counts[%s] FROM genre_rating_rollups
+                WHERE genre = %s AND bucket = 'day' AND bucket_start = CURRENT_DATE
+            ), 0)
+        """, (RATING, GENRE.value))
+        return cursor.fetchone()[0]
+
+
+@pytest.fixture
+def movie_id(db_transaction):
+    return movies.create_movie(models.MovieCreate(
+        title="Тест удаления", director="Режиссер", release_year=2001, genre=GENRE
+    ))["movie_id"]
+
+
+def _add_reviews(movie_id, count):
+    return [
+        reviews.add_review(movie_id, models.ReviewCreate(
+            movie_id=movie_id, user_name=f"tester{i}", rating=RATING, review_text=None
+        ))["review_id"]
+        for i in range(count)
+    ]
+
+
+def test_delete_movie_detaches_genre_rollups(db_transaction, movie_id):
+    before = _genre_rating_count(db_transaction)
+    _add_reviews(movie_id, 2)
+    assert _genre_rating_count(db_transaction) == before + 2
+
+    result = movies.delete_movie(movie_id)
+    assert result["job_id"]
+    assert _genre_rating_count(db_transaction) == before
+
+    deletion = movies.get_movie_deletion(movie_id)
+    assert deletion.title == "Тест удаления"
+    assert deletion.total_reviews == 2
+
+
+def test_delete_review_of_hidden_movie_keeps_genre_rollups(db_transaction, movie_id):
+    before = _genre_rating_count(db_transaction)
+    review_ids = _add_reviews(movie_id, 2)
+    movies.delete_movie(movie_id)
+    assert _genre_rating_count(db_transaction) == before
+
+    # Гистограммы фильма уже вычтены из жанра при скрытии
+    reviews.delete_review(review_ids[0], movie_id)
+    assert _genre_rating_count(db_transaction) == before
+
+
+def test_delete_review_of_visible_movie_updates_genre_rollups(db_transaction, movie_id):
+    before = _genre_rating_count(db_transaction)
+    review_ids = _add_reviews(movie_id, 2)
+    reviews.delete_review(review_ids[0], movie_id)
+    assert _genre_rating_count(db_transaction) == before + 1
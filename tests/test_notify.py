@@ -0,0 +1,160 @@
+"""
+Отправка уведомлений подписчикам (bot/notify.py) на очереди в памяти
+(MemoryStore) и поддельном send_message: объединение уведомлений чата,
+общий и чатовый лимиты, пауза по RetryAfter и отписка по Forbidden.
+"""
+
+import asyncio
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+from bot import notify
+
+
+class Recorder:
+    """send_message, который запоминает сообщения или бросает ошибки из errors"""
+
+    def __init__(self, errors=None):
+        self.messages = []
+        # chat_id -> список исключений для очередных попыток
+        self.errors = errors or {}
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        pending = self.errors.get(chat_id)
+        if pending:
+            raise pending.pop(0)
+        self.messages.append((time.monotonic(), chat_id, text))
+
+
+def _store(chats, movies, changes=1):
+    store = notify.MemoryStore()
+    for chat_id in chats:
+        for movie_id in movies:
+            store.subscribe(chat_id, movie_id)
+    for movie_id in movies:
+        for _ in range(changes):
+            store.change(movie_id, 8)
+    return store
+
+
+def _sender(store, recorder, **kwargs):
+    kwargs.setdefault('rate', 1000)
+    kwargs.setdefault('chat_rate', 1)
+    return notify.Sender(store, recorder.send_message, **kwargs)
+
+
+def _due_now(store):
+    for row in store.rows.values():
+        row['next_attempt_at'] = 0.0
+
+
+def test_chat_notifications_batched_into_one_message():
+    store = _store([1], range(1, 4))
+    recorder = Recorder()
+    sender = _sender(store, recorder)
+
+    assert asyncio.run(sender.run_once()) == 1
+    assert len(recorder.messages) == 1
+    _, chat_id, text = recorder.messages[0]
+    assert chat_id == 1
+    assert all(f"Фильм {movie_id}" in text for movie_id in range(1, 4))
+    assert store.pending() == 0
+    assert sender.counters['notifications'] == 3
+
+
+def test_movies_over_message_limit_deferred():
+    movies = range(1, notify.NOTIFY_MAX_MOVIES + 3)
+    store = _store([1], movies)
+    recorder = Recorder()
+    sender = _sender(store, recorder)
+
+    asyncio.run(sender.run_once())
+    assert len(recorder.messages) == 1
+    assert sender.counters['notifications'] == notify.NOTIFY_MAX_MOVIES
+    assert store.pending() == 2
+    assert sender.counters['deferred'] == 2
+
+
+def test_chat_rate_defers_second_message():
+    store = _store([1], [1])
+    recorder = Recorder()
+    sender = _sender(store, recorder, chat_rate=0.5)
+
+    async def run():
+        await sender.run_once()
+        store.change(1, 6)
+        await sender.run_once()
+
+    asyncio.run(run())
+    assert len(recorder.messages) == 1
+    assert store.pending() == 1
+    assert sender.counters['deferred'] == 1
+    row = next(row for row in store.rows.values() if row['sent_at'] is None)
+    assert row['next_attempt_at'] - time.monotonic() > 1
+
+
+def test_global_rate_spreads_messages():
+    chats = range(1, 31)
+    store = _store(chats, [1])
+    recorder = Recorder()
+    # Всплеск 20 сообщений, затем 20 в секунду: 10 оставшихся - за 0.5 с
+    sender = _sender(store, recorder, rate=20)
+
+    started = time.monotonic()
+    assert asyncio.run(sender.run_once()) == 30
+    assert len(recorder.messages) == 30
+    assert time.monotonic() - started >= 0.45
+    first = recorder.messages[0][0]
+    assert sum(1 for sent_at, _, _ in recorder.messages if sent_at - first < 0.2) <= 25
+
+
+def test_retry_after_pauses_all_sending():
+    store = _store([1, 2], [1])
+    recorder = Recorder(errors={1: [RetryAfter(1)]})
+    sender = _sender(store, recorder)
+
+    started = time.monotonic()
+    asyncio.run(sender.run_once())
+    assert sender.counters['retry_after'] == 1
+    # Сообщение другому чату ждало конца паузы
+    assert [chat_id for _, chat_id, _ in recorder.messages] == [2]
+    assert recorder.messages[0][0] - started >= 0.9
+    # Строки первого чата отложены на время паузы
+    assert store.pending() == 1
+    assert sender.counters['deferred'] == 1
+
+    _due_now(store)
+    asyncio.run(sender.run_once())
+    assert store.pending() == 0
+    assert [chat_id for _, chat_id, _ in recorder.messages] == [2, 1]
+
+
+def test_forbidden_unsubscribes_chat():
+    store = _store([1, 2], [1, 2])
+    recorder = Recorder(errors={1: [Forbidden("Forbidden: bot was blocked by the user")]})
+    sender = _sender(store, recorder)
+
+    asyncio.run(sender.run_once())
+    assert sender.counters['closed_chats'] == 1
+    assert not any(chat_id == 1 for chat_id, _ in store.subscriptions)
+    assert all(row['sent_at'] is not None for row in store.rows.values())
+    assert all(row['last_error'] for row in store.rows.values() if row['chat_id'] == 1)
+    assert [chat_id for _, chat_id, _ in recorder.messages] == [2]
+
+    # Новые изменения фильма закрытому чату больше не ставятся
+    store.change(1, 9)
+    assert {row['chat_id'] for row in store.rows.values() if row['sent_at'] is None} == {2}
+
+
+def test_unchanged_values_skipped():
+    store = _store([1], [1])
+    # Подписчик уже видел текущие значения
+    store.subscriptions[(1, 1)] = store.stats[1]
+    recorder = Recorder()
+    sender = _sender(store, recorder)
+
+    asyncio.run(sender.run_once())
+    assert recorder.messages == []
+    assert store.pending() == 0
+    assert sender.counters['skipped'] == 1